@@ -0,0 +1,110 @@
+# Measure the rendezvous message rate with each JSON codec that is installed
+# (see wormhole.util.JSON_CODECS). First the codecs alone, encoding and
+# decoding the messages a mailbox exchange is made of, then a real relay (in
+# this process, keeping its state in memory) with two clients connected to it
+# over localhost: one client adds messages to a mailbox as fast as it can,
+# and we time how long it takes the other to hear all of them.
+#
+# run like: python misc/bench-json-codecs.py [MESSAGES [BODY_BYTES]]
+
+from __future__ import print_function, unicode_literals
+import sys, time
+from twisted.internet import defer, task
+from autobahn.twisted import websocket
+from wormhole import util
+from wormhole.server.server import RelayServer
+from wormhole.test.common import allocate_tcp_port
+
+MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+BODY_BYTES = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+CODEC_ROUNDS = 100*1000
+
+def protocol_messages():
+    body = "ab" * BODY_BYTES # hex, like the encrypted bodies
+    add = {"type": "add", "phase": "1", "body": body, "id": "c0ffee12"}
+    return [add,
+            {"type": "ack", "id": "c0ffee12", "server_tx": 1500000000.123456},
+            {"type": "message", "side": "6e3a4f2b1c", "phase": "1",
+             "body": body, "server_rx": 1500000000.123, "id": "c0ffee12",
+             "server_tx": 1500000000.456789},
+            ]
+
+def measure_codec():
+    messages = protocol_messages()
+    encoded = [util.dict_to_bytes(m) for m in messages]
+    start = time.time()
+    for i in range(CODEC_ROUNDS):
+        for m in messages:
+            util.dict_to_bytes(m)
+    encode = time.time() - start
+    start = time.time()
+    for i in range(CODEC_ROUNDS):
+        for b in encoded:
+            util.bytes_to_dict(b)
+    decode = time.time() - start
+    count = CODEC_ROUNDS * len(messages)
+    return count / encode, count / decode
+
+class Client(websocket.WebSocketClientProtocol):
+    def onOpen(self):
+        self.factory.connected.callback(self)
+    def onMessage(self, payload, isBinary):
+        m = util.bytes_to_dict(payload)
+        if m["type"] == "message" and m["side"] == "sender":
+            self.factory.heard += 1
+            if self.factory.heard == self.factory.expected:
+                self.factory.done.callback(time.time())
+    def command(self, mtype, **kwargs):
+        kwargs["type"] = mtype
+        self.sendMessage(util.dict_to_bytes(kwargs), False)
+
+@defer.inlineCallbacks
+def connect(reactor, port, expected=None):
+    f = websocket.WebSocketClientFactory("ws://127.0.0.1:%d/v1" % port)
+    f.protocol = Client
+    f.connected = defer.Deferred()
+    f.done = defer.Deferred()
+    f.heard = 0
+    f.expected = expected
+    reactor.connectTCP("127.0.0.1", port, f)
+    c = yield f.connected
+    defer.returnValue(c)
+
+@defer.inlineCallbacks
+def measure_relay(reactor):
+    port = allocate_tcp_port()
+    s = RelayServer(str("tcp:%d:interface=127.0.0.1" % port), None,
+                    rendezvous_state="memory")
+    s.startService()
+    try:
+        sender = yield connect(reactor, port)
+        receiver = yield connect(reactor, port, MESSAGES)
+        for c, side in [(sender, "sender"), (receiver, "receiver")]:
+            c.command("bind", appid="bench", side=side)
+            c.command("open", mailbox="mb1")
+        body = "ab" * BODY_BYTES
+        start = time.time()
+        for i in range(MESSAGES):
+            sender.command("add", phase="%d" % i, body=body)
+        end = yield receiver.factory.done
+        for c in [sender, receiver]:
+            c.transport.loseConnection()
+        yield task.deferLater(reactor, 0.1, lambda: None)
+    finally:
+        yield s.stopService()
+    defer.returnValue(MESSAGES / (end - start))
+
+@defer.inlineCallbacks
+def main(reactor):
+    print("%d-byte bodies; %d messages through the relay"
+          % (2*BODY_BYTES, MESSAGES))
+    print("%-8s %14s %14s %14s" % ("codec", "encode msg/s", "decode msg/s",
+                                   "relay msg/s"))
+    for name in sorted(util.JSON_CODECS):
+        util.use_json_codec(name)
+        encode, decode = measure_codec()
+        rate = yield measure_relay(reactor)
+        print("%-8s %14d %14d %14d" % (name, encode, decode, rate))
+
+if __name__ == "__main__":
+    task.react(main)
@@ -0,0 +1,80 @@
+# Measure how long claim_nameplate() and open_mailbox() take against a relay
+# database that already holds lots of live channels, once with the v4 schema
+# (no indexes on the side tables) and once with the current one.
+#
+# run like: python misc/bench-rendezvous-db.py [LIVE_ROWS [OPERATIONS]]
+
+from __future__ import print_function
+import os, sys, time, shutil, tempfile
+from wormhole.server.database import get_db, TARGET_VERSION
+from wormhole.server.rendezvous import Rendezvous
+
+LIVE_ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 100*1000
+OPERATIONS = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+APPID = "appid"
+
+def populate(db):
+    # one nameplate (claimed by one side) per live channel, each with a
+    # mailbox (opened by one side) holding two messages
+    db.executemany("INSERT INTO `mailboxes`"
+                   " (`app_id`, `id`, `updated`, `for_nameplate`)"
+                   " VALUES (?,?,?,?)",
+                   ((APPID, "mb%d" % i, 1, True) for i in range(LIVE_ROWS)))
+    db.executemany("INSERT INTO `mailbox_sides`"
+                   " (`mailbox_id`, `opened`, `side`, `added`)"
+                   " VALUES (?,?,?,?)",
+                   (("mb%d" % i, True, "side1", 1) for i in range(LIVE_ROWS)))
+    db.executemany("INSERT INTO `nameplates`"
+                   " (`id`, `app_id`, `name`, `mailbox_id`) VALUES (?,?,?,?)",
+                   ((i+1, APPID, "np%d" % i, "mb%d" % i)
+                    for i in range(LIVE_ROWS)))
+    db.executemany("INSERT INTO `nameplate_sides`"
+                   " (`nameplates_id`, `claimed`, `side`, `added`)"
+                   " VALUES (?,?,?,?)",
+                   ((i+1, True, "side1", 1) for i in range(LIVE_ROWS)))
+    db.executemany("INSERT INTO `messages`"
+                   " (`app_id`, `mailbox_id`, `side`, `phase`, `body`,"
+                   "  `server_rx`, `msg_id`) VALUES (?,?,?,?,?,?,?)",
+                   ((APPID, "mb%d" % (i//2), "side1", "%d" % i, "body", i,
+                     "msg%d" % i) for i in range(2*LIVE_ROWS)))
+    db.commit()
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies)-1, int(len(latencies) * p))]
+
+def measure(name, f):
+    latencies = []
+    for i in range(OPERATIONS):
+        start = time.time()
+        f(i)
+        latencies.append(time.time() - start)
+    latencies.sort()
+    print("  %-16s p50 %8.3fms  p99 %8.3fms"
+          % (name, 1e3*percentile(latencies, 0.50),
+             1e3*percentile(latencies, 0.99)))
+
+def run(version, basedir):
+    fn = os.path.join(basedir, "v%d.sqlite" % version)
+    db = get_db(fn, version)
+    populate(db)
+    app = Rendezvous(db, None, None, True).get_app(APPID)
+    print("schema v%d, %d live channels:" % (version, LIVE_ROWS))
+    # the second side of an existing channel
+    measure("claim_nameplate",
+            lambda i: app.claim_nameplate("np%d" % i, "side2", 2))
+    measure("open_mailbox",
+            lambda i: app.open_mailbox("mb%d" % (LIVE_ROWS-1-i), "side2", 2))
+    measure("get_messages",
+            lambda i: app.open_mailbox("mb%d" % i, "side1", 3).get_messages())
+    db.close()
+
+def main():
+    basedir = tempfile.mkdtemp()
+    try:
+        run(4, basedir)
+        run(TARGET_VERSION, basedir)
+    finally:
+        shutil.rmtree(basedir)
+
+if __name__ == "__main__":
+    main()
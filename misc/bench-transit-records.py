@@ -0,0 +1,93 @@
+# Measure how fast transit.Connection can frame and parse records, without
+# any network involved. This compares the old bytestring-slicing parser (kept
+# here for reference) against wormhole._records, and reports MB/s for both.
+#
+# run like: python misc/bench-transit-records.py [RECORD_SIZE [TOTAL_MB]]
+
+from __future__ import print_function
+import sys, time
+from binascii import hexlify, unhexlify
+from nacl.secret import SecretBox
+from wormhole._records import (RecordDecoder, encode_length, encode_nonce,
+                               decode_nonce)
+
+RECORD_SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 16*1024
+TOTAL_MB = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+CHUNK_SIZE = 64*1024 # roughly what a TCP read hands to dataReceived
+KEY = b"k"*SecretBox.KEY_SIZE
+
+def old_encode(box, records):
+    out = []
+    for nonce, record in enumerate(records):
+        encrypted = box.encrypt(record, unhexlify("%048x" % nonce))
+        out.append(unhexlify("%08x" % len(encrypted)))
+        out.append(encrypted)
+    return out
+
+def new_encode(box, records):
+    out = []
+    for nonce, record in enumerate(records):
+        encrypted = box.encrypt(record, encode_nonce(nonce))
+        out.append(encode_length(len(encrypted)))
+        out.append(encrypted)
+    return out
+
+def old_decode(box, chunks):
+    buf = b""
+    next_nonce = 0
+    got = 0
+    for data in chunks:
+        buf += data
+        while True:
+            if len(buf) < 4:
+                break
+            length = int(hexlify(buf[:4]), 16)
+            if len(buf) < 4+length:
+                break
+            encrypted, buf = buf[4:4+length], buf[4+length:]
+            nonce = int(hexlify(encrypted[:SecretBox.NONCE_SIZE]), 16)
+            assert nonce == next_nonce
+            next_nonce += 1
+            got += len(box.decrypt(encrypted))
+    return got
+
+def new_decode(box, chunks):
+    decoder = RecordDecoder()
+    next_nonce = 0
+    got = 0
+    for data in chunks:
+        decoder.feed(data)
+        while True:
+            encrypted = decoder.next_frame()
+            if encrypted is None:
+                break
+            assert decode_nonce(encrypted) == next_nonce
+            next_nonce += 1
+            got += len(box.decrypt(encrypted))
+    return got
+
+def rechunk(pieces):
+    stream = b"".join(pieces)
+    return [stream[i:i+CHUNK_SIZE] for i in range(0, len(stream), CHUNK_SIZE)]
+
+def measure(name, f, *args):
+    start = time.time()
+    f(*args)
+    elapsed = time.time() - start
+    mb = TOTAL_MB
+    print("%-12s %8.3fs  %8.1f MB/s" % (name, elapsed, mb / elapsed))
+
+def main():
+    box = SecretBox(KEY)
+    count = TOTAL_MB * 1024 * 1024 // RECORD_SIZE
+    records = [b"\x00" * RECORD_SIZE] * count
+    print("%d records of %d bytes (%d MB), fed in %d-byte chunks"
+          % (count, RECORD_SIZE, TOTAL_MB, CHUNK_SIZE))
+    measure("old encode", old_encode, box, records)
+    measure("new encode", new_encode, box, records)
+    chunks = rechunk(new_encode(box, records))
+    measure("old decode", old_decode, box, chunks)
+    measure("new decode", new_decode, box, chunks)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# Measure how many bytes a rendezvous session puts on the wire, with and
+# without permessage-deflate. Two wormholes (in this process) connect to a
+# relay (also in this process) through a TCP proxy that counts the bytes in
+# each direction, then do what a "wormhole send --text" does: exchange PAKE
+# and VERSION messages, then an offer and an answer, and close. The counts
+# include the HTTP upgrade and the WebSocket framing.
+#
+# run like: python misc/bench-websocket-deflate.py [SESSIONS]
+
+from __future__ import print_function, unicode_literals
+import sys, json
+from twisted.internet import defer, task
+from twisted.protocols import portforward
+from wormhole import wormhole
+from wormhole.server.server import RelayServer
+from wormhole.test.common import allocate_tcp_port
+
+SESSIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+APPID = "lothar.com/wormhole/text-or-file-xfer"
+
+# (name, server's permessage_deflate, clients' websocket_deflate)
+SETTINGS = [
+    ("off", None, None),
+    ("offered, not accepted", None, True),
+    ("default", True, True),
+    ("small window", {"window_bits": 9, "peer_window_bits": 9}, True),
+    ("small window+memory", {"window_bits": 9, "mem_level": 1,
+                             "peer_window_bits": 9},
+     {"window_bits": 9, "mem_level": 1}),
+    ]
+
+class Counts(object):
+    up = 0 # client to relay
+    down = 0
+
+class CountingProxyClient(portforward.ProxyClient):
+    def dataReceived(self, data):
+        self.peer.factory.counts.down += len(data)
+        portforward.ProxyClient.dataReceived(self, data)
+
+class CountingProxyClientFactory(portforward.ProxyClientFactory):
+    protocol = CountingProxyClient
+
+class CountingProxyServer(portforward.ProxyServer):
+    clientProtocolFactory = CountingProxyClientFactory
+    def dataReceived(self, data):
+        self.factory.counts.up += len(data)
+        portforward.ProxyServer.dataReceived(self, data)
+
+class CountingProxyFactory(portforward.ProxyFactory):
+    protocol = CountingProxyServer
+
+@defer.inlineCallbacks
+def session(reactor, relay_url, deflate):
+    w1 = wormhole.create(APPID, relay_url, reactor, websocket_deflate=deflate)
+    w2 = wormhole.create(APPID, relay_url, reactor, websocket_deflate=deflate)
+    w1.allocate_code()
+    code = yield w1.get_code()
+    w2.set_code(code)
+    offer = {"offer": {"message": "the quick brown fox " * 5}}
+    w1.send_message(json.dumps(offer).encode("utf-8"))
+    yield w2.get_message()
+    answer = {"answer": {"message_ack": "ok"}}
+    w2.send_message(json.dumps(answer).encode("utf-8"))
+    yield w1.get_message()
+    yield defer.gatherResults([w1.close(), w2.close()])
+
+@defer.inlineCallbacks
+def measure(reactor, server_deflate, client_deflate):
+    relay_port = allocate_tcp_port()
+    options = []
+    if server_deflate is not None:
+        options.append(("permessage_deflate", server_deflate))
+    s = RelayServer(str("tcp:%d:interface=127.0.0.1" % relay_port), None,
+                    websocket_protocol_options=options)
+    s.startService()
+    f = CountingProxyFactory("127.0.0.1", relay_port)
+    f.counts = Counts()
+    proxy = reactor.listenTCP(0, f, interface="127.0.0.1")
+    relay_url = "ws://127.0.0.1:%d/v1" % proxy.getHost().port
+    try:
+        for i in range(SESSIONS):
+            yield session(reactor, relay_url, client_deflate)
+        # let the proxy see the last of the closing handshakes
+        yield task.deferLater(reactor, 0.1, lambda: None)
+    finally:
+        yield proxy.stopListening()
+        yield s.stopService()
+    defer.returnValue((f.counts.up / SESSIONS, f.counts.down / SESSIONS))
+
+@defer.inlineCallbacks
+def main(reactor):
+    print("bytes per session (two clients), averaged over %d sessions"
+          % SESSIONS)
+    print("%-22s %8s %8s %8s %7s" % ("", "up", "down", "total", "saved"))
+    baseline = None
+    for name, server_deflate, client_deflate in SETTINGS:
+        up, down = yield measure(reactor, server_deflate, client_deflate)
+        total = up + down
+        if baseline is None:
+            baseline = total
+        print("%-22s %8d %8d %8d %6.1f%%"
+              % (name, up, down, total, 100.0 * (baseline - total) / baseline))
+
+if __name__ == "__main__":
+    task.react(main)
@@ -0,0 +1,365 @@
+# Find out how much load one rendezvous relay can take. This runs many
+# simulated client pairs through the real protocol, the way two wormhole
+# clients would use it: both bind, one allocates a nameplate, both claim it
+# and open its mailbox, each adds a PAKE, a VERSION, and an application
+# message (and waits for the other's), then both release, close, and
+# disconnect. It reports the throughput, the p50/p95/p99 latency of each
+# command (until its response: "allocated", "claimed", "released", "closed",
+# the echo of an "add", or just the "ack" for "bind" and "open"), how long an
+# "add" takes to reach the other side ("deliver"), and the relay's CPU use
+# and memory.
+#
+# By default the relay runs in a child process (the same way --workers
+# starts its extra workers), so its CPU and memory can be told apart from the
+# load generator's. --in-process runs it in this process instead, and --url
+# uses one that is already running (give its --pid to see its CPU and
+# memory). CPU and memory are read from /proc, so are only shown on Linux.
+#
+# run like: python misc/loadtest-rendezvous.py [--pairs N] [--concurrency N]
+#            [--state sqlite|memory] [--workers N]
+
+from __future__ import print_function, unicode_literals
+import os, sys, json, time, argparse, subprocess
+from binascii import hexlify
+from six.moves.urllib_parse import urlparse
+from twisted.internet import defer, task, endpoints, protocol
+from autobahn.twisted import websocket
+from wormhole.util import dict_to_bytes, bytes_to_dict
+from wormhole.server.server import RelayServer
+from wormhole.transit import allocate_tcp_port
+
+APPID = "loadtest"
+# (phase, body size): roughly what "wormhole send --text" adds
+PHASES = [("pake", 33), ("version", 120), ("0", 200)]
+COMMANDS = ["bind", "allocate", "claim", "open", "add", "deliver",
+            "release", "close"]
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(description="rendezvous relay load test")
+    p.add_argument("--pairs", type=int, default=2000,
+                   help="how many client pairs to run (default 2000)")
+    p.add_argument("--concurrency", type=int, default=200,
+                   help="how many pairs to run at once (default 200)")
+    p.add_argument("--state", default="sqlite",
+                   help="the relay's --rendezvous-state (default sqlite)")
+    p.add_argument("--db", default=":memory:",
+                   help="the relay's database (default :memory:)")
+    p.add_argument("--workers", type=int, default=1,
+                   help="the relay's --workers (default 1)")
+    p.add_argument("--timeout", type=float, default=60,
+                   help="give up on a pair after this many seconds")
+    p.add_argument("--in-process", action="store_true",
+                   help="run the relay in this process")
+    p.add_argument("--url", help="use the relay already running here")
+    p.add_argument("--pid", type=int,
+                   help="with --url: the relay's process, to measure")
+    return p.parse_args(argv)
+
+
+class Latencies(object):
+    def __init__(self):
+        self._samples = dict((command, []) for command in COMMANDS)
+
+    def add(self, command, seconds):
+        self._samples[command].append(seconds)
+
+    def count(self):
+        return sum(len(s) for c, s in self._samples.items()
+                   if c != "deliver")
+
+    def report(self):
+        print("%-9s %8s %8s %8s %8s %8s" % ("command", "count", "p50 ms",
+                                            "p95 ms", "p99 ms", "max ms"))
+        for command in COMMANDS:
+            samples = sorted(self._samples[command])
+            if not samples:
+                continue
+            def ms(q):
+                # nearest rank
+                return 1000 * samples[int(round(q * (len(samples)-1)))]
+            print("%-9s %8d %8.1f %8.1f %8.1f %8.1f"
+                  % (command, len(samples), ms(0.50), ms(0.95), ms(0.99),
+                     ms(1.0)))
+
+
+class ServerError(Exception):
+    pass
+
+class LoadClient(websocket.WebSocketClientProtocol):
+    # responses are matched to what's waiting for them by "key": ("ack", id)
+    # for acks, ("message", side, phase) for messages, and (type,) for the
+    # rest, since each connection only sends one of those commands at a time
+    def onOpen(self):
+        self._next_id = 0
+        self._waiting = {}
+        self._arrived = {}
+        self.factory.opened.callback(self)
+
+    def onMessage(self, payload, isBinary):
+        m = bytes_to_dict(payload)
+        mtype = m["type"]
+        if mtype == "error":
+            self._fail(ServerError(m["error"]))
+            return
+        if mtype == "ack":
+            key = ("ack", m["id"])
+        elif mtype == "message":
+            key = ("message", m["side"], m["phase"])
+        else:
+            key = (mtype,)
+        d = self._waiting.pop(key, None)
+        if d:
+            d.callback(m)
+        elif mtype != "ack":
+            self._arrived[key] = m
+
+    def onClose(self, wasClean, code, reason):
+        self._fail(ServerError("connection lost: %s" % (reason,)))
+
+    def _fail(self, why):
+        waiting, self._waiting = self._waiting, {}
+        for d in waiting.values():
+            d.errback(why)
+
+    def expect(self, key):
+        if key in self._arrived:
+            return defer.succeed(self._arrived.pop(key))
+        d = self._waiting[key] = defer.Deferred()
+        return d
+
+    def call(self, latencies, mtype, response, **kwargs):
+        """Send a command, and fire with its response (which must be
+        expected by 'response'), recording the time it took."""
+        self._next_id += 1
+        kwargs["id"] = "%d" % self._next_id
+        kwargs["type"] = mtype
+        if response == "ack":
+            response = ("ack", kwargs["id"])
+        d = self.expect(response)
+        start = time.time()
+        self.sendMessage(dict_to_bytes(kwargs), False)
+        def _done(m):
+            latencies.add(mtype, time.time() - start)
+            return m
+        d.addCallback(_done)
+        return d
+
+class LoadClientFactory(websocket.WebSocketClientFactory):
+    protocol = LoadClient
+    def clientConnectionFailed(self, connector, reason):
+        self.opened.errback(reason)
+
+
+class Load(object):
+    def __init__(self, reactor, url, args):
+        self._reactor = reactor
+        self._url = url
+        self._args = args
+        self.latencies = Latencies()
+        self.completed = 0
+        self.failures = {}
+
+    def _connect(self):
+        p = urlparse(self._url)
+        f = LoadClientFactory(self._url)
+        f.opened = defer.Deferred()
+        self._reactor.connectTCP(p.hostname, p.port, f)
+        return f.opened
+
+    @defer.inlineCallbacks
+    def _pair(self, i):
+        lat = self.latencies
+        a = b = None
+        try:
+            a = yield self._connect()
+            b = yield self._connect()
+            a.side, b.side = "%x-a" % i, "%x-b" % i
+            both = [a, b]
+            yield defer.gatherResults([c.call(lat, "bind", "ack", appid=APPID,
+                                              side=c.side) for c in both],
+                                      consumeErrors=True)
+            m = yield a.call(lat, "allocate", ("allocated",))
+            nameplate = m["nameplate"]
+            claimed = yield defer.gatherResults(
+                [c.call(lat, "claim", ("claimed",), nameplate=nameplate)
+                 for c in both], consumeErrors=True)
+            mailbox = claimed[0]["mailbox"]
+            yield defer.gatherResults(
+                [c.call(lat, "open", "ack", mailbox=mailbox) for c in both],
+                consumeErrors=True)
+            for phase, size in PHASES:
+                ds = []
+                for sender, receiver in [(a, b), (b, a)]:
+                    body = hexlify(os.urandom(size)).decode("ascii")
+                    start = time.time()
+                    key = ("message", sender.side, phase)
+                    d = receiver.expect(key)
+                    d.addCallback(lambda _, start=start:
+                                  lat.add("deliver", time.time() - start))
+                    ds.append(d)
+                    ds.append(sender.call(lat, "add", key, phase=phase,
+                                          body=body))
+                yield defer.gatherResults(ds, consumeErrors=True)
+            yield defer.gatherResults(
+                [c.call(lat, "release", ("released",)) for c in both],
+                consumeErrors=True)
+            yield defer.gatherResults(
+                [c.call(lat, "close", ("closed",), mood="happy")
+                 for c in both], consumeErrors=True)
+            self.completed += 1
+        finally:
+            for c in [a, b]:
+                if c:
+                    c.transport.loseConnection()
+
+    def _failed(self, f):
+        if isinstance(f.value, defer.FirstError):
+            f = f.value.subFailure
+        why = "%s: %s" % (f.type.__name__, f.getErrorMessage())
+        self.failures[why] = self.failures.get(why, 0) + 1
+
+    def run(self):
+        sem = defer.DeferredSemaphore(self._args.concurrency)
+        ds = []
+        for i in range(self._args.pairs):
+            d = sem.run(lambda i=i: self._pair(i).addTimeout(
+                self._args.timeout, self._reactor))
+            d.addErrback(self._failed)
+            ds.append(d)
+        return defer.gatherResults(ds)
+
+
+def _proc_stat(pid):
+    with open("/proc/%d/stat" % pid) as f:
+        data = f.read()
+    # the command name (in parens) may contain spaces
+    return data[data.rindex(")")+2:].split()
+
+class ProcessTree(object):
+    """CPU time and RSS of a process and its descendants (the extra
+    workers), from /proc."""
+    def __init__(self, pid):
+        self._pid = pid
+        self.available = os.path.exists("/proc/%d/stat" % pid)
+        self._ticks = os.sysconf(str("SC_CLK_TCK")) if self.available else 1
+        self._page = os.sysconf(str("SC_PAGE_SIZE")) if self.available else 1
+        self.peak_rss = 0
+
+    def _stats(self):
+        stats = {}
+        for name in os.listdir("/proc"):
+            if name.isdigit():
+                try:
+                    stats[int(name)] = _proc_stat(int(name))
+                except (IOError, OSError, ValueError):
+                    pass # it went away
+        tree = [self._pid]
+        for pid in tree:
+            tree.extend(p for p, s in stats.items() if int(s[1]) == pid)
+        return [stats[pid] for pid in tree if pid in stats]
+
+    def sample(self):
+        """Return the CPU seconds used so far, and note the RSS."""
+        if not self.available:
+            return 0
+        stats = self._stats()
+        rss = sum(int(s[21]) for s in stats) * self._page
+        self.peak_rss = max(self.peak_rss, rss)
+        return sum(int(s[11]) + int(s[12]) for s in stats) / self._ticks
+
+
+def raise_fd_limit():
+    # each pair uses two connections (and, in-process, two more for the
+    # relay's side of them)
+    try:
+        from resource import getrlimit, setrlimit, RLIMIT_NOFILE
+    except ImportError:
+        return
+    soft, hard = getrlimit(RLIMIT_NOFILE)
+    try:
+        setrlimit(RLIMIT_NOFILE, (hard, hard))
+    except ValueError:
+        pass
+
+@defer.inlineCallbacks
+def wait_for_port(reactor, port):
+    ep = endpoints.TCP4ClientEndpoint(reactor, "127.0.0.1", port)
+    for i in range(300):
+        try:
+            p = yield ep.connect(protocol.Factory.forProtocol(protocol.Protocol))
+        except Exception:
+            yield task.deferLater(reactor, 0.1, lambda: None)
+            continue
+        p.transport.loseConnection()
+        defer.returnValue(None)
+    raise RuntimeError("the relay never started listening on %d" % port)
+
+@defer.inlineCallbacks
+def main(reactor, args):
+    raise_fd_limit()
+    relay = child = None
+    if args.url:
+        url = args.url
+        measured = args.pid
+    else:
+        port = allocate_tcp_port()
+        url = "ws://127.0.0.1:%d/v1" % port
+        config = dict(rendezvous_web_port="tcp:%d:interface=127.0.0.1" % port,
+                      advertise_version=None, db_url=args.db,
+                      rendezvous_state=args.state, workers=args.workers)
+        if args.in_process:
+            relay = RelayServer(**config)
+            relay.startService()
+            measured = os.getpid()
+        else:
+            devnull = open(os.devnull, "wb")
+            child = subprocess.Popen([sys.executable, "-m",
+                                      "wormhole.server.workers",
+                                      json.dumps(config)],
+                                     stdin=subprocess.PIPE, stdout=devnull,
+                                     stderr=devnull)
+            measured = child.pid
+        yield wait_for_port(reactor, port)
+
+    tree = ProcessTree(measured) if measured else None
+    sampler = None
+    if tree and tree.available:
+        sampler = task.LoopingCall(tree.sample)
+        sampler.clock = reactor
+        sampler.start(0.5)
+    cpu_start = tree.sample() if tree else 0
+    start = time.time()
+    load = Load(reactor, url, args)
+    try:
+        yield load.run()
+    finally:
+        elapsed = time.time() - start
+        cpu = (tree.sample() if tree else 0) - cpu_start
+        if sampler:
+            sampler.stop()
+        if relay:
+            yield relay.stopService()
+        if child:
+            child.stdin.close() # which makes it (and its workers) exit
+            child.wait()
+
+    print("%d pairs (%d at a time) against %s, %s state, %d worker(s)"
+          % (args.pairs, args.concurrency, url, args.state, args.workers))
+    print("%d completed in %.1fs: %.1f pairs/s, %.0f commands/s"
+          % (load.completed, elapsed, load.completed / elapsed,
+             load.latencies.count() / elapsed))
+    for why, count in sorted(load.failures.items()):
+        print("%d failed: %s" % (count, why))
+    print()
+    load.latencies.report()
+    print()
+    if tree and tree.available:
+        print("relay%s: %.1f%% CPU (of one core), %.1f MB peak RSS"
+              % (" (and load generator)" if relay else "",
+                 100 * cpu / elapsed, tree.peak_rss / 1e6))
+    else:
+        print("relay CPU and memory: not available")
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    task.react(main, [args])
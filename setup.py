@@ -42,8 +42,7 @@ setup(name="magic-wormhole",
       ],
       extras_require={
           ':sys_platform=="win32"': ["pypiwin32"],
-          "dev": ["mock", "tox", "pyflakes",
-                  "magic-wormhole-transit-relay==0.1.0"],
+          "dev": ["mock", "tox", "pyflakes"],
       },
       test_suite="wormhole.test",
       cmdclass=commands,
@@ -0,0 +1,143 @@
+# no unicode_literals
+from __future__ import absolute_import
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# When both sides of a file transfer advertise "compression-v1", every file
+# record starts with a flag byte. RAW records carry the file data as-is.
+# COMPRESSED records carry the next piece of a single compression stream,
+# flushed at the end of the record so the receiver can decode it right away.
+# Only COMPRESSED records are fed into the stream, so the sender can send
+# incompressible data (like a zipfile, or a video) without paying to
+# compress it.
+
+RAW = b"\x00"
+COMPRESSED = b"\x01"
+
+# in order of preference: both sides pick the first one they both have
+PREFERENCE = [u"zstd", u"zlib"]
+
+class DecompressionError(ValueError):
+    pass
+
+def available_methods():
+    return [m for m in PREFERENCE if m != u"zstd" or zstandard is not None]
+
+def choose_method(ours, theirs):
+    for method in PREFERENCE:
+        if method in ours and method in theirs:
+            return method
+    return None
+
+class _ZlibCompressStream(object):
+    def __init__(self):
+        self._c = zlib.compressobj(6)
+    def compress(self, data):
+        return self._c.compress(data) + self._c.flush(zlib.Z_SYNC_FLUSH)
+
+class _ZlibDecompressStream(object):
+    def __init__(self):
+        self._d = zlib.decompressobj()
+    def decompress(self, data, limit):
+        out = self._d.decompress(data, limit)
+        if self._d.unconsumed_tail:
+            raise DecompressionError("record expands past %d bytes" % limit)
+        return out
+
+class _ZstdCompressStream(object):
+    def __init__(self):
+        self._c = zstandard.ZstdCompressor(level=3).compressobj()
+    def compress(self, data):
+        return (self._c.compress(data) +
+                self._c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+
+class _ZstdDecompressStream(object):
+    # zstandard's decompressobj() has no output limit, so a small record
+    # could expand to gigabytes before we got to check its size. Instead we
+    # feed the stream through a stream_writer, which hands us its output a
+    # piece (at most WRITE_SIZE) at a time, and stop it as soon as a record
+    # goes past the limit.
+    WRITE_SIZE = 64*1024
+
+    def __init__(self):
+        self._writer = zstandard.ZstdDecompressor().stream_writer(
+            self, write_size=self.WRITE_SIZE)
+        self._out = []
+        self._size = 0
+        self._limit = 0
+
+    def write(self, data): # called by the stream_writer
+        self._size += len(data)
+        if self._size > self._limit:
+            raise DecompressionError("record expands past %d bytes"
+                                     % self._limit)
+        self._out.append(bytes(data))
+        return len(data)
+
+    def decompress(self, data, limit):
+        self._out = []
+        self._size = 0
+        self._limit = limit
+        self._writer.write(data)
+        out, self._out = b"".join(self._out), []
+        return out
+
+_STREAMS = {u"zlib": (_ZlibCompressStream, _ZlibDecompressStream),
+            u"zstd": (_ZstdCompressStream, _ZstdDecompressStream),
+            }
+
+class Compressor(object):
+    """I turn each block of file data into one flagged record.
+
+    Before compressing a block, I compress a small sample of it on its own
+    (quickly), and send the whole block raw if the sample doesn't shrink
+    enough. Each time that happens, I skip sampling for the next few blocks
+    (twice as many as last time, up to MAX_SKIP), so a long run of
+    incompressible data costs next to nothing.
+    """
+    SAMPLE_SIZE = 4096
+    MIN_SAVINGS = 0.1 # the sample must shrink by at least this fraction
+    MAX_SKIP = 32
+
+    def __init__(self, method):
+        self._stream = _STREAMS[method][0]()
+        self._skip = 0
+        self._backoff = 0
+
+    def _worth_compressing(self, data):
+        if self._skip:
+            self._skip -= 1
+            return False
+        sample = data[:self.SAMPLE_SIZE]
+        limit = len(sample) * (1 - self.MIN_SAVINGS)
+        if len(zlib.compress(sample, 1)) <= limit:
+            self._backoff = 0
+            return True
+        self._backoff = min(max(1, 2*self._backoff), self.MAX_SKIP)
+        self._skip = self._backoff
+        return False
+
+    def compress(self, data):
+        if data and self._worth_compressing(data):
+            return COMPRESSED + self._stream.compress(data)
+        return RAW + data
+
+class Decompressor(object):
+    """I undo what Compressor did, one record at a time. No record may
+    decompress to more than 'limit' bytes."""
+    def __init__(self, method, limit):
+        self._stream = _STREAMS[method][1]()
+        self._limit = limit
+
+    def decompress(self, record):
+        if not record:
+            return record # the empty kick from connectConsumer(expected=0)
+        flag = record[:1]
+        if flag == RAW:
+            return record[1:]
+        if flag == COMPRESSED:
+            return self._stream.decompress(record[1:], self._limit)
+        raise DecompressionError("unknown record flag %r" % (flag,))
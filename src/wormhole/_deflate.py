@@ -0,0 +1,91 @@
+from __future__ import unicode_literals
+from autobahn.websocket.compress import (PerMessageDeflateOffer,
+                                         PerMessageDeflateOfferAccept,
+                                         PerMessageDeflateResponse,
+                                         PerMessageDeflateResponseAccept)
+
+# permessage-deflate (RFC 7692) compresses each WebSocket message, which
+# suits the rendezvous protocol's small and repetitive JSON (the encrypted
+# bodies themselves won't shrink). It is only used when the client offers it
+# and the server accepts. Both sides take the same setting: true (to use
+# zlib's defaults), or a dict with any of:
+#
+#  window_bits: the LZ77 window (as log2 of its size, 9-15) to compress what
+#               we send with
+#  mem_level: how much memory zlib may use to compress what we send (1-9)
+#  peer_window_bits: ask the other side to compress with a window no bigger
+#                    than this, which limits what we need to decompress it
+#
+# Smaller numbers use less memory per connection, and compress less.
+
+OPTIONS = ("window_bits", "mem_level", "peer_window_bits")
+WINDOW_BITS = range(9, 16)
+MEM_LEVELS = range(1, 10)
+
+def parse_options(value):
+    """Check a permessage-deflate setting. Returns a dict of options, or None
+    if compression is off. Raises ValueError."""
+    if value is None or value is False:
+        return None
+    if value is True:
+        return {}
+    if not isinstance(value, dict):
+        raise ValueError("permessage-deflate wants true, false, or a dict of"
+                         " options, not %r" % (value,))
+    for key, v in value.items():
+        if key not in OPTIONS:
+            raise ValueError("unknown permessage-deflate option %r (try one"
+                             " of: %s)" % (key, ", ".join(OPTIONS)))
+        allowed = MEM_LEVELS if key == "mem_level" else WINDOW_BITS
+        if isinstance(v, bool) or v not in allowed:
+            raise ValueError("permessage-deflate %s must be %d-%d, not %r"
+                             % (key, allowed[0], allowed[-1], v))
+    return dict(value)
+
+# The autobahn classes are called with positional arguments, and read with
+# _get(), because their names were changed from camelCase in later versions.
+
+def _get(obj, name, old_name):
+    return getattr(obj, name, getattr(obj, old_name, 0))
+
+def _window_bits(options, limit):
+    window_bits = options.get("window_bits")
+    if window_bits and limit:
+        window_bits = min(window_bits, limit) # what the peer asked for
+    return window_bits
+
+def server_accept(options):
+    """Return a perMessageCompressionAccept function, for the server's
+    WebSocket factory."""
+    def accept(offers):
+        for offer in offers:
+            if isinstance(offer, PerMessageDeflateOffer):
+                limit = _get(offer, "request_max_window_bits",
+                             "requestMaxWindowBits")
+                peer_window_bits = 0
+                if _get(offer, "accept_max_window_bits",
+                        "acceptMaxWindowBits"):
+                    peer_window_bits = options.get("peer_window_bits", 0)
+                return PerMessageDeflateOfferAccept(
+                    offer, False, peer_window_bits, None,
+                    _window_bits(options, limit), options.get("mem_level"))
+        return None
+    return accept
+
+def client_offers(options):
+    """Return the perMessageCompressionOffers for a client's factory."""
+    return [PerMessageDeflateOffer(True, True, False,
+                                   options.get("peer_window_bits", 0))]
+
+def client_accept(options):
+    """Return a perMessageCompressionAccept function, for a client's
+    factory."""
+    def accept(response):
+        if isinstance(response, PerMessageDeflateResponse):
+            limit = _get(response, "client_max_window_bits",
+                         "clientMaxWindowBits")
+            return PerMessageDeflateResponseAccept(
+                response, None, _window_bits(options, limit),
+                options.get("mem_level"))
+        return None
+    return accept
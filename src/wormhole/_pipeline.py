@@ -0,0 +1,190 @@
+# no unicode_literals
+from __future__ import absolute_import
+from collections import deque
+from zope.interface import implementer
+from twisted.internet import interfaces, defer, threads
+from twisted.python import log, threadpool
+from twisted.python.failure import Failure
+
+# SecretBox.encrypt/decrypt release the GIL while libsodium does the work, so
+# a thread pool can seal and open several transit records at once. The
+# classes here let transit.Connection do that without giving up the strict
+# record ordering that the nonces demand.
+
+class OrderedPipeline(object):
+    """I run jobs on a threadpool, and deliver their results in the order
+    the jobs were submitted.
+
+    At most 'window' jobs may be outstanding (submitted but not yet
+    delivered): callers are expected to check is_full() and stop submitting
+    until the 'changed' callback tells them some room has opened up. If a job
+    fails, 'fail' is called with the Failure, and all later results are
+    discarded.
+
+    submit() returns a Deferred that fires (with None) after that job's
+    result has been delivered, or errbacks if it (or an earlier job) failed.
+    """
+    def __init__(self, reactor, threadpool, window, deliver, fail,
+                 changed=None):
+        assert window > 0
+        self._reactor = reactor
+        self._threadpool = threadpool
+        self._window = window
+        self._deliver = deliver
+        self._fail = fail
+        self._changed = changed
+        self._slots = deque() # [done, result, Deferred], in submission order
+        self._failed = False
+        self._drain_waiters = []
+        self.submitted = 0
+
+    def is_full(self):
+        return len(self._slots) >= self._window
+
+    def is_empty(self):
+        return not self._slots
+
+    def submit(self, f, *args):
+        assert not self._failed
+        slot = [False, None, defer.Deferred()]
+        self._slots.append(slot)
+        self.submitted += 1
+        d = threads.deferToThreadPool(self._reactor, self._threadpool,
+                                      f, *args)
+        d.addBoth(self._finished, slot)
+        d.addErrback(log.err) # deliver() raised
+        return slot[2]
+
+    def _finished(self, res, slot):
+        slot[0] = True
+        slot[1] = res
+        if self._failed:
+            return
+        while self._slots and self._slots[0][0]:
+            done, res, d = self._slots.popleft()
+            if isinstance(res, Failure):
+                self._failed = True
+                abandoned = [d] + [s[2] for s in self._slots]
+                self._slots.clear()
+                self._fail(res)
+                for d in abandoned:
+                    d.errback(res)
+                break
+            self._deliver(res)
+            d.callback(None)
+        if self._changed:
+            self._changed()
+        if not self._slots:
+            waiters, self._drain_waiters = self._drain_waiters, []
+            for d in waiters:
+                d.callback(None)
+
+    def when_drained(self):
+        """Return a Deferred that fires once every submitted job has been
+        delivered (or abandoned because an earlier one failed)."""
+        if not self._slots:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._drain_waiters.append(d)
+        return d
+
+
+@implementer(interfaces.IPushProducer)
+class ProducerThrottle(object):
+    """I sit between a transport and an outbound producer (like a
+    FileSender), and hold the producer back when either the transport's
+    buffer or the encryption pipeline is full.
+
+    Streaming producers are paused and resumed. Non-streaming ones are pulled
+    (resumeProducing) until the pipeline is full each time the transport
+    asks for more, because a pull producer that writes into the pipeline
+    doesn't put anything into the transport buffer right away, so waiting for
+    that buffer to drain would leave the pipeline idle.
+    """
+    def __init__(self, producer, streaming, pipeline):
+        self._producer = producer
+        self._streaming = streaming
+        self._pipeline = pipeline
+        self._transport_paused = False
+        self._producer_paused = False
+        self._want_pull = False
+
+    def detach(self):
+        self._producer = None
+
+    # the transport calls these
+    def pauseProducing(self):
+        self._transport_paused = True
+        self.pipelineChanged()
+
+    def resumeProducing(self):
+        if self._streaming:
+            self._transport_paused = False
+        else:
+            self._want_pull = True
+        self.pipelineChanged()
+
+    def stopProducing(self):
+        if self._producer:
+            self._producer.stopProducing()
+
+    # the Connection calls this after each record it submits
+    def recordSubmitted(self):
+        # a streaming producer must be paused as soon as the pipeline fills,
+        # but pull producers are only asked for more (in pipelineChanged)
+        # while there's room, so they need nothing here
+        if self._streaming:
+            self.pipelineChanged()
+
+    # the Connection calls this whenever the pipeline fills or drains
+    def pipelineChanged(self):
+        if self._producer is None:
+            return
+        if self._streaming:
+            pause = self._transport_paused or self._pipeline.is_full()
+            if pause and not self._producer_paused:
+                self._producer_paused = True
+                self._producer.pauseProducing()
+            elif not pause and self._producer_paused:
+                self._producer_paused = False
+                self._producer.resumeProducing()
+            return
+        while self._want_pull and self._producer is not None:
+            if self._pipeline.is_full():
+                # the transport will ask again once the results are written
+                self._want_pull = False
+                break
+            before = self._pipeline.submitted
+            self._producer.resumeProducing()
+            if self._pipeline.submitted == before:
+                break # it didn't write anything, don't spin
+
+class TransferThreadPool(threadpool.ThreadPool):
+    """A started ThreadPool that is only needed for one transfer (or one
+    connection of it). Call stopSoon() when it is finished with. If the
+    reactor starts to shut down first, the pool is stopped then.
+    """
+    def __init__(self, reactor, maxthreads, name):
+        threadpool.ThreadPool.__init__(self, 1, maxthreads, name)
+        self._reactor = reactor
+        self.start()
+        self._trigger = reactor.addSystemEventTrigger("before", "shutdown",
+                                                      self._shutdown)
+
+    def _shutdown(self):
+        self._trigger = None
+        self.stop()
+
+    def stopSoon(self):
+        """Stop the pool, and remove its shutdown trigger (so stopping many
+        of these doesn't leave the reactor holding on to them). stop() waits
+        for the threads to finish whatever they are in the middle of, so
+        that happens on one of the reactor's own threads, not the reactor
+        thread. Returns a Deferred that fires when the pool has stopped."""
+        if self._trigger is None:
+            return defer.succeed(None) # already stopped
+        self._reactor.removeSystemEventTrigger(self._trigger)
+        self._trigger = None
+        return threads.deferToThreadPool(self._reactor,
+                                         self._reactor.getThreadPool(),
+                                         self.stop)
@@ -0,0 +1,76 @@
+# no unicode_literals
+from __future__ import absolute_import
+import struct
+
+# Transit records are framed as a 4-byte big-endian length, followed by that
+# many bytes of SecretBox output (a 24-byte big-endian nonce, then the
+# ciphertext and MAC). This module holds the framing code, so
+# transit.Connection doesn't have to re-slice a growing bytestring (and
+# round-trip every length and nonce through hex) for each inbound record.
+
+LENGTH_SIZE = 4
+NONCE_SIZE = 24
+MAX_NONCE = 2**(8*NONCE_SIZE)
+MAX_LENGTH = 2**(8*LENGTH_SIZE)
+
+_LENGTH = struct.Struct(">L")
+_NONCE = struct.Struct(">QQQ")
+_MASK64 = 2**64 - 1
+
+def encode_length(length):
+    return _LENGTH.pack(length)
+
+def encode_nonce(nonce):
+    # big-endian, zero-padded to 24 bytes
+    return _NONCE.pack(nonce >> 128, (nonce >> 64) & _MASK64, nonce & _MASK64)
+
+def decode_nonce(buf, offset=0):
+    high, mid, low = _NONCE.unpack_from(buf, offset)
+    if high or mid:
+        return (high << 128) | (mid << 64) | low
+    return low
+
+class RecordDecoder(object):
+    """I accumulate inbound bytes and split them into length-prefixed frames.
+
+    Data is appended to a single bytearray, and a read offset marks how much
+    of it has already been consumed. The consumed prefix is only discarded
+    once it makes up at least half of the buffer, so the cost of compaction
+    is amortized across many records instead of being paid on every one.
+    """
+    def __init__(self):
+        self._buf = bytearray()
+        self._offset = 0
+
+    def feed(self, data):
+        if data:
+            self._buf.extend(data)
+
+    def buffered(self):
+        return len(self._buf) - self._offset
+
+    def next_frame(self):
+        """Return the next complete frame (as bytes, without the length
+        prefix), or None if more data is needed."""
+        buf = self._buf
+        offset = self._offset
+        available = len(buf) - offset
+        if available < LENGTH_SIZE:
+            return None
+        (length,) = _LENGTH.unpack_from(buf, offset)
+        if available < LENGTH_SIZE + length:
+            return None
+        start = offset + LENGTH_SIZE
+        end = start + length
+        # a copy, not a memoryview: an exported view (which PyPy may not
+        # release right away) would stop us resizing buf below
+        frame = bytes(buf[start:end])
+        if end == len(buf):
+            del buf[:]
+            self._offset = 0
+        else:
+            self._offset = end
+            if end > len(buf) // 2:
+                del buf[:end]
+                self._offset = 0
+        return frame
@@ -9,8 +9,12 @@ from twisted.internet import defer, endpoints, task
 from twisted.application import internet
 from autobahn.twisted import websocket
 from . import _interfaces, errors
+from ._deflate import (parse_options as parse_deflate_options,
+                       client_offers as deflate_offers,
+                       client_accept as deflate_accept)
 from .util import (bytes_to_hexstr, hexstr_to_bytes,
-                   bytes_to_dict, dict_to_bytes)
+                   bytes_to_dict, dict_to_bytes,
+                   bytes_to_dict_and_body, dict_and_body_to_bytes)
 
 class WSClient(websocket.WebSocketClientProtocol):
     def onConnect(self, response):
@@ -26,9 +30,8 @@ class WSClient(websocket.WebSocketClientProtocol):
         self._RC.ws_open(self)
 
     def onMessage(self, payload, isBinary):
-        assert not isBinary
         try:
-            self._RC.ws_message(payload)
+            self._RC.ws_message(payload, isBinary)
         except:
             from twisted.python.failure import Failure
             print("LOGGING", Failure())
@@ -67,6 +70,7 @@ class RendezvousConnector(object):
     _journal = attrib(validator=provides(_interfaces.IJournal))
     _tor = attrib(validator=optional(provides(_interfaces.ITorManager)))
     _timing = attrib(validator=provides(_interfaces.ITiming))
+    _websocket_deflate = attrib(default=None) # see _deflate.py
 
     def __attrs_post_init__(self):
         self._have_made_a_successful_connection = False
@@ -74,8 +78,14 @@ class RendezvousConnector(object):
 
         self._trace = None
         self._ws = None
+        self._binary = False # can we send bodies without hex-encoding them?
         f = WSFactory(self, self._url)
         f.setProtocolOptions(autoPingInterval=60, autoPingTimeout=600)
+        deflate = parse_deflate_options(self._websocket_deflate)
+        if deflate is not None:
+            f.setProtocolOptions(
+                perMessageCompressionOffers=deflate_offers(deflate),
+                perMessageCompressionAccept=deflate_accept(deflate))
         p = urlparse(self._url)
         ep = self._make_endpoint(p.hostname, p.port or 80)
         self._connector = internet.ClientService(ep, f)
@@ -121,7 +131,10 @@ class RendezvousConnector(object):
     def tx_add(self, phase, body):
         assert isinstance(phase, type("")), type(phase)
         assert isinstance(body, type(b"")), type(body)
-        self._tx("add", phase=phase, body=bytes_to_hexstr(body))
+        if self._binary:
+            self._tx("add", raw_body=body, phase=phase)
+        else:
+            self._tx("add", phase=phase, body=bytes_to_hexstr(body))
 
     def tx_release(self, nameplate):
         self._tx("release", nameplate=nameplate)
@@ -164,8 +177,9 @@ class RendezvousConnector(object):
         self._debug("R.connected")
         self._have_made_a_successful_connection = True
         self._ws = proto
+        self._binary = False # until this server says otherwise
         try:
-            self._tx("bind", appid=self._appid, side=self._side)
+            self._tx("bind", appid=self._appid, side=self._side, binary=True)
             self._N.connected()
             self._M.connected()
             self._L.connected()
@@ -175,15 +189,19 @@ class RendezvousConnector(object):
             raise
         self._debug("R.connected finished notifications")
 
-    def ws_message(self, payload):
-        msg = bytes_to_dict(payload)
+    def ws_message(self, payload, isBinary=False):
+        if isBinary:
+            header, body = bytes_to_dict_and_body(payload)
+            msg = dict(header, body=body)
+        else:
+            header = msg = bytes_to_dict(payload)
         if msg["type"] != "ack":
                 self._debug("R.rx(%s %s%s)" %
                             (msg["type"], msg.get("phase",""),
                         "[mine]" if msg.get("side","") == self._side else "",
                              ))
 
-        self._timing.add("ws_receive", _side=self._side, message=msg)
+        self._timing.add("ws_receive", _side=self._side, message=header)
         if self._debug_record_inbound_f:
             self._debug_record_inbound_f(msg)
         mtype = msg["type"]
@@ -235,7 +253,7 @@ class RendezvousConnector(object):
     def _stopped(self, res):
         self._T.stopped()
 
-    def _tx(self, mtype, **kwargs):
+    def _tx(self, mtype, raw_body=None, **kwargs):
         assert self._ws
         # msgid is used by misc/dump-timing.py to correlate our sends with
         # their receives, and vice versa. They are also correlated with the
@@ -244,9 +262,12 @@ class RendezvousConnector(object):
         kwargs["id"] = bytes_to_hexstr(os.urandom(2))
         kwargs["type"] = mtype
         self._debug("R.tx(%s %s)" % (mtype.upper(), kwargs.get("phase", "")))
-        payload = dict_to_bytes(kwargs)
         self._timing.add("ws_send", _side=self._side, **kwargs)
-        self._ws.sendMessage(payload, False)
+        if raw_body is None:
+            self._ws.sendMessage(dict_to_bytes(kwargs), False)
+        else:
+            payload = dict_and_body_to_bytes(kwargs, raw_body)
+            self._ws.sendMessage(payload, True)
 
     def _response_handle_allocated(self, msg):
         nameplate = msg["nameplate"]
@@ -269,6 +290,9 @@ class RendezvousConnector(object):
     def _response_handle_ack(self, msg):
         pass
 
+    def _response_handle_bound(self, msg):
+        self._binary = bool(msg.get("binary"))
+
     def _response_handle_error(self, msg):
         # the server sent us a type=error. Most cases are due to our mistakes
         # (malformed protocol messages, sending things in the wrong order),
@@ -290,7 +314,9 @@ class RendezvousConnector(object):
         side = msg["side"]
         phase = msg["phase"]
         assert isinstance(phase, type("")), type(phase)
-        body = hexstr_to_bytes(msg["body"]) # bytes
+        body = msg["body"]
+        if not isinstance(body, type(b"")): # binary messages carry bytes
+            body = hexstr_to_bytes(body)
         self._M.rx_message(side, phase, body)
 
     def _response_handle_released(self, msg):
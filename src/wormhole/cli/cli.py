@@ -70,6 +70,10 @@ class AliasedGroup(click.Group):
     metavar="tcp:HOST:PORT",
     help="transit relay to use",
 )
+@click.option(
+    "--websocket-deflate", is_flag=True, default=False,
+    help="ask the relay to compress rendezvous messages",
+)
 @click.option(
     "--dump-timing", type=type(u""), # TODO: hide from --help output
     default=None,
@@ -81,7 +85,8 @@ class AliasedGroup(click.Group):
     version=__version__,
 )
 @click.pass_context
-def wormhole(context, dump_timing, transit_helper, relay_url, appid):
+def wormhole(context, dump_timing, websocket_deflate, transit_helper,
+             relay_url, appid):
     """
     Create a Magic Wormhole and communicate through it.
 
@@ -94,6 +99,7 @@ def wormhole(context, dump_timing, transit_helper, relay_url, appid):
     cfg.relay_url = relay_url
     cfg.transit_helper = transit_helper
     cfg.dump_timing = dump_timing
+    cfg.websocket_deflate = websocket_deflate
 
 
 @inlineCallbacks
@@ -156,6 +162,9 @@ CommonArgs = _compose(
     click.option("--listen/--no-listen", default=True,
                  help="(debug) don't open a listening socket for Transit",
                  ),
+    click.option("--crypto-threads", default=0, metavar="N",
+                 help="encrypt/decrypt file data on N worker threads",
+                 ),
 )
 
 TorArgs = _compose(
@@ -221,6 +230,10 @@ def go(f, cfg):
     "--accept-file", is_flag=True,
     help="accept file transfer without asking for confirmation",
 )
+@click.option(
+    "--fsync", is_flag=True, default=False,
+    help="flush the received file to disk as it arrives",
+)
 @click.option(
     "--output-file", "-o",
     metavar="FILENAME|DIRNAME",
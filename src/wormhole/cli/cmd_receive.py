@@ -1,21 +1,24 @@
 from __future__ import print_function
-import os, sys, six, tempfile, zipfile, hashlib, shutil
+import os, sys, six, json, tempfile, zipfile, hashlib, shutil
 from tqdm import tqdm
 from humanize import naturalsize
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.python import log
 from wormhole import create, input_with_completion, __version__
 from ..transit import TransitReceiver
 from ..errors import TransferError
 from ..util import (dict_to_bytes, bytes_to_dict, bytes_to_hexstr,
-                    estimate_free_space)
+                    estimate_free_space, hash_file_prefix)
 from .welcome import handle_welcome
 
 APPID = u"lothar.com/wormhole/text-or-file-xfer"
 
 KEY_TIMER = 1.0
 VERIFY_TIMER = 1.0
+# While receiving a resumable file, we record our progress in a sidecar next
+# to the .tmp file every CHECKPOINT_BYTES, and when the transfer fails.
+CHECKPOINT_BYTES = 16*1024*1024
 
 class RespondError(Exception):
     def __init__(self, response):
@@ -47,6 +50,9 @@ class Receiver:
         self._reactor = reactor
         self._tor = None
         self._transit_receiver = None
+        self._resume_path = None # sidecar, if the sender can resume
+        self._resume_offset = 0
+        self._hasher = hashlib.sha256()
 
     def _msg(self, *args, **kwargs):
         print(*args, file=self.args.stderr, **kwargs)
@@ -68,7 +74,8 @@ class Receiver:
         w = create(self.args.appid or APPID, self.args.relay_url,
                    self._reactor,
                    tor=self._tor,
-                   timing=self.args.timing)
+                   timing=self.args.timing,
+                   websocket_deflate=self.args.websocket_deflate)
         self._w = w # so tests can wait on events too
 
         # I wanted to do this instead:
@@ -224,11 +231,13 @@ class Receiver:
                              no_listen=(not self.args.listen),
                              tor=self._tor,
                              reactor=self._reactor,
-                             timing=self.args.timing)
+                             timing=self.args.timing,
+                             crypto_threads=self.args.crypto_threads)
         self._transit_receiver = tr
         transit_key = w.derive_key(APPID+u"/transit-key", tr.TRANSIT_KEY_LENGTH)
         tr.set_transit_key(transit_key)
 
+        tr.add_connection_abilities(sender_transit.get("abilities-v1", []))
         tr.add_connection_hints(sender_transit.get("hints-v1", []))
         receiver_abilities = tr.get_connection_abilities()
         receiver_hints = yield tr.get_connection_hints()
@@ -245,10 +254,12 @@ class Receiver:
             returnValue(None)
         # transit will be created by this point, but not connected
         if "file" in them_d:
-            f = self._handle_file(them_d)
+            f = yield self._handle_file(them_d)
             self._send_permission(w)
             rp = yield self._establish_transit()
-            datahash = yield self._transfer_data(rp, f)
+            # with --fsync, each checkpoint describes data that's on disk
+            fsync = CHECKPOINT_BYTES if self.args.fsync else None
+            datahash = yield self._transfer_data(rp, f, fsync)
             self._write_file(f)
             yield self._close_transit(rp, datahash)
         elif "directory" in them_d:
@@ -269,6 +280,7 @@ class Receiver:
         print(them_d["message"], file=self.args.stdout)
         self._send_data({"answer": {"message_ack": "ok"}}, w)
 
+    @inlineCallbacks
     def _handle_file(self, them_d):
         file_data = them_d["file"]
         self.abs_destname = self._decide_destname("file",
@@ -284,7 +296,60 @@ class Receiver:
                   (naturalsize(self.xfersize), os.path.basename(self.abs_destname)))
         self._ask_permission()
         tmp_destname = self.abs_destname + ".tmp"
-        return open(tmp_destname, "wb")
+        if file_data.get("resumable"):
+            self._resume_path = tmp_destname + ".resume"
+            f = yield self._open_partial(tmp_destname)
+            if f:
+                returnValue(f)
+        returnValue(open(tmp_destname, "wb"))
+
+    @inlineCallbacks
+    def _open_partial(self, tmp_destname):
+        # If an earlier attempt left a partial .tmp file and a sidecar that
+        # still describes it, reopen it (positioned at the end of the good
+        # data) so we can ask the sender to skip that part. Otherwise return
+        # None, and we'll start from scratch.
+        try:
+            with open(self._resume_path, "r") as sf:
+                state = json.load(sf)
+            offset = state["offset"]
+            if (state["filesize"] != self.xfersize
+                or not isinstance(offset, six.integer_types)
+                or not 0 < offset < self.xfersize):
+                returnValue(None)
+            f = open(tmp_destname, "r+b")
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            returnValue(None)
+        # the partial file might be many GB: hash it off the reactor thread,
+        # so the wormhole connection stays alive meanwhile
+        hasher = hashlib.sha256()
+        got = yield threads.deferToThreadPool(self._reactor,
+                                              self._reactor.getThreadPool(),
+                                              hash_file_prefix,
+                                              f, offset, hasher)
+        if got < offset or hasher.hexdigest() != state.get("sha256"):
+            f.close()
+            returnValue(None)
+        f.truncate(offset)
+        self._resume_offset = offset
+        self._hasher = hasher
+        self._msg(u"Found %s from an earlier attempt" % naturalsize(offset))
+        returnValue(f)
+
+    def _checkpoint(self, f, received):
+        # note how much of the .tmp file is good, for the next attempt
+        if not self._resume_path:
+            return
+        f.flush()
+        state = {"filesize": self.xfersize,
+                 "offset": received,
+                 "sha256": self._hasher.hexdigest()}
+        tmp_path = self._resume_path + ".new"
+        with open(tmp_path, "w") as sf:
+            json.dump(state, sf)
+        if os.path.exists(self._resume_path):
+            os.remove(self._resume_path) # windows can't rename over it
+        os.rename(tmp_path, self._resume_path)
 
     def _handle_directory(self, them_d):
         file_data = them_d["directory"]
@@ -345,7 +410,11 @@ class Receiver:
             t.detail(answer="yes")
 
     def _send_permission(self, w):
-        self._send_data({"answer": { "file_ack": "ok" }}, w)
+        answer = {"file_ack": "ok"}
+        if self._resume_offset:
+            answer["resume"] = {"offset": self._resume_offset,
+                                "sha256": self._hasher.hexdigest()}
+        self._send_data({"answer": answer}, w)
 
     @inlineCallbacks
     def _establish_transit(self):
@@ -354,34 +423,70 @@ class Receiver:
         returnValue(record_pipe)
 
     @inlineCallbacks
-    def _transfer_data(self, record_pipe, f):
+    def _transfer_data(self, record_pipe, f, fsync=None):
         # now receive the rest of the owl
         self._msg(u"Receiving (%s).." % record_pipe.describe())
 
+        if self._resume_offset:
+            header = bytes_to_dict((yield record_pipe.receive_record()))
+            if header.get("resume-offset") != self._resume_offset:
+                # they didn't like our partial file, so start over
+                f.seek(0)
+                f.truncate()
+                self._resume_offset = 0
+                self._hasher = hashlib.sha256()
+            else:
+                self._msg(u"Resuming after %s" %
+                          naturalsize(self._resume_offset))
+        offset = self._resume_offset
+        expected = self.xfersize - offset
+
         with self.args.timing.add("rx file"):
             progress = tqdm(file=self.args.stderr,
                             disable=self.args.hide_progress,
-                            unit="B", unit_scale=True, total=self.xfersize)
-            hasher = hashlib.sha256()
+                            unit="B", unit_scale=True, total=self.xfersize,
+                            initial=offset)
+            hasher = self._hasher
+            counts = {"received": offset, "checkpointed": offset}
+            def _hash_and_checkpoint(data):
+                hasher.update(data)
+                counts["received"] += len(data)
+                if (counts["received"] - counts["checkpointed"]
+                    >= CHECKPOINT_BYTES):
+                    self._checkpoint(f, counts["received"])
+                    counts["checkpointed"] = counts["received"]
             with progress:
-                received = yield record_pipe.writeToFile(f, self.xfersize,
-                                                         progress.update,
-                                                         hasher.update)
+                decompressor = self._transit_receiver.get_decompressor()
+                try:
+                    received = yield record_pipe.writeToFile(
+                        f, expected, progress.update, _hash_and_checkpoint,
+                        decompressor, threaded=True, fsync=fsync)
+                except Exception:
+                    self._checkpoint(f, counts["received"])
+                    if self._resume_path:
+                        self._msg()
+                        self._msg(u"Kept %s of partial data: receive again"
+                                  u" to resume" %
+                                  naturalsize(counts["received"]))
+                    raise
             datahash = hasher.digest()
 
         # except TransitError
-        if received < self.xfersize:
+        if received < expected:
             self._msg()
             self._msg(u"Connection dropped before full file received")
-            self._msg(u"got %d bytes, wanted %d" % (received, self.xfersize))
+            self._msg(u"got %d bytes, wanted %d" % (offset + received,
+                                                    self.xfersize))
             raise TransferError("Connection dropped before full file received")
-        assert received == self.xfersize
+        assert received == expected
         returnValue(datahash)
 
     def _write_file(self, f):
         tmp_name = f.name
         f.close()
         os.rename(tmp_name, self.abs_destname)
+        if self._resume_path and os.path.exists(self._resume_path):
+            os.remove(self._resume_path)
         self._msg(u"Received file written to %s" %
                   os.path.basename(self.abs_destname))
 
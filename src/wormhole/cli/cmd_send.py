@@ -3,13 +3,13 @@ import os, sys, six, tempfile, zipfile, hashlib
 from tqdm import tqdm
 from humanize import naturalsize
 from twisted.python import log
-from twisted.protocols import basic
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.internet.defer import inlineCallbacks, returnValue
 from ..errors import TransferError, UnsendableFileError
 from wormhole import create, __version__
-from ..transit import TransitSender
-from ..util import dict_to_bytes, bytes_to_dict, bytes_to_hexstr
+from ..transit import TransitSender, CompressingConsumer, FileProducer
+from ..util import (dict_to_bytes, bytes_to_dict, bytes_to_hexstr,
+                    hash_file_prefix)
 from .welcome import handle_welcome
 
 APPID = u"lothar.com/wormhole/text-or-file-xfer"
@@ -53,7 +53,8 @@ class Sender:
         w = create(self._args.appid or APPID, self._args.relay_url,
                    self._reactor,
                    tor=self._tor,
-                   timing=self._timing)
+                   timing=self._timing,
+                   websocket_deflate=self._args.websocket_deflate)
         d = self._go(w)
 
         # if we succeed, we should close and return the w.close results
@@ -150,7 +151,8 @@ class Sender:
                                no_listen=(not args.listen),
                                tor=self._tor,
                                reactor=self._reactor,
-                               timing=self._timing)
+                               timing=self._timing,
+                               crypto_threads=args.crypto_threads)
             self._transit_sender = ts
 
             # for now, send this before the main offer
@@ -207,6 +209,7 @@ class Sender:
 
     def _handle_transit(self, receiver_transit):
         ts = self._transit_sender
+        ts.add_connection_abilities(receiver_transit.get("abilities-v1", []))
         ts.add_connection_hints(receiver_transit.get("hints-v1", []))
 
     def _build_offer(self):
@@ -282,6 +285,8 @@ class Sender:
             offer["file"] = {
                 "filename": basename,
                 "filesize": filesize,
+                # we can pick up where an earlier attempt left off
+                "resumable": True,
                 }
             print(u"Sending %s file named '%s'"
                   % (naturalsize(filesize), basename),
@@ -347,38 +352,78 @@ class Sender:
             raise TransferError("ambiguous response from remote, "
                                 "transfer abandoned: %s" % (them_answer,))
 
-        yield self._send_file()
+        yield self._send_file(them_answer.get("resume"))
+
+    @inlineCallbacks
+    def _check_resume(self, resume, filesize):
+        # The receiver kept part of the file from an earlier attempt, and
+        # told us how much it has, and its hash. If our file starts the same
+        # way, we can skip that part. Fires with (offset, hasher), where the
+        # hasher has already seen everything before the offset.
+        offset = resume.get("offset") if isinstance(resume, dict) else None
+        if (not isinstance(offset, six.integer_types)
+            or not 0 < offset <= filesize):
+            returnValue((0, hashlib.sha256()))
+        # that part might be many GB: hash it off the reactor thread, so the
+        # wormhole connection stays alive meanwhile
+        hasher = hashlib.sha256()
+        self._fd_to_send.seek(0, 0)
+        got = yield threads.deferToThreadPool(self._reactor,
+                                              self._reactor.getThreadPool(),
+                                              hash_file_prefix,
+                                              self._fd_to_send, offset, hasher)
+        if got < offset or hasher.hexdigest() != resume.get("sha256"):
+            print(u"Receiver's partial file doesn't match, sending all of it",
+                  file=self._args.stderr)
+            returnValue((0, hashlib.sha256()))
+        returnValue((offset, hasher))
 
 
     @inlineCallbacks
-    def _send_file(self):
+    def _send_file(self, resume=None):
         ts = self._transit_sender
 
         self._fd_to_send.seek(0,2)
         filesize = self._fd_to_send.tell()
-        self._fd_to_send.seek(0,0)
+        offset, hasher = yield self._check_resume(resume, filesize)
+        self._fd_to_send.seek(offset,0)
 
         record_pipe = yield ts.connect()
         self._timing.add("transit connected")
         # record_pipe should implement IConsumer, chunks are just records
         stderr = self._args.stderr
         print(u"Sending (%s).." % record_pipe.describe(), file=stderr)
+        if resume is not None:
+            # they asked to resume, so the first record says where we start
+            # (which is 0 if we couldn't use their partial file)
+            record_pipe.send_record(dict_to_bytes({"resume-offset": offset}))
+            if offset:
+                print(u"Resuming after %s" % naturalsize(offset), file=stderr)
 
-        hasher = hashlib.sha256()
         progress = tqdm(file=stderr, disable=self._args.hide_progress,
                         unit="B", unit_scale=True,
-                        total=filesize)
+                        total=filesize, initial=offset)
         def _count_and_hash(data):
             hasher.update(data)
             progress.update(len(data))
             return data
-        fs = basic.FileSender()
+        # fill each record up to the size our peer agreed to accept. A
+        # directory's zipfile is spooled in memory (it has no max_size, so it
+        # never rolls over), and must not be asked for a fileno() to map.
+        spooled = isinstance(self._fd_to_send, tempfile.SpooledTemporaryFile)
+        fs = FileProducer(self._fd_to_send, ts.get_record_size(), offset,
+                          mappable=not spooled, reactor=self._reactor)
+
+        consumer = record_pipe
+        compressor = ts.get_compressor()
+        if compressor:
+            consumer = CompressingConsumer(record_pipe, compressor)
 
         with self._timing.add("tx file"):
             with progress:
-                if filesize:
+                if filesize > offset:
                     # don't send zero-length files
-                    yield fs.beginFileTransfer(self._fd_to_send, record_pipe,
+                    yield fs.beginFileTransfer(consumer,
                                                transform=_count_and_hash)
 
         expected_hash = hasher.digest()
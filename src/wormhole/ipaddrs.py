@@ -1,30 +1,148 @@
 # no unicode_literals
 # Find all of our ip addresses. From tahoe's src/allmydata/util/iputil.py
 
-import os, re, subprocess, errno
+import os, re, subprocess, errno, socket, struct, time
 from sys import platform
 from twisted.python.procutils import which
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+# Where we can, we ask the kernel directly, with getifaddrs(3) (which glibc
+# implements with netlink). That takes a few microseconds, and works in
+# minimal containers that don't have /bin/ip. Elsewhere (Windows), or if it
+# fails, we fall back to running one of the tools below and parsing its
+# output, which costs a fork and tens of milliseconds. Either way, the answer
+# is cached for CACHE_SECONDS.
+
+CACHE_SECONDS = 30
+_cache = {} # "when", "addresses"
 
 # Wow, I'm really amazed at home much mileage we've gotten out of calling
 # the external route.exe program on windows...  It appears to work on all
 # versions so far.  Still, the real system calls would much be preferred...
 # ... thus wrote Greg Smith in time immemorial...
 _win32_re = re.compile(r'^\s*\d+\.\d+\.\d+\.\d+\s.+\s(?P<address>\d+\.\d+\.\d+\.\d+)\s+(?P<metric>\d+)\s*$', flags=re.M|re.I|re.S)
-_win32_commands = (('route.exe', ('print',), _win32_re),)
+_win32_commands = (('route.exe', ('print',), (_win32_re,)),)
 
 # These work in most Unices.
 _addr_re = re.compile(r'^\s*inet [a-zA-Z]*:?(?P<address>\d+\.\d+\.\d+\.\d+)[\s/].+$', flags=re.M|re.I|re.S)
-_unix_commands = (('/bin/ip', ('addr',), _addr_re),
-                  ('/sbin/ip', ('addr',), _addr_re),
-                  ('/sbin/ifconfig', ('-a',), _addr_re),
-                  ('/usr/sbin/ifconfig', ('-a',), _addr_re),
-                  ('/usr/etc/ifconfig', ('-a',), _addr_re),
-                  ('ifconfig', ('-a',), _addr_re),
-                  ('/sbin/ifconfig', (), _addr_re),
+# "inet6 2001:db8::1/64" (ip), "inet6 addr: 2001:db8::1/64" (old ifconfig),
+# "inet6 2001:db8::1 prefixlen 64" (new ifconfig), "inet6 fe80::1%lo0" (BSD)
+_addr6_re = re.compile(r'^\s*inet6 (?:addr:\s*)?(?P<address>[0-9a-f]*:[0-9a-f:]*)(?:%\S+)?[\s/].+$', flags=re.M|re.I|re.S)
+_both_re = (_addr_re, _addr6_re)
+_unix_commands = (('/bin/ip', ('addr',), _both_re),
+                  ('/sbin/ip', ('addr',), _both_re),
+                  ('/sbin/ifconfig', ('-a',), _both_re),
+                  ('/usr/sbin/ifconfig', ('-a',), _both_re),
+                  ('/usr/etc/ifconfig', ('-a',), _both_re),
+                  ('ifconfig', ('-a',), _both_re),
+                  ('/sbin/ifconfig', (), _both_re),
                  )
 
+# IPv6 link-local addresses (fe80::/10) are useless to anybody who doesn't
+# also know which of our interfaces they belong to
+_link_local_re = re.compile(r'^fe[89ab][0-9a-f]?:', flags=re.I)
+
 
 def find_addresses():
+    now = time.time()
+    if _cache and 0 <= now - _cache["when"] < CACHE_SECONDS:
+        return list(_cache["addresses"])
+    addresses = None
+    try:
+        addresses = _find_addresses_natively()
+    except Exception:
+        pass
+    if not addresses:
+        addresses = _find_addresses_with_tools()
+    _cache["when"] = now
+    _cache["addresses"] = addresses
+    return list(addresses)
+
+def _usable(addr):
+    return not _link_local_re.match(addr)
+
+IFF_UP = 0x1
+
+if ctypes is not None:
+    class _ifaddrs(ctypes.Structure):
+        pass
+    # the same layout on Linux and the BSDs (including OS-X)
+    _ifaddrs._fields_ = [("ifa_next", ctypes.POINTER(_ifaddrs)),
+                         ("ifa_name", ctypes.c_char_p),
+                         ("ifa_flags", ctypes.c_uint),
+                         ("ifa_addr", ctypes.c_void_p),
+                         ("ifa_netmask", ctypes.c_void_p),
+                         ("ifa_ifu", ctypes.c_void_p),
+                         ("ifa_data", ctypes.c_void_p),
+                         ]
+
+_libc = []
+
+def _get_libc():
+    if not _libc:
+        # CDLL(None) is the running program, which includes libc. Using
+        # ctypes.util.find_library() instead would spawn a subprocess.
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.getifaddrs.argtypes = [ctypes.POINTER(ctypes.POINTER(_ifaddrs))]
+        libc.getifaddrs.restype = ctypes.c_int
+        libc.freeifaddrs.argtypes = [ctypes.POINTER(_ifaddrs)]
+        libc.freeifaddrs.restype = None
+        _libc.append(libc)
+    return _libc[0]
+
+# a BSD sockaddr starts with a one-byte sa_len, then a one-byte sa_family,
+# while Linux (and most others) use a two-byte sa_family
+_bsd_sockaddr = platform.startswith(("darwin", "freebsd", "openbsd",
+                                     "netbsd", "dragonfly"))
+
+def _sa_family(sockaddr):
+    if _bsd_sockaddr:
+        return ord(ctypes.string_at(sockaddr + 1, 1))
+    return struct.unpack("=H", ctypes.string_at(sockaddr, 2))[0]
+
+def _getifaddrs():
+    """Return (flags, address) for each IPv4 and IPv6 address on this host,
+    or raise OSError/AttributeError if getifaddrs() is unavailable."""
+    if ctypes is None or platform == "win32":
+        raise OSError("no getifaddrs() here")
+    libc = _get_libc()
+    ifap = ctypes.POINTER(_ifaddrs)()
+    if libc.getifaddrs(ctypes.byref(ifap)) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    found = []
+    try:
+        p = ifap
+        while p:
+            ifa = p.contents
+            p = ifa.ifa_next
+            if not ifa.ifa_addr:
+                continue
+            family = _sa_family(ifa.ifa_addr)
+            if family == socket.AF_INET:
+                # sockaddr_in: family, port, then the address
+                packed = ctypes.string_at(ifa.ifa_addr + 4, 4)
+            elif family == socket.AF_INET6:
+                # sockaddr_in6: family, port, flowinfo, then the address
+                packed = ctypes.string_at(ifa.ifa_addr + 8, 16)
+            else:
+                continue # link-layer addresses, and the like
+            found.append((ifa.ifa_flags, socket.inet_ntop(family, packed)))
+    finally:
+        libc.freeifaddrs(ifap)
+    return found
+
+def _find_addresses_natively():
+    addresses = []
+    for flags, addr in _getifaddrs():
+        if flags & IFF_UP and _usable(addr) and addr not in addresses:
+            addresses.append(addr)
+    return addresses
+
+def _find_addresses_with_tools():
     # originally by Greg Smith, hacked by Zooko and then Daira
 
     # We don't reach here for cygwin.
@@ -33,11 +151,11 @@ def find_addresses():
     else:
         commands = _unix_commands
 
-    for (pathtotool, args, regex) in commands:
+    for (pathtotool, args, regexes) in commands:
         # If pathtotool is a fully qualified path then we just try that.
         # If it is merely an executable name then we use Twisted's
         # "which()" utility and try each executable in turn until one
-        # gives us something that resembles a dotted-quad IPv4 address.
+        # gives us something that resembles an IPv4 or IPv6 address.
 
         if os.path.isabs(pathtotool):
             exes_to_try = [pathtotool]
@@ -46,7 +164,7 @@ def find_addresses():
 
         for exe in exes_to_try:
             try:
-                addresses = _query(exe, args, regex)
+                addresses = _query(exe, args, regexes)
             except Exception:
                 addresses = []
             if addresses:
@@ -54,7 +172,7 @@ def find_addresses():
 
     return ["127.0.0.1"]
 
-def _query(path, args, regex):
+def _query(path, args, regexes):
     env = {'LANG': 'en_US.UTF-8'}
     trial = 0
     while True:
@@ -75,10 +193,13 @@ def _query(path, args, regex):
     addresses = []
     outputsplit = output.split('\n')
     for outline in outputsplit:
-        m = regex.match(outline)
-        if m:
-            addr = m.group('address')
-            if addr not in addresses:
-                addresses.append(addr)
+        for regex in regexes:
+            m = regex.match(outline)
+            if m:
+                addr = m.group('address')
+                if not _usable(addr):
+                    continue
+                if addr not in addresses:
+                    addresses.append(addr)
 
     return addresses
@@ -34,13 +34,31 @@ def _validate_websocket_protocol_option(option):
     except:
         raise click.BadParameter("could not parse JSON value for {}".format(key))
 
+    if key == "permessage_deflate":
+        from .._deflate import parse_options
+        try:
+            parse_options(value)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
     return (key, value)
 
+def _validate_rendezvous_state(ctx, param, value):
+    from .storage import get_backend
+    try:
+        get_backend(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    return value
+
 LaunchArgs = _compose(
     click.option(
         "--rendezvous", default="tcp:4000", metavar="tcp:PORT",
         help="endpoint specification for the rendezvous port",
     ),
+    click.option(
+        "--transit", default=None, metavar="tcp:PORT",
+        help="endpoint specification for the transit relay port (if any)",
+    ),
     click.option(
         "--advertise-version", metavar="VERSION",
         help="version to recommend to clients",
@@ -66,6 +84,39 @@ LaunchArgs = _compose(
         "--relay-database-path", default="relay.sqlite", metavar="PATH",
         help="location for the relay server state database",
     ),
+    click.option(
+        "--rendezvous-state", default="sqlite", metavar="URL",
+        callback=_validate_rendezvous_state,
+        help=("where to keep nameplates, mailboxes, and messages: 'sqlite'"
+              " (in the relay database), 'memory' (faster, but forgets them"
+              " on restart), or the URL of a storage plugin (usage records"
+              " are always stored in the relay database)"),
+    ),
+    click.option(
+        "--db-journal-mode", default=None,
+        type=click.Choice(["delete", "truncate", "persist", "wal"]),
+        help=("SQLite journal mode for the relay database ('wal' makes"
+              " commits much cheaper); by default, leave it alone"),
+    ),
+    click.option(
+        "--db-synchronous", default=None,
+        type=click.Choice(["off", "normal", "full", "extra"]),
+        help=("SQLite 'synchronous' setting for the relay database ('normal'"
+              " is safe with 'wal'); by default, leave it alone"),
+    ),
+    click.option(
+        "--db-commit-window", default=0.0, type=float, metavar="SECONDS",
+        help=("group the database commits of all rendezvous commands within"
+              " this many seconds into one (default 0: commit each one"
+              " right away)"),
+    ),
+    click.option(
+        "--workers", default=1, type=int, metavar="N",
+        help=("run the rendezvous server as N processes sharing the port"
+              " (requires --rendezvous-state=memory and SO_REUSEPORT). Each"
+              " app-id is served by one of them, so this only helps servers"
+              " with many app-ids"),
+    ),
     click.option(
         "--stats-json-path", default="stats.json", metavar="PATH",
         help="location to write the relay stats file",
@@ -73,7 +124,8 @@ LaunchArgs = _compose(
     click.option(
         "--websocket-protocol-option", multiple=True, metavar="OPTION=VALUE",
         callback=_validate_websocket_protocol_options,
-        help="a websocket server protocol option to configure",
+        help=("a websocket server protocol option to configure"
+              " (permessage_deflate=true enables compression)"),
     ),
 )
 
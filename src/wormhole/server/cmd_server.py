@@ -21,6 +21,13 @@ class MyPlugin(object):
             signal_error=self.args.signal_error,
             stats_file=self.args.stats_json_path,
             allow_list=self.args.allow_list,
+            transit_port=(str(self.args.transit) if self.args.transit
+                          else None),
+            rendezvous_state=self.args.rendezvous_state,
+            db_journal_mode=self.args.db_journal_mode,
+            db_synchronous=self.args.db_synchronous,
+            db_commit_window=self.args.db_commit_window,
+            workers=self.args.workers,
         )
 
 class MyTwistdConfig(twistd.ServerOptions):
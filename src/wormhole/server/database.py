@@ -1,9 +1,13 @@
 from __future__ import unicode_literals
 import os
+import time
 import sqlite3
 import tempfile
 from pkg_resources import resource_string
 from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+from twisted.internet import defer, threads, reactor
+from twisted.application import service
 
 class DBError(Exception):
     pass
@@ -18,7 +22,11 @@ def get_upgrader(new_version):
                                    "db-schemas/upgrade-to-v%d.sql" % new_version)
     return schema_bytes.decode("utf-8")
 
-TARGET_VERSION = 3
+TARGET_VERSION = 5
+
+# the values accepted by get_db(journal_mode=, synchronous=)
+JOURNAL_MODES = ("delete", "truncate", "persist", "wal")
+SYNCHRONOUS_MODES = ("off", "normal", "full", "extra")
 
 def dict_factory(cursor, row):
     d = {}
@@ -46,11 +54,11 @@ def _initialize_db_connection(db):
     if problems:
         raise DBError("failed foreign key check: %s" % (problems,))
 
-def _open_db_connection(dbfile):
+def _open_db_connection(dbfile, check_same_thread=True):
     """Open a new connection to the SQLite3 database at the given path.
     """
     try:
-        db = sqlite3.connect(dbfile)
+        db = sqlite3.connect(dbfile, check_same_thread=check_same_thread)
     except (EnvironmentError, sqlite3.OperationalError) as e:
         raise DBError("Unable to create/open db file %s: %s" % (dbfile, e))
     _initialize_db_connection(db)
@@ -66,7 +74,8 @@ def _get_temporary_dbfile(dbfile):
     os.close(fd)
     return name
 
-def _atomic_create_and_initialize_db(dbfile, target_version):
+def _atomic_create_and_initialize_db(dbfile, target_version,
+                                     check_same_thread):
     """Create and return a new database, initialized with the application
     schema.
 
@@ -77,19 +86,43 @@ def _atomic_create_and_initialize_db(dbfile, target_version):
     _initialize_db_schema(db, target_version)
     db.close()
     os.rename(temp_dbfile, dbfile)
-    return _open_db_connection(dbfile)
+    return _open_db_connection(dbfile, check_same_thread)
+
+def _set_durability(db, journal_mode, synchronous):
+    if journal_mode is not None:
+        if journal_mode not in JOURNAL_MODES:
+            raise DBError("unknown journal mode %r" % (journal_mode,))
+        # this returns the new mode, which is "memory" for :memory: dbs
+        row = db.execute("PRAGMA journal_mode=%s" % journal_mode).fetchone()
+        log.msg("db journal_mode is %s" % row["journal_mode"])
+    if synchronous is not None:
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise DBError("unknown synchronous mode %r" % (synchronous,))
+        db.execute("PRAGMA synchronous=%s" % synchronous)
 
-def get_db(dbfile, target_version=TARGET_VERSION):
+def get_db(dbfile, target_version=TARGET_VERSION, check_same_thread=True,
+           journal_mode=None, synchronous=None):
     """Open or create the given db file. The parent directory must exist.
     Returns the db connection object, or raises DBError.
+
+    Pass check_same_thread=False if the connection will be handed to a
+    UsageWriter or DBThread, which use it from a background thread.
+
+    journal_mode (one of JOURNAL_MODES) and synchronous (one of
+    SYNCHRONOUS_MODES) set the corresponding PRAGMAs, and are left at
+    SQLite's defaults (or, for the journal mode, whatever the file was last
+    set to) when None. 'wal' with 'normal' avoids most of the fsyncs that a
+    commit costs, at the risk of losing the last few commits (but not of
+    corrupting the file) if the machine crashes.
     """
     if dbfile == ":memory:":
-        db = _open_db_connection(dbfile)
+        db = _open_db_connection(dbfile, check_same_thread)
         _initialize_db_schema(db, target_version)
     elif os.path.exists(dbfile):
-        db = _open_db_connection(dbfile)
+        db = _open_db_connection(dbfile, check_same_thread)
     else:
-        db = _atomic_create_and_initialize_db(dbfile, target_version)
+        db = _atomic_create_and_initialize_db(dbfile, target_version,
+                                              check_same_thread)
 
     try:
         version = db.execute("SELECT version FROM version").fetchone()["version"]
@@ -114,8 +147,37 @@ def get_db(dbfile, target_version=TARGET_VERSION):
     if version != target_version:
         raise DBError("Unable to handle db version %s" % version)
 
+    _set_durability(db, journal_mode, synchronous)
     return db
 
+def count_usage(kind, result, amount=1):
+    """Return the (sql, values) statements that add 'amount' to one of the
+    usage_counts. Execute them in the same transaction as the usage record
+    they count, so the two can't disagree."""
+    return [("INSERT OR IGNORE INTO `usage_counts` (`kind`, `result`, `count`)"
+             " VALUES (?,?,0)", (kind, result)),
+            ("UPDATE `usage_counts` SET `count`=`count`+?"
+             " WHERE `kind`=? AND `result`=?", (amount, kind, result)),
+            ]
+
+def transit_usage(started, total_time, waiting_time, total_bytes, result):
+    """Return the (sql, values) statements that record (and count) one
+    transit relay connection."""
+    statements = [("INSERT INTO `transit_usage`"
+                   " (`started`, `total_time`, `waiting_time`,"
+                   "  `total_bytes`, `result`)"
+                   " VALUES (?,?,?, ?,?)",
+                   (started, total_time, waiting_time, total_bytes, result))]
+    statements.extend(count_usage("transit", result))
+    statements.extend(count_usage("transit_bytes", result, total_bytes))
+    return statements
+
+def get_usage_counts(db, kind):
+    """Return a dict of result -> count for the given kind of usage."""
+    c = db.execute("SELECT `result`, `count` FROM `usage_counts`"
+                   " WHERE `kind`=?", (kind,))
+    return dict([(row["result"], row["count"]) for row in c.fetchall()])
+
 def dump_db(db):
     # to let _iterdump work, we need to restore the original row factory
     orig = db.row_factory
@@ -124,3 +186,270 @@ def dump_db(db):
         return "".join(db.iterdump())
     finally:
         db.row_factory = orig
+
+
+class UsageWriter(service.Service):
+    """I append rows (usage records) to the database from a background
+    thread, so the reactor never waits for a commit, or for the fsync that
+    comes with it.
+
+    Rows are written in batches, one commit per batch: at most FLUSH_DELAY
+    seconds after they were added, or as soon as MAX_BATCH of them are
+    waiting. The db connection must have been opened with
+    check_same_thread=False. Rows that haven't been written yet are lost if
+    the process dies, which is a fine price for usage statistics.
+
+    The writer thread may be using the connection at any time, so anything
+    else that reads from it (like the all-time stats) must do so through
+    run(), which calls it in that thread, in between batches.
+    """
+    FLUSH_DELAY = 1.0
+    MAX_BATCH = 500
+
+    def __init__(self, db, threadpool=None, reactor=reactor):
+        self._db = db
+        self._reactor = reactor
+        self._own_pool = threadpool is None
+        if threadpool is None:
+            threadpool = ThreadPool(1, 1, "wormhole-usage-writer")
+        self._threadpool = threadpool
+        self._pending = [] # (sql, values)
+        self._timer = None
+        self._last_batch = defer.succeed(None)
+        self._stopped = False
+
+    def add(self, sql, values):
+        self.add_many([(sql, values)])
+
+    def add_many(self, statements):
+        """Queue several (sql, values) statements, which will be committed
+        together."""
+        self._pending.extend(statements)
+        if len(self._pending) >= self.MAX_BATCH:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self._reactor.callLater(self.FLUSH_DELAY,
+                                                  self.flush)
+
+    def flush(self):
+        """Start writing everything added so far. Returns a Deferred that
+        fires (with None) once it has all been committed."""
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            if self._own_pool and not self._threadpool.started:
+                self._threadpool.start()
+            done = defer.Deferred()
+            d = threads.deferToThreadPool(self._reactor, self._threadpool,
+                                          self._write, batch)
+            d.addErrback(log.err, "error writing usage records")
+            d.addBoth(lambda _: done.callback(None))
+            self._last_batch = done
+        # the pool has a single thread, so batches are written in order, and
+        # this one is done once the last one is
+        d = defer.Deferred()
+        def _fired(res):
+            d.callback(None)
+            return res
+        self._last_batch.addBoth(_fired)
+        return d
+
+    def _write(self, batch):
+        # runs in the writer thread
+        for (sql, values) in batch:
+            self._db.execute(sql, values)
+        self._db.commit()
+
+    def run(self, f, *args, **kwargs):
+        """Call f in the writer thread, and return a Deferred that fires (in
+        the reactor thread) with its result."""
+        if self._stopped:
+            # nobody is writing any more
+            return defer.maybeDeferred(f, *args, **kwargs)
+        if self._own_pool and not self._threadpool.started:
+            self._threadpool.start()
+        return threads.deferToThreadPool(self._reactor, self._threadpool,
+                                         f, *args, **kwargs)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        yield defer.maybeDeferred(service.Service.stopService, self)
+        try:
+            yield self.flush()
+        finally:
+            self._stopped = True
+            if self._own_pool and self._threadpool.started:
+                self._threadpool.stop()
+
+
+class DBThread(service.Service):
+    """I run functions that use the database on a single background thread,
+    one at a time, in the order they were submitted, so the reactor never
+    waits for sqlite (or the disk underneath it).
+
+    run() returns a Deferred that fires (in the reactor thread) with the
+    function's result, or its exception. Code running in the DB thread can
+    use call_in_reactor() to get back to the reactor: that is the only safe
+    way for it to send anything to a client. The db connection must have
+    been opened with check_same_thread=False, and once I am in use, all
+    other access to it (and to anything else that the functions touch)
+    should go through me too.
+    """
+
+    def __init__(self, db, threadpool=None, reactor=reactor):
+        self._db = db
+        self._reactor = reactor
+        self._own_pool = threadpool is None
+        if threadpool is None:
+            threadpool = ThreadPool(1, 1, "wormhole-db")
+        self._threadpool = threadpool
+        self._last = defer.succeed(None)
+        self._stopped = False
+
+    def run(self, f, *args, **kwargs):
+        if self._stopped:
+            # stragglers (like clients disconnecting as we shut down) can
+            # have the db to themselves now
+            return defer.maybeDeferred(f, *args, **kwargs)
+        if self._own_pool and not self._threadpool.started:
+            self._threadpool.start()
+        d = threads.deferToThreadPool(self._reactor, self._threadpool,
+                                      f, *args, **kwargs)
+        # remember when the queue will be empty, for stopService()
+        done = defer.Deferred()
+        d.addBoth(lambda res: (done.callback(None), res)[1])
+        self._last = done
+        return d
+
+    def call_in_reactor(self, f, *args, **kwargs):
+        self._reactor.callFromThread(f, *args, **kwargs)
+
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        yield defer.maybeDeferred(service.Service.stopService, self)
+        # the pool has a single thread, so everything that was queued is
+        # done once the last thing is (and that might queue more)
+        try:
+            while True:
+                last = self._last
+                yield last
+                if last is self._last:
+                    break
+        finally:
+            self._stopped = True
+            if self._own_pool and self._threadpool.started:
+                self._threadpool.stop()
+
+
+_SCHEDULED = object() # a GroupCommitDB timer that was set from a DBThread
+
+class GroupCommitDB(service.Service):
+    """I wrap a db connection, and turn each commit() into a request for a
+    commit that happens at most 'window' seconds later. Every request made
+    in the meantime (by any command from any client) shares that one real
+    commit, and its fsync. With window=0, commit() commits right away.
+
+    Reads on the same connection see uncommitted changes, so the rendezvous
+    code behaves the same either way, but other processes (like
+    'wormhole-server count-channels') see them a bit later, and a crash
+    loses the last window's worth of changes. Stopping the service commits
+    whatever is left.
+
+    get_stats() reports how many commits were requested and performed, how
+    many requests each real commit absorbed, and how long they took.
+
+    If the connection is used from a DBThread, pass it as 'thread': commit()
+    will then be called in that thread, so the timer is set through the
+    reactor, and the delayed commit is run back in the DB thread.
+    """
+
+    def __init__(self, db, window=0, reactor=reactor, thread=None):
+        self._db = db
+        self._window = window
+        self._reactor = reactor
+        self._thread = thread
+        self._timer = None
+        self._requested = 0 # commit() calls since the last real commit
+        self._commit_requests = 0
+        self._commits = 0
+        self._max_batch = 0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+        self._last_latency = None
+
+    def __getattr__(self, name):
+        # everything else (executescript, row_factory, close..) goes
+        # straight to the connection
+        return getattr(self._db, name)
+
+    def execute(self, *args):
+        return self._db.execute(*args)
+
+    def commit(self):
+        self._requested += 1
+        self._commit_requests += 1
+        if not self._window:
+            self.flush()
+        elif self._timer is None:
+            if self._thread:
+                # a flush that finds nothing to commit is harmless, so this
+                # timer is never cancelled
+                self._timer = _SCHEDULED
+                self._thread.call_in_reactor(self._reactor.callLater,
+                                             self._window,
+                                             self._scheduled_flush)
+            else:
+                self._timer = self._reactor.callLater(self._window,
+                                                      self.flush)
+
+    def flush(self):
+        """Commit now, if any commits have been requested."""
+        if self._timer is not None:
+            if self._timer is not _SCHEDULED and self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        if not self._requested:
+            return
+        batch, self._requested = self._requested, 0
+        start = time.time()
+        self._db.commit()
+        latency = time.time() - start
+        self._commits += 1
+        self._max_batch = max(self._max_batch, batch)
+        self._total_latency += latency
+        self._max_latency = max(self._max_latency, latency)
+        self._last_latency = latency
+
+    def _scheduled_flush(self):
+        # the timer fires in the reactor, but the commit belongs in the DB
+        # thread
+        d = self._thread.run(self.flush)
+        d.addErrback(log.err, "error committing")
+
+    def get_stats(self):
+        commits = self._commits
+        return {"window": self._window,
+                "commit_requests": self._commit_requests,
+                "commits": commits,
+                "pending": self._requested,
+                "batch_size": {
+                    "mean": (self._commit_requests - self._requested)
+                            / float(commits) if commits else None,
+                    "max": self._max_batch,
+                    },
+                "commit_latency": {
+                    "mean": self._total_latency / commits if commits else None,
+                    "max": self._max_latency,
+                    "last": self._last_latency,
+                    },
+                }
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._thread:
+            return self._thread.run(self.flush)
+        self.flush()
@@ -0,0 +1,26 @@
+CREATE TABLE `usage_counts`
+(
+ `kind` VARCHAR,
+ `result` VARCHAR,
+ `count` INTEGER,
+ PRIMARY KEY (`kind`, `result`)
+);
+
+INSERT INTO `usage_counts` (`kind`, `result`, `count`)
+ SELECT 'nameplate', `result`, COUNT() FROM `nameplate_usage`
+ GROUP BY `result`;
+INSERT INTO `usage_counts` (`kind`, `result`, `count`)
+ SELECT 'mailbox', `result`, COUNT() FROM `mailbox_usage`
+ GROUP BY `result`;
+INSERT INTO `usage_counts` (`kind`, `result`, `count`)
+ SELECT 'mailbox_standalone', `result`, COUNT() FROM `mailbox_usage`
+ WHERE `for_nameplate`=0 GROUP BY `result`;
+INSERT INTO `usage_counts` (`kind`, `result`, `count`)
+ SELECT 'transit', `result`, COUNT() FROM `transit_usage`
+ GROUP BY `result`;
+INSERT INTO `usage_counts` (`kind`, `result`, `count`)
+ SELECT 'transit_bytes', `result`, COALESCE(SUM(`total_bytes`), 0)
+ FROM `transit_usage` GROUP BY `result`;
+
+DELETE FROM `version`;
+INSERT INTO `version` (`version`) VALUES (4);
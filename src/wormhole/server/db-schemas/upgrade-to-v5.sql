@@ -0,0 +1,7 @@
+CREATE INDEX `nameplate_sides_idx` ON `nameplate_sides`
+ (`nameplates_id`, `side`);
+CREATE INDEX `mailbox_sides_idx` ON `mailbox_sides` (`mailbox_id`, `side`);
+CREATE INDEX `messages_mailbox_idx` ON `messages` (`mailbox_id`, `server_rx`);
+
+DELETE FROM `version`;
+INSERT INTO `version` (`version`) VALUES (5);
@@ -1,8 +1,13 @@
 from __future__ import print_function, unicode_literals
-import os, random, base64, collections
+import os, re, time, heapq, random, base64, collections
 from collections import namedtuple
 from twisted.python import log
+from twisted.internet import defer, task
 from twisted.application import service
+from zope.interface import implementer
+from .database import count_usage, get_usage_counts, transit_usage
+from .storage import (IMailbox, IAppNamespace, IRendezvousStorage,
+                      IUsageWriter)
 
 def generate_mailbox_id():
     return base64.b32encode(os.urandom(8)).lower().strip(b"=").decode("ascii")
@@ -20,6 +25,166 @@ TransitUsage = namedtuple("TransitUsage",
 SidedMessage = namedtuple("SidedMessage", ["side", "phase", "body",
                                            "server_rx", "msg_id"])
 
+class _FreeIds(object):
+    """I track which ids in range(lo, hi) are free, with O(1) pick, take,
+    and put.
+
+    Conceptually this is an array holding every id in the range, with the
+    free ones in slots [0, self.free) and the taken ones after them, so a
+    random free id is one randrange() away. The array is only stored where
+    it differs from the identity (slot i holds lo+i), and is forgotten
+    whenever every id is free again, so a range that is rarely used (like
+    the 6-digit one) costs nothing until it is needed.
+    """
+    def __init__(self, lo, hi):
+        self._lo = lo
+        self._size = hi - lo
+        self.free = self._size
+        self._slots = {} # slot -> id, where it isn't lo+slot
+        self._where = {} # id -> slot, likewise
+
+    def _get(self, slot):
+        return self._slots.get(slot, self._lo + slot)
+
+    def _set(self, slot, id_int):
+        if id_int == self._lo + slot:
+            self._slots.pop(slot, None)
+            self._where.pop(id_int, None)
+        else:
+            self._slots[slot] = id_int
+            self._where[id_int] = slot
+
+    def _swap(self, slot1, slot2):
+        id1, id2 = self._get(slot1), self._get(slot2)
+        self._set(slot1, id2)
+        self._set(slot2, id1)
+
+    def pick(self):
+        return self._get(random.randrange(self.free))
+
+    def take(self, id_int):
+        slot = self._where.get(id_int, id_int - self._lo)
+        if slot < self.free:
+            self.free -= 1
+            self._swap(slot, self.free)
+
+    def put(self, id_int):
+        slot = self._where.get(id_int, id_int - self._lo)
+        if slot >= self.free:
+            self._swap(slot, self.free)
+            self.free += 1
+            if self.free == self._size:
+                # any order will do, so go back to the one we needn't store
+                self._slots.clear()
+                self._where.clear()
+
+class NameplateAllocator(object):
+    """I hand out the shortest available numeric nameplate, chosen at random
+    among the free ones of that length, in constant time.
+
+    Only canonical numbers ("1" to "999999", no leading zeros) are tracked:
+    clients can claim any name they like, but other names can never collide
+    with the ones we allocate.
+    """
+    MAX_DIGITS = 6
+    _numeric = re.compile(r"^[1-9][0-9]*$")
+
+    def __init__(self, claimed=()):
+        self._sizes = [_FreeIds(10**(digits-1), 10**digits)
+                       for digits in range(1, self.MAX_DIGITS+1)]
+        for name in claimed:
+            self.claimed(name)
+
+    def _lookup(self, name):
+        if len(name) > self.MAX_DIGITS or not self._numeric.match(name):
+            return None
+        return self._sizes[len(name)-1]
+
+    def allocate(self):
+        """Return a free name. It remains free until claimed() is called."""
+        for size in self._sizes:
+            if size.free:
+                return "%d" % size.pick()
+        raise ValueError("unable to find a free nameplate-id")
+
+    def claimed(self, name):
+        size = self._lookup(name)
+        if size:
+            size.take(int(name))
+
+    def released(self, name):
+        size = self._lookup(name)
+        if size:
+            size.put(int(name))
+
+class ExpirationIndex(object):
+    """I remember when each mailbox was last updated, filed into buckets of
+    GRANULARITY seconds (a simple timer wheel). touch() and remove() are
+    O(1), and finding the mailboxes that were last updated before some time
+    only visits those, plus the keys of the one bucket that straddles the
+    cutoff."""
+    GRANULARITY = 60
+
+    def __init__(self):
+        self._updated = {} # key -> when
+        self._buckets = {} # bucket number -> set of keys
+        self._order = [] # heap of bucket numbers
+
+    def __len__(self):
+        return len(self._updated)
+
+    def _bucket(self, when):
+        return int(when // self.GRANULARITY)
+
+    def get(self, key):
+        return self._updated.get(key)
+
+    def touch(self, key, when):
+        old = self._updated.get(key)
+        self._updated[key] = when
+        bucket = self._bucket(when)
+        if old is not None:
+            old_bucket = self._bucket(old)
+            if old_bucket == bucket:
+                return
+            # empty buckets are cleaned up by expired()
+            self._buckets[old_bucket].discard(key)
+        if bucket not in self._buckets:
+            self._buckets[bucket] = set()
+            heapq.heappush(self._order, bucket)
+        self._buckets[bucket].add(key)
+
+    def remove(self, key):
+        when = self._updated.pop(key, None)
+        if when is not None:
+            self._buckets[self._bucket(when)].discard(key)
+
+    def expired(self, old, limit=None):
+        """Return (up to 'limit' of) the keys last updated at or before
+        'old', oldest buckets first. They stay in the index until the caller
+        touches or removes them."""
+        found = []
+        for bucket in self._iter_buckets():
+            if bucket * self.GRANULARITY > old:
+                break
+            for key in self._buckets[bucket]:
+                if self._updated[key] <= old:
+                    found.append(key)
+                    if limit is not None and len(found) >= limit:
+                        return found
+            if (bucket+1) * self.GRANULARITY > old:
+                break # this one straddles the cutoff, the rest are newer
+        return found
+
+    def _iter_buckets(self):
+        # bucket numbers in ascending order, dropping empty ones from the
+        # front of the heap as we go
+        while self._order and not self._buckets[self._order[0]]:
+            del self._buckets[heapq.heappop(self._order)]
+        for bucket in sorted(self._order):
+            yield bucket
+
+@implementer(IMailbox)
 class Mailbox:
     def __init__(self, app, db, app_id, mailbox_id):
         self._app = app
@@ -63,6 +228,7 @@ class Mailbox:
     def _touch(self, when):
         self._db.execute("UPDATE `mailboxes` SET `updated`=? WHERE `id`=?",
                          (when, self._mailbox_id))
+        self._app._mailbox_updated(self._mailbox_id, when)
 
     def get_messages(self):
         messages = []
@@ -71,8 +237,11 @@ class Mailbox:
                               " WHERE `app_id`=? AND `mailbox_id`=?"
                               " ORDER BY `server_rx` ASC",
                               (self._app_id, self._mailbox_id)).fetchall():
+            body = row["body"]
+            if not isinstance(body, (type(""), type(b""))):
+                body = bytes(body) # py2 reads BLOBs as buffers
             sm = SidedMessage(side=row["side"], phase=row["phase"],
-                              body=row["body"], server_rx=row["server_rx"],
+                              body=body, server_rx=row["server_rx"],
                               msg_id=row["msg_id"])
             messages.append(sm)
         return messages
@@ -85,7 +254,8 @@ class Mailbox:
 
     def remove_listener(self, handle):
         #log.msg("remove_listener", self._mailbox_id, handle)
-        self._listeners.pop(handle, None)
+        if self._listeners.pop(handle, None) and not self._listeners:
+            self._app._mailbox_unlistened(self)
         #log.msg(" removed", len(self._listeners))
 
     def has_listeners(self):
@@ -157,9 +327,12 @@ class Mailbox:
         # used at test shutdown to accelerate client disconnects
         for (send_f, stop_f) in self._listeners.values():
             stop_f()
-        self._listeners = {}
+        if self._listeners:
+            self._listeners = {}
+            self._app._mailbox_unlistened(self)
 
 
+@implementer(IAppNamespace)
 class AppNamespace(object):
 
     def __init__(self, db, blur_usage, log_requests, app_id, allow_list):
@@ -168,6 +341,9 @@ class AppNamespace(object):
         self._log_requests = log_requests
         self._app_id = app_id
         self._mailboxes = {}
+        self._allocator = None # built on first use
+        self._expiry = None # likewise
+        self._last_prune = None
         self._nameplate_counts = collections.defaultdict(int)
         self._mailbox_counts = collections.defaultdict(int)
         self._allow_list = allow_list
@@ -185,22 +361,19 @@ class AppNamespace(object):
         return set([row["name"] for row in c.fetchall()])
 
     def _find_available_nameplate_id(self):
-        claimed = self._get_nameplate_ids()
-        for size in range(1,4): # stick to 1-999 for now
-            available = set()
-            for id_int in range(10**(size-1), 10**size):
-                id = "%d" % id_int
-                if id not in claimed:
-                    available.add(id)
-            if available:
-                return random.choice(list(available))
-        # ouch, 999 currently claimed. Try random ones for a while.
-        for tries in range(1000):
-            id_int = random.randrange(1000, 1000*1000)
-            id = "%d" % id_int
-            if id not in claimed:
-                return id
-        raise ValueError("unable to find a free nameplate-id")
+        if self._allocator is None:
+            # nameplates may have survived a restart, so start from what is
+            # already stored, and then keep track as they come and go
+            self._allocator = NameplateAllocator(self._get_nameplate_ids())
+        return self._allocator.allocate()
+
+    def _nameplate_added(self, name):
+        if self._allocator is not None:
+            self._allocator.claimed(name)
+
+    def _nameplate_removed(self, name):
+        if self._allocator is not None:
+            self._allocator.released(name)
 
     def allocate_nameplate(self, side, when):
         nameplate_id = self._find_available_nameplate_id()
@@ -231,6 +404,7 @@ class AppNamespace(object):
                    " VALUES(?,?,?)")
             npid = db.execute(sql, (self._app_id, name, mailbox_id)
                               ).lastrowid
+            self._nameplate_added(name)
         else:
             npid = row["id"]
             mailbox_id = row["mailbox_id"]
@@ -295,18 +469,28 @@ class AppNamespace(object):
         db.execute("DELETE FROM `nameplate_sides` WHERE `nameplates_id`=?",
                    (npid,))
         db.execute("DELETE FROM `nameplates` WHERE `id`=?", (npid,))
+        self._nameplate_removed(name)
         self._summarize_nameplate_and_store(side_rows, when, pruned=False)
         db.commit()
 
-    def _summarize_nameplate_and_store(self, side_rows, delete_time, pruned):
+    def _commit(self):
+        self._db.commit()
+
+    def _record_usage(self, statements):
         # requires caller to db.commit()
+        for (sql, values) in statements:
+            self._db.execute(sql, values)
+
+    def _summarize_nameplate_and_store(self, side_rows, delete_time, pruned):
         u = self._summarize_nameplate_usage(side_rows, delete_time, pruned)
-        self._db.execute("INSERT INTO `nameplate_usage`"
-                         " (`app_id`,"
-                         " `started`, `total_time`, `waiting_time`, `result`)"
-                         " VALUES (?, ?,?,?,?)",
-                         (self._app_id,
-                          u.started, u.total_time, u.waiting_time, u.result))
+        statements = [("INSERT INTO `nameplate_usage`"
+                       " (`app_id`,"
+                       " `started`, `total_time`, `waiting_time`, `result`)"
+                       " VALUES (?, ?,?,?,?)",
+                       (self._app_id,
+                        u.started, u.total_time, u.waiting_time, u.result))]
+        statements.extend(count_usage("nameplate", u.result))
+        self._record_usage(statements)
         self._nameplate_counts[u.result] += 1
 
     def _summarize_nameplate_usage(self, side_rows, delete_time, pruned):
@@ -339,6 +523,7 @@ class AppNamespace(object):
                              " (`app_id`, `id`, `for_nameplate`, `updated`)"
                              " VALUES(?,?,?,?)",
                              (self._app_id, mailbox_id, for_nameplate, when))
+            self._mailbox_updated(mailbox_id, when)
             # we don't need a commit here, because mailbox.open() only
             # does SELECT FROM `mailbox_sides`, not from `mailboxes`
 
@@ -371,20 +556,25 @@ class AppNamespace(object):
 
         if mailbox_id in self._mailboxes:
             self._mailboxes.pop(mailbox_id)
+        if self._expiry is not None:
+            self._expiry.remove(mailbox_id)
         #if self._log_requests:
         #    log.msg("freed+killed #%s, now have %d DB mailboxes, %d live" %
         #            (mailbox_id, len(self.get_claimed()), len(self._mailboxes)))
 
     def _summarize_mailbox_and_store(self, for_nameplate, side_rows,
                                      delete_time, pruned):
-        db = self._db
         u = self._summarize_mailbox(side_rows, delete_time, pruned)
-        db.execute("INSERT INTO `mailbox_usage`"
-                   " (`app_id`, `for_nameplate`,"
-                   "  `started`, `total_time`, `waiting_time`, `result`)"
-                   " VALUES (?,?, ?,?,?,?)",
-                   (self._app_id, for_nameplate,
-                    u.started, u.total_time, u.waiting_time, u.result))
+        statements = [("INSERT INTO `mailbox_usage`"
+                       " (`app_id`, `for_nameplate`,"
+                       "  `started`, `total_time`, `waiting_time`, `result`)"
+                       " VALUES (?,?, ?,?,?,?)",
+                       (self._app_id, for_nameplate,
+                        u.started, u.total_time, u.waiting_time, u.result))]
+        statements.extend(count_usage("mailbox", u.result))
+        if not for_nameplate:
+            statements.extend(count_usage("mailbox_standalone", u.result))
+        self._record_usage(statements)
         self._mailbox_counts[u.result] += 1
 
     def _summarize_mailbox(self, side_rows, delete_time, pruned):
@@ -421,74 +611,93 @@ class AppNamespace(object):
         return Usage(started=started, waiting_time=waiting_time,
                      total_time=total_time, result=result)
 
-    def prune(self, now, old):
-        # The pruning check runs every 10 minutes, and "old" is defined to be
-        # 11 minutes ago (unit tests can use different values). The client is
-        # allowed to disconnect for up to 9 minutes without losing the
-        # channel (nameplate, mailbox, and messages).
-
-        # Each time a client does something, the mailbox.updated field is
-        # updated with the current timestamp. If a client is subscribed to
-        # the mailbox when pruning check runs, the "updated" field is also
-        # updated. After that check, if the "updated" field is "old", the
-        # channel is deleted.
-
-        # For now, pruning is logged even if log_requests is False, to debug
-        # the pruning process, and since pruning is triggered by a timer
-        # instead of by user action. It does reveal which mailboxes were
-        # present when the pruning process began, though, so in the log run
-        # it should do less logging.
-        log.msg(" prune begins (%s)" % self._app_id)
-        db = self._db
-        modified = False
+    def _get_mailbox_times(self):
+        c = self._db.execute("SELECT `id`, `updated` FROM `mailboxes`"
+                             " WHERE `app_id`=?", (self._app_id,))
+        return [(row["id"], row["updated"]) for row in c.fetchall()]
+
+    def _get_expiry(self):
+        if self._expiry is None:
+            # as with the allocator, start from whatever is stored, then
+            # follow along
+            self._expiry = ExpirationIndex()
+            for (mailbox_id, updated) in self._get_mailbox_times():
+                self._expiry.touch(mailbox_id, updated or 0)
+        return self._expiry
+
+    def _mailbox_updated(self, mailbox_id, when):
+        if self._expiry is not None:
+            self._expiry.touch(mailbox_id, when)
+
+    def _mailbox_unlistened(self, mailbox):
+        # A mailbox with listeners never expires. Its last listener has just
+        # gone, so give it a full CHANNEL_EXPIRATION_TIME from the last prune
+        # (which would have found it still listened-to), so a client that
+        # reconnects in time finds its channel intact.
+        if self._last_prune is None:
+            return
+        updated = self._get_expiry().get(mailbox._mailbox_id)
+        if updated is not None and updated < self._last_prune:
+            mailbox._touch(self._last_prune)
+            self._commit()
 
-        for mailbox in self._mailboxes.values():
-            if mailbox.has_listeners():
-                log.msg("touch %s because listeners" % mailbox._mailbox_id)
+    def prune(self, now, old):
+        """Delete every nameplate and mailbox that was last used at or before
+        'old', except for mailboxes that somebody is still listening to.
+        Returns the number of old mailboxes visited."""
+        return self.prune_some(now, old)
+
+    def prune_some(self, now, old, limit=None):
+        """Like prune(), but visit at most 'limit' mailboxes. Returns the
+        number visited: keep calling until it returns less than 'limit'.
+
+        The pruning check runs every 10 minutes, and "old" is defined to be
+        11 minutes ago (unit tests can use different values). Each time a
+        client does something, the mailbox.updated field is updated with the
+        current timestamp, which also moves it in the expiration index, so
+        only mailboxes that really are old get visited here. A mailbox that
+        is old but still has listeners is touched instead: that client is
+        allowed to disconnect for up to 9 minutes without losing the channel
+        (nameplate, mailbox, and messages).
+        """
+        self._last_prune = now
+        expired = self._get_expiry().expired(old, limit)
+        for mailbox_id in expired:
+            mailbox = self._mailboxes.get(mailbox_id)
+            if mailbox and mailbox.has_listeners():
+                if self._log_requests:
+                    log.msg("touch %s because listeners" % mailbox_id)
                 mailbox._touch(now)
-        db.commit() # make sure the updates are visible below
-
-        new_mailboxes = set()
-        old_mailboxes = set()
-        for row in db.execute("SELECT * FROM `mailboxes` WHERE `app_id`=?",
-                              (self._app_id,)).fetchall():
-            mailbox_id = row["id"]
-            log.msg("  1: age=%s, old=%s, %s" %
-                    (now - row["updated"], now - old, mailbox_id))
-            if row["updated"] > old:
-                new_mailboxes.add(mailbox_id)
             else:
-                old_mailboxes.add(mailbox_id)
-        log.msg(" 2: mailboxes:", new_mailboxes, old_mailboxes)
-
-        old_nameplates = set()
-        for row in db.execute("SELECT * FROM `nameplates` WHERE `app_id`=?",
-                              (self._app_id,)).fetchall():
+                self._prune_mailbox(mailbox_id, now)
+        if expired:
+            self._commit()
+        return len(expired)
+
+    def _prune_mailbox(self, mailbox_id, now):
+        # delete the mailbox, its messages, and any nameplate that points
+        # to it
+        db = self._db
+        for row in db.execute("SELECT * FROM `nameplates`"
+                              " WHERE `app_id`=? AND `mailbox_id`=?",
+                              (self._app_id, mailbox_id)).fetchall():
             npid = row["id"]
-            mailbox_id = row["mailbox_id"]
-            if mailbox_id in old_mailboxes:
-                old_nameplates.add(npid)
-        log.msg(" 3: old_nameplates dbids", old_nameplates)
-
-        for npid in old_nameplates:
-            log.msg("  deleting nameplate with dbid", npid)
+            if self._log_requests:
+                log.msg("  deleting nameplate with dbid", npid)
             side_rows = db.execute("SELECT * FROM `nameplate_sides`"
                                    " WHERE `nameplates_id`=?",
                                    (npid,)).fetchall()
             db.execute("DELETE FROM `nameplate_sides` WHERE `nameplates_id`=?",
                        (npid,))
             db.execute("DELETE FROM `nameplates` WHERE `id`=?", (npid,))
+            self._nameplate_removed(row["name"])
             self._summarize_nameplate_and_store(side_rows, now, pruned=True)
-            modified = True
 
-        # delete all messages for old mailboxes
-        # delete all old mailboxes
-
-        for mailbox_id in old_mailboxes:
+        if self._log_requests:
             log.msg("  deleting mailbox", mailbox_id)
-            row = db.execute("SELECT * FROM `mailboxes`"
-                             " WHERE `id`=?", (mailbox_id,)).fetchone()
-            for_nameplate = row["for_nameplate"]
+        row = db.execute("SELECT * FROM `mailboxes`"
+                         " WHERE `id`=?", (mailbox_id,)).fetchone()
+        if row:
             side_rows = db.execute("SELECT * FROM `mailbox_sides`"
                                    " WHERE `mailbox_id`=?",
                                    (mailbox_id,)).fetchall()
@@ -498,13 +707,9 @@ class AppNamespace(object):
                        (mailbox_id,))
             db.execute("DELETE FROM `mailboxes` WHERE `id`=?",
                        (mailbox_id,))
-            self._summarize_mailbox_and_store(for_nameplate, side_rows,
+            self._summarize_mailbox_and_store(row["for_nameplate"], side_rows,
                                               now, pruned=True)
-            modified = True
-
-        if modified:
-            db.commit()
-        log.msg("  prune complete, modified:", modified)
+        self.free_mailbox(mailbox_id)
 
     def get_counts(self):
         return (self._nameplate_counts, self._mailbox_counts)
@@ -514,23 +719,67 @@ class AppNamespace(object):
             channel._shutdown()
 
 
+@implementer(IRendezvousStorage, IUsageWriter)
 class Rendezvous(service.MultiService):
+    """I hold all the app namespaces. If 'db_thread' (a DBThread) is given,
+    everything that touches them or the database must happen in that
+    thread: use run() to get there, and call_in_reactor() to get back."""
 
-    def __init__(self, db, welcome, blur_usage, allow_list):
+    def __init__(self, db, welcome, blur_usage, allow_list, db_thread=None):
         service.MultiService.__init__(self)
         self._db = db
+        self._db_thread = db_thread
         self._welcome = welcome
         self._blur_usage = blur_usage
         log_requests = blur_usage is None
         self._log_requests = log_requests
         self._allow_list = allow_list
         self._apps = {}
+        self._prune_task = None
+        self._prune_stats = {"passes": 0, "mailboxes_visited": 0,
+                             "busy_seconds": 0.0, "max_slice_seconds": 0.0,
+                             "last": None}
 
     def get_welcome(self):
         return self._welcome
     def get_log_requests(self):
         return self._log_requests
 
+    def run(self, f, *args, **kwargs):
+        """Call f where the app namespaces may be used: in the DB thread if
+        we have one, otherwise right away. Returns a Deferred."""
+        if self._db_thread:
+            return self._db_thread.run(f, *args, **kwargs)
+        return defer.maybeDeferred(f, *args, **kwargs)
+
+    def call_in_reactor(self, f, *args, **kwargs):
+        """Call f in the reactor thread, from wherever run() ran us."""
+        if self._db_thread:
+            self._db_thread.call_in_reactor(f, *args, **kwargs)
+        else:
+            f(*args, **kwargs)
+
+    def get_usage_writer(self):
+        # usage records go into the same database as everything else, so
+        # they must be written in the same thread, and share its commits
+        return self
+
+    def record_transit_usage(self, started, total_time, waiting_time,
+                             total_bytes, result):
+        statements = transit_usage(started, total_time, waiting_time,
+                                   total_bytes, result)
+        d = self.run(self._write_usage, statements)
+        d.addErrback(log.err, "error writing usage records")
+
+    def get_usage_counts(self, kind):
+        return self.run(get_usage_counts, self._db, kind)
+
+    def _write_usage(self, statements):
+        # runs wherever run() runs us
+        for (sql, values) in statements:
+            self._db.execute(sql, values)
+        self._db.commit()
+
     def get_app(self, app_id):
         assert isinstance(app_id, type(""))
         if not app_id in self._apps:
@@ -558,33 +807,101 @@ class Rendezvous(service.MultiService):
             apps.add(row["app_id"])
         return apps
 
+    PRUNE_SLICE = 100 # mailboxes per reactor turn
+
     def prune_all_apps(self, now, old):
-        # As with AppNamespace.prune_old_mailboxes, we log for now.
-        log.msg("beginning app prune")
+        """Prune every app, all at once."""
+        for _ in self._prune(now, old, None):
+            pass
+
+    def prune_in_slices(self, now, old):
+        """Prune every app, PRUNE_SLICE mailboxes at a time, letting the
+        reactor run in between. Returns a Deferred that fires when done. If
+        the previous pass is still running, this does nothing."""
+        if self._prune_task is not None:
+            log.msg("previous prune still running, skipping this one")
+            return defer.succeed(None)
+        slices = self._prune(now, old, self.PRUNE_SLICE)
+        if self._db_thread:
+            slices = self._each_in_db_thread(slices)
+        self._prune_task = task.cooperate(slices)
+        d = self._prune_task.whenDone()
+        d.addErrback(lambda f: f.trap(task.TaskStopped))
+        def _done(res):
+            self._prune_task = None
+            return res
+        d.addBoth(_done)
+        return d
+
+    def _each_in_db_thread(self, iterator):
+        # advance the iterator one step at a time in the DB thread, so client
+        # commands can be run in between the steps
+        done = []
+        failed = []
+        def _step():
+            if next(iterator, done) is done:
+                done.append(True)
+        while not done:
+            d = self._db_thread.run(_step)
+            # raise any error from here, instead of from the Deferred: the
+            # cooperator can't cope with a failure after stop()
+            d.addErrback(failed.append)
+            yield d
+            if failed:
+                failed[0].raiseException()
+
+    def _prune(self, now, old, limit):
+        # yields between slices
+        began = time.time()
+        last = {"started": now, "apps": 0, "mailboxes_visited": 0,
+                "slices": 0, "busy_seconds": 0.0, "max_slice_seconds": 0.0}
         for app_id in sorted(self.get_all_apps()):
-            log.msg(" app prune checking %r" % (app_id,))
             app = self.get_app(app_id)
-            app.prune(now, old)
-        log.msg("app prune ends, %d apps" % len(self._apps))
+            last["apps"] += 1
+            while True:
+                start = time.time()
+                if limit is None:
+                    visited = app.prune(now, old)
+                else:
+                    visited = app.prune_some(now, old, limit)
+                took = time.time() - start
+                last["mailboxes_visited"] += visited
+                last["slices"] += 1
+                last["busy_seconds"] += took
+                last["max_slice_seconds"] = max(last["max_slice_seconds"],
+                                                took)
+                if limit is None or visited < limit:
+                    break
+                yield None
+        last["elapsed_seconds"] = time.time() - began
+        ps = self._prune_stats
+        ps["passes"] += 1
+        ps["mailboxes_visited"] += last["mailboxes_visited"]
+        ps["busy_seconds"] += last["busy_seconds"]
+        ps["max_slice_seconds"] = max(ps["max_slice_seconds"],
+                                      last["max_slice_seconds"])
+        ps["last"] = last
+        log.msg("prune: %d apps, %d old mailboxes, %d slices, busy %.3fs"
+                " (longest slice %.3fs)"
+                % (last["apps"], last["mailboxes_visited"], last["slices"],
+                   last["busy_seconds"], last["max_slice_seconds"]))
 
     def get_stats(self):
+        stats = self._get_current_stats()
+        stats["all_time"] = self._get_all_time_stats()
+        return stats
+
+    def collect_stats(self):
+        # everything we have lives where run() runs
+        return self.run(self.get_stats)
+
+    def _get_current_stats(self):
         stats = {}
 
         # current status: expected to be zero most of the time
         c = stats["active"] = {}
         c["apps"] = len(self.get_all_apps())
-        def q(query, values=()):
-            row = self._db.execute(query, values).fetchone()
-            return list(row.values())[0]
-        c["nameplates_total"] = q("SELECT COUNT() FROM `nameplates`")
-        # TODO: nameplates with only one side (most of them)
-        # TODO: nameplates with two sides (very fleeting)
-        # TODO: nameplates with three or more sides (crowded, unlikely)
-        c["mailboxes_total"] = q("SELECT COUNT() FROM `mailboxes`")
-        # TODO: mailboxes with only one side (most of them)
-        # TODO: mailboxes with two sides (somewhat fleeting, in-transit)
-        # TODO: mailboxes with three or more sides (unlikely)
-        c["messages_total"] = q("SELECT COUNT() FROM `messages`")
+        c.update(self._count_active())
 
         # usage since last reboot
         nameplate_counts = collections.defaultdict(int)
@@ -605,37 +922,28 @@ class Rendezvous(service.MultiService):
             urb["mailbox_moods"][result] = count
         urb["mailboxes_total"] = sum(mailbox_counts.values())
 
-        # historical usage (all-time)
-        u = stats["all_time"] = {}
+        # what pruning costs us
+        stats["prune"] = dict(self._prune_stats)
+
+        return stats
+
+    def _get_all_time_stats(self):
+        # historical usage (all-time), from the running totals, since
+        # counting the usage tables themselves gets slower every day
+        u = {}
+        counts = get_usage_counts(self._db, "nameplate")
         un = u["nameplate_moods"] = {}
-        # TODO: there's probably a single SQL query for all this
-        un["happy"] = q("SELECT COUNT() FROM `nameplate_usage`"
-                        " WHERE `result`='happy'")
-        un["lonely"] = q("SELECT COUNT() FROM `nameplate_usage`"
-                         " WHERE `result`='lonely'")
-        un["pruney"] = q("SELECT COUNT() FROM `nameplate_usage`"
-                         " WHERE `result`='pruney'")
-        un["crowded"] = q("SELECT COUNT() FROM `nameplate_usage`"
-                          " WHERE `result`='crowded'")
-        u["nameplates_total"] = q("SELECT COUNT() FROM `nameplate_usage`")
+        for result in ["happy", "lonely", "pruney", "crowded"]:
+            un[result] = counts.get(result, 0)
+        u["nameplates_total"] = sum(counts.values())
+        counts = get_usage_counts(self._db, "mailbox")
         um = u["mailbox_moods"] = {}
-        um["happy"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                        " WHERE `result`='happy'")
-        um["scary"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                        " WHERE `result`='scary'")
-        um["lonely"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                         " WHERE `result`='lonely'")
-        um["quiet"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                        " WHERE `result`='quiet'")
-        um["errory"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                         " WHERE `result`='errory'")
-        um["pruney"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                         " WHERE `result`='pruney'")
-        um["crowded"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                          " WHERE `result`='crowded'")
-        u["mailboxes_total"] = q("SELECT COUNT() FROM `mailbox_usage`")
-        u["mailboxes_standalone"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                                      " WHERE `for_nameplate`=0")
+        for result in ["happy", "scary", "lonely", "quiet", "errory", "pruney",
+                       "crowded"]:
+            um[result] = counts.get(result, 0)
+        u["mailboxes_total"] = sum(counts.values())
+        counts = get_usage_counts(self._db, "mailbox_standalone")
+        u["mailboxes_standalone"] = sum(counts.values())
 
         # recent timings (last 100 operations)
         # TODO: median/etc of nameplate.total_time
@@ -645,7 +953,23 @@ class Rendezvous(service.MultiService):
         # other
         # TODO: mailboxes without nameplates (needs new DB schema)
 
-        return stats
+        return u
+
+    def _count_active(self):
+        def q(query, values=()):
+            row = self._db.execute(query, values).fetchone()
+            return list(row.values())[0]
+        c = {}
+        c["nameplates_total"] = q("SELECT COUNT() FROM `nameplates`")
+        # TODO: nameplates with only one side (most of them)
+        # TODO: nameplates with two sides (very fleeting)
+        # TODO: nameplates with three or more sides (crowded, unlikely)
+        c["mailboxes_total"] = q("SELECT COUNT() FROM `mailboxes`")
+        # TODO: mailboxes with only one side (most of them)
+        # TODO: mailboxes with two sides (somewhat fleeting, in-transit)
+        # TODO: mailboxes with three or more sides (unlikely)
+        c["messages_total"] = q("SELECT COUNT() FROM `messages`")
+        return c
 
     def stopService(self):
         # This forcibly boots any clients that are still connected, which
@@ -654,6 +978,12 @@ class Rendezvous(service.MultiService):
         # stopService on the relay), but the other client (in its thread) is
         # still waiting for a message. By killing off all connections, that
         # other client gets an error, and exits promptly.
+        if self._prune_task is not None:
+            self._prune_task.stop()
+        d = self.run(self._shutdown_apps)
+        d.addCallback(lambda _: service.MultiService.stopService(self))
+        return d
+
+    def _shutdown_apps(self):
         for app in self._apps.values():
             app._shutdown()
-        return service.MultiService.stopService(self)
@@ -0,0 +1,256 @@
+from __future__ import print_function, unicode_literals
+from collections import OrderedDict
+from twisted.python import log
+from .database import UsageWriter, get_usage_counts, transit_usage
+from .rendezvous import (Mailbox, AppNamespace, Rendezvous, CrowdedError,
+                         ReclaimedError, generate_mailbox_id)
+
+# Nameplates, mailboxes, and messages only live for a few minutes (they're
+# pruned after 11 minutes of inactivity), so there's little point in
+# committing every change to them to disk. These classes keep that state in
+# python dictionaries instead, which makes each protocol command a handful of
+# dict operations. Only the usage summaries, which are written when a
+# nameplate or mailbox goes away, are stored in the database, and those go
+# through a UsageWriter. The cost is that a server restart forgets all
+# in-flight channels, and 'wormhole-server count-channels' (which reads the
+# database) can't see them.
+
+class MemoryMailbox(Mailbox):
+    def __init__(self, app, app_id, mailbox_id, for_nameplate, when):
+        Mailbox.__init__(self, app, None, app_id, mailbox_id)
+        self._for_nameplate = for_nameplate
+        self._updated = when
+        self._sides = OrderedDict() # side -> {opened, added, mood}
+        self._messages = []
+        self._deleted = False
+
+    def open(self, side, when):
+        assert isinstance(side, type("")), type(side)
+        if side not in self._sides:
+            self._sides[side] = {"side": side, "opened": True, "added": when,
+                                 "mood": None}
+        # as with the database version, re-opening a mailbox which a side
+        # previously closed does not mark it as opened again
+        self._touch(when)
+
+    def _touch(self, when):
+        self._updated = when
+        self._app._mailbox_updated(self._mailbox_id, when)
+
+    def get_messages(self):
+        return sorted(self._messages, key=lambda sm: sm.server_rx)
+
+    def _add_message(self, sm):
+        self._messages.append(sm)
+        self._touch(sm.server_rx)
+
+    def close(self, side, mood, when):
+        assert isinstance(side, type("")), type(side)
+        if self._deleted:
+            return
+        row = self._sides.get(side)
+        if not row:
+            return
+        row["opened"] = False
+        row["mood"] = mood
+
+        # are any sides still open?
+        if any([sr["opened"] for sr in self._sides.values()]):
+            return
+
+        # nope. delete and summarize
+        self._deleted = True
+        self._app._summarize_mailbox_and_store(self._for_nameplate,
+                                               list(self._sides.values()),
+                                               when, pruned=False)
+        # Shut down any listeners, just in case they're still lingering
+        # around.
+        for (send_f, stop_f) in self._listeners.values():
+            stop_f()
+        self._listeners = {}
+        self._app.free_mailbox(self._mailbox_id)
+
+
+class MemoryAppNamespace(AppNamespace):
+
+    def __init__(self, usage, blur_usage, log_requests, app_id, allow_list):
+        AppNamespace.__init__(self, None, blur_usage, log_requests, app_id,
+                              allow_list)
+        self._usage = usage
+        self._nameplates = {} # name -> (mailbox_id, {side: {claimed, added}})
+        self._mailbox_nameplates = {} # mailbox_id -> name
+
+    def _commit(self):
+        pass
+
+    def _record_usage(self, statements):
+        self._usage.add_many(statements)
+
+    def has_state(self):
+        return bool(self._nameplates or self._mailboxes)
+
+    def count_state(self):
+        messages = sum([len(mb._messages) for mb in self._mailboxes.values()])
+        return (len(self._nameplates), len(self._mailboxes), messages)
+
+    def _get_nameplate_ids(self):
+        return set(self._nameplates)
+
+    def claim_nameplate(self, name, side, when):
+        assert isinstance(name, type("")), type(name)
+        assert isinstance(side, type("")), type(side)
+        if name not in self._nameplates:
+            if self._log_requests:
+                log.msg("creating nameplate#%s for app_id %s" %
+                        (name, self._app_id))
+            mailbox_id = generate_mailbox_id()
+            self._add_mailbox(mailbox_id, True, side, when)
+            self._nameplates[name] = (mailbox_id, OrderedDict())
+            self._mailbox_nameplates[mailbox_id] = name
+            self._nameplate_added(name)
+        mailbox_id, sides = self._nameplates[name]
+
+        row = sides.get(side)
+        if not row:
+            sides[side] = {"side": side, "claimed": True, "added": when}
+        elif not row["claimed"]:
+            raise ReclaimedError("you cannot re-claim a nameplate that your side previously released")
+
+        self.open_mailbox(mailbox_id, side, when) # may raise CrowdedError
+        if len(sides) > 2:
+            # this line will probably never get hit: any crowding is noticed
+            # on mailbox sides first, inside open_mailbox()
+            raise CrowdedError("too many sides have claimed this nameplate")
+        return mailbox_id
+
+    def release_nameplate(self, name, side, when):
+        assert isinstance(name, type("")), type(name)
+        assert isinstance(side, type("")), type(side)
+        if name not in self._nameplates:
+            return
+        mailbox_id, sides = self._nameplates[name]
+        row = sides.get(side)
+        if not row:
+            return
+        row["claimed"] = False
+
+        # now, are there any remaining claims?
+        if any([sr["claimed"] for sr in sides.values()]):
+            return
+        # delete and summarize
+        del self._nameplates[name]
+        del self._mailbox_nameplates[mailbox_id]
+        self._nameplate_removed(name)
+        self._summarize_nameplate_and_store(list(sides.values()), when,
+                                            pruned=False)
+
+    def _add_mailbox(self, mailbox_id, for_nameplate, side, when):
+        assert isinstance(mailbox_id, type("")), type(mailbox_id)
+        if mailbox_id not in self._mailboxes:
+            if self._log_requests:
+                log.msg("spawning #%s for app_id %s" % (mailbox_id,
+                                                        self._app_id))
+            self._mailboxes[mailbox_id] = MemoryMailbox(self, self._app_id,
+                                                        mailbox_id,
+                                                        for_nameplate, when)
+            self._mailbox_updated(mailbox_id, when)
+
+    def open_mailbox(self, mailbox_id, side, when):
+        assert isinstance(mailbox_id, type("")), type(mailbox_id)
+        self._add_mailbox(mailbox_id, False, side, when) # ensure it exists
+        mailbox = self._mailboxes[mailbox_id]
+        mailbox.open(side, when)
+        if len(mailbox._sides) > 2:
+            raise CrowdedError("too many sides have opened this mailbox")
+        return mailbox
+
+    def _get_mailbox_times(self):
+        return [(mailbox_id, mailbox._updated)
+                for (mailbox_id, mailbox) in self._mailboxes.items()]
+
+    def _prune_mailbox(self, mailbox_id, now):
+        # the same rules as AppNamespace._prune_mailbox(), which see
+        name = self._mailbox_nameplates.pop(mailbox_id, None)
+        if name is not None:
+            if self._log_requests:
+                log.msg("  deleting nameplate", name)
+            mailbox_id, sides = self._nameplates.pop(name)
+            self._nameplate_removed(name)
+            self._summarize_nameplate_and_store(list(sides.values()), now,
+                                                pruned=True)
+        if self._log_requests:
+            log.msg("  deleting mailbox", mailbox_id)
+        mailbox = self._mailboxes[mailbox_id]
+        mailbox._deleted = True
+        self._summarize_mailbox_and_store(mailbox._for_nameplate,
+                                          list(mailbox._sides.values()),
+                                          now, pruned=True)
+        self.free_mailbox(mailbox_id)
+
+
+class MemoryRendezvous(Rendezvous):
+    """I am a Rendezvous that keeps nameplates, mailboxes, and messages in
+    memory, and writes usage records to 'db' from a background thread (so
+    'db' must be opened with check_same_thread=False). get_stats() reads
+    'db' right away, so once that thread is running, use collect_stats()."""
+
+    def __init__(self, db, welcome, blur_usage, allow_list, usage=None):
+        Rendezvous.__init__(self, db, welcome, blur_usage, allow_list)
+        if usage is None:
+            usage = UsageWriter(db)
+        self._usage = usage
+        usage.setServiceParent(self) # to flush it at shutdown
+
+    def get_app(self, app_id):
+        assert isinstance(app_id, type(""))
+        if not app_id in self._apps:
+            if self._log_requests:
+                log.msg("spawning app_id %s" % (app_id,))
+            self._apps[app_id] = MemoryAppNamespace(
+                self._usage,
+                self._blur_usage,
+                self._log_requests,
+                app_id,
+                self._allow_list,
+            )
+        return self._apps[app_id]
+
+    def get_usage_writer(self):
+        return self
+
+    def record_transit_usage(self, started, total_time, waiting_time,
+                             total_bytes, result):
+        self._usage.add_many(transit_usage(started, total_time, waiting_time,
+                                           total_bytes, result))
+
+    def get_usage_counts(self, kind):
+        # the usage writer's thread owns the database: start writing
+        # whatever it still holds, and read the counts once it's done
+        self._usage.flush()
+        return self._usage.run(get_usage_counts, self._db, kind)
+
+    def collect_stats(self):
+        # our state lives in the reactor, but the usage totals must be read
+        # in the thread that writes them
+        stats = self._get_current_stats()
+        d = self._usage.run(self._get_all_time_stats)
+        def _got(all_time):
+            stats["all_time"] = all_time
+            return stats
+        d.addCallback(_got)
+        return d
+
+    def get_all_apps(self):
+        return set([app_id for (app_id, app) in self._apps.items()
+                    if app.has_state()])
+
+    def _count_active(self):
+        nameplates = mailboxes = messages = 0
+        for app in self._apps.values():
+            n, mb, msg = app.count_state()
+            nameplates += n
+            mailboxes += mb
+            messages += msg
+        return {"nameplates_total": nameplates,
+                "mailboxes_total": mailboxes,
+                "messages_total": messages}
@@ -1,10 +1,13 @@
 from __future__ import unicode_literals
 import time
-from twisted.internet import reactor
+from collections import OrderedDict
+from twisted.internet import reactor, defer
+from twisted.internet.defer import inlineCallbacks
 from twisted.python import log
 from autobahn.twisted import websocket
 from .rendezvous import CrowdedError, ReclaimedError, SidedMessage
-from ..util import dict_to_bytes, bytes_to_dict
+from ..util import (dict_to_bytes, bytes_to_dict, dict_and_body_to_bytes,
+                    bytes_to_dict_and_body, bytes_to_hexstr)
 
 # The WebSocket allows the client to send "commands" to the server, and the
 # server to send "responses" to the client. Note that commands and responses
@@ -64,7 +67,8 @@ from ..util import dict_to_bytes, bytes_to_dict
 #        current_cli_version: out-of-date clients display a warning
 #        motd: all clients display message, then continue normally
 #        error: all clients display mesage, then terminate with error
-# -> {type: "bind", appid:, side:}
+# -> {type: "bind", appid:, side:, binary: bool} # .binary is optional
+#  <- {type: "bound", binary: true} # only if .binary was set
 #
 # -> {type: "list"} -> nameplates
 #  <- {type: "nameplates", nameplates: [{id: str,..},..]}
@@ -81,6 +85,12 @@ from ..util import dict_to_bytes, bytes_to_dict
 #  <- {type: "message", side:, phase:, body:, msg_id:}} # body is hex
 # -> {type: "add", phase: str, body: hex} # will send echo in a "message"
 #
+# Once a connection has been "bound" with binary=true, either side may send a
+# command or response as a binary WebSocket message instead, with the body
+# outside the JSON (see util.dict_and_body_to_bytes). Bodies that arrive that
+# way are stored as bytes, and go out that way to connections that asked for
+# it, and as hex to everyone else. Everything else is still sent as JSON.
+#
 # -> {type: "close", mood: str} -> closed
 #     .mailbox is optional, but must match previous open()
 #  <- {type: "closed"}
@@ -95,6 +105,11 @@ class Error(Exception):
     def __init__(self, explain):
         self._explain = explain
 
+# The rendezvous (and its database) might live in another thread, so every
+# command that uses it has to wait for a Deferred. Commands from one
+# connection are still handled one at a time, in the order they arrived:
+# each waits in self._commands for the previous one to finish.
+
 class WebSocketRendezvous(websocket.WebSocketServerProtocol):
     def __init__(self):
         websocket.WebSocketServerProtocol.__init__(self)
@@ -109,6 +124,10 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
         self._mailbox = None
         self._mailbox_id = None
         self._did_close = False
+        self._binary = False # set by bind
+        self._proxy = None # set if another worker owns our app
+        self._commands = defer.succeed(None)
+        self._disconnected = False
 
     def onConnect(self, request):
         rv = self.factory.rendezvous
@@ -122,45 +141,88 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
 
     def onMessage(self, payload, isBinary):
         server_rx = time.time()
-        msg = bytes_to_dict(payload)
-        try:
-            if "type" not in msg:
-                raise Error("missing 'type'")
-            self.send("ack", id=msg.get("id"))
-
-            mtype = msg["type"]
-            if mtype == "ping":
-                return self.handle_ping(msg)
-            if mtype == "bind":
-                return self.handle_bind(msg)
-
-            if not self._app:
-                raise Error("must bind first")
-            if mtype == "list":
-                return self.handle_list()
-            if mtype == "allocate":
-                return self.handle_allocate(server_rx)
-            if mtype == "claim":
-                return self.handle_claim(msg, server_rx)
-            if mtype == "release":
-                return self.handle_release(msg, server_rx)
-
-            if mtype == "open":
-                return self.handle_open(msg, server_rx)
-            if mtype == "add":
-                return self.handle_add(msg, server_rx)
-            if mtype == "close":
-                return self.handle_close(msg, server_rx)
-
-            raise Error("unknown type")
-        except Error as e:
-            self.send("error", error=e._explain, orig=msg)
+        self._enqueue(self._handle, payload, isBinary, server_rx)
+
+    def _enqueue(self, f, *args):
+        self._commands.addCallback(lambda _: f(*args))
+        self._commands.addErrback(log.err, "error handling a command")
+
+    def _handle(self, payload, isBinary, server_rx):
+        if isBinary:
+            msg, body = bytes_to_dict_and_body(payload)
+            msg["body"] = body
+        else:
+            msg = bytes_to_dict(payload)
+        d = defer.maybeDeferred(self._dispatch, msg, payload, isBinary,
+                                server_rx)
+        def _error(f):
+            f.trap(Error)
+            orig = msg
+            if isBinary:
+                # the copy we send back is JSON, so its body must be hex
+                orig = dict(msg, body=bytes_to_hexstr(body))
+            self.send("error", error=f.value._explain, orig=orig)
+        d.addErrback(_error)
+        return d
+
+    def _dispatch(self, msg, payload, isBinary, server_rx):
+        if "type" not in msg:
+            raise Error("missing 'type'")
+        self._ack(msg)
+        if self._proxy:
+            return self._proxy.forward(payload, isBinary)
+        if self._is_remote_bind(msg):
+            # the owning worker will handle this, and everything after it.
+            # We still parse, check, and ack each message, so it only has
+            # to do the part that needs the app's state.
+            self._proxy = self.factory.router.proxy(self, msg["appid"])
+            return self._proxy.forward(payload, isBinary)
+
+        mtype = msg["type"]
+        if mtype == "ping":
+            return self.handle_ping(msg)
+        if mtype == "bind":
+            return self.handle_bind(msg)
+
+        if not self._app:
+            raise Error("must bind first")
+        if mtype == "list":
+            return self.handle_list()
+        if mtype == "allocate":
+            return self.handle_allocate(server_rx)
+        if mtype == "claim":
+            return self.handle_claim(msg, server_rx)
+        if mtype == "release":
+            return self.handle_release(msg, server_rx)
+
+        if mtype == "open":
+            return self.handle_open(msg, server_rx)
+        if mtype == "add":
+            return self.handle_add(msg, server_rx)
+        if mtype == "close":
+            return self.handle_close(msg, server_rx)
+
+        raise Error("unknown type")
+
+    def _ack(self, msg):
+        self.send("ack", id=msg.get("id"))
+
+    def _is_remote_bind(self, msg):
+        router = self.factory.router
+        return (router is not None and msg["type"] == "bind"
+                and not (self._app or self._side)
+                and "appid" in msg and "side" in msg
+                and not router.is_local(msg["appid"]))
+
+    def _run(self, f, *args):
+        return self.factory.rendezvous.run(f, *args)
 
     def handle_ping(self, msg):
         if "ping" not in msg:
             raise Error("ping requires 'ping'")
         self.send("pong", pong=msg["ping"])
 
+    @inlineCallbacks
     def handle_bind(self, msg):
         if self._app or self._side:
             raise Error("already bound")
@@ -168,25 +230,33 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
             raise Error("bind requires 'appid'")
         if "side" not in msg:
             raise Error("bind requires 'side'")
-        self._app = self.factory.rendezvous.get_app(msg["appid"])
+        rv = self.factory.rendezvous
+        self._app = yield self._run(rv.get_app, msg["appid"])
         self._side = msg["side"]
+        if msg.get("binary") is True:
+            self._binary = True
+            self.send("bound", binary=True)
 
 
+    @inlineCallbacks
     def handle_list(self):
-        nameplate_ids = sorted(self._app.get_nameplate_ids())
+        nameplate_ids = yield self._run(self._app.get_nameplate_ids)
         # provide room to add nameplate attributes later (like which wordlist
         # is used for each, maybe how many words)
-        nameplates = [{"id": nid} for nid in nameplate_ids]
+        nameplates = [{"id": nid} for nid in sorted(nameplate_ids)]
         self.send("nameplates", nameplates=nameplates)
 
+    @inlineCallbacks
     def handle_allocate(self, server_rx):
         if self._did_allocate:
             raise Error("you already allocated one, don't be greedy")
-        nameplate_id = self._app.allocate_nameplate(self._side, server_rx)
+        nameplate_id = yield self._run(self._app.allocate_nameplate,
+                                       self._side, server_rx)
         assert isinstance(nameplate_id, type(""))
         self._did_allocate = True
         self.send("allocated", nameplate=nameplate_id)
 
+    @inlineCallbacks
     def handle_claim(self, msg, server_rx):
         if "nameplate" not in msg:
             raise Error("claim requires 'nameplate'")
@@ -197,14 +267,15 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
         assert isinstance(nameplate_id, type("")), type(nameplate_id)
         self._nameplate_id = nameplate_id
         try:
-            mailbox_id = self._app.claim_nameplate(nameplate_id, self._side,
-                                                   server_rx)
+            mailbox_id = yield self._run(self._app.claim_nameplate,
+                                         nameplate_id, self._side, server_rx)
         except CrowdedError:
             raise Error("crowded")
         except ReclaimedError:
             raise Error("reclaimed")
         self.send("claimed", mailbox=mailbox_id)
 
+    @inlineCallbacks
     def handle_release(self, msg, server_rx):
         if self._did_release:
             raise Error("only one release per connection")
@@ -219,10 +290,12 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
             nameplate_id = self._nameplate_id
         assert nameplate_id is not None
         self._did_release = True
-        self._app.release_nameplate(nameplate_id, self._side, server_rx)
+        yield self._run(self._app.release_nameplate, nameplate_id, self._side,
+                        server_rx)
         self.send("released")
 
 
+    @inlineCallbacks
     def handle_open(self, msg, server_rx):
         if self._mailbox:
             raise Error("only one open per connection")
@@ -231,20 +304,31 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
         mailbox_id = msg["mailbox"]
         assert isinstance(mailbox_id, type(""))
         self._mailbox_id = mailbox_id
-        try:
-            self._mailbox = self._app.open_mailbox(mailbox_id, self._side,
-                                                   server_rx)
-        except CrowdedError:
-            raise Error("crowded")
+        rv = self.factory.rendezvous
         def _send(sm):
-            self.send("message", side=sm.side, phase=sm.phase,
-                      body=sm.body, server_rx=sm.server_rx, id=sm.msg_id)
+            # new messages are added wherever the rendezvous lives
+            rv.call_in_reactor(self._send_message, sm)
         def _stop():
             pass
+        def _open():
+            mailbox = self._app.open_mailbox(mailbox_id, self._side,
+                                             server_rx)
+            return (mailbox, mailbox.add_listener(self, _send, _stop))
+        try:
+            self._mailbox, old_sms = yield self._run(_open)
+        except CrowdedError:
+            raise Error("crowded")
         self._listening = True
-        for old_sm in self._mailbox.add_listener(self, _send, _stop):
-            _send(old_sm)
+        for old_sm in old_sms:
+            self._send_message(old_sm, fresh=True)
+
+    def _send_message(self, sm, fresh=False):
+        if self._disconnected:
+            return # it was on its way when the client left
+        self.sendPreparedMessage(self.factory.messages.get(sm, self._binary,
+                                                           fresh))
 
+    @inlineCallbacks
     def handle_add(self, msg, server_rx):
         if not self._mailbox:
             raise Error("must open mailbox before adding")
@@ -256,8 +340,9 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
         sm = SidedMessage(side=self._side, phase=msg["phase"],
                           body=msg["body"], server_rx=server_rx,
                           msg_id=msg_id)
-        self._mailbox.add_message(sm)
+        yield self._run(self._mailbox.add_message, sm)
 
+    @inlineCallbacks
     def handle_close(self, msg, server_rx):
         if self._did_close:
             raise Error("only one close per connection")
@@ -272,19 +357,25 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
             mailbox_id = self._mailbox_id
         if not self._mailbox:
             try:
-                self._mailbox = self._app.open_mailbox(mailbox_id, self._side,
-                                                       server_rx)
+                self._mailbox = yield self._run(self._app.open_mailbox,
+                                                mailbox_id, self._side,
+                                                server_rx)
             except CrowdedError:
                 raise Error("crowded")
-        if self._listening:
-            self._mailbox.remove_listener(self)
-            self._listening = False
+        mailbox, listening = self._mailbox, self._listening
+        def _close():
+            if listening:
+                mailbox.remove_listener(self)
+            mailbox.close(self._side, msg.get("mood"), server_rx)
+        self._listening = False
         self._did_close = True
-        self._mailbox.close(self._side, msg.get("mood"), server_rx)
+        yield self._run(_close)
         self._mailbox = None
         self.send("closed")
 
     def send(self, mtype, **kwargs):
+        if self._disconnected:
+            return # the command finished after the client left
         kwargs["type"] = mtype
         kwargs["server_tx"] = time.time()
         payload = dict_to_bytes(kwargs)
@@ -292,9 +383,61 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
 
     def onClose(self, wasClean, code, reason):
         #log.msg("onClose", self, self._mailbox, self._listening)
+        self._disconnected = True
+        if self._proxy:
+            self._proxy.close()
+            self._proxy = None
+        # after any commands that are still running
+        self._enqueue(self._stop_listening)
+
+    def _stop_listening(self):
         if self._mailbox and self._listening:
-            self._mailbox.remove_listener(self)
-
+            self._listening = False
+            return self._run(self._mailbox.remove_listener, self)
+
+
+class MessageCache(object):
+    """I turn each SidedMessage into a "message" response just once: the
+    JSON, and the WebSocket frame around it. Every listener of the mailbox
+    gets the same bytes when it is broadcast (all in the same reactor turn,
+    so they can share a server_tx). A connection that opens the mailbox
+    later is sent the old messages with fresh=True, which stamps them (and
+    remembers them) anew, so its server_tx is still when it was sent."""
+    MAX_MESSAGES = 500
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._prepared = OrderedDict() # (SidedMessage, binary) -> prepared
+        self.encoded = 0
+        self.reused = 0
+
+    def get(self, sm, binary=False, fresh=False):
+        # bodies that arrived in binary messages are kept as bytes: only
+        # those can be sent that way
+        binary = binary and isinstance(sm.body, type(b""))
+        key = (sm, binary)
+        prepared = None if fresh else self._prepared.get(key)
+        if prepared is not None:
+            self.reused += 1
+            return prepared
+        msg = {"type": "message", "side": sm.side, "phase": sm.phase,
+               "server_rx": sm.server_rx, "id": sm.msg_id,
+               "server_tx": time.time()}
+        if binary:
+            payload = dict_and_body_to_bytes(msg, sm.body)
+        else:
+            body = sm.body
+            if isinstance(body, type(b"")):
+                body = bytes_to_hexstr(body)
+            msg["body"] = body
+            payload = dict_to_bytes(msg)
+        prepared = self._factory.prepareMessage(payload, binary)
+        self.encoded += 1
+        self._prepared.pop(key, None) # so it counts as the newest
+        self._prepared[key] = prepared
+        if len(self._prepared) > self.MAX_MESSAGES:
+            self._prepared.popitem(last=False) # the oldest
+        return prepared
 
 class WebSocketRendezvousFactory(websocket.WebSocketServerFactory):
     protocol = WebSocketRendezvous
@@ -304,3 +447,5 @@ class WebSocketRendezvousFactory(websocket.WebSocketServerFactory):
         self.setProtocolOptions(autoPingInterval=60, autoPingTimeout=600)
         self.rendezvous = rendezvous
         self.reactor = reactor # for tests to control
+        self.messages = MessageCache(self)
+        self.router = None # a workers.WorkerRouter, with --workers
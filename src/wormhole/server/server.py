@@ -8,14 +8,18 @@ try:
 except ImportError: # pragma: nocover
     getrlimit, setrlimit, RLIMIT_NOFILE = None, None, None # pragma: nocover
 from twisted.python import log
-from twisted.internet import reactor, endpoints
+from twisted.internet import reactor, endpoints, defer
 from twisted.application import service, internet
 from twisted.web import server, static
 from twisted.web.resource import Resource
 from autobahn.twisted.resource import WebSocketResource
-from .database import get_db
-from .rendezvous import Rendezvous
+from .database import get_db, GroupCommitDB, DBThread
+from .storage import get_backend, parse_url
 from .rendezvous_websocket import WebSocketRendezvousFactory
+from .._deflate import (parse_options as parse_deflate_options,
+                        server_accept as deflate_accept)
+from .transit_server import Transit
+from . import workers as workers_
 
 SECONDS = 1.0
 MINUTE = 60*SECONDS
@@ -40,13 +44,38 @@ class RelayServer(service.MultiService):
     def __init__(self, rendezvous_web_port,
                  advertise_version, db_url=":memory:", blur_usage=None,
                  signal_error=None, stats_file=None, allow_list=True,
-                 websocket_protocol_options=()):
+                 websocket_protocol_options=(), transit_port=None,
+                 rendezvous_state="sqlite", db_journal_mode=None,
+                 db_synchronous=None, db_commit_window=0,
+                 workers=1, worker_index=0, worker_dir=None):
         service.MultiService.__init__(self)
+        # rendezvous_state is a storage URL, see storage.py
+        backend, backend_url = get_backend(rendezvous_state)
+        if workers > 1 and backend.state_in_database:
+            # each worker prunes the apps it owns, which it can only tell
+            # apart from the others' if the database doesn't hold them all
+            raise ValueError("workers>1 requires rendezvous_state='memory'")
         self._blur_usage = blur_usage
         self._allow_list = allow_list
         self._db_url = db_url
+        self._rendezvous_state = rendezvous_state
 
-        db = get_db(db_url)
+        db = get_db(db_url, check_same_thread=False,
+                    journal_mode=db_journal_mode, synchronous=db_synchronous)
+        self._group_commit = None
+        self._db_thread = None
+        if backend.state_in_database:
+            # the rendezvous state lives in the database, and
+            # everything that uses it runs in a separate thread, so a slow
+            # disk never stalls the reactor. This is added first so it is
+            # stopped last, after everything that might still use it.
+            self._db_thread = DBThread(db)
+            self._db_thread.setServiceParent(self)
+            # every rendezvous command commits (often more than once), so
+            # let them share commits
+            db = GroupCommitDB(db, db_commit_window, thread=self._db_thread)
+            db.setServiceParent(self)
+            self._group_commit = db
         welcome = {
             # adding .motd will cause all clients to display the message,
             # then keep running normally
@@ -65,8 +94,11 @@ class RelayServer(service.MultiService):
         if signal_error:
             welcome["error"] = signal_error
 
-        self._rendezvous = Rendezvous(db, welcome, blur_usage, self._allow_list)
+        self._rendezvous = backend.create(backend_url, db, welcome,
+                                          blur_usage, self._allow_list,
+                                          db_thread=self._db_thread)
         self._rendezvous.setServiceParent(self) # for the pruning timer
+        usage = self._rendezvous.get_usage_writer()
 
         root = Root()
         wsrf = WebSocketRendezvousFactory(None, self._rendezvous)
@@ -77,9 +109,57 @@ class RelayServer(service.MultiService):
         if blur_usage:
             site.logRequests = False
 
-        r = endpoints.serverFromString(reactor, rendezvous_web_port)
-        rendezvous_web_service = internet.StreamServerEndpointService(r, site)
+        self._workers = workers
+        self._router = None
+        self._worker_dir = None
+        self._remove_worker_dir = False
+        if workers > 1:
+            # all workers accept on the same port, and send the clients of
+            # apps they don't own to the worker that does
+            if worker_dir is None:
+                worker_dir = workers_.make_worker_dir()
+                self._remove_worker_dir = True
+            self._worker_dir = worker_dir
+            router = workers_.WorkerRouter(worker_index, workers, worker_dir,
+                                           wsrf, self._rendezvous)
+            router.setServiceParent(self)
+            wsrf.router = router
+            self._router = router
+            rendezvous_web_service = workers_.ReusePortService(
+                rendezvous_web_port, site)
+        else:
+            r = endpoints.serverFromString(reactor, rendezvous_web_port)
+            rendezvous_web_service = internet.StreamServerEndpointService(
+                r, site)
         rendezvous_web_service.setServiceParent(self)
+        if self._remove_worker_dir:
+            # we're the first worker (nobody gave us a worker_dir), so we
+            # start the rest, once we know which port they should share
+            config = dict(advertise_version=advertise_version,
+                          db_url=db_url, blur_usage=blur_usage,
+                          signal_error=signal_error, allow_list=allow_list,
+                          websocket_protocol_options=list(
+                              websocket_protocol_options),
+                          rendezvous_state=rendezvous_state,
+                          db_journal_mode=db_journal_mode,
+                          db_synchronous=db_synchronous,
+                          db_commit_window=db_commit_window,
+                          workers=workers, worker_dir=worker_dir)
+            def _get_config():
+                port = rendezvous_web_service.port.getHost().port
+                config["rendezvous_web_port"] = _with_port(
+                    rendezvous_web_port, port)
+                return config
+            workers_.WorkerSpawner(_get_config, workers).setServiceParent(self)
+
+        self._transit = None
+        if transit_port:
+            transit = Transit(db, blur_usage, usage=usage)
+            transit.setServiceParent(self) # for the stopService() cleanup
+            t = endpoints.serverFromString(reactor, transit_port)
+            transit_service = internet.StreamServerEndpointService(t, transit)
+            transit_service.setServiceParent(self)
+            self._transit = transit
 
         self._stats_file = stats_file
         if self._stats_file and os.path.exists(self._stats_file):
@@ -130,6 +210,8 @@ class RelayServer(service.MultiService):
         self.increase_rlimits()
         log.msg("websocket listening on /wormhole-relay/ws")
         log.msg("Wormhole relay server (Rendezvous) running")
+        if self._transit:
+            log.msg("transit relay running")
         if self._blur_usage:
             log.msg("blurring access times to %d seconds" % self._blur_usage)
             log.msg("not logging HTTP requests")
@@ -137,25 +219,74 @@ class RelayServer(service.MultiService):
             log.msg("not blurring access times")
         if not self._allow_list:
             log.msg("listing of allocated nameplates disallowed")
+        scheme = parse_url(self._rendezvous_state)[0]
+        if scheme != "sqlite":
+            log.msg("keeping rendezvous state in %s" % scheme)
+        elif self._group_commit and self._group_commit._window:
+            log.msg("grouping db commits every %s seconds"
+                    % self._group_commit._window)
+        if self._router:
+            log.msg("running as worker %d of %d"
+                    % (self._router._index, self._workers))
+
+    def stopService(self):
+        d = defer.maybeDeferred(service.MultiService.stopService, self)
+        if self._remove_worker_dir:
+            d.addBoth(self._cleanup_worker_dir)
+        return d
+
+    def _cleanup_worker_dir(self, res):
+        workers_.remove_worker_dir(self._worker_dir)
+        return res
 
     def timer(self):
         now = time.time()
         old = now - CHANNEL_EXPIRATION_TIME
-        self._rendezvous.prune_all_apps(now, old)
-        self.dump_stats(now, validity=EXPIRATION_CHECK_PERIOD+60)
+        # pruning is spread over several reactor turns, so clients don't
+        # notice it
+        d = self._rendezvous.prune_in_slices(now, old)
+        if self._router and self._stats_file:
+            d.addCallback(lambda _: self._router.collect_stats())
+        else:
+            d.addCallback(lambda _: None)
+        d.addCallback(lambda worker_stats: self.dump_stats(
+            now, validity=EXPIRATION_CHECK_PERIOD+60,
+            worker_stats=worker_stats))
+        # an error here would stop the TimerService
+        d.addErrback(log.err, "error during prune/dump_stats")
+        return d
 
-    def dump_stats(self, now, validity):
+    def dump_stats(self, now, validity, worker_stats=None):
+        # worker_stats: the rendezvous stats of the other workers
         if not self._stats_file:
-            return
-        tmpfn = self._stats_file + ".tmp"
+            return defer.succeed(None)
+        d = self._get_stats(worker_stats)
+        d.addCallback(self._write_stats, now, validity)
+        return d
 
+    @defer.inlineCallbacks
+    def _get_stats(self, worker_stats):
+        # each part is read in the thread that owns it: the database (and
+        # any rendezvous state in it) belongs to the DB thread or the usage
+        # writer, and the transit relay's connections to the reactor
         data = {}
-        data["created"] = now
-        data["valid_until"] = now + validity
-
         start = time.time()
-        data["rendezvous"] = self._rendezvous.get_stats()
+        rendezvous = yield self._rendezvous.collect_stats()
+        if worker_stats is not None:
+            rendezvous = workers_.merge_stats(rendezvous, worker_stats)
+        data["rendezvous"] = rendezvous
         log.msg("get_stats took:", time.time() - start)
+        if self._transit:
+            data["transit"] = yield self._transit.collect_stats()
+        if self._group_commit:
+            data["database"] = yield self._db_thread.run(
+                self._group_commit.get_stats)
+        defer.returnValue(data)
+
+    def _write_stats(self, data, now, validity):
+        tmpfn = self._stats_file + ".tmp"
+        data["created"] = now
+        data["valid_until"] = now + validity
 
         with open(tmpfn, "wb") as f:
             # json.dump(f) has str-vs-unicode issues on py2-vs-py3
@@ -164,5 +295,17 @@ class RelayServer(service.MultiService):
         os.rename(tmpfn, self._stats_file)
 
 
+def _with_port(description, port):
+    # "tcp:0:interface=127.0.0.1" -> "tcp:PORT:interface=127.0.0.1"
+    parts = description.split(":")
+    parts[1] = str(port)
+    return ":".join(parts)
+
 def _set_options(options, factory):
-    factory.setProtocolOptions(**dict(options))
+    options = dict(options)
+    # permessage_deflate=true (or a dict, see _deflate.py) is ours, and
+    # becomes autobahn's perMessageCompressionAccept
+    deflate = parse_deflate_options(options.pop("permessage_deflate", None))
+    if deflate is not None:
+        options["perMessageCompressionAccept"] = deflate_accept(deflate)
+    factory.setProtocolOptions(**options)
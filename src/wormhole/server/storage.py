@@ -0,0 +1,173 @@
+from __future__ import print_function, unicode_literals
+from zope.interface import Interface
+
+# The rendezvous server keeps its nameplates, mailboxes, and messages in a
+# "storage backend", chosen with --rendezvous-state=URL. The URL's scheme
+# names the backend, and the rest (if any) is passed to it:
+#
+#  sqlite: (or just "sqlite") keeps everything in the relay database, next to
+#          the usage records. This is the default.
+#  memory: (or just "memory") keeps everything in python dictionaries, and
+#          only writes usage records to the relay database.
+#
+# Other backends (say, one that keeps state in an external key-value store,
+# so several servers can share it) can be added without touching the server:
+# call register_backend() before the server starts, or publish the backend
+# from another distribution under the "magic_wormhole.rendezvous_storage"
+# entry point group, with the scheme as the entry point name.
+#
+# A backend is an object with a .state_in_database attribute and a .create()
+# method, which returns an IRendezvousStorage provider (normally a
+# Rendezvous subclass). Every backend must pass the conformance tests in
+# wormhole.test.test_storage (subclass StorageConformance to run them).
+
+ENTRY_POINT_GROUP = "magic_wormhole.rendezvous_storage"
+
+class IMailbox(Interface):
+    """One two-sided store-and-forward queue, as returned by
+    IAppNamespace.open_mailbox()."""
+    def open(side, when):
+        """Record that 'side' has opened this mailbox."""
+    def get_messages():
+        """Return all SidedMessages added so far, oldest first."""
+    def add_listener(handle, send_f, stop_f):
+        """Call send_f(sm) for each new message, until remove_listener(
+        handle), or stop_f() if the mailbox goes away first. Returns the
+        messages that were already there."""
+    def remove_listener(handle):
+        pass
+    def has_listeners():
+        pass
+    def add_message(sm):
+        """Store a SidedMessage, and send it to every listener."""
+    def close(side, mood, when):
+        """Record that 'side' is done. Once every side that opened the
+        mailbox has closed it, it is deleted and its usage recorded."""
+
+class IAppNamespace(Interface):
+    """The nameplates and mailboxes of one app_id."""
+    def get_nameplate_ids():
+        """Return the set of nameplates that can be listed (empty if listing
+        is disallowed)."""
+    def allocate_nameplate(side, when):
+        """Claim the shortest unused numeric nameplate, and return it."""
+    def claim_nameplate(name, side, when):
+        """Claim a nameplate (creating it, and opening its mailbox, if
+        necessary), and return its mailbox id. Raises CrowdedError if two
+        other sides got there first, or ReclaimedError if this side already
+        released it."""
+    def release_nameplate(name, side, when):
+        """Once every side that claimed it has released it, the nameplate
+        is deleted and its usage recorded."""
+    def open_mailbox(mailbox_id, side, when):
+        """Return the IMailbox (creating it if necessary), after opening it
+        for 'side'. Raises CrowdedError if two other sides opened it."""
+    def free_mailbox(mailbox_id):
+        """Forget an IMailbox that has been deleted."""
+    def prune(now, old):
+        """Delete every mailbox (and its nameplate) that hasn't been used
+        since 'old', unless somebody is still listening to it. Returns how
+        many mailboxes were looked at."""
+    def prune_some(now, old, limit=None):
+        """Like prune(), but stop after looking at 'limit' mailboxes."""
+    def get_counts():
+        """Return (nameplate_results, mailbox_results): two dicts that count
+        the usage records written since startup, by result."""
+
+class IUsageWriter(Interface):
+    """Records usage in the relay database, in whatever way (and thread)
+    the storage backend uses it."""
+    def record_transit_usage(started, total_time, waiting_time, total_bytes,
+                             result):
+        """Record (and count) one transit relay connection."""
+    def get_usage_counts(kind):
+        """Return a Deferred with a dict of result -> count for one kind of
+        usage (like "transit" or "transit_bytes"), including everything
+        recorded so far."""
+
+class IRendezvousStorage(Interface):
+    """The whole rendezvous state: a Service, whose stopService() also
+    finishes writing any usage records."""
+    def get_welcome():
+        pass
+    def get_log_requests():
+        pass
+    def run(f, *args, **kwargs):
+        """Call f where the state may be used, and return a Deferred with
+        its result. Every use of an IAppNamespace or IMailbox must happen
+        inside a run()."""
+    def call_in_reactor(f, *args, **kwargs):
+        """From inside run(), arrange for f to be called by the reactor."""
+    def get_app(app_id):
+        """Return the IAppNamespace for app_id."""
+    def get_all_apps():
+        """Return the set of app_ids that have any nameplates, mailboxes, or
+        messages."""
+    def prune_all_apps(now, old):
+        pass
+    def prune_in_slices(now, old):
+        """Prune every app, a bit at a time. Returns a Deferred."""
+    def get_usage_writer():
+        """Return the IUsageWriter that other services (the transit relay)
+        should use to record their usage in the relay database."""
+    def get_stats():
+        """Return a JSON-serializable dict with "active", "since_reboot",
+        "all_time", and "prune" keys, for --stats-json-path. This reads
+        everything right away, so call it inside run(), and only when
+        nothing else can be writing usage records."""
+    def collect_stats():
+        """Return a Deferred that fires with the same dict, after reading
+        each part wherever it may be read. Call this from the reactor."""
+
+
+class SQLiteStorage(object):
+    """Everything lives in the relay database, which is then only used from
+    its DB thread."""
+    state_in_database = True
+
+    def create(self, url, db, welcome, blur_usage, allow_list,
+               db_thread=None):
+        from .rendezvous import Rendezvous
+        if url:
+            raise ValueError("the sqlite backend uses the relay database,"
+                             " and takes no arguments: %r" % (url,))
+        return Rendezvous(db, welcome, blur_usage, allow_list,
+                          db_thread=db_thread)
+
+class MemoryStorage(object):
+    """Everything lives in memory, except usage records, which are written to
+    the relay database by a UsageWriter (so 'db' must allow that)."""
+    state_in_database = False
+
+    def create(self, url, db, welcome, blur_usage, allow_list,
+               db_thread=None):
+        from .rendezvous_memory import MemoryRendezvous
+        if url:
+            raise ValueError("the memory backend takes no arguments: %r"
+                             % (url,))
+        return MemoryRendezvous(db, welcome, blur_usage, allow_list)
+
+_backends = {"sqlite": SQLiteStorage(),
+             "memory": MemoryStorage(),
+             }
+
+def register_backend(scheme, backend):
+    _backends[scheme] = backend
+
+def parse_url(url):
+    """'memory' -> ('memory', ''), 'kv:host:1234' -> ('kv', 'host:1234')"""
+    scheme, _, rest = url.partition(":")
+    return scheme, rest
+
+def get_backend(url):
+    """Return (backend, url-without-scheme), or raise ValueError."""
+    scheme, rest = parse_url(url)
+    if scheme not in _backends:
+        from pkg_resources import iter_entry_points
+        for ep in iter_entry_points(ENTRY_POINT_GROUP, scheme):
+            register_backend(scheme, ep.load())
+            break
+    if scheme not in _backends:
+        raise ValueError("unknown rendezvous storage %r (try one of: %s)"
+                         % (url, ", ".join(sorted(_backends))))
+    return _backends[scheme], rest
@@ -0,0 +1,576 @@
+from __future__ import print_function, unicode_literals
+import os, re, time, errno, collections
+try:
+    import fcntl
+except ImportError: # pragma: nocover
+    fcntl = None # windows
+from zope.interface import implementer
+from twisted.python import log
+from twisted.internet import protocol, interfaces, reactor, defer
+from twisted.application import service
+from .database import get_usage_counts, transit_usage
+
+SECONDS = 1.0
+MINUTE = 60*SECONDS
+HOUR = 60*MINUTE
+DAY = 24*HOUR
+MB = 1000*1000
+
+def round_to(size, coarseness):
+    return int(coarseness*(1+int((size-1)/coarseness)))
+
+def blur_size(size):
+    if size == 0:
+        return 0
+    if size < 1e6:
+        return round_to(size, 10e3)
+    if size < 1e9:
+        return round_to(size, 1e6)
+    return round_to(size, 100e6)
+
+# On Linux (with python3.10 or newer), os.splice() moves bytes from a socket
+# into a pipe, and from a pipe into another socket, without copying them into
+# userspace. Once two connections are paired up, we stop Twisted from reading
+# them and do that instead, so the payload never passes through python. Other
+# platforms (and non-TCP transports) get the usual producer/consumer loop.
+_splice = getattr(os, "splice", None)
+SPLICE_FLAGS = (getattr(os, "SPLICE_F_MOVE", 0) |
+                getattr(os, "SPLICE_F_NONBLOCK", 0))
+SPLICE_CHUNK = 1024*1024
+PIPE_SIZE = 1024*1024 # we ask for this much, but the kernel may say no
+DEFAULT_PIPE_SIZE = 65536
+
+def _can_splice(reactor, transport):
+    return (_splice is not None
+            and interfaces.IReactorFDSet.providedBy(reactor)
+            and interfaces.ITCPTransport.providedBy(transport)
+            and not interfaces.ISSLTransport.providedBy(transport)
+            and hasattr(transport, "fileno")
+            and hasattr(transport, "stopReading"))
+
+class _Pipe(object):
+    """I am a kernel pipe carrying one direction of a spliced pair, and I
+    remember how many bytes are sitting in it."""
+    def __init__(self):
+        self.r, self.w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.capacity = DEFAULT_PIPE_SIZE
+        if hasattr(fcntl, "F_SETPIPE_SZ"):
+            try:
+                self.capacity = fcntl.fcntl(self.w, fcntl.F_SETPIPE_SZ,
+                                            PIPE_SIZE)
+            except EnvironmentError:
+                pass # larger than /proc/sys/fs/pipe-max-size
+        self.pending = 0
+        self.eof = False # the socket that fills us has closed
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
+
+@implementer(interfaces.IReadWriteDescriptor)
+class _SplicedEnd(object):
+    """I take over one socket of a spliced pair from its Twisted transport:
+    I splice what arrives on it into 'inbound', and splice 'outbound' out to
+    it."""
+    def __init__(self, reactor, splicer, tc, inbound, outbound):
+        self._reactor = reactor
+        self._splicer = splicer
+        self.tc = tc
+        self._fd = tc.transport.fileno()
+        self.inbound = inbound
+        self.outbound = outbound
+        self.peer = None
+        self._reading = False
+        self._writing = False
+
+    def fileno(self):
+        return self._fd
+
+    def logPrefix(self):
+        return "TransitSplice"
+
+    def takeOver(self):
+        # Only one selectable may watch an fd (epoll keeps one per fd), so
+        # the transport must stop reading and writing it before we start.
+        # Nothing has been written to it yet ("ok\n" goes through the pipe),
+        # so it has nothing buffered.
+        t = self.tc.transport
+        t.stopReading()
+        t.stopWriting()
+
+    def giveBack(self):
+        # the splice didn't get going: the transport can have it back
+        self.stopReading()
+        self.stopWriting()
+        self.tc.transport.startReading()
+
+    def startReading(self):
+        if not self._reading and not self.inbound.eof:
+            self._reading = True
+            self._reactor.addReader(self)
+
+    def stopReading(self):
+        if self._reading:
+            self._reading = False
+            self._reactor.removeReader(self)
+
+    def startWriting(self):
+        if not self._writing:
+            self._writing = True
+            self._reactor.addWriter(self)
+
+    def stopWriting(self):
+        if self._writing:
+            self._writing = False
+            self._reactor.removeWriter(self)
+
+    def doRead(self):
+        pipe = self.inbound
+        try:
+            n = _splice(self._fd, pipe.w, SPLICE_CHUNK, flags=SPLICE_FLAGS)
+        except EnvironmentError as e:
+            if e.errno == errno.EAGAIN:
+                if pipe.pending:
+                    self.stopReading() # the pipe is full
+                return
+            self._splicer.finish()
+            return
+        if n == 0:
+            # they closed: deliver whatever is still in the pipe, then close
+            # both sides (like loseConnection() does for the plain relay)
+            self.stopReading()
+            pipe.eof = True
+            if not pipe.pending:
+                self._splicer.finish()
+            return
+        pipe.pending += n
+        self.tc._total_sent += n
+        self.peer.startWriting()
+        if pipe.pending >= pipe.capacity:
+            self.stopReading()
+
+    def doWrite(self):
+        pipe = self.outbound
+        try:
+            n = _splice(pipe.r, self._fd, pipe.pending, flags=SPLICE_FLAGS)
+        except EnvironmentError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            self._splicer.finish()
+            return
+        pipe.pending -= n
+        if not pipe.pending:
+            self.stopWriting()
+            if pipe.eof:
+                self._splicer.finish()
+                return
+        self.peer.startReading() # in case the pipe had filled up
+
+    def connectionLost(self, reason):
+        self._splicer.finish()
+
+class _Splicer(object):
+    def __init__(self, reactor, a, b):
+        ab = _Pipe()
+        try:
+            ba = _Pipe()
+        except EnvironmentError:
+            ab.close()
+            raise
+        self._pipes = [ab, ba]
+        self._ends = [_SplicedEnd(reactor, self, a, ab, ba),
+                      _SplicedEnd(reactor, self, b, ba, ab)]
+        self._ends[0].peer, self._ends[1].peer = self._ends[1], self._ends[0]
+        self._finished = False
+
+    def start(self):
+        """Take both sockets over from their transports: until finish(),
+        the _SplicedEnds are the only things reading or writing them. If
+        that fails, the transports get their sockets back, and this raises
+        EnvironmentError (so the caller can relay normally)."""
+        try:
+            for end in self._ends:
+                end.takeOver()
+            for end in self._ends:
+                os.write(end.outbound.w, b"ok\n")
+                end.outbound.pending += 3
+                end.startWriting()
+                end.startReading()
+        except EnvironmentError:
+            self._finished = True
+            for end in self._ends:
+                end.giveBack()
+            for pipe in self._pipes:
+                pipe.close()
+            raise
+
+    def finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        for end in self._ends:
+            end.stopReading()
+            end.stopWriting()
+        for pipe in self._pipes:
+            pipe.close()
+        # give the sockets back to their transports, which will close them
+        for end in self._ends:
+            end.tc.transport.loseConnection()
+
+class TransitConnection(protocol.Protocol):
+    def __init__(self):
+        self._got_token = False
+        self._got_side = False
+        self._token_buffer = b""
+        self._sent_ok = False
+        self._buddy = None
+        self._had_buddy = False
+        self._splicer = None
+        self._total_sent = 0
+
+    def describeToken(self):
+        d = "-"
+        if self._got_token:
+            d = self._got_token[:16].decode("ascii")
+        if self._got_side:
+            d += "-" + self._got_side.decode("ascii")
+        else:
+            d += "-<unsided>"
+        return d
+
+    def connectionMade(self):
+        self._started = time.time()
+        self._log_requests = self.factory._log_requests
+
+    def dataReceived(self, data):
+        if self._sent_ok:
+            # We are an IPushProducer to our buddy's IConsumer, so they'll
+            # throttle us (by calling pauseProducing()) when their outbound
+            # buffer is full (e.g. when their downstream pipe is full). In
+            # practice, this buffers about 10MB per connection, after which
+            # point the sender will only transmit data as fast as the
+            # receiver can handle it.
+            if self._buddy is None:
+                return # they're gone, and we're about to be
+            self._total_sent += len(data)
+            self._buddy.transport.write(data)
+            return
+
+        if self._got_token: # but not yet sent_ok
+            self.transport.write(b"impatient\n")
+            if self._log_requests:
+                log.msg("transit impatience failure")
+            return self.disconnect() # impatience yields failure
+
+        # else this should be (part of) the token
+        self._token_buffer += data
+        buf = self._token_buffer
+
+        # old: "please relay {64}\n"
+        # new: "please relay {64} for side {16}\n"
+        (old, handshake_len, token) = self._check_old_handshake(buf)
+        assert old in ("yes", "waiting", "no")
+        if old == "yes":
+            # remember they aren't supposed to send anything past their
+            # handshake until we've said go
+            if len(buf) > handshake_len:
+                self.transport.write(b"impatient\n")
+                if self._log_requests:
+                    log.msg("transit impatience failure")
+                return self.disconnect() # impatience yields failure
+            return self._got_handshake(token, None)
+        (new, handshake_len, token, side) = self._check_new_handshake(buf)
+        assert new in ("yes", "waiting", "no")
+        if new == "yes":
+            if len(buf) > handshake_len:
+                self.transport.write(b"impatient\n")
+                if self._log_requests:
+                    log.msg("transit impatience failure")
+                return self.disconnect() # impatience yields failure
+            return self._got_handshake(token, side)
+        if (old == "no" and new == "no"):
+            self.transport.write(b"bad handshake\n")
+            if self._log_requests:
+                log.msg("transit handshake failure")
+            return self.disconnect() # incorrectness yields failure
+        # else we'll keep waiting
+
+    def _check_old_handshake(self, buf):
+        # old: "please relay {64}\n"
+        # return ("yes", handshake, token) if buf contains an old-style handshake
+        # return ("waiting", None, None) if it might eventually contain one
+        # return ("no", None, None) if it could never contain one
+        wanted = len("please relay \n")+32*2
+        if len(buf) < wanted-1 and b"\n" in buf:
+            return ("no", None, None)
+        if len(buf) < wanted:
+            return ("waiting", None, None)
+
+        mo = re.search(br"^please relay (\w{64})\n", buf, re.M)
+        if mo:
+            token = mo.group(1)
+            return ("yes", wanted, token)
+        return ("no", None, None)
+
+    def _check_new_handshake(self, buf):
+        # new: "please relay {64} for side {16}\n"
+        wanted = len("please relay  for side \n")+32*2+8*2
+        if len(buf) < wanted-1 and b"\n" in buf:
+            return ("no", None, None, None)
+        if len(buf) < wanted:
+            return ("waiting", None, None, None)
+
+        mo = re.search(br"^please relay (\w{64}) for side (\w{16})\n", buf, re.M)
+        if mo:
+            token = mo.group(1)
+            side = mo.group(2)
+            return ("yes", wanted, token, side)
+        return ("no", None, None, None)
+
+    def _got_handshake(self, token, side):
+        self._got_token = token
+        self._got_side = side
+        self.factory.connection_got_token(token, side, self)
+
+    def buddy_connected(self, them, splicer=None):
+        self._buddy = them
+        self._had_buddy = True
+        self._sent_ok = True
+        self._splicer = splicer
+        if splicer:
+            return # it will send our "ok\n"
+        self.transport.write(b"ok\n")
+        # Connect the two as a producer/consumer pair. We use streaming=True,
+        # so this expects the IPushProducer interface, and uses
+        # pauseProducing() to throttle, and resumeProducing() to unthrottle.
+        self._buddy.transport.registerProducer(self.transport, True)
+        # The Transit object calls buddy_connected() on both protocols, so
+        # there will be two producer/consumer pairs.
+
+    def buddy_disconnected(self):
+        if self._log_requests:
+            log.msg("buddy_disconnected %s" % self.describeToken())
+        self._buddy = None
+        self.transport.loseConnection()
+
+    def close(self):
+        if self._splicer:
+            self._splicer.finish()
+        else:
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if self._splicer:
+            self._splicer.finish()
+        if self._buddy:
+            self._buddy.buddy_disconnected()
+        self.factory.transitFinished(self, self._got_token, self._got_side,
+                                     self.describeToken())
+
+        # Record usage. There are four cases:
+        # * 1: we connected, never had a buddy
+        # * 2: we connected first, we disconnect before the buddy
+        # * 3: we connected first, buddy disconnects first
+        # * 4: buddy connected first, we disconnect before buddy
+        # * 5: buddy connected first, buddy disconnects first
+
+        # whoever disconnects first gets to write the usage record (1,2,4)
+
+        finished = time.time()
+        if not self._had_buddy: # 1
+            total_time = finished - self._started
+            self.factory.recordUsage(self._started, "lonely", 0,
+                                     total_time, None)
+        if self._had_buddy and self._buddy: # 2,4
+            total_bytes = self._total_sent + self._buddy._total_sent
+            starts = [self._started, self._buddy._started]
+            total_time = finished - min(starts)
+            waiting_time = max(starts) - min(starts)
+            self.factory.recordUsage(self._started, "happy", total_bytes,
+                                     total_time, waiting_time)
+
+    def disconnect(self):
+        self.transport.loseConnection()
+        self.factory.transitFailed(self)
+        finished = time.time()
+        total_time = finished - self._started
+        self.factory.recordUsage(self._started, "errory", 0,
+                                 total_time, None)
+
+class Transit(protocol.ServerFactory, service.MultiService):
+    # I manage pairs of simultaneous connections to a secondary TCP port,
+    # both forwarded to the other. Clients must begin each connection with
+    # "please relay TOKEN for SIDE\n" (or a legacy form without the "for
+    # SIDE"). Two connections match if they use the same TOKEN and have
+    # different SIDEs (the redundant connections are dropped when a winner is
+    # selected). If the connections use old-style handshakes, the first two
+    # with the same TOKEN will be paired.
+    #
+    # Clients are expected to write their own handshake, then wait for "ok\n"
+    # from the Transit. Once the ok is received, each client should send its
+    # final handshake message (after which the transit will forward
+    # everything to the other client).
+    #
+    # For now, the transit layer imposes no limits on the amount of data
+    # transferred, or on the number of concurrent connections.
+
+    protocol = TransitConnection
+
+    def __init__(self, db, blur_usage, splice=True, usage=None,
+                 reactor=reactor):
+        service.MultiService.__init__(self)
+        self._db = db
+        self._reactor = reactor
+        self._usage = usage # an IUsageWriter, or None to use 'db' directly
+        self._blur_usage = blur_usage
+        self._log_requests = blur_usage is None
+        self._splice = splice
+        self._pending_requests = {} # token -> set((side, TransitConnection))
+        self._active_connections = set() # TransitConnection
+        self._counts = collections.defaultdict(int)
+        self._count_bytes = 0
+
+    def connection_got_token(self, token, new_side, new_tc):
+        if token not in self._pending_requests:
+            self._pending_requests[token] = set()
+        potentials = self._pending_requests[token]
+        for old in potentials:
+            (old_side, old_tc) = old
+            if ((old_side is None)
+                or (new_side is None)
+                or (old_side != new_side)):
+                # we found a match
+                if self._log_requests:
+                    log.msg("transit relay 2: %s" % new_tc.describeToken())
+
+                # drop and stop tracking the rest
+                potentials.remove(old)
+                for (_, leftover_tc) in potentials:
+                    leftover_tc.disconnect() # TODO: not "errory"?
+                self._pending_requests.pop(token)
+
+                # glue the two ends together
+                self._active_connections.add(new_tc)
+                self._active_connections.add(old_tc)
+                self._glue(old_tc, new_tc)
+                return
+        if self._log_requests:
+            log.msg("transit relay 1: %s" % new_tc.describeToken())
+        potentials.add((new_side, new_tc))
+        # TODO: timer
+
+    def _glue(self, a, b):
+        splicer = None
+        if (self._splice and _can_splice(self._reactor, a.transport)
+            and _can_splice(self._reactor, b.transport)):
+            try:
+                splicer = _Splicer(self._reactor, a, b)
+                splicer.start()
+            except EnvironmentError as e:
+                # probably out of file descriptors
+                log.msg("unable to splice, relaying normally: %s" % (e,))
+                splicer = None
+        a.buddy_connected(b, splicer)
+        b.buddy_connected(a, splicer)
+
+    def recordUsage(self, started, result, total_bytes,
+                    total_time, waiting_time):
+        if self._log_requests:
+            log.msg(format="Transit.recordUsage {bytes}B", bytes=total_bytes)
+        if self._blur_usage:
+            started = self._blur_usage * (started // self._blur_usage)
+            total_bytes = blur_size(total_bytes)
+        if self._usage:
+            self._usage.record_transit_usage(started, total_time,
+                                             waiting_time, total_bytes, result)
+        else:
+            for (sql, values) in transit_usage(started, total_time,
+                                               waiting_time, total_bytes,
+                                               result):
+                self._db.execute(sql, values)
+            self._db.commit()
+        self._counts[result] += 1
+        self._count_bytes += total_bytes
+
+    def transitFinished(self, tc, token, side, description):
+        if token in self._pending_requests:
+            side_tc = (side, tc)
+            if side_tc in self._pending_requests[token]:
+                self._pending_requests[token].remove(side_tc)
+            if not self._pending_requests[token]: # set is now empty
+                del self._pending_requests[token]
+        if self._log_requests:
+            log.msg("transitFinished %s" % (description,))
+        self._active_connections.discard(tc)
+
+    def transitFailed(self, p):
+        if self._log_requests:
+            log.msg("transitFailed %r" % p)
+        pass
+
+    def get_stats(self):
+        stats = self._get_current_stats()
+        stats["all_time"] = self._get_all_time_stats()
+        return stats
+
+    def collect_stats(self):
+        """Like get_stats(), but returns a Deferred. Our connections are
+        counted here, in the reactor, but the all-time totals come from the
+        usage writer, which may be writing to the database."""
+        stats = self._get_current_stats()
+        if self._usage:
+            d = defer.gatherResults(
+                [self._usage.get_usage_counts("transit"),
+                 self._usage.get_usage_counts("transit_bytes")],
+                consumeErrors=True)
+            d.addCallback(lambda counts: self._summarize_all_time(*counts))
+        else:
+            d = defer.maybeDeferred(self._get_all_time_stats)
+        def _got(all_time):
+            stats["all_time"] = all_time
+            return stats
+        d.addCallback(_got)
+        return d
+
+    def _get_current_stats(self):
+        stats = {}
+
+        # current status: expected to be zero most of the time
+        c = stats["active"] = {}
+        c["connected"] = len(self._active_connections) // 2
+        c["waiting"] = len(self._pending_requests)
+
+        # usage since last reboot
+        rb = stats["since_reboot"] = {}
+        rb["bytes"] = self._count_bytes
+        rb["total"] = sum(self._counts.values(), 0)
+        rbm = rb["moods"] = {}
+        for result, count in self._counts.items():
+            rbm[result] = count
+
+        return stats
+
+    def _get_all_time_stats(self):
+        return self._summarize_all_time(
+            get_usage_counts(self._db, "transit"),
+            get_usage_counts(self._db, "transit_bytes"))
+
+    def _summarize_all_time(self, counts, byte_counts):
+        # historical usage (all-time)
+        u = {}
+        u["total"] = sum(counts.values())
+        u["bytes"] = sum(byte_counts.values())
+        um = u["moods"] = {}
+        for result in ["happy", "lonely", "errory"]:
+            um[result] = counts.get(result, 0)
+
+        return u
+
+    def stopService(self):
+        # drop everybody, so a restart doesn't leave clients hanging
+        for tc in list(self._active_connections):
+            tc.close()
+        for potentials in list(self._pending_requests.values()):
+            for (_, tc) in list(potentials):
+                tc.close()
+        return service.MultiService.stopService(self)
@@ -0,0 +1,459 @@
+from __future__ import print_function, unicode_literals
+import os, sys, json, errno, shutil, socket, struct, tempfile, zlib
+from twisted.python import log
+from twisted.internet import reactor, defer, protocol, endpoints, stdio
+from twisted.application import service, internet
+from twisted.protocols import basic
+from .rendezvous_websocket import WebSocketRendezvous
+
+# With --workers=N, the rendezvous server runs as N processes, all accepting
+# WebSocket connections on the same port (with SO_REUSEPORT, the kernel
+# spreads new connections among them). The first process (the one that
+# twistd started) spawns the others, and is the only one that runs the
+# transit relay or writes the stats file.
+#
+# Each app_id belongs to exactly one worker: owner_of() hashes it. All of an
+# app's nameplates and mailboxes live in that worker's Rendezvous, exactly as
+# they would in a single-process server, because claiming a nameplate opens
+# its mailbox, and pruning a mailbox removes its nameplate, so they can't be
+# split up. When a client binds to an app that belongs to another worker,
+# the worker it connected to becomes a relay: it keeps terminating the
+# WebSocket (framing, pings, and compression are the expensive part), and
+# parses, checks, and acks each message, then forwards its payload to the
+# owner over a unix-domain socket, where a _ProxiedRendezvous (a
+# WebSocketRendezvous with no transport of its own) handles it, and forwards
+# that protocol's responses back. Two sides that land on different workers
+# thus still meet in the same Rendezvous.
+#
+# This spreads the load of many apps over the workers, but all the clients
+# of one app still end up in a single worker. Splitting an app up would need
+# a way to allocate and list its nameplates across workers, which this
+# doesn't attempt.
+#
+# The link between two workers carries length-prefixed frames, each with a
+# one-byte opcode and a 32-bit connection (or request) number:
+#
+#  D/B: a text/binary message for connection N (in either direction)
+#  C: connection N was closed by the client
+#  S: please send your stats, as request N
+#  T: here are the stats (JSON) for request N
+
+_HEADER = struct.Struct(">cI")
+
+def owner_of(app_id, workers):
+    # python's hash() is randomized per-process, so use something stable
+    return zlib.crc32(app_id.encode("utf-8")) % workers
+
+def socket_path(worker_dir, index):
+    return os.path.join(worker_dir, "worker-%d.sock" % index)
+
+
+class _Link(basic.Int32StringReceiver):
+    MAX_LENGTH = 16*1024*1024
+
+    def connectionMade(self):
+        self.factory.handler.link_made(self)
+
+    def send_frame(self, op, number, payload=b""):
+        self.sendString(_HEADER.pack(op, number) + payload)
+
+    def stringReceived(self, frame):
+        op, number = _HEADER.unpack_from(frame)
+        self.factory.handler.frame_received(self, op, number,
+                                            frame[_HEADER.size:])
+
+    def connectionLost(self, why):
+        self.factory.handler.link_lost(self)
+
+class _LinkFactory(protocol.Factory):
+    protocol = _Link
+    def __init__(self, handler):
+        self.handler = handler
+
+
+class _ProxiedRendezvous(WebSocketRendezvous):
+    """I run the rendezvous protocol, in the owning worker, for a client that
+    is connected to some other worker."""
+    def __init__(self, factory, link, conn_id):
+        WebSocketRendezvous.__init__(self)
+        self.factory = factory
+        self._link = link
+        self._conn_id = conn_id
+        self._reactor = factory.reactor
+
+    def sendMessage(self, payload, isBinary=False):
+        self._link.send_frame(b"B" if isBinary else b"D", self._conn_id,
+                              payload)
+
+    def sendPreparedMessage(self, prepared):
+        # the framing is done by the worker the client is connected to
+        self.sendMessage(prepared.payload, prepared.binary)
+
+    def _ack(self, msg):
+        # and so is the ack
+        pass
+
+class _Inbound(object):
+    # connections from other workers, to the apps that we own
+    def __init__(self, router):
+        self._router = router
+        self._proxied = {} # link -> {conn_id: _ProxiedRendezvous}
+
+    def link_made(self, link):
+        self._proxied[link] = {}
+
+    def frame_received(self, link, op, conn_id, payload):
+        conns = self._proxied[link]
+        if op in (b"D", b"B"):
+            p = conns.get(conn_id)
+            if p is None:
+                p = _ProxiedRendezvous(self._router._wsrf, link, conn_id)
+                conns[conn_id] = p
+            p.onMessage(payload, op == b"B")
+        elif op == b"C":
+            p = conns.pop(conn_id, None)
+            if p:
+                p.onClose(True, None, None)
+        elif op == b"S":
+            d = self._router._get_local_stats()
+            d.addCallback(lambda stats: link.send_frame(
+                b"T", conn_id, json.dumps(stats).encode("utf-8")))
+            d.addErrback(log.err, "error collecting stats for a worker")
+        else:
+            log.msg("unknown frame %r from another worker" % (op,))
+
+    def link_lost(self, link):
+        # the other worker went away, and took those clients with it
+        for p in self._proxied.pop(link, {}).values():
+            p.onClose(False, None, None)
+
+
+class _Outbound(object):
+    # our connection to one other worker, for the clients (connected to us)
+    # that bound to its apps, and to ask for its stats
+    def __init__(self, router, index):
+        self._router = router
+        self._index = index
+        self._link = None
+        self._queue = [] # frames waiting for the link
+        self._clients = {} # conn_id -> WebSocketRendezvous
+        self._next_id = 1
+        self._stats_requests = {} # request id -> Deferred
+        ep = endpoints.UNIXClientEndpoint(
+            router._reactor, socket_path(router._worker_dir, index))
+        self._service = internet.ClientService(
+            ep, _LinkFactory(self),
+            retryPolicy=internet.backoffPolicy(initialDelay=0.1, maxDelay=2.0))
+        self._service.startService()
+
+    def stop(self):
+        return self._service.stopService()
+
+    def _send(self, op, number, payload=b""):
+        if self._link:
+            self._link.send_frame(op, number, payload)
+        else:
+            self._queue.append((op, number, payload))
+
+    def link_made(self, link):
+        self._link = link
+        queue, self._queue = self._queue, []
+        for frame in queue:
+            link.send_frame(*frame)
+
+    def link_lost(self, link):
+        self._link = None
+        self._queue = []
+        # the other worker has forgotten about these connections, so the
+        # clients will have to reconnect, like they would if we restarted
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            client._proxy = None
+            client.dropConnection(abort=True)
+        requests, self._stats_requests = self._stats_requests, {}
+        for d in requests.values():
+            d.callback(None)
+
+    def frame_received(self, link, op, number, payload):
+        if op in (b"D", b"B"):
+            client = self._clients.get(number)
+            if client:
+                client.sendMessage(payload, op == b"B")
+        elif op == b"T":
+            d = self._stats_requests.pop(number, None)
+            if d:
+                d.callback(json.loads(payload.decode("utf-8")))
+        else:
+            log.msg("unknown frame %r from worker %d" % (op, self._index))
+
+    def add_client(self, client):
+        conn_id = self._next_id
+        self._next_id += 1
+        self._clients[conn_id] = client
+        return _Proxy(self, conn_id)
+
+    def get_stats(self):
+        # fires with None if the worker isn't there
+        request_id = self._next_id
+        self._next_id += 1
+        d = self._stats_requests[request_id] = defer.Deferred()
+        self._send(b"S", request_id)
+        return d
+
+class _Proxy(object):
+    # the client side's handle on a proxied connection
+    def __init__(self, outbound, conn_id):
+        self._outbound = outbound
+        self._conn_id = conn_id
+
+    def forward(self, payload, isBinary):
+        self._outbound._send(b"B" if isBinary else b"D", self._conn_id,
+                             payload)
+
+    def close(self):
+        if self._outbound._clients.pop(self._conn_id, None):
+            self._outbound._send(b"C", self._conn_id)
+
+
+class WorkerRouter(service.Service):
+    """I connect one worker to the others: I listen for the ones whose
+    clients bound to our apps, and connect to the ones that own the apps our
+    clients bind to."""
+
+    def __init__(self, index, workers, worker_dir, wsrf, rendezvous,
+                 reactor=reactor):
+        self._index = index
+        self._workers = workers
+        self._worker_dir = worker_dir
+        self._wsrf = wsrf
+        self._rendezvous = rendezvous
+        self._reactor = reactor
+        self._inbound = _Inbound(self)
+        self._outbound = {} # index -> _Outbound
+        self._port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        path = socket_path(self._worker_dir, self._index)
+        if os.path.exists(path):
+            os.unlink(path) # left over from a previous run
+        self._port = self._reactor.listenUNIX(path,
+                                              _LinkFactory(self._inbound))
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        yield defer.maybeDeferred(service.Service.stopService, self)
+        outbound, self._outbound = self._outbound, {}
+        for o in outbound.values():
+            yield o.stop()
+        if self._port:
+            yield self._port.stopListening()
+            self._port = None
+
+    def owner_of(self, app_id):
+        return owner_of(app_id, self._workers)
+
+    def is_local(self, app_id):
+        return self.owner_of(app_id) == self._index
+
+    def _get_outbound(self, index):
+        if index not in self._outbound:
+            self._outbound[index] = _Outbound(self, index)
+        return self._outbound[index]
+
+    def proxy(self, client, app_id):
+        """Route the rest of this client's connection to the worker that
+        owns app_id. Returns a handle with .forward(payload, isBinary) and
+        .close()."""
+        return self._get_outbound(self.owner_of(app_id)).add_client(client)
+
+    def _get_local_stats(self):
+        return self._rendezvous.collect_stats()
+
+    def collect_stats(self):
+        """Return a Deferred that fires with a list of the other workers'
+        rendezvous stats (None for any that didn't answer)."""
+        ds = [self._get_outbound(index).get_stats()
+              for index in range(self._workers) if index != self._index]
+        return defer.gatherResults(ds)
+
+
+def merge_stats(mine, others):
+    """Combine the rendezvous stats of all workers. Current and since-reboot
+    counts are added up, but the all-time counts come from the database,
+    which the workers share, so any worker's will do."""
+    merged = json.loads(json.dumps(mine)) # deep copy
+    answered = [s for s in others if s is not None]
+    for stats in answered:
+        for key in ["active", "since_reboot"]:
+            _add(merged[key], stats[key])
+        p, q = merged["prune"], stats["prune"]
+        for key in ["passes", "mailboxes_visited", "busy_seconds"]:
+            p[key] += q[key]
+        p["max_slice_seconds"] = max(p["max_slice_seconds"],
+                                     q["max_slice_seconds"])
+    merged["workers"] = {"total": 1+len(others),
+                         "answered": 1+len(answered)}
+    return merged
+
+def _add(into, more):
+    for key, value in more.items():
+        if isinstance(value, dict):
+            _add(into.setdefault(key, {}), value)
+        else:
+            into[key] = into.get(key, 0) + value
+
+
+def listen_reuseport(reactor, description, factory):
+    """Listen on a 'tcp:PORT[:interface=ADDR][:backlog=N]' endpoint, with
+    SO_REUSEPORT set, so other processes can listen on the same port. Returns
+    the IListeningPort."""
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise ValueError("--workers needs SO_REUSEPORT, which this platform"
+                         " doesn't have")
+    parts = description.split(":")
+    if parts[0] != "tcp":
+        raise ValueError("--workers only works with a tcp:PORT endpoint,"
+                         " not %r" % (description,))
+    port = int(parts[1])
+    kwargs = dict(p.split("=", 1) for p in parts[2:])
+    interface = kwargs.get("interface", "")
+    backlog = int(kwargs.get("backlog", 50))
+    family = socket.AF_INET6 if ":" in interface else socket.AF_INET
+    s = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind((interface, port))
+        s.listen(backlog)
+        s.setblocking(False)
+        # adoptStreamPort dup()s the descriptor
+        return reactor.adoptStreamPort(s.fileno(), family, factory)
+    finally:
+        s.close()
+
+class ReusePortService(service.Service):
+    def __init__(self, description, factory, reactor=reactor):
+        self._description = description
+        self._factory = factory
+        self._reactor = reactor
+        self.port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self.port = listen_reuseport(self._reactor, self._description,
+                                     self._factory)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.port:
+            port, self.port = self.port, None
+            return port.stopListening()
+
+
+class _WorkerProcess(protocol.ProcessProtocol):
+    def __init__(self, spawner, index):
+        self._spawner = spawner
+        self._index = index
+        self._buffer = b""
+        self.ended = defer.Deferred()
+
+    def outReceived(self, data):
+        # the worker logs to stdout, and we put that into our own log
+        lines = (self._buffer + data).split(b"\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            log.msg("worker %d: %s" % (self._index,
+                                       line.decode("utf-8", "replace")))
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+        self._spawner.worker_ended(self._index, reason)
+
+class WorkerSpawner(service.Service):
+    """I run (and restart, if they die) the other workers, each as
+    'python -m wormhole.server.workers CONFIG'. They exit when our end of
+    their stdin goes away, so they don't outlive us even if we are killed."""
+    RESTART_DELAY = 1.0
+
+    def __init__(self, get_config, workers, reactor=reactor):
+        # get_config() returns the RelayServer arguments for the workers. It
+        # is called when we start, since the port they listen on might not
+        # be known before then.
+        self._get_config = get_config
+        self._config = None
+        self._workers = workers
+        self._reactor = reactor
+        self._processes = {} # index -> (ProcessTransport, _WorkerProcess)
+
+    def startService(self):
+        service.Service.startService(self)
+        self._config = self._get_config()
+        for index in range(1, self._workers):
+            self._spawn(index)
+
+    def _spawn(self, index):
+        config = dict(self._config, worker_index=index)
+        p = _WorkerProcess(self, index)
+        args = [sys.executable, "-m", "wormhole.server.workers",
+                json.dumps(config)]
+        t = self._reactor.spawnProcess(p, sys.executable, args,
+                                       env=os.environ,
+                                       childFDs={0: "w", 1: "r", 2: "r"})
+        self._processes[index] = (t, p)
+        log.msg("started worker %d (pid %d)" % (index, t.pid))
+
+    def worker_ended(self, index, reason):
+        self._processes.pop(index, None)
+        if self.running:
+            log.msg("worker %d exited (%s), restarting" %
+                    (index, reason.getErrorMessage()))
+            self._reactor.callLater(self.RESTART_DELAY, self._restart, index)
+
+    def _restart(self, index):
+        if self.running and index not in self._processes:
+            self._spawn(index)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        ended = []
+        for (t, p) in self._processes.values():
+            try:
+                t.signalProcess("TERM")
+            except OSError as e: # it might have exited already
+                if e.errno != errno.ESRCH:
+                    raise
+            except Exception: # ProcessExitedAlready
+                pass
+            ended.append(p.ended)
+        return defer.DeferredList(ended)
+
+def make_worker_dir():
+    return tempfile.mkdtemp(prefix="wormhole-workers-")
+
+def remove_worker_dir(worker_dir):
+    shutil.rmtree(worker_dir, ignore_errors=True)
+
+
+class _Parent(protocol.Protocol):
+    # our stdin is a pipe from the first worker. When it closes, that
+    # worker is gone, and we should go too.
+    def dataReceived(self, data):
+        pass
+    def connectionLost(self, why):
+        if reactor.running:
+            reactor.stop()
+
+def main(argv):
+    from .server import RelayServer
+    config = json.loads(argv[0])
+    log.startLogging(sys.stdout, setStdout=False)
+    rs = RelayServer(**config)
+    stdio.StandardIO(_Parent())
+    reactor.callWhenRunning(rs.startService)
+    reactor.addSystemEventTrigger("before", "shutdown", rs.stopService)
+    reactor.run()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
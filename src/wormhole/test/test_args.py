@@ -23,6 +23,8 @@ class Send(unittest.TestCase):
         self.assertEqual(cfg.tor, False)
         self.assertEqual(cfg.verify, False)
         self.assertEqual(cfg.zeromode, False)
+        self.assertEqual(cfg.crypto_threads, 0)
+        self.assertEqual(cfg.websocket_deflate, False)
 
     def test_appid(self):
         cfg = config("--appid", "xyz", "send", "--text", "hi")
@@ -41,10 +43,18 @@ class Send(unittest.TestCase):
         self.assertEqual(cfg.what, None)
         self.assertEqual(cfg.text, u"hi")
 
+    def test_websocket_deflate(self):
+        cfg = config("--websocket-deflate", "send", "--text", "hi")
+        self.assertEqual(cfg.websocket_deflate, True)
+
     def test_nolisten(self):
         cfg = config("send", "--no-listen", "fn")
         self.assertEqual(cfg.listen, False)
 
+    def test_crypto_threads(self):
+        cfg = config("send", "--crypto-threads", "4", "fn")
+        self.assertEqual(cfg.crypto_threads, 4)
+
     def test_code(self):
         cfg = config("send", "--code", "1-abc", "fn")
         self.assertEqual(cfg.code, u"1-abc")
@@ -110,12 +120,15 @@ class Receive(unittest.TestCase):
         self.assertEqual(cfg.listen, True)
         self.assertEqual(cfg.only_text, False)
         self.assertEqual(cfg.output_file, None)
+        self.assertEqual(cfg.fsync, False)
         self.assertEqual(cfg.appid, None)
         self.assertEqual(cfg.relay_url, RENDEZVOUS_RELAY)
         self.assertEqual(cfg.transit_helper, TRANSIT_RELAY)
         self.assertEqual(cfg.tor, False)
         self.assertEqual(cfg.verify, False)
         self.assertEqual(cfg.zeromode, False)
+        self.assertEqual(cfg.crypto_threads, 0)
+        self.assertEqual(cfg.websocket_deflate, False)
 
     def test_appid(self):
         cfg = config("--appid", "xyz", "receive")
@@ -127,6 +140,10 @@ class Receive(unittest.TestCase):
         cfg = config("receive", "--no-listen")
         self.assertEqual(cfg.listen, False)
 
+    def test_crypto_threads(self):
+        cfg = config("receive", "--crypto-threads", "2")
+        self.assertEqual(cfg.crypto_threads, 2)
+
     def test_code(self):
         cfg = config("receive", "1-abc")
         self.assertEqual(cfg.code, u"1-abc")
@@ -163,6 +180,10 @@ class Receive(unittest.TestCase):
         cfg = config("receive", "--accept-file")
         self.assertEqual(cfg.accept_file, True)
 
+    def test_fsync(self):
+        cfg = config("receive", "--fsync")
+        self.assertEqual(cfg.fsync, True)
+
     def test_output_file(self):
         cfg = config("receive", "--output-file", "fn")
         self.assertEqual(cfg.output_file, u"fn")
@@ -1,5 +1,5 @@
 from __future__ import print_function
-import os, sys, re, io, zipfile, six, stat
+import os, sys, re, io, json, zipfile, hashlib, six, stat
 from textwrap import fill, dedent
 from humanize import naturalsize
 import mock
@@ -66,6 +66,7 @@ class OfferData(unittest.TestCase):
         self.assertNotIn("directory", d)
         self.assertEqual(d["file"]["filesize"], len(message))
         self.assertEqual(d["file"]["filename"], filename)
+        self.assertEqual(d["file"]["resumable"], True)
         self.assertEqual(fd_to_send.tell(), 0)
         self.assertEqual(fd_to_send.read(), message)
 
@@ -381,7 +382,9 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
     @inlineCallbacks
     def _do_test(self, as_subprocess=False,
                  mode="text", addslash=False, override_filename=False,
-                 fake_tor=False, overwrite=False, mock_accept=False):
+                 fake_tor=False, overwrite=False, mock_accept=False,
+                 resume=None):
+        assert resume in (None, "good", "mismatch")
         assert mode in ("text", "file", "empty-file", "directory",
                         "slow-text", "slow-sender-text")
         if fake_tor:
@@ -424,6 +427,18 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
                 existing_file = os.path.join(receive_dir, receive_filename)
                 with open(existing_file, 'w') as f:
                     f.write('pls overwrite me')
+            if resume:
+                # pretend an earlier attempt got part of the way
+                partial = message[:10].encode("ascii")
+                if resume == "mismatch":
+                    partial = b"X" * 10
+                tmp_file = os.path.join(receive_dir, receive_filename+".tmp")
+                with open(tmp_file, "wb") as f:
+                    f.write(partial)
+                with open(tmp_file+".resume", "w") as f:
+                    json.dump({"filesize": len(message), "offset": 10,
+                               "sha256": hashlib.sha256(partial).hexdigest()},
+                              f)
 
         elif mode == "directory":
             # $send_dir/
@@ -641,6 +656,14 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
             self.failUnless(os.path.exists(fn))
             with open(fn, "r") as f:
                 self.failUnlessEqual(f.read(), message)
+            self.failIf(os.path.exists(fn+".tmp.resume"))
+            if resume == "good":
+                self.failUnlessIn(u"Resuming after 10 Bytes", send_stderr)
+                self.failUnlessIn(u"Resuming after 10 Bytes", receive_stderr)
+            elif resume == "mismatch":
+                self.failUnlessIn(u"Receiver's partial file doesn't match",
+                                  send_stderr)
+                self.failIfIn(u"Resuming after", receive_stderr)
         elif mode == "directory":
             self.failUnlessEqual(receive_stdout, "")
             want = (r"Receiving directory \(\d+ \w+\) into: {name}/"
@@ -680,6 +703,10 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
         return self._do_test(mode="file", fake_tor=True)
     def test_empty_file(self):
         return self._do_test(mode="empty-file")
+    def test_file_resume(self):
+        return self._do_test(mode="file", resume="good")
+    def test_file_resume_mismatch(self):
+        return self._do_test(mode="file", resume="mismatch")
 
     def test_directory(self):
         return self._do_test(mode="directory")
@@ -852,6 +879,58 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
     def test_fail_directory_toobig(self):
         return self._do_test_fail("directory", "toobig")
 
+class Resume(unittest.TestCase):
+    def setUp(self):
+        self.cfg = cfg = config("receive")
+        cfg.stderr = io.StringIO()
+        self.r = cmd_receive.Receiver(cfg)
+        self.r.xfersize = 100
+        d = self.mktemp()
+        os.mkdir(d)
+        self.tmp_destname = os.path.join(d, "file.tmp")
+        self.r._resume_path = self.tmp_destname + ".resume"
+
+    def write_partial(self, data, state):
+        with open(self.tmp_destname, "wb") as f:
+            f.write(data)
+        with open(self.r._resume_path, "w") as f:
+            f.write(state if isinstance(state, str) else json.dumps(state))
+
+    @inlineCallbacks
+    def test_checkpoint(self):
+        with open(self.tmp_destname, "wb") as f:
+            f.write(b"a"*30)
+            self.r._hasher.update(b"a"*30)
+            self.r._checkpoint(f, 30)
+            f.write(b"b"*10) # written after the checkpoint, so ignored
+        d = self.r._open_partial(self.tmp_destname)
+        self.assertNoResult(d) # it's hashed in a thread
+        f = yield d
+        self.assertEqual(self.r._resume_offset, 30)
+        self.assertEqual(f.tell(), 30)
+        f.close()
+        with open(self.tmp_destname, "rb") as f:
+            self.assertEqual(f.read(), b"a"*30)
+
+    @inlineCallbacks
+    def test_unusable(self):
+        good = {"filesize": 100, "offset": 30,
+                "sha256": hashlib.sha256(b"a"*30).hexdigest()}
+        for data, state in [(b"a"*30, "not json"),
+                            (b"a"*30, dict(good, filesize=99)),
+                            (b"a"*30, dict(good, offset=100)),
+                            (b"a"*30, dict(good, offset="30")),
+                            (b"a"*30, dict(good, sha256="00")),
+                            (b"a"*20, good), # the .tmp file got shorter
+                            ]:
+            self.write_partial(data, state)
+            f = yield self.r._open_partial(self.tmp_destname)
+            self.assertEqual(f, None)
+            self.assertEqual(self.r._resume_offset, 0)
+        os.remove(self.tmp_destname)
+        f = yield self.r._open_partial(self.tmp_destname)
+        self.assertEqual(f, None)
+
 class ZeroMode(ServerBase, unittest.TestCase):
     @inlineCallbacks
     def test_text(self):
@@ -1257,6 +1336,11 @@ class FakeConfig(object):
     blur_usage = True
     advertise_version = u"fake.version.1"
     transit = str('tcp:4321')
+    rendezvous_state = "sqlite"
+    db_journal_mode = "wal"
+    db_synchronous = "normal"
+    db_commit_window = 0.05
+    workers = 1
     rendezvous = str('tcp:1234')
     signal_error = True
     allow_list = False
@@ -1279,6 +1363,7 @@ class Server(unittest.TestCase):
         plugin = MyPlugin(cfg)
         relay = plugin.makeService(None)
         self.assertEqual(False, relay._allow_list)
+        self.assertEqual(0.05, relay._group_commit._window)
 
     @mock.patch("wormhole.server.cmd_server.start_server")
     def test_start_no_args(self, fake_start_server):
@@ -1321,6 +1406,29 @@ class Server(unittest.TestCase):
              ],
         )
 
+    @mock.patch("wormhole.server.cmd_server.start_server")
+    def test_websocket_deflate_option(self, fake_start_server):
+        result = self.runner.invoke(
+            server, [
+                'start',
+                '--websocket-protocol-option',
+                'permessage_deflate={"window_bits": 10, "mem_level": 4}',
+            ])
+        self.assertEqual(0, result.exit_code)
+        cfg = fake_start_server.mock_calls[0][1][0]
+        self.assertEqual(cfg.websocket_protocol_option,
+                         [("permessage_deflate",
+                           {"window_bits": 10, "mem_level": 4})])
+
+        result = self.runner.invoke(
+            server, [
+                'start',
+                '--websocket-protocol-option=permessage_deflate={"level": 4}',
+            ])
+        self.assertNotEqual(0, result.exit_code)
+        self.assertIn("unknown permessage-deflate option 'level'",
+                      result.output)
+
     def test_broken_websocket_protocol_options(self):
         result = self.runner.invoke(
             server, [
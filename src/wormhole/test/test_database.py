@@ -3,7 +3,8 @@ import os
 from twisted.python import filepath
 from twisted.trial import unittest
 from ..server import database
-from ..server.database import get_db, TARGET_VERSION, dump_db
+from ..server.database import (get_db, TARGET_VERSION, dump_db,
+                                get_usage_counts)
 
 class DB(unittest.TestCase):
     def test_create_default(self):
@@ -59,3 +60,90 @@ class DB(unittest.TestCase):
             with open("new.sql","w") as f: f.write(latest_text)
             # check with "diff -u _trial_temp/up.sql _trial_temp/new.sql"
             self.assertEqual(dbA_text, latest_text)
+
+    def test_upgrade_usage_counts(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "upgrade.db")
+        db = get_db(fn, 3)
+        for result in ["happy", "happy", "lonely"]:
+            db.execute("INSERT INTO `nameplate_usage` (`result`) VALUES (?)",
+                       (result,))
+        db.execute("INSERT INTO `mailbox_usage` (`for_nameplate`, `result`)"
+                   " VALUES (?,?)", (False, "scary"))
+        db.execute("INSERT INTO `mailbox_usage` (`for_nameplate`, `result`)"
+                   " VALUES (?,?)", (True, "happy"))
+        db.execute("INSERT INTO `transit_usage` (`total_bytes`, `result`)"
+                   " VALUES (?,?)", (100, "happy"))
+        db.commit()
+        db.close()
+
+        # the running totals start out with the history
+        db = get_db(fn, 4)
+        self.assertEqual(get_usage_counts(db, "nameplate"),
+                         {"happy": 2, "lonely": 1})
+        self.assertEqual(get_usage_counts(db, "mailbox"),
+                         {"happy": 1, "scary": 1})
+        self.assertEqual(get_usage_counts(db, "mailbox_standalone"),
+                         {"scary": 1})
+        self.assertEqual(get_usage_counts(db, "transit"), {"happy": 1})
+        self.assertEqual(get_usage_counts(db, "transit_bytes"), {"happy": 100})
+
+        # and carry on from there
+        for (sql, values) in database.count_usage("nameplate", "happy"):
+            db.execute(sql, values)
+        for (sql, values) in database.count_usage("nameplate", "crowded"):
+            db.execute(sql, values)
+        self.assertEqual(get_usage_counts(db, "nameplate"),
+                         {"happy": 3, "lonely": 1, "crowded": 1})
+        db.close()
+
+    def test_indexes(self):
+        # the side tables and messages are looked up by their mailbox or
+        # nameplate, and that shouldn't mean scanning all of them
+        def plan(db, query, values):
+            rows = db.execute("EXPLAIN QUERY PLAN " + query, values).fetchall()
+            return " ".join([row["detail"] for row in rows])
+        queries = [
+            ("SELECT * FROM `nameplate_sides`"
+             " WHERE `nameplates_id`=? AND `side`=?", (1, "side"),
+             "nameplate_sides_idx"),
+            ("SELECT * FROM `mailbox_sides`"
+             " WHERE `mailbox_id`=? AND `side`=?", ("mbid", "side"),
+             "mailbox_sides_idx"),
+            ("SELECT * FROM `messages` WHERE `app_id`=? AND `mailbox_id`=?"
+             " ORDER BY `server_rx` ASC", ("appid", "mbid"),
+             "messages_mailbox_idx"),
+            ]
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "upgrade.db")
+        get_db(fn, 4).close()
+        for db in [get_db(":memory:"), get_db(fn)]: # new, and upgraded
+            for (query, values, index) in queries:
+                p = plan(db, query, values)
+                self.assertIn("USING INDEX %s" % index, p)
+                self.assertNotIn("TEMP B-TREE", p) # no sorting
+            db.close()
+
+    def test_durability(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "wal.db")
+        db = get_db(fn, journal_mode="wal", synchronous="off")
+        self.assertEqual(db.execute("PRAGMA journal_mode").fetchone(),
+                         {"journal_mode": "wal"})
+        self.assertEqual(db.execute("PRAGMA synchronous").fetchone(),
+                         {"synchronous": 0})
+        db.close()
+        # WAL mode sticks to the file, synchronous does not
+        db = get_db(fn)
+        self.assertEqual(db.execute("PRAGMA journal_mode").fetchone(),
+                         {"journal_mode": "wal"})
+        db.close()
+
+    def test_bad_durability(self):
+        self.assertRaises(database.DBError, get_db, ":memory:",
+                          journal_mode="; DROP TABLE version")
+        self.assertRaises(database.DBError, get_db, ":memory:",
+                          synchronous="sometimes")
@@ -0,0 +1,106 @@
+from __future__ import print_function, unicode_literals
+import mock
+from twisted.trial import unittest
+from .. import ipaddrs
+
+IP_ADDR_OUTPUT = """\
+1: lo: <LOOPBACK,UP,LOWER_UP> mtu 65536 qdisc noqueue state UNKNOWN
+    link/loopback 00:00:00:00:00:00 brd 00:00:00:00:00:00
+    inet 127.0.0.1/8 scope host lo
+       valid_lft forever preferred_lft forever
+    inet6 ::1/128 scope host
+       valid_lft forever preferred_lft forever
+2: eth0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 qdisc fq_codel state UP
+    link/ether 52:54:00:12:34:56 brd ff:ff:ff:ff:ff:ff
+    inet 192.168.1.5/24 brd 192.168.1.255 scope global eth0
+       valid_lft forever preferred_lft forever
+    inet6 2001:db8::5/64 scope global dynamic
+       valid_lft 86000sec preferred_lft 14000sec
+    inet6 fe80::5054:ff:fe12:3456/64 scope link
+       valid_lft forever preferred_lft forever
+"""
+
+IFCONFIG_OUTPUT = """\
+lo0: flags=8049<UP,LOOPBACK,RUNNING,MULTICAST> mtu 16384
+	inet 127.0.0.1 netmask 0xff000000
+	inet6 ::1 prefixlen 128
+	inet6 fe80::1%lo0 prefixlen 64 scopeid 0x1
+en0: flags=8863<UP,BROADCAST,SMART,RUNNING,SIMPLEX,MULTICAST> mtu 1500
+	inet6 fe80::1c2b:3a4d:5e6f:7a8b%en0 prefixlen 64 secured scopeid 0x4
+	inet 10.0.0.7 netmask 0xffffff00 broadcast 10.0.0.255
+	inet6 2001:db8:1::7 prefixlen 64 autoconf secured
+"""
+
+class FakeProcess:
+    def __init__(self, output):
+        self._output = output
+    def communicate(self):
+        return (self._output, "")
+
+class Query(unittest.TestCase):
+    def query(self, output):
+        with mock.patch("subprocess.Popen",
+                        return_value=FakeProcess(output)):
+            return ipaddrs._query("/bin/ip", ("addr",), ipaddrs._both_re)
+
+    def test_ip(self):
+        self.assertEqual(self.query(IP_ADDR_OUTPUT),
+                         ["127.0.0.1", "::1", "192.168.1.5", "2001:db8::5"])
+
+    def test_ifconfig(self):
+        self.assertEqual(self.query(IFCONFIG_OUTPUT),
+                         ["127.0.0.1", "::1", "10.0.0.7", "2001:db8:1::7"])
+
+class Native(unittest.TestCase):
+    def setUp(self):
+        ipaddrs._cache.clear()
+        self.addCleanup(ipaddrs._cache.clear)
+
+    def test_getifaddrs(self):
+        if ipaddrs.platform == "win32":
+            raise unittest.SkipTest("no getifaddrs() on windows")
+        addresses = ipaddrs._find_addresses_natively()
+        self.assertIn("127.0.0.1", addresses)
+        for addr in addresses:
+            self.assertFalse(addr.startswith("fe80:"), addr)
+
+    def test_filter(self):
+        found = [(0x1, "127.0.0.1"), (0x1, "::1"),
+                 (0x0, "10.0.0.9"), # interface is down
+                 (0x1, "192.168.1.5"), (0x1, "192.168.1.5"),
+                 (0x1, "fe80::5054:ff:fe12:3456"),
+                 (0x1, "2001:db8::5")]
+        with mock.patch("wormhole.ipaddrs._getifaddrs", return_value=found):
+            self.assertEqual(ipaddrs._find_addresses_natively(),
+                             ["127.0.0.1", "::1", "192.168.1.5",
+                              "2001:db8::5"])
+
+    def test_cached(self):
+        with mock.patch("wormhole.ipaddrs._getifaddrs",
+                        return_value=[(0x1, "10.0.0.7")]) as g:
+            with mock.patch("time.time", return_value=1000.0):
+                self.assertEqual(ipaddrs.find_addresses(), ["10.0.0.7"])
+                addresses = ipaddrs.find_addresses()
+                self.assertEqual(addresses, ["10.0.0.7"])
+                self.assertEqual(g.call_count, 1)
+                addresses.append("mutated by the caller")
+                self.assertEqual(ipaddrs.find_addresses(), ["10.0.0.7"])
+            later = 1000.0 + ipaddrs.CACHE_SECONDS
+            with mock.patch("time.time", return_value=later):
+                self.assertEqual(ipaddrs.find_addresses(), ["10.0.0.7"])
+                self.assertEqual(g.call_count, 2)
+
+    def test_fallback(self):
+        with mock.patch("wormhole.ipaddrs._getifaddrs",
+                        side_effect=OSError("nope")):
+            with mock.patch("wormhole.ipaddrs._find_addresses_with_tools",
+                            return_value=["10.0.0.7"]) as t:
+                self.assertEqual(ipaddrs.find_addresses(), ["10.0.0.7"])
+        self.assertEqual(t.call_count, 1)
+
+    def test_fallback_when_empty(self):
+        with mock.patch("wormhole.ipaddrs._getifaddrs", return_value=[]):
+            with mock.patch("wormhole.ipaddrs._find_addresses_with_tools",
+                            return_value=["127.0.0.1"]) as t:
+                self.assertEqual(ipaddrs.find_addresses(), ["127.0.0.1"])
+        self.assertEqual(t.call_count, 1)
@@ -12,7 +12,8 @@ from .._interfaces import (IKey, IReceive, IBoss, ISend, IMailbox, IOrder,
 from .._key import derive_key, derive_phase_key, encrypt_data
 from ..journal import ImmediateJournal
 from ..util import (dict_to_bytes, bytes_to_dict,
-                    hexstr_to_bytes, bytes_to_hexstr, to_bytes)
+                    hexstr_to_bytes, bytes_to_hexstr, to_bytes,
+                    dict_and_body_to_bytes, bytes_to_dict_and_body)
 from spake2 import SPAKE2_Symmetric
 from nacl.secret import SecretBox
 
@@ -1502,7 +1503,7 @@ class Rendezvous(unittest.TestCase):
                 yield bytes_to_dict(c[1][0])
         self.assertEqual(list(sent_messages(ws)),
                          [dict(appid="appid", side="side", id="0000",
-                               type="bind"),
+                               type="bind", binary=True),
                           ])
 
         rc.ws_close(True, None, None)
@@ -1512,6 +1513,49 @@ class Rendezvous(unittest.TestCase):
                                   ("a.lost", ),
                                   ])
 
+    def test_binary(self):
+        # bodies are sent as hex until the server says it takes them raw,
+        # and can arrive either way
+        rc, events = self.build()
+        ws = mock.Mock()
+        rc.ws_open(ws)
+        ws.reset_mock()
+        rc.tx_add("phase1", b"\x00\xff")
+        ((name, args, kwargs),) = ws.mock_calls
+        self.assertEqual(args[1], False)
+        self.assertEqual(bytes_to_dict(args[0])["body"], "00ff")
+
+        rc.ws_message(dict_to_bytes({"type": "bound", "binary": True}))
+        ws.reset_mock()
+        rc.tx_add("phase2", b"\x00\xff")
+        ((name, args, kwargs),) = ws.mock_calls
+        self.assertEqual(args[1], True)
+        header, body = bytes_to_dict_and_body(args[0])
+        self.assertEqual((header["type"], header["phase"], body),
+                         ("add", "phase2", b"\x00\xff"))
+        self.assertNotIn("body", header)
+
+        rc._M.mock("rx_message")
+        events[:] = []
+        rc.ws_message(dict_to_bytes({"type": "message", "side": "side2",
+                                     "phase": "phase1", "body": "0102"}))
+        rc.ws_message(dict_and_body_to_bytes({"type": "message",
+                                              "side": "side2",
+                                              "phase": "phase2"},
+                                             b"\x03\x04"), True)
+        self.assertEqual(events, [("m.rx_message", "side2", "phase1",
+                                   b"\x01\x02"),
+                                  ("m.rx_message", "side2", "phase2",
+                                   b"\x03\x04")])
+
+        # a new connection starts out sending hex again
+        rc.ws_close(True, None, None)
+        rc.ws_open(ws)
+        ws.reset_mock()
+        rc.tx_add("phase3", b"\x00")
+        ((name, args, kwargs),) = ws.mock_calls
+        self.assertEqual(args[1], False)
+
 
 
 # TODO
@@ -1,15 +1,20 @@
 from __future__ import print_function, unicode_literals
-import os, json, itertools, time
+import os, json, itertools, time, random, threading, sqlite3
 import mock
 from twisted.trial import unittest
-from twisted.python import log
-from twisted.internet import reactor, defer, endpoints
+from twisted.python import log, failure
+from twisted.internet import reactor, defer, endpoints, task
 from twisted.internet.defer import inlineCallbacks, returnValue
 from autobahn.twisted import websocket
 from .common import ServerBase
-from ..server import server, rendezvous
+from .. import _deflate
+from ..util import (bytes_to_dict, bytes_to_dict_and_body,
+                    dict_and_body_to_bytes)
+from ..server import (server, rendezvous, rendezvous_memory,
+                      rendezvous_websocket)
 from ..server.rendezvous import Usage, SidedMessage
-from ..server.database import get_db
+from ..server.database import (get_db, UsageWriter, GroupCommitDB,
+                                DBThread)
 
 def easy_relay(
         rendezvous_web_port=str("tcp:0"),
@@ -360,6 +365,83 @@ class Server(_Util, ServerBase, unittest.TestCase):
         self.assertEqual(len(msgs), 5)
         self.assertEqual(msgs[-1]["body"], "body")
 
+class Allocator(unittest.TestCase):
+    def test_free_ids(self):
+        # compare against a plain set, through lots of random operations
+        free = rendezvous._FreeIds(100, 200)
+        expected = set(range(100, 200))
+        for i in range(5000):
+            id_int = random.randrange(100, 200)
+            if random.random() < 0.5:
+                free.take(id_int)
+                expected.discard(id_int)
+            else:
+                free.put(id_int)
+                expected.add(id_int)
+            self.assertEqual(free.free, len(expected))
+            if expected:
+                self.assertIn(free.pick(), expected)
+        # once everything is free again, nothing needs to be stored
+        for id_int in range(100, 200):
+            free.put(id_int)
+        self.assertEqual(free.free, 100)
+        self.assertEqual((free._slots, free._where), ({}, {}))
+
+    def test_shortest_first(self):
+        a = rendezvous.NameplateAllocator()
+        names = set()
+        for i in range(9):
+            name = a.allocate()
+            a.claimed(name)
+            names.add(name)
+        self.assertEqual(names, set(["%d" % i for i in range(1, 10)]))
+        name = a.allocate()
+        self.assertEqual(len(name), 2)
+        # until claimed, the same name is still free
+        a.released("5")
+        self.assertEqual(a.allocate(), "5")
+
+    def test_exhausted(self):
+        self.patch(rendezvous.NameplateAllocator, "MAX_DIGITS", 1)
+        a = rendezvous.NameplateAllocator(["%d" % i for i in range(1, 10)])
+        self.assertRaises(ValueError, a.allocate)
+        a.released("7")
+        self.assertEqual(a.allocate(), "7")
+
+    def test_other_names(self):
+        a = rendezvous.NameplateAllocator(["0", "01", "abc", "1234567",
+                                           "\u0661", ""])
+        for size in a._sizes:
+            self.assertEqual(size._where, {})
+        a.released("abc")
+        a.claimed("1")
+        a.released("1")
+        self.assertEqual(a._sizes[0].free, 9)
+
+    def test_rebuild(self):
+        # nameplates that are already in the database (e.g. from before a
+        # restart) are not handed out again
+        db = get_db(":memory:")
+        rv = rendezvous.Rendezvous(db, None, None, True)
+        app = rv.get_app("appid")
+        for i in range(1, 10):
+            app.claim_nameplate("%d" % i, "side", 1)
+        app2 = rendezvous.Rendezvous(db, None, None, True).get_app("appid")
+        self.assertEqual(len(app2.allocate_nameplate("side", 1)), 2)
+        # and released ones are available again
+        app2.release_nameplate("3", "side", 2)
+        self.assertEqual(app2.allocate_nameplate("side", 3), "3")
+
+    def test_prune(self):
+        rv = rendezvous.Rendezvous(get_db(":memory:"), None, None, True)
+        app = rv.get_app("appid")
+        name = app.allocate_nameplate("side", 1)
+        self.assertEqual(app._allocator._sizes[0].free, 8)
+        app.prune(now=10, old=5)
+        self.assertEqual(app.get_nameplate_ids(), set())
+        self.assertEqual(app._allocator._sizes[0].free, 9)
+        del name
+
 class Prune(unittest.TestCase):
 
     def _get_mailbox_updated(self, app, mbox_id):
@@ -387,7 +469,7 @@ class Prune(unittest.TestCase):
         rv = rendezvous.Rendezvous(get_db(":memory:"), None, None, True)
         app = rv.get_app("appid")
         app.allocate_nameplate("side", 121)
-        app.prune = mock.Mock()
+        app.prune = mock.Mock(return_value=0)
         rv.prune_all_apps(now=123, old=122)
         self.assertEqual(app.prune.mock_calls, [mock.call(123, 122)])
 
@@ -521,6 +603,142 @@ class Prune(unittest.TestCase):
                          ("messages", messages_survive, messages, desc))
 
 
+class Expiration(unittest.TestCase):
+    def test_index(self):
+        e = rendezvous.ExpirationIndex()
+        self.assertEqual(e.GRANULARITY, 60)
+        e.touch("a", 10)
+        e.touch("b", 70)
+        e.touch("c", 75)
+        e.touch("d", 200)
+        self.assertEqual(len(e), 4)
+        self.assertEqual(e.expired(5), [])
+        self.assertEqual(e.expired(10), ["a"])
+        self.assertEqual(sorted(e.expired(72)), ["a", "b"])
+        self.assertEqual(len(e.expired(100, limit=2)), 2)
+        e.touch("a", 300) # moves to a later bucket
+        self.assertEqual(e.get("a"), 300)
+        self.assertEqual(sorted(e.expired(100)), ["b", "c"])
+        e.remove("b")
+        e.remove("c")
+        e.remove("nonexistent")
+        self.assertEqual(e.expired(250), ["d"])
+        # the emptied buckets are forgotten
+        self.assertEqual(sorted(e._buckets), [3, 5])
+        self.assertEqual(e.get("b"), None)
+
+    def test_only_old_ones(self):
+        db = get_db(":memory:")
+        rv = rendezvous.Rendezvous(db, None, None, True)
+        app = rv.get_app("appid")
+        app.open_mailbox("mb-old", "side1", 1)
+        rv.prune_all_apps(now=123, old=50) # builds the index
+        self.assertEqual(rv.get_stats()["prune"]["mailboxes_visited"], 1)
+
+        # from now on, the index follows along
+        for i in range(10):
+            app.open_mailbox("mb-%d" % i, "side1", 100)
+        app.open_mailbox("mb-2", "side2", 200)
+        mb = app.open_mailbox("mb-3", "side1", 100)
+        mb.close("side1", "happy", 150)
+        app._mailboxes["mb-4"].add_message(SidedMessage("side1", "phase",
+                                                        "body", 200, "msgid"))
+        rv.prune_all_apps(now=300, old=150)
+        stats = rv.get_stats()["prune"]
+        self.assertEqual(stats["passes"], 2)
+        self.assertEqual(stats["last"]["mailboxes_visited"], 7)
+        mailboxes = set([row["id"] for row in
+                         db.execute("SELECT * FROM `mailboxes`").fetchall()])
+        self.assertEqual(mailboxes, set(["mb-2", "mb-4"]))
+        self.assertEqual(sorted(app._mailboxes), ["mb-2", "mb-4"])
+
+    def test_unlistened(self):
+        # a mailbox which was listened to during the last prune gets a full
+        # expiration period once the listener goes away
+        db = get_db(":memory:")
+        rv = rendezvous.Rendezvous(db, None, None, True)
+        app = rv.get_app("appid")
+        mb = app.open_mailbox("mb", "side1", 1)
+        mb.add_listener("handle", None, None)
+        rv.prune_all_apps(now=100, old=50)
+        row = db.execute("SELECT * FROM `mailboxes`").fetchone()
+        self.assertEqual(row["updated"], 100)
+
+        mb2 = app.open_mailbox("mb2", "side1", 190)
+        mb2.add_listener("handle", None, None)
+        rv.prune_all_apps(now=200, old=150)
+        mb2.remove_listener("handle")
+        row = db.execute("SELECT * FROM `mailboxes` WHERE `id`=?",
+                         ("mb2",)).fetchone()
+        self.assertEqual(row["updated"], 200)
+        mb.remove_listener("other handle") # still listened to
+        rv.prune_all_apps(now=300, old=200)
+        self.assertEqual([row["id"] for row in
+                          db.execute("SELECT * FROM `mailboxes`").fetchall()],
+                         ["mb"])
+
+    @inlineCallbacks
+    def test_slices(self):
+        db = get_db(":memory:")
+        rv = rendezvous.Rendezvous(db, None, None, True)
+        self.patch(rendezvous.Rendezvous, "PRUNE_SLICE", 3)
+        for app_id in ["app1", "app2"]:
+            app = rv.get_app(app_id)
+            for i in range(10):
+                app.claim_nameplate("%d" % i, "side1", 1)
+            app.open_mailbox("mb-new-%s" % app_id, "side1", 60)
+        yield rv.prune_in_slices(now=123, old=50)
+        self.assertEqual(db.execute("SELECT COUNT() AS `c` FROM `nameplates`")
+                         .fetchone()["c"], 0)
+        self.assertEqual(db.execute("SELECT COUNT() AS `c` FROM `mailboxes`")
+                         .fetchone()["c"], 2)
+        last = rv.get_stats()["prune"]["last"]
+        self.assertEqual(last["apps"], 2)
+        self.assertEqual(last["mailboxes_visited"], 20)
+        self.assertEqual(last["slices"], 2*4)
+        self.assertEqual(rv.get_stats()["all_time"]["nameplate_moods"]
+                         ["pruney"], 20)
+
+    @inlineCallbacks
+    def test_slices_in_db_thread(self):
+        db = get_db(":memory:", check_same_thread=False)
+        t = DBThread(db)
+        t.startService()
+        self.addCleanup(t.stopService)
+        rv = rendezvous.Rendezvous(db, None, None, True, db_thread=t)
+        self.patch(rendezvous.Rendezvous, "PRUNE_SLICE", 3)
+        app = rv.get_app("appid")
+        for i in range(10):
+            app.claim_nameplate("%d" % i, "side1", 1)
+        threads = []
+        orig = app.prune_some
+        def prune_some(*args):
+            threads.append(threading.current_thread())
+            return orig(*args)
+        app.prune_some = prune_some
+        yield rv.prune_in_slices(now=123, old=50)
+        self.assertEqual(len(threads), 4)
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual(rv.get_stats()["all_time"]["nameplate_moods"]
+                         ["pruney"], 10)
+
+    @inlineCallbacks
+    def test_stop_while_slicing(self):
+        db = get_db(":memory:")
+        rv = rendezvous.Rendezvous(db, None, None, True)
+        self.patch(rendezvous.Rendezvous, "PRUNE_SLICE", 1)
+        app = rv.get_app("appid")
+        for i in range(10):
+            app.open_mailbox("mb-%d" % i, "side1", 1)
+        rv.startService()
+        d = rv.prune_in_slices(now=123, old=50)
+        # only one pass at a time
+        self.successResultOf(rv.prune_in_slices(now=124, old=50))
+        yield rv.stopService()
+        yield d
+        self.assertEqual(rv._prune_task, None)
+        self.assertEqual(rv.get_stats()["prune"]["passes"], 0)
+
 def strip_message(msg):
     m2 = msg.copy()
     m2.pop("id", None)
@@ -530,6 +748,528 @@ def strip_message(msg):
 def strip_messages(messages):
     return [strip_message(m) for m in messages]
 
+class FakeThreadPool:
+    # jobs run only when the test says so
+    started = True
+    def __init__(self):
+        self.jobs = []
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        self.jobs.append((onResult, f, args, kwargs))
+    def run_all(self):
+        while self.jobs:
+            onResult, f, args, kwargs = self.jobs.pop(0)
+            try:
+                res = f(*args, **kwargs)
+            except Exception:
+                onResult(False, failure.Failure())
+            else:
+                onResult(True, res)
+
+class FakeReactor(task.Clock):
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+class WriteBehind(unittest.TestCase):
+    def setUp(self):
+        self.db = get_db(":memory:")
+        self.clock = FakeReactor()
+        self.pool = FakeThreadPool()
+        self.w = UsageWriter(self.db, threadpool=self.pool,
+                             reactor=self.clock)
+
+    def rows(self):
+        return self.db.execute("SELECT * FROM `transit_usage`").fetchall()
+
+    def add(self, n):
+        self.w.add("INSERT INTO `transit_usage` (`started`, `result`)"
+                   " VALUES (?,?)", (n, "happy"))
+
+    def test_delayed(self):
+        self.add(1)
+        self.add(2)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(UsageWriter.FLUSH_DELAY)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(len(self.pool.jobs), 1) # one batch
+        self.assertEqual(self.rows(), [])
+        self.pool.run_all()
+        self.assertEqual([r["started"] for r in self.rows()], [1, 2])
+
+    def test_flush(self):
+        self.add(1)
+        d1 = self.w.flush()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.add(2)
+        d2 = self.w.flush()
+        d3 = self.w.flush() # nothing new: waits for the previous batch
+        self.assertNoResult(d1)
+        self.assertNoResult(d3)
+        self.assertEqual(len(self.pool.jobs), 2)
+        self.pool.run_all()
+        for d in [d1, d2, d3]:
+            self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(len(self.rows()), 2)
+        self.assertEqual(self.successResultOf(self.w.flush()), None)
+
+    def test_full_batch(self):
+        self.patch(UsageWriter, "MAX_BATCH", 3)
+        self.add(1)
+        self.add(2)
+        self.add(3) # starts writing right away
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(len(self.pool.jobs), 1)
+        self.pool.run_all()
+        self.assertEqual(len(self.rows()), 3)
+
+    def test_stop(self):
+        self.w.startService()
+        self.add(1)
+        d = self.w.stopService()
+        self.assertNoResult(d)
+        self.pool.run_all()
+        self.successResultOf(d)
+        self.assertEqual(len(self.rows()), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_add_many(self):
+        self.patch(UsageWriter, "MAX_BATCH", 3)
+        self.add(1)
+        # statements added together are never split between two batches
+        self.w.add_many([("INSERT INTO `transit_usage` (`started`) VALUES (?)",
+                          (n,)) for n in [2, 3, 4]])
+        self.assertEqual(len(self.pool.jobs), 1)
+        self.assertEqual(len(self.pool.jobs[0][2][0]), 4)
+        self.pool.run_all()
+        self.assertEqual(len(self.rows()), 4)
+
+    def test_run(self):
+        self.add(1)
+        self.w.flush()
+        d = self.w.run(lambda: len(self.rows()))
+        # reads happen in the writer thread, after the batches before them
+        self.assertNoResult(d)
+        self.assertEqual(len(self.pool.jobs), 2)
+        self.pool.run_all()
+        self.assertEqual(self.successResultOf(d), 1)
+
+        self.w.startService()
+        self.successResultOf(self.w.stopService())
+        # once stopped, reads run right away
+        self.assertEqual(self.successResultOf(self.w.run(lambda: 2)), 2)
+        self.assertEqual(self.pool.jobs, [])
+
+    def test_error(self):
+        self.w.add("INSERT INTO `nonexistent` VALUES (?)", (1,))
+        d = self.w.flush()
+        self.pool.run_all()
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+        self.add(1)
+        self.w.flush()
+        self.pool.run_all()
+        self.assertEqual(len(self.rows()), 1)
+
+class DatabaseThread(unittest.TestCase):
+    def setUp(self):
+        self.db = get_db(":memory:")
+        self.clock = FakeReactor()
+        self.pool = FakeThreadPool()
+        self.t = DBThread(self.db, threadpool=self.pool, reactor=self.clock)
+
+    def rows(self):
+        return self.db.execute("SELECT * FROM `transit_usage`").fetchall()
+
+    def test_run(self):
+        calls = []
+        def f(n):
+            calls.append(n)
+            return n*2
+        d1 = self.t.run(f, 1)
+        d2 = self.t.run(f, 2)
+        self.assertNoResult(d1)
+        self.pool.run_all()
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(self.successResultOf(d1), 2)
+        self.assertEqual(self.successResultOf(d2), 4)
+
+    def test_error(self):
+        def f():
+            raise rendezvous.CrowdedError("too many sides")
+        d = self.t.run(f)
+        self.pool.run_all()
+        self.failureResultOf(d, rendezvous.CrowdedError)
+
+    def test_usage_records(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "relay.sqlite")
+        db = GroupCommitDB(get_db(fn), 0.1, reactor=self.clock, thread=self.t)
+        other = get_db(fn)
+        rv = rendezvous.Rendezvous(db, None, None, True, db_thread=self.t)
+        usage = rv.get_usage_writer()
+        for n in [1, 2]:
+            usage.record_transit_usage(n, 2, 1, 100, "happy")
+        self.assertEqual(self.pool.jobs[0][1], rv._write_usage)
+        self.pool.run_all()
+        # they wait for the next group commit, like everything else
+        self.assertEqual(other.execute("SELECT * FROM `transit_usage`")
+                         .fetchall(), [])
+        self.assertEqual(db.get_stats()["pending"], 2)
+        self.clock.advance(0.1)
+        self.pool.run_all()
+        self.assertEqual(len(other.execute("SELECT * FROM `transit_usage`")
+                             .fetchall()), 2)
+        self.assertEqual(db.get_stats()["commits"], 1)
+        db.close()
+        other.close()
+
+    def test_stop(self):
+        self.t.startService()
+        calls = []
+        self.t.run(calls.append, 1)
+        d = self.t.stopService()
+        self.assertNoResult(d)
+        self.pool.run_all()
+        self.successResultOf(d)
+        self.assertEqual(calls, [1])
+        # once stopped, anything else runs right away
+        self.successResultOf(self.t.run(calls.append, 2))
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(self.pool.jobs, [])
+
+    def test_group_commit(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "relay.sqlite")
+        db = GroupCommitDB(get_db(fn), 0.1, reactor=self.clock, thread=self.t)
+        other = get_db(fn)
+        def add():
+            db.execute("INSERT INTO `transit_usage` (`started`) VALUES (1)")
+            db.commit()
+        self.t.run(add)
+        self.t.run(add)
+        self.pool.run_all()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(0.1)
+        # the timer fires in the reactor, and commits in the DB thread
+        self.assertEqual(other.execute("SELECT * FROM `transit_usage`")
+                         .fetchall(), [])
+        self.pool.run_all()
+        self.assertEqual(len(other.execute("SELECT * FROM `transit_usage`")
+                             .fetchall()), 2)
+        self.assertEqual(db.get_stats()["commits"], 1)
+        d = db.stopService() # commits in the DB thread too
+        self.pool.run_all()
+        self.successResultOf(d)
+        db.close()
+        other.close()
+
+    def test_group_commit_error(self):
+        db = GroupCommitDB(get_db(":memory:"), 0.1, reactor=self.clock,
+                           thread=self.t)
+        self.addCleanup(db.close)
+        self.t.run(db.commit)
+        self.pool.run_all()
+        def flush():
+            raise sqlite3.OperationalError("disk I/O error")
+        db.flush = flush
+        self.clock.advance(0.1)
+        self.pool.run_all()
+        self.assertEqual(len(self.flushLoggedErrors(sqlite3.OperationalError)),
+                         1)
+
+class GroupCommit(unittest.TestCase):
+    def setUp(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "relay.sqlite")
+        self.clock = task.Clock()
+        self.db = GroupCommitDB(get_db(fn, journal_mode="wal",
+                                       synchronous="normal"),
+                                0.1, reactor=self.clock)
+        self.addCleanup(self.db.close)
+        # a second connection only sees what has really been committed
+        self.other = get_db(fn)
+        self.addCleanup(self.other.close)
+
+    def add(self, n):
+        self.db.execute("INSERT INTO `transit_usage` (`started`, `result`)"
+                        " VALUES (?,?)", (n, "happy"))
+        self.db.commit()
+
+    def committed(self):
+        rows = self.other.execute("SELECT * FROM `transit_usage`").fetchall()
+        return [r["started"] for r in rows]
+
+    def test_window(self):
+        self.add(1)
+        self.add(2)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.assertEqual(self.committed(), [])
+        # our own connection can see them already
+        self.assertEqual(len(self.db.execute("SELECT * FROM `transit_usage`")
+                             .fetchall()), 2)
+        self.clock.advance(0.1)
+        self.assertEqual(self.committed(), [1, 2])
+        self.add(3)
+        self.clock.advance(0.1)
+        self.assertEqual(self.committed(), [1, 2, 3])
+        stats = self.db.get_stats()
+        self.assertEqual(stats["commit_requests"], 3)
+        self.assertEqual(stats["commits"], 2)
+        self.assertEqual(stats["pending"], 0)
+        self.assertEqual(stats["batch_size"], {"mean": 1.5, "max": 2})
+        latency = stats["commit_latency"]
+        self.assertGreaterEqual(latency["max"], latency["mean"])
+        self.assertGreaterEqual(latency["max"], latency["last"])
+
+    def test_no_window(self):
+        self.db._window = 0
+        self.add(1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.committed(), [1])
+        self.assertEqual(self.db.get_stats()["commits"], 1)
+
+    def test_stop(self):
+        self.db.startService()
+        self.add(1)
+        self.db.stopService()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.committed(), [1])
+
+    def test_no_requests(self):
+        self.db.flush()
+        stats = self.db.get_stats()
+        self.assertEqual(stats["commits"], 0)
+        self.assertEqual(stats["batch_size"]["mean"], None)
+        self.assertEqual(stats["commit_latency"]["mean"], None)
+
+    def test_relay(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        rs = easy_relay(db_url=os.path.join(basedir, "relay.sqlite"),
+                        db_journal_mode="wal", db_synchronous="normal",
+                        db_commit_window=0.5)
+        db = rs._group_commit
+        self.assertIdentical(rs._rendezvous._db, db)
+        self.assertEqual(db.execute("PRAGMA journal_mode").fetchone(),
+                         {"journal_mode": "wal"})
+        self.assertEqual(db.execute("PRAGMA synchronous").fetchone(),
+                         {"synchronous": 1})
+        self.assertEqual(db.get_stats()["window"], 0.5)
+        # memory mode commits from the usage writer instead
+        rs = easy_relay(rendezvous_state="memory")
+        self.assertEqual(rs._group_commit, None)
+
+class MemoryState(unittest.TestCase):
+    def setUp(self):
+        self.db = get_db(":memory:", check_same_thread=False)
+        self.rv = rendezvous_memory.MemoryRendezvous(self.db, None, None,
+                                                     True)
+        self.rv.startService()
+        self.addCleanup(self.rv.stopService)
+        self.app = self.rv.get_app("appid")
+
+    @inlineCallbacks
+    def usage(self, table):
+        yield self.rv._usage.flush()
+        rows = self.db.execute("SELECT * FROM `%s`" % table).fetchall()
+        returnValue(rows)
+
+    @inlineCallbacks
+    def test_nameplate(self):
+        app = self.app
+        name = app.allocate_nameplate("side1", 0)
+        self.assertEqual(app.get_nameplate_ids(), set([name]))
+        mailbox_id = app.claim_nameplate(name, "side1", 1)
+        self.assertEqual(app.claim_nameplate(name, "side2", 3), mailbox_id)
+        self.assertRaises(rendezvous.CrowdedError,
+                          app.claim_nameplate, name, "side3", 4)
+
+        app.release_nameplate(name+"not", "side1", 5)
+        app.release_nameplate(name, "side4", 5)
+        app.release_nameplate(name, "side1", 5)
+        self.assertRaises(rendezvous.ReclaimedError,
+                          app.claim_nameplate, name, "side1", 5)
+        app.release_nameplate(name, "side2", 6)
+        app.release_nameplate(name, "side3", 7)
+        self.assertEqual(app.get_nameplate_ids(), set())
+        # nothing touched the database yet
+        self.assertEqual(self.db.execute("SELECT * FROM `nameplates`")
+                         .fetchall(), [])
+
+        rows = yield self.usage("nameplate_usage")
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["app_id"], "appid")
+        self.assertEqual(rows[0]["started"], 0)
+        self.assertEqual(rows[0]["waiting_time"], 3)
+        self.assertEqual(rows[0]["total_time"], 7)
+        self.assertEqual(rows[0]["result"], "crowded")
+
+    @inlineCallbacks
+    def test_mailbox(self):
+        app = self.app
+        m1 = app.open_mailbox("mid", "side1", 0)
+        self.assertIdentical(m1, app.open_mailbox("mid", "side1", 1))
+        self.assertIdentical(m1, app.open_mailbox("mid", "side2", 2))
+
+        l1 = []; stop1 = []; stop1_f = lambda: stop1.append(True)
+        self.assertEqual(m1.add_listener("handle1", l1.append, stop1_f), [])
+        sm1 = SidedMessage("side1", "phase", "body", 10, "msgid")
+        m1.add_message(sm1)
+        self.assertEqual(l1, [sm1])
+        sm0 = SidedMessage("side2", "phase", "body", 5, "msgid")
+        m1.add_message(sm0)
+        self.assertEqual(m1.add_listener("handle2", l1.append, stop1_f),
+                         [sm0, sm1])
+        m1.remove_listener("handle2")
+
+        m1.close("side2", "happy", 11)
+        self.assertEqual(stop1, [])
+        m1.close("side3", "happy", 12) # never opened, ignored
+        m1.close("side1", "scary", 13)
+        self.assertEqual(stop1, [True])
+        self.assertNotIn("mid", app._mailboxes)
+        m1.close("side1", "scary", 14) # already gone, ignored
+
+        rows = yield self.usage("mailbox_usage")
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["for_nameplate"], False)
+        self.assertEqual(rows[0]["started"], 0)
+        self.assertEqual(rows[0]["waiting_time"], 2)
+        self.assertEqual(rows[0]["total_time"], 13)
+        self.assertEqual(rows[0]["result"], "scary")
+
+        # a new open() gets a fresh mailbox
+        m2 = app.open_mailbox("mid", "side1", 20)
+        self.assertNotIdentical(m1, m2)
+        self.assertEqual(m2.get_messages(), [])
+
+    def test_crowded_mailbox(self):
+        app = self.app
+        app.open_mailbox("mid", "side1", 0)
+        app.open_mailbox("mid", "side2", 0)
+        self.assertRaises(rendezvous.CrowdedError,
+                          app.open_mailbox, "mid", "side3", 0)
+
+    @inlineCallbacks
+    def test_prune(self):
+        app = self.app
+        app.claim_nameplate("np-old", "side1", 1)
+        app.claim_nameplate("np-new", "side1", 1)
+        app.claim_nameplate("np-new", "side2", 60) # touches the mailbox
+        app.open_mailbox("mb-old", "side1", 1)
+        mb = app.open_mailbox("mb-listening", "side1", 1)
+        mb.add_listener("handle", lambda sm: None, lambda: None)
+        app.open_mailbox("mb-new", "side1", 60)
+
+        self.rv.prune_all_apps(now=123, old=50)
+        self.assertEqual(app.get_nameplate_ids(), set(["np-new"]))
+        self.assertEqual(sorted([mb._mailbox_id
+                                 for mb in app._mailboxes.values()]),
+                         sorted(["mb-listening", "mb-new",
+                                 app._nameplates["np-new"][0]]))
+
+        rows = yield self.usage("nameplate_usage")
+        self.assertEqual([r["result"] for r in rows], ["pruney"])
+        rows = yield self.usage("mailbox_usage")
+        self.assertEqual([r["result"] for r in rows], ["pruney"]*2)
+
+    def test_stats(self):
+        app = self.app
+        self.assertEqual(self.rv.get_all_apps(), set())
+        app.claim_nameplate("np1", "side1", 1)
+        mb = app.open_mailbox("mb1", "side1", 1)
+        mb.add_message(SidedMessage("side1", "phase", "body", 10, "msgid"))
+        self.assertEqual(self.rv.get_all_apps(), set(["appid"]))
+        stats = self.rv.get_stats()
+        self.assertEqual(stats["active"],
+                         {"apps": 1, "nameplates_total": 1,
+                          "mailboxes_total": 2, "messages_total": 1})
+
+    def test_collect_stats(self):
+        pool = FakeThreadPool()
+        usage = UsageWriter(self.db, threadpool=pool, reactor=FakeReactor())
+        rv = rendezvous_memory.MemoryRendezvous(self.db, None, None, True,
+                                                usage=usage)
+        app = rv.get_app("appid")
+        app.claim_nameplate("np1", "side1", 1)
+        app.release_nameplate("np1", "side1", 2)
+        usage.flush()
+        d = rv.collect_stats()
+        # the totals are read in the writer thread, after the records
+        self.assertNoResult(d)
+        pool.run_all()
+        stats = self.successResultOf(d)
+        self.assertEqual(stats["since_reboot"]["nameplates_total"], 1)
+        self.assertEqual(stats["all_time"]["nameplates_total"], 1)
+        self.assertEqual(stats, rv.get_stats())
+
+class MemoryWebSocketAPI(ServerBase, unittest.TestCase):
+    def setUp(self):
+        self._clients = []
+        self._setup_relay(None, rendezvous_state="memory")
+
+    def tearDown(self):
+        for c in self._clients:
+            c.transport.loseConnection()
+        return ServerBase.tearDown(self)
+
+    @inlineCallbacks
+    def make_client(self):
+        f = WSFactory(self.relayurl)
+        f.d = defer.Deferred()
+        reactor.connectTCP("127.0.0.1", self.rdv_ws_port, f)
+        c = yield f.d
+        self._clients.append(c)
+        yield c.next_non_ack() # welcome
+        returnValue(c)
+
+    @inlineCallbacks
+    def test_exchange(self):
+        self.assertIsInstance(self._rendezvous,
+                              rendezvous_memory.MemoryRendezvous)
+        c1 = yield self.make_client()
+        c2 = yield self.make_client()
+        c1.send("bind", appid="appid", side="side1")
+        c2.send("bind", appid="appid", side="side2")
+
+        c1.send("allocate")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "allocated")
+        nameplate = m["nameplate"]
+        c1.send("claim", nameplate=nameplate)
+        m = yield c1.next_non_ack()
+        mailbox = m["mailbox"]
+        c1.send("open", mailbox=mailbox)
+        c1.send("add", phase="pake", body="1234")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "message")
+
+        c2.send("claim", nameplate=nameplate)
+        m = yield c2.next_non_ack()
+        self.assertEqual(m["mailbox"], mailbox)
+        c2.send("open", mailbox=mailbox)
+        m = yield c2.next_non_ack()
+        self.assertEqual((m["type"], m["side"], m["body"]),
+                         ("message", "side1", "1234"))
+
+        for c in [c1, c2]:
+            c.send("release")
+            m = yield c.next_non_ack()
+            self.assertEqual(m["type"], "released")
+            c.send("close", mood="happy")
+            m = yield c.next_non_ack()
+            self.assertEqual(m["type"], "closed")
+        self.assertEqual(self._rendezvous.get_all_apps(), set())
+
+        yield self._rendezvous._usage.flush()
+        db = self._relay_server._db
+        rows = db.execute("SELECT * FROM `mailbox_usage`").fetchall()
+        self.assertEqual([r["result"] for r in rows], ["happy"])
+        rows = db.execute("SELECT * FROM `nameplate_usage`").fetchall()
+        self.assertEqual([r["result"] for r in rows], ["happy"])
+
 class WSClient(websocket.WebSocketClientProtocol):
     def __init__(self):
         websocket.WebSocketClientProtocol.__init__(self)
@@ -540,8 +1280,11 @@ class WSClient(websocket.WebSocketClientProtocol):
     def onOpen(self):
         self.factory.d.callback(self)
     def onMessage(self, payload, isBinary):
-        assert not isBinary
-        event = json.loads(payload.decode("utf-8"))
+        if isBinary:
+            header, body = bytes_to_dict_and_body(payload)
+            event = dict(header, body=body)
+        else:
+            event = json.loads(payload.decode("utf-8"))
         if event["type"] == "error":
             self.errors.append(event)
         if self.d:
@@ -585,6 +1328,10 @@ class WSClient(websocket.WebSocketClientProtocol):
         payload = json.dumps(kwargs).encode("utf-8")
         self.sendMessage(payload, False)
 
+    def send_binary(self, mtype, body, **kwargs):
+        kwargs["type"] = mtype
+        self.sendMessage(dict_and_body_to_bytes(kwargs, body), True)
+
     def send_notype(self, **kwargs):
         payload = json.dumps(kwargs).encode("utf-8")
         self.sendMessage(payload, False)
@@ -668,6 +1415,10 @@ class WebSocketAPI(_Util, ServerBase, unittest.TestCase):
     def setUp(self):
         self._clients = []
         self._setup_relay(None, advertise_version="advertised.version")
+        # the first prune pass runs in the DB thread: let it finish before
+        # the tests use the rendezvous directly
+        if self._rendezvous._prune_task:
+            return self._rendezvous._prune_task.whenDone()
 
     def tearDown(self):
         for c in self._clients:
@@ -1005,6 +1756,117 @@ class WebSocketAPI(_Util, ServerBase, unittest.TestCase):
         self.assertEqual(len(l1), 1)
         self.assertEqual(l1[0].body, "body")
 
+    @inlineCallbacks
+    def test_binary(self):
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side1", binary=True)
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["type"], m["binary"]), ("bound", True))
+        c2 = yield self.make_client() # an older client
+        yield c2.next_non_ack()
+        c2.send("bind", appid="appid", side="side2")
+        yield c2.sync()
+        self.assertEqual([e for e in c2.events if e["type"] != "ack"], [])
+
+        # binary commands use the same validation
+        c1.send_binary("add", b"\x01", phase="phase")
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["error"], "must open mailbox before adding")
+        self.assertEqual(err["orig"], {"type": "add", "phase": "phase",
+                                       "body": "01"})
+
+        for c in [c1, c2]:
+            c.send("open", mailbox="mb1")
+            yield c.sync()
+        c1.send_binary("add", b"\x00\xff", phase="phase1")
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["type"], m["side"], m["phase"], m["body"]),
+                         ("message", "side1", "phase1", b"\x00\xff"))
+        m = yield c2.next_non_ack()
+        self.assertEqual((m["type"], m["side"], m["phase"], m["body"]),
+                         ("message", "side1", "phase1", "00ff"))
+        c2.send("add", phase="phase1", body="abcd")
+        for c in [c1, c2]:
+            m = yield c.next_non_ack()
+            self.assertEqual((m["side"], m["body"]), ("side2", "abcd"))
+
+        # the body was stored as bytes, so it can be replayed either way
+        c3 = yield self.make_client()
+        yield c3.next_non_ack()
+        c3.send("bind", appid="appid", side="side1", binary=True)
+        c3.send("open", mailbox="mb1")
+        m = yield c3.next_non_ack()
+        self.assertEqual(m["type"], "bound")
+        bodies = []
+        for i in range(2):
+            m = yield c3.next_non_ack()
+            bodies.append(m["body"])
+        self.assertEqual(bodies, [b"\x00\xff", "abcd"])
+
+    @inlineCallbacks
+    def test_binary_add_not_hexed(self):
+        # between binary clients, a body is never turned into hex (which is
+        # only needed to echo it back in an error)
+        clients = []
+        for side in ["side1", "side2"]:
+            c = yield self.make_client()
+            yield c.next_non_ack()
+            c.send("bind", appid="appid", side=side, binary=True)
+            m = yield c.next_non_ack()
+            self.assertEqual(m["type"], "bound")
+            c.send("open", mailbox="mb1")
+            yield c.sync()
+            clients.append(c)
+        hexstr = mock.Mock(side_effect=rendezvous_websocket.bytes_to_hexstr)
+        with mock.patch.object(rendezvous_websocket, "bytes_to_hexstr",
+                               hexstr):
+            clients[0].send_binary("add", b"\x00\xff", phase="phase1")
+            for c in clients:
+                m = yield c.next_non_ack()
+                self.assertEqual(m["body"], b"\x00\xff")
+            self.assertEqual(hexstr.mock_calls, [])
+            clients[0].send_binary("bogus", b"\x01")
+            err = yield clients[0].next_non_ack()
+            self.assertEqual(err["error"], "unknown type")
+            self.assertEqual(err["orig"]["body"], "01")
+            self.assertEqual(len(hexstr.mock_calls), 1)
+
+    @inlineCallbacks
+    def test_broadcast_encoded_once(self):
+        # every listener gets the same bytes
+        messages = self._relay_server._rendezvous_websocket.messages
+        clients = []
+        for side in ["side1", "side2"]:
+            c = yield self.make_client()
+            yield c.next_non_ack()
+            c.send("bind", appid="appid", side=side)
+            c.send("open", mailbox="mb1")
+            yield c.sync()
+            clients.append(c)
+        clients[0].send("add", phase="phase", body="body")
+        received = []
+        for c in clients:
+            m = yield c.next_non_ack()
+            self.assertEqual((m["type"], m["body"]), ("message", "body"))
+            received.append(m)
+        self.assertEqual(received[0], received[1]) # same server_tx, too
+        self.assertEqual((messages.encoded, messages.reused), (1, 1))
+
+        # a later opener gets the same message, but with its own server_tx
+        later = received[0]["server_tx"] + 100
+        c3 = yield self.make_client()
+        yield c3.next_non_ack()
+        c3.send("bind", appid="appid", side="side1") # reconnected
+        with mock.patch.object(rendezvous_websocket, "time") as t:
+            t.time.return_value = later
+            c3.send("open", mailbox="mb1")
+            m = yield c3.next_non_ack()
+        self.assertEqual(m["server_tx"], later)
+        self.assertEqual(dict(m, server_tx=None),
+                         dict(received[0], server_tx=None))
+        self.assertEqual((messages.encoded, messages.reused), (2, 1))
+
     @inlineCallbacks
     def test_close(self):
         c1 = yield self.make_client()
@@ -1107,6 +1969,15 @@ class WebSocketAPI(_Util, ServerBase, unittest.TestCase):
             yield d
         self.assertFalse(mb1.has_listeners())
 
+    def test_send_after_disconnect(self):
+        # a command that was waiting for the rendezvous when the client
+        # left has nobody to answer
+        p = rendezvous_websocket.WebSocketRendezvous()
+        p.sendMessage = mock.Mock()
+        p._disconnected = True
+        p.send("bound", binary=True)
+        self.assertEqual(p.sendMessage.mock_calls, [])
+
     @inlineCallbacks
     def test_interrupted_client_nameplate(self):
         # a client's interactions with the server might be split over
@@ -1264,6 +2135,189 @@ class WebSocketAPI(_Util, ServerBase, unittest.TestCase):
         c.close()
         yield c.d
 
+    @inlineCallbacks
+    def test_busy_database(self):
+        # while the database is busy, the commands that need it wait, but
+        # everything else carries on, and each connection's commands are
+        # still handled in order
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side")
+        yield c1.sync()
+        c2 = yield self.make_client()
+        yield c2.next_non_ack()
+
+        busy = threading.Event()
+        self._rendezvous.run(busy.wait, 10)
+        c1.send("list")
+        c1.send("ping", ping=99)
+        yield c2.sync()
+        self.assertEqual([e for e in c1.events if e["type"] != "ack"], [])
+        busy.set()
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "nameplates")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "pong")
+
+
+class WebSocketDeflate(ServerBase, unittest.TestCase):
+    def setUp(self):
+        self._clients = []
+        deflate = {"window_bits": 10, "mem_level": 4, "peer_window_bits": 11}
+        self._setup_relay(None, websocket_protocol_options=[
+            ("permessage_deflate", deflate)])
+
+    def tearDown(self):
+        for c in self._clients:
+            c.transport.loseConnection()
+        return ServerBase.tearDown(self)
+
+    @inlineCallbacks
+    def make_client(self, deflate):
+        f = WSFactory(self.relayurl)
+        if deflate is not None:
+            f.setProtocolOptions(
+                perMessageCompressionOffers=_deflate.client_offers(deflate),
+                perMessageCompressionAccept=_deflate.client_accept(deflate))
+        f.d = defer.Deferred()
+        reactor.connectTCP("127.0.0.1", self.rdv_ws_port, f)
+        c = yield f.d
+        self._clients.append(c)
+        m = yield c.next_non_ack()
+        self.assertEqual(m["type"], "welcome")
+        returnValue(c)
+
+    @inlineCallbacks
+    def test_negotiated(self):
+        c1 = yield self.make_client({"peer_window_bits": 9})
+        pmd = c1._perMessageCompress
+        self.assertNotEqual(pmd, None)
+        # the server compresses with the smaller of its window_bits and what
+        # we asked for, and asked us to use its peer_window_bits
+        self.assertEqual(pmd.server_max_window_bits, 9)
+        self.assertEqual(pmd.client_max_window_bits, 11)
+        c1.send("bind", appid="appid", side="side1")
+        c1.send("open", mailbox="mb1")
+        c1.send("add", phase="phase", body="ab"*1000)
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["body"], "ab"*1000)
+
+    @inlineCallbacks
+    def test_not_offered(self):
+        c1 = yield self.make_client(None)
+        self.assertEqual(c1._perMessageCompress, None)
+
+    def test_options(self):
+        self.assertEqual(_deflate.parse_options(None), None)
+        self.assertEqual(_deflate.parse_options(False), None)
+        self.assertEqual(_deflate.parse_options(True), {})
+        self.assertEqual(_deflate.parse_options({"mem_level": 1}),
+                         {"mem_level": 1})
+        for bad in ["yes", {"level": 9}, {"mem_level": 10},
+                    {"window_bits": 8}, {"peer_window_bits": True}]:
+            self.assertRaises(ValueError, _deflate.parse_options, bad)
+        self.assertRaises(ValueError, server.RelayServer, str("tcp:0"), None,
+                          websocket_protocol_options=[("permessage_deflate",
+                                                       {"window_bits": 16})])
+
+class MessageCache(unittest.TestCase):
+    def test_cache(self):
+        f = rendezvous_websocket.WebSocketRendezvousFactory(None, None)
+        messages = f.messages
+        self.patch(messages, "MAX_MESSAGES", 2)
+        sm1 = SidedMessage("side1", "phase1", "body1", 1, "msg1")
+        p1 = messages.get(sm1)
+        m = bytes_to_dict(p1.payload)
+        self.assertIn("server_tx", m)
+        del m["server_tx"]
+        self.assertEqual(m, {"type": "message", "side": "side1",
+                             "phase": "phase1", "body": "body1",
+                             "server_rx": 1, "id": "msg1"})
+        # an equal SidedMessage (as read back from the database) is a hit
+        self.assertIdentical(messages.get(SidedMessage(*sm1)), p1)
+        for i in [2, 3]:
+            messages.get(SidedMessage("side1", "phase%d" % i, "body", i,
+                                      "msg%d" % i))
+        # the oldest was forgotten
+        self.assertNotIdentical(messages.get(sm1), p1)
+        self.assertEqual((messages.encoded, messages.reused), (4, 1))
+        # fresh ones are stamped again, and replace what was remembered
+        with mock.patch.object(rendezvous_websocket, "time") as t:
+            t.time.return_value = 12345
+            p2 = messages.get(sm1, fresh=True)
+        self.assertEqual(bytes_to_dict(p2.payload)["server_tx"], 12345)
+        self.assertIdentical(messages.get(sm1), p2)
+
+    def test_binary(self):
+        f = rendezvous_websocket.WebSocketRendezvousFactory(None, None)
+        messages = f.messages
+        sm = SidedMessage("side1", "phase1", b"\x00\xff", 1, "msg1")
+        p = messages.get(sm, True)
+        self.assertTrue(p.binary)
+        header, body = bytes_to_dict_and_body(p.payload)
+        self.assertEqual((header["phase"], body), ("phase1", b"\x00\xff"))
+        p = messages.get(sm)
+        self.assertFalse(p.binary)
+        self.assertEqual(bytes_to_dict(p.payload)["body"], "00ff")
+        # bodies that arrived as hex are sent as hex
+        p = messages.get(sm._replace(body="00ff"), True)
+        self.assertFalse(p.binary)
+        self.assertEqual(bytes_to_dict(p.payload)["body"], "00ff")
+
+
+class UsageCounts(unittest.TestCase):
+    def use(self, app):
+        # leave behind a happy nameplate+mailbox, a lonely nameplate+mailbox,
+        # and a standalone scary mailbox
+        name = app.allocate_nameplate("side1", 1)
+        mailbox_id = app.claim_nameplate(name, "side2", 2)
+        for side in ["side1", "side2"]:
+            app.release_nameplate(name, side, 3)
+            app.open_mailbox(mailbox_id, side, 3).close(side, "happy", 4)
+        name = app.allocate_nameplate("side1", 5)
+        mailbox_id = app.claim_nameplate(name, "side1", 5)
+        app.release_nameplate(name, "side1", 6)
+        app.open_mailbox(mailbox_id, "side1", 6).close("side1", "lonely", 7)
+        app.open_mailbox("mb1", "side1", 8).close("side1", "scary", 9)
+
+    def check(self, db, stats):
+        def q(query):
+            return list(db.execute(query).fetchone().values())[0]
+        u = stats["all_time"]
+        self.assertEqual(u["nameplates_total"],
+                         q("SELECT COUNT() FROM `nameplate_usage`"))
+        self.assertEqual(u["nameplate_moods"],
+                         {"happy": 1, "lonely": 1, "pruney": 0, "crowded": 0})
+        self.assertEqual(u["mailboxes_total"],
+                         q("SELECT COUNT() FROM `mailbox_usage`"))
+        self.assertEqual(u["mailbox_moods"],
+                         {"happy": 1, "lonely": 1, "scary": 1, "quiet": 0,
+                          "errory": 0, "pruney": 0, "crowded": 0})
+        self.assertEqual(u["mailboxes_standalone"],
+                         q("SELECT COUNT() FROM `mailbox_usage`"
+                           " WHERE `for_nameplate`=0"))
+        self.assertEqual(u["mailboxes_standalone"], 1)
+
+    def test_sqlite(self):
+        db = get_db(":memory:")
+        rv = rendezvous.Rendezvous(db, None, None, True)
+        self.use(rv.get_app("appid"))
+        self.check(db, rv.get_stats())
+        # the counts are kept in the database, so they survive a restart
+        rv2 = rendezvous.Rendezvous(db, None, None, True)
+        self.check(db, rv2.get_stats())
+        self.assertEqual(rv2.get_stats()["since_reboot"]["nameplates_total"],
+                         0)
+
+    @inlineCallbacks
+    def test_memory(self):
+        db = get_db(":memory:", check_same_thread=False)
+        rv = rendezvous_memory.MemoryRendezvous(db, None, None, True)
+        rv.startService()
+        self.addCleanup(rv.stopService)
+        self.use(rv.get_app("appid"))
+        yield rv._usage.flush()
+        self.check(db, rv.get_stats())
 
 class Summary(unittest.TestCase):
     def test_mailbox(self):
@@ -1374,25 +2428,97 @@ class Summary(unittest.TestCase):
         self.assertEqual(row["started"], 20)
 
 class DumpStats(unittest.TestCase):
+    def relay(self, **kwargs):
+        rs = easy_relay(**kwargs)
+        # the stats are gathered in its DB thread
+        self.addCleanup(rs._db_thread.stopService)
+        return rs
+
+    @inlineCallbacks
     def test_nostats(self):
-        rs = easy_relay()
+        rs = self.relay()
         # with no ._stats_file, this should do nothing
-        rs.dump_stats(1, 1)
+        yield rs.dump_stats(1, 1)
 
+    @inlineCallbacks
     def test_empty(self):
         basedir = self.mktemp()
         os.mkdir(basedir)
         fn = os.path.join(basedir, "stats.json")
-        rs = easy_relay(stats_file=fn)
+        rs = self.relay(stats_file=fn)
         now = 1234
         validity = 500
-        rs.dump_stats(now, validity)
+        yield rs.dump_stats(now, validity)
         with open(fn, "rb") as f:
             data_bytes = f.read()
         data = json.loads(data_bytes.decode("utf-8"))
         self.assertEqual(data["created"], now)
         self.assertEqual(data["valid_until"], now+validity)
         self.assertEqual(data["rendezvous"]["all_time"]["mailboxes_total"], 0)
+        self.assertNotIn("transit", data)
+
+    @inlineCallbacks
+    def test_transit(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "stats.json")
+        rs = self.relay(stats_file=fn, transit_port=str("tcp:0"))
+        yield rs.dump_stats(1234, 500)
+        with open(fn, "rb") as f:
+            data = json.loads(f.read().decode("utf-8"))
+        self.assertEqual(data["transit"]["all_time"]["total"], 0)
+        self.assertEqual(data["transit"]["active"],
+                         {"connected": 0, "waiting": 0})
+
+    @inlineCallbacks
+    def test_transit_threads(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "stats.json")
+        rs = self.relay(stats_file=fn, transit_port=str("tcp:0"))
+        t = rs._transit
+        threads = {}
+        def record(name, orig):
+            def f(*args):
+                threads[name] = threading.current_thread()
+                return orig(*args)
+            return f
+        t._get_current_stats = record("current", t._get_current_stats)
+        self.patch(rendezvous, "get_usage_counts",
+                   record("all_time", rendezvous.get_usage_counts))
+        yield rs.dump_stats(1234, 500)
+        # the reactor changes the connections while the DB thread works, so
+        # they are counted in the reactor, and only the totals in the thread
+        self.assertEqual(threads["current"], threading.current_thread())
+        self.assertNotEqual(threads["all_time"], threading.current_thread())
+
+    @inlineCallbacks
+    def test_database(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "stats.json")
+        rs = self.relay(stats_file=fn)
+        app = rs._rendezvous.get_app("appid")
+        app.claim_nameplate("1", "side1", 1)
+        yield rs.dump_stats(1234, 500)
+        with open(fn, "rb") as f:
+            data = json.loads(f.read().decode("utf-8"))
+        self.assertEqual(data["database"]["window"], 0)
+        self.assertEqual(data["database"]["pending"], 0)
+        self.assertEqual(data["database"]["commits"],
+                         data["database"]["commit_requests"])
+        self.assertEqual(data["database"]["batch_size"]["max"], 1)
+
+    @inlineCallbacks
+    def test_timer(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "stats.json")
+        rs = self.relay(stats_file=fn)
+        yield rs.timer()
+        with open(fn, "rb") as f:
+            data = json.loads(f.read().decode("utf-8"))
+        self.assertEqual(data["rendezvous"]["prune"]["passes"], 1)
 
 
 class Startup(unittest.TestCase):
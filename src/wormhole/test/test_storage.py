@@ -0,0 +1,258 @@
+from __future__ import print_function, unicode_literals
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, returnValue
+from zope.interface.verify import verifyObject
+from ..server import storage, server
+from ..server.storage import (IRendezvousStorage, IAppNamespace, IMailbox,
+                              IUsageWriter)
+from ..server.rendezvous import CrowdedError, ReclaimedError, SidedMessage
+from ..server.rendezvous_memory import MemoryRendezvous
+from ..server.database import get_db, DBThread
+
+class StorageConformance(object):
+    """The tests that every rendezvous storage backend must pass. To check a
+    new backend, subclass this (and unittest.TestCase), and set .url to a
+    storage URL for it."""
+    url = None
+
+    def setUp(self):
+        self.db = get_db(":memory:", check_same_thread=False)
+        backend, rest = storage.get_backend(self.url)
+        self.db_thread = None
+        if backend.state_in_database:
+            self.db_thread = DBThread(self.db)
+            self.db_thread.startService()
+            self.addCleanup(self.db_thread.stopService)
+        self.rv = backend.create(rest, self.db, {}, None, True,
+                                 db_thread=self.db_thread)
+        self.rv.startService()
+        self.addCleanup(self.stop)
+
+    def stop(self):
+        if self.rv.running:
+            return self.rv.stopService()
+
+    def call(self, f, *args):
+        # all use of the state must go through run()
+        return self.rv.run(f, *args)
+
+    @inlineCallbacks
+    def app(self, app_id="appid"):
+        app = yield self.call(self.rv.get_app, app_id)
+        returnValue(app)
+
+    @inlineCallbacks
+    def test_interfaces(self):
+        verifyObject(IRendezvousStorage, self.rv)
+        app = yield self.app()
+        verifyObject(IAppNamespace, app)
+        mb = yield self.call(app.open_mailbox, "mb1", "side1", 1)
+        verifyObject(IMailbox, mb)
+        verifyObject(IUsageWriter, self.rv.get_usage_writer())
+
+    @inlineCallbacks
+    def test_usage_writer(self):
+        writer = self.rv.get_usage_writer()
+        writer.record_transit_usage(1, 2, 1, 100, "happy")
+        writer.record_transit_usage(3, 2, 1, 50, "happy")
+        writer.record_transit_usage(5, 2, 2, 0, "lonely")
+        counts = yield writer.get_usage_counts("transit")
+        self.assertEqual(counts, {"happy": 2, "lonely": 1})
+        counts = yield writer.get_usage_counts("transit_bytes")
+        self.assertEqual(counts, {"happy": 150, "lonely": 0})
+
+    @inlineCallbacks
+    def test_claim(self):
+        app = yield self.app()
+        name = yield self.call(app.allocate_nameplate, "side1", 1)
+        ids = yield self.call(app.get_nameplate_ids)
+        self.assertEqual(ids, set([name]))
+        mailbox_id = yield self.call(app.claim_nameplate, name, "side1", 1)
+        mailbox_id2 = yield self.call(app.claim_nameplate, name, "side2", 2)
+        self.assertEqual(mailbox_id, mailbox_id2)
+        d = self.call(app.claim_nameplate, name, "side3", 3)
+        yield self.assertFailure(d, CrowdedError)
+        apps = yield self.call(self.rv.get_all_apps)
+        self.assertEqual(apps, set(["appid"]))
+        # other apps have their own nameplates
+        other = yield self.app("other")
+        ids = yield self.call(other.get_nameplate_ids)
+        self.assertEqual(ids, set())
+
+    @inlineCallbacks
+    def test_release(self):
+        app = yield self.app()
+        yield self.call(app.claim_nameplate, "1", "side1", 1)
+        yield self.call(app.claim_nameplate, "1", "side2", 2)
+        yield self.call(app.release_nameplate, "1", "side1", 3)
+        d = self.call(app.claim_nameplate, "1", "side1", 4)
+        yield self.assertFailure(d, ReclaimedError)
+        # releasing something you never claimed does nothing
+        yield self.call(app.release_nameplate, "1", "side3", 5)
+        yield self.call(app.release_nameplate, "2", "side1", 5)
+        ids = yield self.call(app.get_nameplate_ids)
+        self.assertEqual(ids, set(["1"]))
+        yield self.call(app.release_nameplate, "1", "side2", 6)
+        ids = yield self.call(app.get_nameplate_ids)
+        self.assertEqual(ids, set())
+        nameplate_counts, mailbox_counts = app.get_counts()
+        self.assertEqual(dict(nameplate_counts), {"happy": 1})
+        self.assertEqual(dict(mailbox_counts), {}) # still open
+
+    @inlineCallbacks
+    def test_messages(self):
+        app = yield self.app()
+        mb1 = yield self.call(app.open_mailbox, "mb1", "side1", 1)
+        heard = []
+        old = yield self.call(mb1.add_listener, "handle1", heard.append,
+                              lambda: None)
+        self.assertEqual(old, [])
+        sm1 = SidedMessage("side1", "phase1", "body1", 2, "msg1")
+        yield self.call(mb1.add_message, sm1)
+        self.assertEqual(heard, [sm1])
+
+        mb2 = yield self.call(app.open_mailbox, "mb1", "side2", 3)
+        old = yield self.call(mb2.add_listener, "handle2", heard.append,
+                              lambda: None)
+        self.assertEqual(old, [sm1])
+        sm2 = SidedMessage("side2", "phase1", "body2", 4, "msg2")
+        yield self.call(mb2.add_message, sm2)
+        self.assertEqual(heard, [sm1, sm2, sm2])
+        has = yield self.call(mb1.has_listeners)
+        self.assertTrue(has)
+        yield self.call(mb1.remove_listener, "handle1")
+        yield self.call(mb2.remove_listener, "handle2")
+        has = yield self.call(mb1.has_listeners)
+        self.assertFalse(has)
+        sm3 = SidedMessage("side1", "phase2", "body3", 5, "msg3")
+        yield self.call(mb1.add_message, sm3)
+        self.assertEqual(len(heard), 3)
+        messages = yield self.call(mb1.get_messages)
+        self.assertEqual(messages, [sm1, sm2, sm3])
+
+        d = self.call(app.open_mailbox, "mb1", "side3", 6)
+        yield self.assertFailure(d, CrowdedError)
+
+    @inlineCallbacks
+    def test_binary_bodies(self):
+        # bodies from binary WebSocket messages are bytes, and stay bytes
+        app = yield self.app()
+        mb = yield self.call(app.open_mailbox, "mb1", "side1", 1)
+        sm1 = SidedMessage("side1", "phase1", b"\x00\xff", 2, "msg1")
+        sm2 = SidedMessage("side1", "phase2", "00ff", 3, "msg2")
+        yield self.call(mb.add_message, sm1)
+        yield self.call(mb.add_message, sm2)
+        messages = yield self.call(mb.get_messages)
+        self.assertEqual(messages, [sm1, sm2])
+        self.assertIsInstance(messages[0].body, type(b""))
+        self.assertIsInstance(messages[1].body, type(""))
+
+    @inlineCallbacks
+    def test_close(self):
+        app = yield self.app()
+        mb = yield self.call(app.open_mailbox, "mb1", "side1", 1)
+        yield self.call(app.open_mailbox, "mb1", "side2", 2)
+        yield self.call(mb.close, "side1", "happy", 3)
+        apps = yield self.call(self.rv.get_all_apps)
+        self.assertEqual(apps, set(["appid"]))
+        yield self.call(mb.close, "side2", "happy", 4)
+        apps = yield self.call(self.rv.get_all_apps)
+        self.assertEqual(apps, set())
+        nameplate_counts, mailbox_counts = app.get_counts()
+        self.assertEqual(dict(mailbox_counts), {"happy": 1})
+        # a mailbox that is re-opened after deletion starts out empty
+        mb = yield self.call(app.open_mailbox, "mb1", "side1", 5)
+        messages = yield self.call(mb.get_messages)
+        self.assertEqual(messages, [])
+
+    @inlineCallbacks
+    def test_prune(self):
+        app = yield self.app()
+        yield self.call(app.claim_nameplate, "1", "side1", 1) # old
+        yield self.call(app.open_mailbox, "mb-new", "side1", 60)
+        mb = yield self.call(app.open_mailbox, "mb-heard", "side1", 1)
+        yield self.call(mb.add_listener, "handle", lambda sm: None,
+                        lambda: None)
+        for i in range(5):
+            yield self.call(app.open_mailbox, "mb-%d" % i, "side1", 1)
+        visited = yield self.call(app.prune_some, 123, 50, 2)
+        self.assertEqual(visited, 2)
+        visited = yield self.call(app.prune, 123, 50)
+        self.assertEqual(visited, 5) # 7 old ones, in all
+        ids = yield self.call(app.get_nameplate_ids)
+        self.assertEqual(ids, set())
+        nameplate_counts, mailbox_counts = app.get_counts()
+        self.assertEqual(dict(nameplate_counts), {"pruney": 1})
+        self.assertEqual(dict(mailbox_counts), {"pruney": 6})
+        # the listened-to one was kept (and counts as fresh), and so was the
+        # new one
+        visited = yield self.call(app.prune, 124, 50)
+        self.assertEqual(visited, 0)
+        apps = yield self.call(self.rv.get_all_apps)
+        self.assertEqual(apps, set(["appid"]))
+        yield self.rv.prune_in_slices(1000, 900)
+        nameplate_counts, mailbox_counts = app.get_counts()
+        self.assertEqual(dict(mailbox_counts), {"pruney": 7})
+        # mb-heard is still heard
+        apps = yield self.call(self.rv.get_all_apps)
+        self.assertEqual(apps, set(["appid"]))
+
+    @inlineCallbacks
+    def test_stats(self):
+        app = yield self.app()
+        yield self.call(app.claim_nameplate, "1", "side1", 1)
+        yield self.call(app.claim_nameplate, "1", "side2", 2)
+        stats = yield self.call(self.rv.get_stats)
+        self.assertEqual(stats["active"]["apps"], 1)
+        self.assertEqual(stats["active"]["nameplates_total"], 1)
+        self.assertEqual(stats["active"]["mailboxes_total"], 1)
+        for side in ["side1", "side2"]:
+            yield self.call(app.release_nameplate, "1", side, 3)
+        stats = yield self.call(self.rv.get_stats)
+        self.assertEqual(stats["since_reboot"]["nameplate_moods"],
+                         {"happy": 1})
+        self.assertIn("prune", stats)
+        # usage records have been written by the time the service stops
+        yield self.stop()
+        stats = yield self.call(self.rv.get_stats)
+        self.assertEqual(stats["all_time"]["nameplate_moods"]["happy"], 1)
+        self.assertEqual(stats["all_time"]["nameplates_total"], 1)
+
+
+class SQLite(StorageConformance, unittest.TestCase):
+    url = "sqlite"
+
+class Memory(StorageConformance, unittest.TestCase):
+    url = "memory:"
+
+
+class Backends(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(storage.parse_url("memory"), ("memory", ""))
+        self.assertEqual(storage.parse_url("kv:host:1234"),
+                         ("kv", "host:1234"))
+
+    def test_unknown(self):
+        e = self.assertRaises(ValueError, storage.get_backend, "nope:")
+        self.assertIn("unknown rendezvous storage 'nope:'", str(e))
+        self.assertRaises(ValueError, server.RelayServer, str("tcp:0"), None,
+                          rendezvous_state="nope:")
+
+    def test_arguments(self):
+        self.assertRaises(ValueError, server.RelayServer, str("tcp:0"), None,
+                          rendezvous_state="memory:please")
+
+    def test_register(self):
+        created = []
+        class Counted(storage.MemoryStorage):
+            def create(self, url, *args, **kwargs):
+                created.append(url)
+                return storage.MemoryStorage.create(self, "", *args, **kwargs)
+        self.patch(storage, "_backends", dict(storage._backends))
+        storage.register_backend("counted", Counted())
+        rs = server.RelayServer(str("tcp:0"), None,
+                                rendezvous_state="counted:123")
+        self.assertEqual(created, ["123"])
+        self.assertIsInstance(rs._rendezvous, MemoryRendezvous)
+        self.assertEqual(rs._db_thread, None)
+        verifyObject(IUsageWriter, rs._rendezvous.get_usage_writer())
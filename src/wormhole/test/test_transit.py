@@ -1,18 +1,22 @@
 from __future__ import print_function, unicode_literals
 import six
 import io
+import os
 import gc
+import tempfile
 import mock
 from binascii import hexlify, unhexlify
 from collections import namedtuple
 from twisted.trial import unittest
-from twisted.internet import defer, task, endpoints, protocol, address, error
+from twisted.internet import (reactor, defer, task, endpoints, protocol,
+                              address, error)
 from twisted.internet.defer import gatherResults, inlineCallbacks
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.test import proto_helpers
-from wormhole_transit_relay import transit_server
+from twisted.protocols import basic
 from ..errors import InternalError
-from .. import transit
+from .. import transit, _records, _pipeline, _compression
+from ..server import transit_server
 from .common import ServerBase
 from nacl.secret import SecretBox
 from nacl.exceptions import CryptoError
@@ -71,6 +75,63 @@ class Highlander(unittest.TestCase):
         self.failureResultOf(d, ValueError)
         self.assertEqual(cancelled, set([1,2,3]))
 
+class Several(unittest.TestCase):
+    def build(self, count):
+        self.clock = task.Clock()
+        self.cancelled = set()
+        self.extras = []
+        self.done = []
+        contenders = [defer.Deferred(lambda d, i=i: self.cancelled.add(i))
+                      for i in range(count)]
+        self.racer = transit._ThereCanBeSeveral(contenders,
+                                                self.extras.append, 5.0,
+                                                self.clock,
+                                                lambda: self.done.append(True))
+        return contenders, self.racer.run()
+
+    def test_extras_within_window(self):
+        contenders, d = self.build(4)
+        contenders[0].errback(ValueError())
+        self.assertNoResult(d)
+        contenders[1].callback("first")
+        # the winner is reported right away, the others keep going
+        self.assertEqual(self.successResultOf(d), "first")
+        self.assertEqual(self.cancelled, set())
+        contenders[2].callback("second")
+        self.assertEqual(self.extras, ["second"])
+        self.clock.advance(5.0)
+        self.assertEqual(self.cancelled, set([3]))
+        self.assertEqual(self.done, [True])
+
+    def test_all_finish_early(self):
+        contenders, d = self.build(2)
+        contenders[1].callback("first")
+        self.assertEqual(self.successResultOf(d), "first")
+        contenders[0].callback("second")
+        self.assertEqual(self.extras, ["second"])
+        # no need to wait for the window
+        self.assertEqual(self.done, [True])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_close_window(self):
+        contenders, d = self.build(3)
+        contenders[0].callback("first")
+        self.assertEqual(self.successResultOf(d), "first")
+        # the transfer finished before the window did
+        self.racer.close_window()
+        self.assertEqual(self.cancelled, set([1, 2]))
+        self.assertEqual(self.done, [True])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.racer.close_window() # idempotent
+        self.assertEqual(self.done, [True])
+
+    def test_none(self):
+        contenders, d = self.build(2)
+        contenders[0].errback(ValueError())
+        contenders[1].errback(TypeError())
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(self.done, [])
+
 class Forever(unittest.TestCase):
     def _forever_setup(self):
         clock = task.Clock()
@@ -229,14 +290,36 @@ class Hints(unittest.TestCase):
         self.assertEqual(stderr,
                          "non-float priority= in TCP hint 'tcp:host:1234:priority=bad'\n")
 
+        h,stderr = p("tcp:[2001:db8::1]:1234:priority=2.6")
+        self.assertEqual(h, transit.DirectTCPV1Hint("2001:db8::1", 1234, 2.6))
+        self.assertEqual(stderr, "")
+
+        h,stderr = p("tcp:[2001:db8::1]")
+        self.assertEqual(h, None)
+        self.assertEqual(stderr,
+                         "unparseable TCP hint (need more colons) 'tcp:[2001:db8::1]'\n")
+
     def test_describe_hint_obj(self):
         d = transit.describe_hint_obj
         self.assertEqual(d(transit.DirectTCPV1Hint("host", 1234, 0.0)),
                          "tcp:host:1234")
         self.assertEqual(d(transit.TorTCPV1Hint("host", 1234, 0.0)),
                          "tor:host:1234")
+        self.assertEqual(d(transit.DirectTCPV1Hint("2001:db8::1", 1234, 0.0)),
+                         "tcp:[2001:db8::1]:1234")
         self.assertEqual(d(UnknownHint("stuff")), str(UnknownHint("stuff")))
 
+    def test_interleave(self):
+        H = transit.DirectTCPV1Hint
+        hints = [H("10.0.0.1", 1, 0.0), H("10.0.0.2", 1, 0.0),
+                 H("host", 1, 0.0), H("2001:db8::1", 1, 0.0),
+                 H("2001:db8::2", 1, 0.0), H("10.0.0.3", 1, 1.0)]
+        self.assertEqual([h.hostname for h in transit.interleave_hints(hints)],
+                         ["10.0.0.3", # highest priority goes first
+                          "2001:db8::1", "10.0.0.1",
+                          "2001:db8::2", "10.0.0.2",
+                          "host"])
+
 # ipaddrs.py currently uses native strings: bytes on py2, unicode on
 # py3
 if six.PY2:
@@ -315,8 +398,85 @@ class Basic(unittest.TestCase):
         abilities = c.get_connection_abilities()
         self.assertEqual(abilities, [{"type": "direct-tcp-v1"},
                                      {"type": "relay-v1"},
+                                     {"type": "large-records-v1",
+                                      "max-record-size": 256*1024},
+                                     {"type": "striped-v1",
+                                      "max-streams": 4},
+                                     {"type": "compression-v1",
+                                      "methods": _compression.available_methods()},
                                      ])
 
+    def test_record_size(self):
+        c = transit.Common(None, no_listen=True)
+        # old peers don't advertise large-records-v1
+        c.add_connection_abilities([{"type": "direct-tcp-v1"},
+                                    {"type": "relay-v1"}])
+        self.assertEqual(c.get_record_size(), 16*1024)
+
+        c.add_connection_abilities([{"type": "large-records-v1",
+                                     "max-record-size": 64*1024}])
+        self.assertEqual(c.get_record_size(), 64*1024)
+
+        # we never go above our own limit
+        c.add_connection_abilities([{"type": "large-records-v1",
+                                     "max-record-size": 2**30}])
+        self.assertEqual(c.get_record_size(), 256*1024)
+        # and never above theirs, even when it is below the default
+        c.add_connection_abilities([{"type": "large-records-v1",
+                                     "max-record-size": 4096}])
+        self.assertEqual(c.get_record_size(), 4096)
+
+        c = transit.Common(None, no_listen=True)
+        c.add_connection_abilities([{"type": "large-records-v1",
+                                     "max-record-size": "big"},
+                                    {"type": "large-records-v1",
+                                     "max-record-size": True},
+                                    {"type": "large-records-v1",
+                                     "max-record-size": 0},
+                                    {"type": "large-records-v1"}])
+        self.assertEqual(c.get_record_size(), 16*1024)
+
+    def test_stream_count(self):
+        c = transit.Common(None, no_listen=True)
+        # old peers don't advertise striped-v1
+        c.add_connection_abilities([{"type": "direct-tcp-v1"}])
+        self.assertEqual(c.get_stream_count(), 1)
+        c.add_connection_abilities([{"type": "striped-v1",
+                                     "max-streams": 2}])
+        self.assertEqual(c.get_stream_count(), 2)
+        c.add_connection_abilities([{"type": "striped-v1",
+                                     "max-streams": 100}])
+        self.assertEqual(c.get_stream_count(), 4)
+
+        c = transit.Common(None, no_listen=True)
+        c.add_connection_abilities([{"type": "striped-v1",
+                                     "max-streams": 0},
+                                    {"type": "striped-v1",
+                                     "max-streams": True},
+                                    {"type": "striped-v1"}])
+        self.assertEqual(c.get_stream_count(), 1)
+
+    def test_compression(self):
+        c = transit.Common(None, no_listen=True)
+        # old peers don't advertise compression-v1
+        self.assertEqual(c.get_compression(), None)
+        self.assertEqual(c.get_compressor(), None)
+        self.assertEqual(c.get_decompressor(), None)
+        c.add_connection_abilities([{"type": "compression-v1",
+                                     "methods": ["lzma", "zlib"]}])
+        self.assertEqual(c.get_compression(), "zlib")
+        self.assertIsInstance(c.get_compressor(), _compression.Compressor)
+        self.assertIsInstance(c.get_decompressor(),
+                              _compression.Decompressor)
+        c.add_connection_abilities([{"type": "compression-v1",
+                                     "methods": ["lzma"]}])
+        self.assertEqual(c.get_compression(), None)
+
+        c = transit.Common(None, no_listen=True)
+        c.add_connection_abilities([{"type": "compression-v1",
+                                     "methods": "zlib"}])
+        self.assertEqual(c.get_compression(), None)
+
     def test_transit_key_wait(self):
         KEY = b"123"
         c = transit.Common("")
@@ -353,6 +513,13 @@ class Basic(unittest.TestCase):
         self.assertEqual(hexlify(r._sender_record_key()),
                          hexlify(s._receiver_record_key()))
 
+        # each stripe gets its own keys
+        self.assertEqual(s._sender_record_key(1), r._receiver_record_key(1))
+        self.assertEqual(r._sender_record_key(1), s._receiver_record_key(1))
+        keys = set([s._sender_record_key(), s._sender_record_key(1),
+                    s._sender_record_key(2), s._receiver_record_key(1)])
+        self.assertEqual(len(keys), 4)
+
     def test_connection_ready(self):
         s = transit.TransitSender("")
         self.assertEqual(s.connection_ready("p1"), "go")
@@ -364,16 +531,88 @@ class Basic(unittest.TestCase):
         self.assertEqual(r.connection_ready("p1"), "wait-for-decision")
         self.assertEqual(r.connection_ready("p2"), "wait-for-decision")
 
+    def test_connection_ready_striped(self):
+        s = transit.TransitSender("")
+        s.add_connection_abilities([{"type": "striped-v1",
+                                     "max-streams": 3}])
+        p1, p2, p3, p4 = [mock.Mock() for i in range(4)]
+        self.assertEqual(s.connection_ready(p1), "go")
+        self.assertEqual(s.connection_ready(p2), "go-stripe")
+        self.assertEqual(p2._stripe_index, 1)
+        self.assertEqual(s.connection_ready(p3), "go-stripe")
+        self.assertEqual(p3._stripe_index, 2)
+        self.assertEqual(s.connection_ready(p4), "nevermind")
+
+        r = transit.TransitReceiver("")
+        r.add_connection_abilities([{"type": "striped-v1",
+                                     "max-streams": 3}])
+        self.assertEqual(r._accept_stripe(0), False)
+        self.assertEqual(r._accept_stripe(2), True)
+        self.assertEqual(r._accept_stripe(3), False)
+        # a repeated index would reuse the stripe's record nonces
+        self.assertEqual(r._accept_stripe(2), False)
+        self.assertEqual(r._accept_stripe(1), True)
+        self.assertEqual(r._accept_stripe(1), False)
+
 
 class Listener(unittest.TestCase):
     def test_listener(self):
         c = transit.Common("")
-        hints, ep = c._build_listener()
+        with mock.patch("wormhole.ipaddrs.find_addresses",
+                        return_value=[LOOPADDR, OTHERADDR]):
+            hints, ep = c._build_listener()
         self.assertIsInstance(hints, (list, set))
         if hints:
             self.assertIsInstance(hints[0], transit.DirectTCPV1Hint)
         self.assertIsInstance(ep, endpoints.TCP4ServerEndpoint)
 
+    def test_listener_ipv6(self):
+        c = transit.Common("")
+        with mock.patch("wormhole.ipaddrs.find_addresses",
+                        return_value=[LOOPADDR, "::1", OTHERADDR,
+                                      "2001:db8::1"]):
+            hints, ep = c._build_listener()
+        self.assertEqual([h.hostname for h in hints],
+                         ["1.2.3.4", "2001:db8::1"])
+        self.assertIsInstance(ep, transit._DualStackServerEndpoint)
+
+    @inlineCallbacks
+    def test_dual_stack(self):
+        ep = transit._DualStackServerEndpoint(reactor,
+                                              transit.allocate_tcp_port())
+        f = protocol.Factory.forProtocol(protocol.Protocol)
+        lp = yield ep.listen(f)
+        self.assertIsInstance(lp, transit._ListeningPorts)
+        yield lp.stopListening()
+
+    @inlineCallbacks
+    def test_dual_stack_no_ipv6(self):
+        # if the IPv6 socket can't be had, we settle for IPv4
+        ep = transit._DualStackServerEndpoint(reactor,
+                                              transit.allocate_tcp_port())
+        f = protocol.Factory.forProtocol(protocol.Protocol)
+        with mock.patch("twisted.internet.endpoints.TCP6ServerEndpoint"
+                        ".listen",
+                        return_value=defer.fail(error.CannotListenError(
+                            "::", 0, "nope"))):
+            lp = yield ep.listen(f)
+        self.assertFalse(lp.ipv6)
+        self.assertEqual(len(lp._ports), 1)
+        yield lp.stopListening()
+
+    @inlineCallbacks
+    def test_get_direct_hints_no_ipv6(self):
+        c = transit.TransitSender("")
+        with mock.patch("wormhole.ipaddrs.find_addresses",
+                        return_value=[OTHERADDR, "2001:db8::1"]):
+            with mock.patch("twisted.internet.endpoints.TCP6ServerEndpoint"
+                            ".listen",
+                            return_value=defer.fail(error.CannotListenError(
+                                "::", 0, "nope"))):
+                hints = yield c.get_connection_hints()
+        c._stop_listening()
+        self.assertEqual([h["hostname"] for h in hints], ["1.2.3.4"])
+
     def test_get_direct_hints(self):
         # this actually starts the listener
         c = transit.TransitSender("")
@@ -429,8 +668,15 @@ class FakeTransport:
         self._peeraddr = peeraddr
         self._buf = b""
         self._connected = True
+        self.producerState = "producing"
     def write(self, data):
         self._buf += data
+    def pauseProducing(self):
+        self.producerState = "paused"
+    def resumeProducing(self):
+        self.producerState = "producing"
+    def writeSequence(self, data):
+        self._buf += b"".join(data)
     def loseConnection(self):
         self._connected = False
         if self.signalConnectionLost:
@@ -617,10 +863,20 @@ class MockOwner:
         return b"send_this"
     def _expect_this(self):
         return b"expect_this"
-    def _sender_record_key(self):
+    def _sender_record_key(self, stripe=0):
+        if stripe:
+            return b"S"*31 + six.int2byte(stripe)
         return b"s"*32
-    def _receiver_record_key(self):
+    def _receiver_record_key(self, stripe=0):
+        if stripe:
+            return b"R"*31 + six.int2byte(stripe)
         return b"r"*32
+    def _accept_stripe(self, index):
+        accepted = self.__dict__.setdefault("_accepted", set())
+        if not 0 < index < 3 or index in accepted:
+            return False
+        accepted.add(index)
+        return True
 
 class MockFactory:
     _connectionWasMade_called = False
@@ -843,6 +1099,109 @@ class Connection(unittest.TestCase):
         self.assertEqual(c.state, "records")
         self.assertEqual(self.successResultOf(d), c)
 
+    def test_receiver_accepted_with_record(self):
+        # the first record might arrive in the same chunk as the "go"
+        owner = MockOwner()
+        factory = MockFactory()
+        addr = address.HostnameAddress("example.com", 1234)
+        c = transit.Connection(owner, None, None, "description")
+        c.transport = FakeTransport(c, addr)
+        c.factory = factory
+        c.connectionMade()
+
+        owner._state = "wait-for-decision"
+        d = c.startNegotiation()
+        c.dataReceived(b"expect_this")
+
+        send_box = SecretBox(owner._receiver_record_key())
+        encrypted = send_box.encrypt(b"record", unhexlify("%048x" % 0))
+        length = unhexlify("%08x" % len(encrypted))
+        c.dataReceived(b"go\n" + length + encrypted[:5])
+        self.assertEqual(c.state, "records")
+        self.assertEqual(self.successResultOf(d), c)
+        rd = c.receive_record()
+        self.assertNoResult(rd)
+        c.dataReceived(encrypted[5:])
+        self.assertEqual(self.successResultOf(rd), b"record")
+
+    def test_sender_striping(self):
+        owner = MockOwner()
+        c = transit.Connection(owner, None, None, "description")
+        t = c.transport = FakeTransport(c, None)
+        c.factory = MockFactory()
+        c.connectionMade()
+
+        owner._state = "go-stripe"
+        c._stripe_index = 2 # set by connection_ready()
+        d = c.startNegotiation()
+        t.read_buf()
+        c.dataReceived(b"expect_this")
+        self.assertEqual(t.read_buf(), b"go-stripe 2\n")
+        self.assertEqual(c.state, "records")
+        self.assertEqual(self.successResultOf(d), c)
+        self.assertEqual(c.send_box._key, owner._sender_record_key(2))
+        self.assertEqual(c.receive_box._key, owner._receiver_record_key(2))
+
+    def test_receiver_striped(self):
+        owner = MockOwner()
+        c = transit.Connection(owner, None, None, "description")
+        c.transport = FakeTransport(c, None)
+        c.factory = MockFactory()
+        c.connectionMade()
+
+        owner._state = "wait-for-decision"
+        d = c.startNegotiation()
+        c.dataReceived(b"expect_this")
+        c.dataReceived(b"go")
+        self.assertNoResult(d)
+        c.dataReceived(b"-stripe ")
+        self.assertNoResult(d)
+
+        send_box = SecretBox(owner._receiver_record_key(1))
+        encrypted = send_box.encrypt(b"record", unhexlify("%048x" % 0))
+        length = unhexlify("%08x" % len(encrypted))
+        c.dataReceived(b"1\n" + length + encrypted)
+        self.assertEqual(c.state, "records")
+        self.assertEqual(self.successResultOf(d), c)
+        self.assertEqual(c._stripe_index, 1)
+        self.assertEqual(self.successResultOf(c.receive_record()), b"record")
+
+    def test_receiver_bad_stripe(self):
+        for bad in [b"go-stripe 3\n", b"go-stripe 0\n", b"go-stripe x\n",
+                    b"go-stripe 11111111"]:
+            owner = MockOwner()
+            c = transit.Connection(owner, None, None, "description")
+            t = c.transport = FakeTransport(c, None)
+            c.factory = MockFactory()
+            c.connectionMade()
+
+            owner._state = "wait-for-decision"
+            d = c.startNegotiation()
+            c.dataReceived(b"expect_this")
+            c.dataReceived(bad)
+            self.assertEqual(t._connected, False)
+            self.failureResultOf(d, transit.BadHandshake)
+
+    def test_receiver_duplicate_stripe(self):
+        owner = MockOwner()
+        owner._state = "wait-for-decision"
+        results = []
+        for i in range(2):
+            c = transit.Connection(owner, None, None, "description")
+            t = c.transport = FakeTransport(c, None)
+            c.factory = MockFactory()
+            c.connectionMade()
+            d = c.startNegotiation()
+            c.dataReceived(b"expect_this")
+            c.dataReceived(b"go-stripe 1\n")
+            results.append((c, t, d))
+        (c1, t1, d1), (c2, t2, d2) = results
+        self.assertEqual(self.successResultOf(d1), c1)
+        self.assertEqual(t1._connected, True)
+        # a second stream with the same index would reuse its nonces
+        self.assertEqual(t2._connected, False)
+        self.failureResultOf(d2, transit.BadHandshake)
+
     def test_receiver_rejected_politely(self):
         # we're on the receiving side, so we wait for the sender to decide
         owner = MockOwner()
@@ -966,6 +1325,14 @@ class Connection(unittest.TestCase):
         with self.assertRaises(InternalError):
             c.send_record(RECORD1)
 
+    def test_records_memoryview(self):
+        # FileProducer hands us slices of a mapped file
+        t, c, owner = self.make_connection()
+        c.send_record(memoryview(b"a record")[2:])
+        buf = t.read_buf()
+        receive_box = SecretBox(owner._sender_record_key())
+        self.assertEqual(receive_box.decrypt(buf[4:]), b"record")
+
     def test_records_good(self):
         # now make sure that outbound records are encrypted properly
         t, c, owner = self.make_connection()
@@ -1256,6 +1623,45 @@ class Connection(unittest.TestCase):
         c.connectionLost()
         self.failureResultOf(d, error.ConnectionClosed)
 
+    def test_writeToFile_compressed(self):
+        c = transit.Connection(None, None, None, "description")
+        c._negotiation_d.addErrback(lambda err: None) # eat it
+        c.transport = proto_helpers.StringTransport()
+        compressor = _compression.Compressor("zlib")
+        decompressor = _compression.Decompressor("zlib", 1000)
+
+        f = io.BytesIO()
+        progress = []
+        d = c.writeToFile(f, 600, progress.append, None, decompressor)
+        c.recordReceived(compressor.compress(b"a"*300))
+        self.assertEqual(f.getvalue(), b"a"*300)
+        self.assertEqual(progress, [300])
+        self.assertNoResult(d)
+        # the decompressed bytes are what count
+        c.recordReceived(compressor.compress(b"b"*300))
+        self.assertEqual(self.successResultOf(d), 600)
+        self.assertEqual(f.getvalue(), b"a"*300 + b"b"*300)
+        self.assertIs(c._consumer, None)
+
+    def test_writeToFile_threaded(self):
+        c = transit.Connection(None, None, None, "description")
+        c._negotiation_d.addErrback(lambda err: None) # eat it
+        c.transport = proto_helpers.StringTransport()
+        c.recordReceived(b"r1.")
+
+        f = io.BytesIO()
+        progress = []
+        d = c.writeToFile(f, 6, progress.append, threaded=True)
+        c.recordReceived(b"r2.")
+        self.assertIs(c._consumer, None)
+        def _check(res):
+            # it only fires once the writer thread is done with the file
+            self.assertEqual(res, 6)
+            self.assertEqual(f.getvalue(), b"r1.r2.")
+            self.assertEqual(progress, [3, 3])
+        d.addCallback(_check)
+        return d
+
     def test_consumer(self):
         # a local producer sends data to a consuming Transit object
         c = transit.Connection(None, None, None, "description")
@@ -1273,6 +1679,513 @@ class Connection(unittest.TestCase):
         c.unregisterProducer()
         self.assertEqual(c.transport.producer, None)
 
+class FakeThreadPool:
+    # jobs run only when the test says so, in whatever order it likes
+    started = True
+    def __init__(self):
+        self.jobs = []
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        self.jobs.append((onResult, f, args, kwargs))
+    def run(self, index=0):
+        onResult, f, args, kwargs = self.jobs.pop(index)
+        try:
+            res = f(*args, **kwargs)
+        except Exception as e:
+            onResult(False, failure.Failure(e))
+        else:
+            onResult(True, res)
+    def run_all(self):
+        while self.jobs:
+            self.run()
+    def stop(self):
+        self.started = False
+
+class FakeReactor:
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+class Pipeline(unittest.TestCase):
+    def build(self, window=3):
+        self.delivered = []
+        self.failed = []
+        self.changes = []
+        self.pool = FakeThreadPool()
+        return _pipeline.OrderedPipeline(FakeReactor(), self.pool, window,
+                                         self.delivered.append,
+                                         self.failed.append,
+                                         lambda: self.changes.append(1))
+
+    def test_ordering(self):
+        p = self.build()
+        self.assertTrue(p.is_empty())
+        d0 = p.submit(lambda x: x*2, 0)
+        d1 = p.submit(lambda x: x*2, 1)
+        self.assertFalse(p.is_full())
+        d2 = p.submit(lambda x: x*2, 2)
+        self.assertTrue(p.is_full())
+        drained = p.when_drained()
+
+        self.pool.run(2) # job 2 finishes first, but must wait for the others
+        self.assertEqual(self.delivered, [])
+        self.assertNoResult(d2)
+        self.pool.run(1)
+        self.assertEqual(self.delivered, [])
+        self.pool.run(0)
+        self.assertEqual(self.delivered, [0, 2, 4])
+        for d in [d0, d1, d2]:
+            self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(self.successResultOf(drained), None)
+        self.assertTrue(p.is_empty())
+        self.assertEqual(len(self.changes), 3)
+        self.assertEqual(self.successResultOf(p.when_drained()), None)
+
+    def test_failure(self):
+        p = self.build()
+        def boom():
+            raise RandomError("boom")
+        d0 = p.submit(boom)
+        d1 = p.submit(lambda: 1)
+        self.pool.run(1)
+        self.pool.run(0)
+        self.assertEqual(self.delivered, [])
+        self.assertEqual(len(self.failed), 1)
+        self.failed[0].trap(RandomError)
+        self.failureResultOf(d0, RandomError)
+        self.failureResultOf(d1, RandomError)
+        self.assertTrue(p.is_empty())
+
+class FakeShutdownReactor(FakeReactor):
+    def __init__(self):
+        self.triggers = {}
+        self.pool = FakeThreadPool()
+    def addSystemEventTrigger(self, phase, event, f):
+        trigger = object()
+        self.triggers[trigger] = (phase, event, f)
+        return trigger
+    def removeSystemEventTrigger(self, trigger):
+        del self.triggers[trigger]
+    def getThreadPool(self):
+        return self.pool
+    def shutdown(self):
+        for (phase, event, f) in list(self.triggers.values()):
+            f()
+
+class TransferThreadPool(unittest.TestCase):
+    def test_stop_soon(self):
+        r = FakeShutdownReactor()
+        pool = _pipeline.TransferThreadPool(r, 2, "test")
+        self.assertTrue(pool.started)
+        self.assertEqual(list(r.triggers.values())[0][:2],
+                         ("before", "shutdown"))
+        d = pool.stopSoon()
+        # the trigger goes away at once, but the threads are joined on one
+        # of the reactor's threads
+        self.assertEqual(r.triggers, {})
+        self.assertTrue(pool.started)
+        self.assertNoResult(d)
+        r.pool.run_all()
+        self.assertFalse(pool.started)
+        self.successResultOf(d)
+        self.successResultOf(pool.stopSoon())
+
+    def test_shutdown(self):
+        r = FakeShutdownReactor()
+        pool = _pipeline.TransferThreadPool(r, 2, "test")
+        r.shutdown()
+        self.assertFalse(pool.started)
+        self.successResultOf(pool.stopSoon())
+        self.assertEqual(r.pool.jobs, [])
+
+class FakeProducer:
+    def __init__(self, pipeline=None, chunks=None):
+        self.calls = []
+        self._pipeline = pipeline
+        self._chunks = chunks
+    def pauseProducing(self):
+        self.calls.append("pause")
+    def resumeProducing(self):
+        self.calls.append("resume")
+        if self._chunks:
+            self._pipeline.submit(lambda c: c, self._chunks.pop(0))
+    def stopProducing(self):
+        self.calls.append("stop")
+
+class Throttle(unittest.TestCase):
+    def test_streaming(self):
+        pool = FakeThreadPool()
+        p = _pipeline.OrderedPipeline(FakeReactor(), pool, 1,
+                                      lambda res: None, lambda f: None)
+        producer = FakeProducer()
+        t = _pipeline.ProducerThrottle(producer, True, p)
+        t.pauseProducing()
+        self.assertEqual(producer.calls, ["pause"])
+        t.resumeProducing()
+        self.assertEqual(producer.calls, ["pause", "resume"])
+        p.submit(lambda: None)
+        t.pipelineChanged()
+        self.assertEqual(producer.calls, ["pause", "resume", "pause"])
+        # the transport would be happy, but the pipeline is still full
+        t.resumeProducing()
+        self.assertEqual(producer.calls, ["pause", "resume", "pause"])
+        pool.run()
+        t.pipelineChanged()
+        self.assertEqual(producer.calls, ["pause", "resume", "pause",
+                                          "resume"])
+        t.stopProducing()
+        self.assertEqual(producer.calls[-1], "stop")
+        t.detach()
+        t.pauseProducing()
+        self.assertEqual(producer.calls[-1], "stop")
+
+    def test_pull(self):
+        pool = FakeThreadPool()
+        delivered = []
+        p = _pipeline.OrderedPipeline(FakeReactor(), pool, 2,
+                                      delivered.append, lambda f: None)
+        producer = FakeProducer(p, [b"1", b"2", b"3"])
+        t = _pipeline.ProducerThrottle(producer, False, p)
+        # one request from the transport fills the pipeline
+        t.resumeProducing()
+        self.assertEqual(producer.calls, ["resume", "resume"])
+        self.assertTrue(p.is_full())
+        # draining the pipeline doesn't pull by itself: the transport will
+        # ask once it has written those
+        pool.run_all()
+        t.pipelineChanged()
+        self.assertEqual(delivered, [b"1", b"2"])
+        self.assertEqual(producer.calls, ["resume", "resume"])
+        # a producer that doesn't write anything isn't called in a loop
+        t.resumeProducing()
+        self.assertEqual(producer.calls, ["resume", "resume", "resume",
+                                          "resume"])
+
+class Records(unittest.TestCase):
+    def test_nonce(self):
+        for n in [0, 1, 255, 2**64-1, 2**64, 2**130+7, 2**(8*24)-1]:
+            encoded = _records.encode_nonce(n)
+            self.assertEqual(encoded, unhexlify("%048x" % n))
+            self.assertEqual(_records.decode_nonce(encoded), n)
+        self.assertEqual(_records.decode_nonce(b"xx"+_records.encode_nonce(9),
+                                               2), 9)
+
+    def test_length(self):
+        self.assertEqual(_records.encode_length(0), b"\x00\x00\x00\x00")
+        self.assertEqual(_records.encode_length(0x01020304),
+                         b"\x01\x02\x03\x04")
+
+    def test_decoder(self):
+        d = _records.RecordDecoder()
+        self.assertEqual(d.next_frame(), None)
+        frames = [b"one", b"", b"three"*1000, b"four"]
+        stream = b"".join(_records.encode_length(len(f))+f for f in frames)
+        # dribble the stream in one byte at a time
+        got = []
+        for i in range(len(stream)):
+            d.feed(stream[i:i+1])
+            while True:
+                frame = d.next_frame()
+                if frame is None:
+                    break
+                got.append(frame)
+        self.assertEqual(got, frames)
+        self.assertEqual(d.buffered(), 0)
+
+        # and all at once, with a trailing partial frame
+        d.feed(stream + b"\x00\x00")
+        got = [d.next_frame() for f in frames]
+        self.assertEqual(got, frames)
+        self.assertEqual(d.next_frame(), None)
+        self.assertEqual(d.buffered(), 2)
+        d.feed(b"\x00\x01!")
+        frame = d.next_frame()
+        self.assertEqual(frame, b"!")
+        self.assertIsInstance(frame, type(b""))
+        self.assertEqual(d.buffered(), 0)
+
+class ThreadedConnection(unittest.TestCase):
+    def make_connection(self):
+        owner = MockOwner()
+        c = transit.Connection(owner, None, None, "description")
+        t = c.transport = FakeTransport(c, None)
+        c.factory = MockFactory()
+        c.connectionMade()
+        owner._state = "go"
+        c.startNegotiation()
+        c.dataReceived(b"expect_this")
+        t.read_buf()
+        self.pool = FakeThreadPool()
+        c.useThreadedCrypto(self.pool, window=2, reactor=FakeReactor())
+        return t, c, owner
+
+    def test_send(self):
+        t, c, owner = self.make_connection()
+        d1 = c.send_record(b"record1")
+        d2 = c.send_record(b"record2")
+        self.assertEqual(t.read_buf(), b"")
+        self.pool.run(1)
+        self.assertEqual(t.read_buf(), b"")
+        self.assertNoResult(d2)
+        self.pool.run(0)
+        self.successResultOf(d1)
+        self.successResultOf(d2)
+
+        buf = t.read_buf()
+        receive_box = SecretBox(owner._sender_record_key())
+        records = []
+        while buf:
+            length = int(hexlify(buf[:4]), 16)
+            encrypted, buf = buf[4:4+length], buf[4+length:]
+            records.append((_records.decode_nonce(encrypted),
+                            receive_box.decrypt(encrypted)))
+        self.assertEqual(records, [(0, b"record1"), (1, b"record2")])
+
+    def test_send_memoryview(self):
+        # a mapped slice is copied before it's handed to a worker, since the
+        # file could be truncated before the worker reads it
+        t, c, owner = self.make_connection()
+        d = c.send_record(memoryview(b"record1"))
+        self.assertIsInstance(self.pool.jobs[0][2][0], type(b""))
+        self.pool.run(0)
+        self.successResultOf(d)
+
+    def test_receive(self):
+        t, c, owner = self.make_connection()
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        send_box = SecretBox(owner._receiver_record_key())
+        data = b""
+        for i in range(3):
+            encrypted = send_box.encrypt(b"record%d" % i,
+                                         _records.encode_nonce(i))
+            data += _records.encode_length(len(encrypted)) + encrypted
+
+        c.dataReceived(data)
+        # only two can be in flight, so we stop reading
+        self.assertEqual(len(self.pool.jobs), 2)
+        self.assertEqual(t.producerState, "paused")
+        # the consumer pausing/resuming us must not unpause the transport
+        c.pauseProducing()
+        c.resumeProducing()
+        self.assertEqual(t.producerState, "paused")
+
+        self.pool.run(1)
+        self.assertEqual(inbound_records, [])
+        self.pool.run(0)
+        # that made room for the third record, which was waiting in the buffer
+        self.assertEqual(inbound_records, [b"record0", b"record1"])
+        self.assertEqual(len(self.pool.jobs), 1)
+        self.assertEqual(t.producerState, "producing")
+        self.pool.run(0)
+        self.assertEqual(inbound_records, [b"record0", b"record1", b"record2"])
+
+    def test_receive_corrupt(self):
+        t, c, owner = self.make_connection()
+        send_box = SecretBox(owner._receiver_record_key())
+        encrypted = send_box.encrypt(b"record", _records.encode_nonce(0))
+        encrypted = encrypted[:-1] + (b"\x00" if encrypted[-1:] != b"\x00"
+                                      else b"\x01")
+        c.dataReceived(_records.encode_length(len(encrypted)) + encrypted)
+        self.assertEqual(t._connected, True)
+        self.pool.run(0)
+        self.assertEqual(t._connected, False)
+        self.assertEqual(len(self.flushLoggedErrors(CryptoError)), 1)
+
+    def test_close_waits_for_pipeline(self):
+        t, c, owner = self.make_connection()
+        c.send_record(b"record1")
+        c.close()
+        self.assertEqual(t._connected, True)
+        self.pool.run(0)
+        self.assertNotEqual(t.read_buf(), b"")
+        self.assertEqual(t._connected, False)
+        self.assertEqual(self.pool.started, False)
+
+class FakeMember(transit._RecordPipe):
+    # stands in for a negotiated Connection inside a StripedConnection
+    def __init__(self, name):
+        self._init_record_pipe()
+        self.name = name
+        self.sent = []
+        self.calls = []
+        self.producer = None
+        self.lost_d = defer.Deferred()
+        self.clean = False
+    def whenLost(self):
+        return self.lost_d
+    def lostCleanly(self):
+        return self.clean
+    def describe(self):
+        return self.name
+    def send_record(self, record):
+        self.sent.append(record)
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+    def unregisterProducer(self):
+        self.producer = None
+    def pauseProducing(self):
+        self.calls.append("pause")
+    def resumeProducing(self):
+        self.calls.append("resume")
+    def stopProducing(self):
+        self.calls.append("stop")
+    def close(self):
+        self.calls.append("close")
+
+def seq(n, record):
+    return unhexlify("%016x" % n) + record
+
+class Striped(unittest.TestCase):
+    def build(self):
+        a, b = FakeMember("a"), FakeMember("b")
+        c = transit.StripedConnection(a)
+        c.add_stream(b)
+        return c, a, b
+
+    def test_describe(self):
+        c, a, b = self.build()
+        self.assertEqual(c.describe(), "a + b")
+        self.assertEqual(c.streams(), [a, b])
+
+    def test_send(self):
+        c, a, b = self.build()
+        self.assertRaises(InternalError, c.send_record, u"not bytes")
+        c.send_record(b"r0")
+        c.send_record(b"r1")
+        c.send_record(b"r2")
+        self.assertEqual(a.sent, [seq(0, b"r0"), seq(2, b"r2")])
+        self.assertEqual(b.sent, [seq(1, b"r1")])
+
+        # records go to members whose transports have room
+        p = FakeProducer()
+        c.registerProducer(p, True)
+        b.producer.pauseProducing()
+        c.send_record(b"r3")
+        c.send_record(b"r4")
+        self.assertEqual(a.sent[2:], [seq(3, b"r3"), seq(4, b"r4")])
+        self.assertEqual(p.calls, [])
+        a.producer.pauseProducing()
+        self.assertEqual(p.calls, ["pause"])
+        b.producer.resumeProducing()
+        self.assertEqual(p.calls, ["pause", "resume"])
+        c.send_record(b"r5")
+        self.assertEqual(b.sent[1:], [seq(5, b"r5")])
+        c.unregisterProducer()
+        self.assertEqual((a.producer, b.producer), (None, None))
+
+    def test_pull_producer(self):
+        c, a, b = self.build()
+        class Pull:
+            def __init__(self):
+                self.count = 0
+            def resumeProducing(self):
+                self.count += 1
+                c.write(b"chunk")
+                if self.count >= 3: # fill both transport buffers
+                    a.producer.pauseProducing()
+                    b.producer.pauseProducing()
+        p = Pull()
+        c.registerProducer(p, False)
+        self.assertEqual(p.count, 3)
+        self.assertEqual(len(a.sent) + len(b.sent), 3)
+        a.producer.resumeProducing()
+        self.assertEqual(p.count, 4)
+
+    def test_receive_in_order(self):
+        c, a, b = self.build()
+        b.recordReceived(seq(1, b"r1"))
+        d = c.receive_record()
+        self.assertNoResult(d)
+        a.recordReceived(seq(0, b"r0"))
+        self.assertEqual(self.successResultOf(d), b"r0")
+        self.assertEqual(self.successResultOf(c.receive_record()), b"r1")
+
+    def test_early_records(self):
+        # records that a member received before joining are not lost
+        a, b = FakeMember("a"), FakeMember("b")
+        b.recordReceived(seq(1, b"r1"))
+        c = transit.StripedConnection(a)
+        a.recordReceived(seq(0, b"r0"))
+        c.add_stream(b)
+        self.assertEqual(self.successResultOf(c.receive_record()), b"r0")
+        self.assertEqual(self.successResultOf(c.receive_record()), b"r1")
+
+    def test_duplicate(self):
+        c, a, b = self.build()
+        a.recordReceived(seq(0, b"r0"))
+        self.assertRaises(transit.BadNonce, b.recordReceived, seq(0, b"r0"))
+        b.recordReceived(seq(2, b"r2"))
+        self.assertRaises(transit.BadNonce, a.recordReceived, seq(2, b"r2"))
+
+    def test_reorder_limit(self):
+        c, a, b = self.build()
+        c.MAX_REORDER = 2
+        b.recordReceived(seq(1, b"r1"))
+        b.recordReceived(seq(2, b"r2"))
+        self.assertEqual(b.calls, [])
+        b.recordReceived(seq(3, b"r3"))
+        # b is ahead, but a holds the missing record, so it keeps going
+        self.assertEqual(b.calls, ["pause"])
+        self.assertEqual(a.calls, [])
+        a.recordReceived(seq(0, b"r0"))
+        self.assertEqual(b.calls, ["pause", "resume"])
+
+    def test_consumer(self):
+        c, a, b = self.build()
+        consumer = proto_helpers.StringTransport()
+        c.connectConsumer(consumer)
+        self.assertIs(consumer.producer, c)
+        a.recordReceived(seq(0, b"r0"))
+        b.recordReceived(seq(1, b"r1"))
+        self.assertEqual(consumer.value(), b"r0r1")
+        c.pauseProducing()
+        self.assertEqual((a.calls, b.calls), (["pause"], ["pause"]))
+        c.resumeProducing()
+        self.assertEqual((a.calls, b.calls), (["pause", "resume"],
+                                              ["pause", "resume"]))
+        c.stopProducing()
+        self.assertEqual(a.calls[-1], "stop")
+        c.disconnectConsumer()
+
+    def test_lost(self):
+        c, a, b = self.build()
+        f = io.BytesIO()
+        d = c.writeToFile(f, 10)
+        a.recordReceived(seq(0, b"12345"))
+        b.lost_d.callback(b)
+        self.failureResultOf(d, error.ConnectionClosed)
+        rd = c.receive_record()
+        a.lost_d.callback(a)
+        self.failureResultOf(rd, error.ConnectionClosed)
+
+    def test_lost_cleanly(self):
+        # the peer closes every member after its last record, but we may
+        # see one of them go away before the record on another arrives
+        c, a, b = self.build()
+        rd = c.receive_record()
+        b.clean = True
+        b.lost_d.callback(b)
+        self.assertNoResult(rd)
+        a.recordReceived(seq(0, b"ack"))
+        self.assertEqual(self.successResultOf(rd), b"ack")
+        # but once they're all gone, nothing more can arrive
+        rd = c.receive_record()
+        a.clean = True
+        a.lost_d.callback(a)
+        self.failureResultOf(rd, error.ConnectionClosed)
+
+    def test_close(self):
+        c, a, b = self.build()
+        closed = []
+        c._closed = lambda: closed.append(True)
+        rd = c.receive_record()
+        c.close()
+        self.assertEqual(closed, [True])
+        self.assertEqual((a.calls, b.calls), (["close"], ["close"]))
+        self.failureResultOf(rd, error.ConnectionClosed)
+        # losing the members after close() is expected
+        a.lost_d.callback(a)
+        b.lost_d.callback(b)
+
 class FileConsumer(unittest.TestCase):
     def test_basic(self):
         f = io.BytesIO()
@@ -1304,6 +2217,421 @@ class FileConsumer(unittest.TestCase):
         self.assertEqual(f.getvalue(), b"."*99+b"!")
         self.assertEqual(hashee, [b"."*99, b"!"])
 
+    def test_decompressor(self):
+        f = io.BytesIO()
+        progress = []
+        compressor = _compression.Compressor("zlib")
+        decompressor = _compression.Decompressor("zlib", 1000)
+        fc = transit.FileConsumer(f, progress.append,
+                                  decompressor=decompressor)
+        fc.write(compressor.compress(b"."*99))
+        fc.write(_compression.RAW + b"!")
+        self.assertEqual(progress, [99, 1])
+        self.assertEqual(f.getvalue(), b"."*99+b"!")
+        self.assertEqual(fc.bytes_written, 100)
+
+    def test_compressing_consumer(self):
+        t = proto_helpers.StringTransport()
+        cc = transit.CompressingConsumer(t, _compression.Compressor("zlib"))
+        p = FakeProducer()
+        cc.registerProducer(p, True)
+        self.assertIs(t.producer, p)
+        cc.write(b"."*99)
+        self.assertEqual(t.value()[:1], _compression.COMPRESSED)
+        cc.unregisterProducer()
+        self.assertIs(t.producer, None)
+
+class ChunkConsumer(object):
+    # like StringTransport, but accepts the memoryviews FileProducer writes
+    def __init__(self):
+        self.producer = None
+        self.streaming = None
+        self.clear()
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.streaming = streaming
+    def unregisterProducer(self):
+        self.producer = None
+    def write(self, data):
+        self.chunks.append(data)
+    def value(self):
+        return b"".join(bytes(c) for c in self.chunks)
+    def clear(self):
+        self.chunks = []
+
+class FileProducer(unittest.TestCase):
+    def setUp(self):
+        self.data = b"".join(b"%06d\n" % i for i in range(100)) # 700 bytes
+        self.fn = self.mktemp()
+        with open(self.fn, "wb") as f:
+            f.write(self.data)
+
+    def open(self):
+        f = open(self.fn, "rb")
+        self.addCleanup(f.close)
+        return f
+
+    def send(self, fp, transform=None):
+        clock = task.Clock()
+        fp._reactor = clock
+        t = ChunkConsumer()
+        d = fp.beginFileTransfer(t, transform)
+        self.assertIs(t.producer, fp)
+        self.assertTrue(t.streaming)
+        return clock, t, d
+
+    def turn(self, clock):
+        # run one reactor turn: Clock.advance(0) would also run the calls
+        # that these make
+        calls, clock.calls = clock.calls, []
+        for c in calls:
+            c.func(*c.args, **c.kw)
+
+    def test_mapped(self):
+        chunks = []
+        def transform(chunk):
+            chunks.append(chunk)
+            return chunk
+        fp = transit.FileProducer(self.open(), 32)
+        clock, t, d = self.send(fp, transform)
+        self.assertEqual(t.value(), b"") # nothing until the reactor runs
+        self.turn(clock)
+        self.assertEqual(len(t.value()), 32*fp.CHUNKS_PER_TURN)
+        self.assertNoResult(d)
+        self.turn(clock)
+        self.successResultOf(d)
+        self.assertEqual(t.value(), self.data)
+        self.assertIs(t.producer, None)
+        if six.PY3:
+            self.assertIsInstance(chunks[0], memoryview)
+        self.assertEqual([len(c) for c in chunks], [32]*21 + [28])
+
+    def test_offset(self):
+        fp = transit.FileProducer(self.open(), 64, offset=100)
+        clock, t, d = self.send(fp)
+        self.turn(clock)
+        self.successResultOf(d)
+        self.assertEqual(t.value(), self.data[100:])
+
+    def test_offset_at_end(self):
+        fp = transit.FileProducer(self.open(), 64, offset=len(self.data))
+        clock, t, d = self.send(fp)
+        self.turn(clock)
+        self.successResultOf(d)
+        self.assertEqual(t.value(), b"")
+
+    def test_unmappable(self):
+        fp = transit.FileProducer(io.BytesIO(self.data), 64, offset=7)
+        clock, t, d = self.send(fp)
+        self.turn(clock)
+        self.turn(clock)
+        self.successResultOf(d)
+        self.assertEqual(t.value(), self.data[7:])
+
+    def test_spooled(self):
+        f = tempfile.SpooledTemporaryFile()
+        self.addCleanup(f.close)
+        f.write(self.data)
+        fp = transit.FileProducer(f, 64, offset=7, mappable=False)
+        with mock.patch.object(f, "fileno") as fileno:
+            clock, t, d = self.send(fp)
+            self.turn(clock)
+            self.turn(clock)
+        self.successResultOf(d)
+        self.assertEqual(t.value(), self.data[7:])
+        # it's read from memory, rather than copied to disk to be mapped
+        self.assertEqual(fileno.mock_calls, [])
+        self.assertIsInstance(t.chunks[0], type(b""))
+
+        f.rollover() # now it's a real file, which can be mapped
+        fp = transit.FileProducer(f, 64)
+        clock, t, d = self.send(fp)
+        self.turn(clock)
+        self.successResultOf(d)
+        self.assertEqual(t.value(), self.data)
+        if six.PY3:
+            self.assertIsInstance(t.chunks[0], memoryview)
+
+    def test_pause(self):
+        fp = transit.FileProducer(self.open(), 32)
+        clock, t, d = self.send(fp)
+        fp.pauseProducing()
+        self.turn(clock)
+        self.assertEqual(t.value(), b"")
+        fp.resumeProducing()
+        self.turn(clock)
+        self.assertEqual(len(t.value()), 32*fp.CHUNKS_PER_TURN)
+
+        # the consumer can pause us in the middle of a turn
+        t.clear()
+        orig_write = t.write
+        def write(data):
+            orig_write(data)
+            fp.pauseProducing()
+        t.write = write
+        self.turn(clock)
+        self.assertEqual(len(t.value()), 32)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        t.write = orig_write
+        fp.resumeProducing()
+        self.turn(clock)
+        self.successResultOf(d)
+
+    def test_stop(self):
+        fp = transit.FileProducer(self.open(), 64)
+        clock, t, d = self.send(fp)
+        fp.stopProducing()
+        self.failureResultOf(d, Exception)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_write_fails(self):
+        fp = transit.FileProducer(self.open(), 64)
+        def transform(chunk):
+            raise ValueError("oops")
+        clock, t, d = self.send(fp, transform)
+        self.turn(clock)
+        self.failureResultOf(d, ValueError)
+        self.assertIs(t.producer, None)
+
+    def test_truncated(self):
+        if not six.PY3:
+            raise unittest.SkipTest("py2 reads the file instead of mapping it")
+        fp = transit.FileProducer(self.open(), 64)
+        clock, t, d = self.send(fp)
+        with open(self.fn, "r+b") as f:
+            f.truncate(100)
+        self.turn(clock)
+        f = self.failureResultOf(d, IOError)
+        self.assertIn("shrank", str(f.value))
+        self.assertEqual(t.value(), self.data[:64])
+
+class BrokenFile:
+    def write(self, data):
+        raise IOError("disk full")
+
+class ThreadedFileConsumer(unittest.TestCase):
+    def build(self, f=None, **kwargs):
+        self.pool = FakeThreadPool()
+        self.f = f or io.BytesIO()
+        self.progress = []
+        self.hashed = []
+        fc = transit.ThreadedFileConsumer(self.f, self.progress.append,
+                                          self.hashed.append,
+                                          threadpool=self.pool,
+                                          reactor=FakeReactor(), **kwargs)
+        self.producer = FakeProducer()
+        fc.registerProducer(self.producer, True)
+        return fc
+
+    def test_basic(self):
+        fc = self.build()
+        fc.write(b"."*99)
+        fc.write(b"!")
+        self.assertEqual(fc.bytes_written, 100)
+        # nothing happens until the writer thread gets to it
+        self.assertEqual(self.f.getvalue(), b"")
+        self.assertEqual(self.progress, [])
+        self.pool.run()
+        self.assertEqual(self.f.getvalue(), b"."*99)
+        self.assertEqual(self.progress, [99])
+        self.assertEqual(self.hashed, [b"."*99])
+        d = fc.finish(100)
+        self.assertNoResult(d)
+        self.pool.run()
+        self.assertEqual(self.successResultOf(d), 100)
+        self.assertEqual(self.f.getvalue(), b"."*99+b"!")
+        self.assertEqual(self.progress, [99, 1])
+        self.assertEqual(self.hashed, [b"."*99, b"!"])
+        fc.unregisterProducer()
+
+    def test_decompressor(self):
+        compressor = _compression.Compressor("zlib")
+        fc = self.build(decompressor=_compression.Decompressor("zlib", 1000))
+        fc.write(compressor.compress(b"."*99))
+        self.assertEqual(fc.bytes_written, 99)
+        self.pool.run_all()
+        self.assertEqual(self.f.getvalue(), b"."*99)
+
+    def test_backpressure(self):
+        fc = self.build(max_queued=10)
+        fc.write(b"a"*6)
+        fc.write(b"b"*4)
+        self.assertEqual(self.producer.calls, [])
+        fc.write(b"c"*2)
+        self.assertEqual(self.producer.calls, ["pause"])
+        fc.write(b"d"*2) # records that were already on their way
+        self.assertEqual(self.producer.calls, ["pause"])
+        self.pool.run() # 8 still queued
+        self.assertEqual(self.producer.calls, ["pause"])
+        self.pool.run() # 4 still queued
+        self.assertEqual(self.producer.calls, ["pause", "resume"])
+        self.pool.run_all()
+        self.assertEqual(self.producer.calls, ["pause", "resume"])
+        self.assertEqual(self.f.getvalue(), b"a"*6+b"b"*4+b"c"*2+b"d"*2)
+
+    def test_write_fails(self):
+        fc = self.build(f=BrokenFile())
+        fc.write(b"one")
+        fc.write(b"two")
+        self.pool.run()
+        # we give up on the transfer right away
+        self.assertEqual(self.producer.calls, ["stop"])
+        fc.write(b"three") # ignored
+        self.assertEqual(len(self.pool.jobs), 1)
+        d = fc.finish(8)
+        self.pool.run_all()
+        self.failureResultOf(d, IOError)
+        self.assertEqual(self.progress, [])
+        self.assertEqual(self.hashed, [])
+
+    def test_connection_lost(self):
+        fc = self.build()
+        fc.write(b"one")
+        d = fc.finish(failure.Failure(error.ConnectionClosed()))
+        self.assertNoResult(d)
+        self.pool.run()
+        self.failureResultOf(d, error.ConnectionClosed)
+        self.assertEqual(self.f.getvalue(), b"one")
+
+    def test_fsync(self):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            fc = self.build(f=f, fsync=4)
+            with mock.patch("os.fsync") as fsync:
+                fc.write(b"abc")
+                fc.write(b"def") # 6 bytes since the last fsync
+                fc.write(b"gh")
+                self.pool.run_all()
+                self.assertEqual(fsync.mock_calls, [mock.call(f.fileno())])
+                d = fc.finish()
+                self.pool.run_all()
+                self.successResultOf(d)
+                self.assertEqual(len(fsync.mock_calls), 2)
+        with open(fn, "rb") as f:
+            self.assertEqual(f.read(), b"abcdefgh")
+
+    def test_fsync_at_end(self):
+        fc = self.build(fsync=0)
+        self.f.fileno = lambda: 99
+        with mock.patch("os.fsync") as fsync:
+            fc.write(b"abc")
+            self.pool.run_all()
+            self.assertEqual(fsync.mock_calls, [])
+            d = fc.finish()
+            self.pool.run_all()
+            self.successResultOf(d)
+            self.assertEqual(fsync.mock_calls, [mock.call(99)])
+
+    def test_fsync_fails(self):
+        fc = self.build(fsync=0) # BytesIO has no fileno()
+        fc.write(b"abc")
+        d = fc.finish()
+        self.pool.run_all()
+        self.failureResultOf(d, io.UnsupportedOperation)
+
+    def test_own_threadpool(self):
+        f = io.BytesIO()
+        fc = transit.ThreadedFileConsumer(f)
+        fc.registerProducer(FakeProducer(), True)
+        fc.write(b"data")
+        fc.unregisterProducer()
+        d = fc.finish()
+        def _check(_):
+            self.assertEqual(f.getvalue(), b"data")
+            self.assertIs(fc._own_threadpool, None)
+        d.addCallback(_check)
+        return d
+
+    def test_own_threadpool_stopped_off_reactor(self):
+        r = FakeShutdownReactor()
+        fc = transit.ThreadedFileConsumer(io.BytesIO(), reactor=r)
+        fc.registerProducer(FakeProducer(), True)
+        pool = fc._own_threadpool
+        self.assertEqual(len(r.triggers), 1)
+        fc.unregisterProducer()
+        d = fc.finish("result")
+        # the shutdown trigger is gone, and the pool is stopped (which waits
+        # for the writer thread) on one of the reactor's threads
+        self.assertEqual(r.triggers, {})
+        self.assertTrue(pool.started)
+        self.assertNoResult(d)
+        r.pool.run_all()
+        self.assertFalse(pool.started)
+        self.assertEqual(self.successResultOf(d), "result")
+
+class Compression(unittest.TestCase):
+    def round_trip(self, method):
+        compressor = _compression.Compressor(method)
+        decompressor = _compression.Decompressor(method, 64*1024)
+        blocks = [b"log line %d\n" % i * 100 for i in range(20)]
+        records = [compressor.compress(b) for b in blocks]
+        for r in records:
+            self.assertEqual(r[:1], _compression.COMPRESSED)
+        self.assertLess(sum(len(r) for r in records),
+                        sum(len(b) for b in blocks) // 10)
+        # each record can be decoded as soon as it arrives
+        self.assertEqual([decompressor.decompress(r) for r in records],
+                         blocks)
+
+    def test_zlib(self):
+        self.round_trip("zlib")
+
+    def test_zstd(self):
+        if "zstd" not in _compression.available_methods():
+            raise unittest.SkipTest("zstandard is not installed")
+        self.round_trip("zstd")
+
+    def test_choose(self):
+        self.assertEqual(_compression.choose_method(["zstd", "zlib"],
+                                                    ["zlib", "zstd"]),
+                         "zstd")
+        self.assertEqual(_compression.choose_method(["zlib", "zstd"],
+                                                    ["zstd"]),
+                         "zstd")
+        self.assertEqual(_compression.choose_method(["zlib"], ["lzma"]), None)
+        self.assertIn("zlib", _compression.available_methods())
+
+    def test_bypass(self):
+        compressor = _compression.Compressor("zlib")
+        decompressor = _compression.Decompressor("zlib", 64*1024)
+        noise = [os.urandom(8192) for i in range(8)]
+        text = b"compress me " * 1000
+        sent = [compressor.compress(b) for b in noise + [text]]
+        flags = [r[:1] for r in sent]
+        # noise is sent raw, and we stop sampling for a while after each
+        # miss: the samples are at blocks 0, 2 and 5, then 10
+        self.assertEqual(flags, [_compression.RAW]*9)
+        self.assertEqual(compressor.compress(text)[:1], _compression.RAW)
+        self.assertEqual(compressor.compress(text)[:1],
+                         _compression.COMPRESSED)
+        self.assertEqual([decompressor.decompress(r) for r in sent],
+                         noise + [text])
+
+    def test_bad_records(self):
+        compressor = _compression.Compressor("zlib")
+        decompressor = _compression.Decompressor("zlib", 1000)
+        self.assertEqual(decompressor.decompress(b""), b"")
+        self.assertRaises(_compression.DecompressionError,
+                          decompressor.decompress, b"\x07data")
+        bomb = compressor.compress(b"\x00" * 2000)
+        self.assertRaises(_compression.DecompressionError,
+                          decompressor.decompress, bomb)
+
+    def test_zstd_bomb(self):
+        if "zstd" not in _compression.available_methods():
+            raise unittest.SkipTest("zstandard is not installed")
+        compressor = _compression.Compressor("zstd")
+        decompressor = _compression.Decompressor("zstd", 64*1024)
+        # a few KB that would expand to 32MB: it must be stopped long
+        # before all of that is held in memory
+        bomb = compressor.compress(b"\x00" * (32*1024*1024))
+        self.assertLess(len(bomb), 64*1024)
+        stream = decompressor._stream
+        self.assertRaises(_compression.DecompressionError,
+                          decompressor.decompress, bomb)
+        self.assertLessEqual(sum(len(o) for o in stream._out), 64*1024)
+        self.assertLessEqual(stream._size, 64*1024 + stream.WRITE_SIZE)
+
 
 DIRECT_HINT_JSON = {"type": "direct-tcp-v1",
                     "hostname": "direct", "port": 1234}
@@ -1477,6 +2805,69 @@ class Transit(unittest.TestCase):
         self._waiters[0].callback("winner")
         self.assertEqual(self.successResultOf(d), "winner")
 
+    def _direct(self, hostname):
+        return {"type": "direct-tcp-v1", "hostname": hostname, "port": 1234}
+
+    @inlineCallbacks
+    def test_happy_eyeballs(self):
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock, no_listen=True)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints()
+        del hints
+        s.add_connection_hints([self._direct("10.0.0.1"),
+                                self._direct("10.0.0.2"),
+                                self._direct("2001:db8::1"),
+                                RELAY_HINT_JSON])
+        s._endpoint_from_hint_obj = self._endpoint_from_hint_obj
+        s._start_connector = self._start_connector
+
+        d = s.connect()
+        # one at a time, IPv6 first
+        self.assertEqual(self._connectors, ["2001:db8::1"])
+        clock.advance(s.ATTEMPT_DELAY)
+        self.assertEqual(self._connectors, ["2001:db8::1", "10.0.0.1"])
+        # a failure doesn't start the next one while another is running
+        self._waiters[0].errback(error.ConnectionRefusedError())
+        self.assertEqual(len(self._connectors), 2)
+        # but once they've all failed, there's no need to wait
+        self._waiters[1].errback(error.ConnectionRefusedError())
+        self.assertEqual(self._connectors,
+                         ["2001:db8::1", "10.0.0.1", "10.0.0.2"])
+        self._waiters[2].errback(error.ConnectionRefusedError())
+        self.assertEqual(self._connectors,
+                         ["2001:db8::1", "10.0.0.1", "10.0.0.2", "relay"])
+        self.assertEqual(clock.seconds(), s.ATTEMPT_DELAY)
+
+        self._waiters[3].callback("winner")
+        self.assertEqual(self.successResultOf(d), "winner")
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_losers_cancelled(self):
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock, no_listen=True)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints()
+        del hints
+        s.add_connection_hints([self._direct("10.0.0.1"),
+                                self._direct("10.0.0.2"),
+                                self._direct("10.0.0.3"),
+                                RELAY_HINT_JSON])
+        s._endpoint_from_hint_obj = self._endpoint_from_hint_obj
+        s._start_connector = self._start_connector
+
+        d = s.connect()
+        clock.advance(s.ATTEMPT_DELAY)
+        self.assertEqual(self._connectors, ["10.0.0.1", "10.0.0.2"])
+        self._waiters[1].callback("winner")
+        self.assertEqual(self.successResultOf(d), "winner")
+        # the attempt in progress is cancelled, and the rest never start
+        self.assertTrue(self._waiters[0].called)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        clock.advance(10*s.RELAY_DELAY)
+        self.assertEqual(self._connectors, ["10.0.0.1", "10.0.0.2"])
+
     @inlineCallbacks
     def test_no_direct_hints(self):
         clock = task.Clock()
@@ -1494,11 +2885,8 @@ class Transit(unittest.TestCase):
 
         d = s.connect()
         self.assertNoResult(d)
-        # since there are no usable direct hints, the relay connector will
-        # only be stalled for 0 seconds
-        self.assertEqual(self._connectors, [])
-
-        clock.advance(0)
+        # since there are no usable direct hints, the relay connector isn't
+        # stalled at all
         self.assertEqual(self._connectors, ["relay"])
 
         self._waiters[0].callback("winner")
@@ -1584,6 +2972,78 @@ class Full(ServerBase, unittest.TestCase):
         yield x.close()
         yield y.close()
 
+    @inlineCallbacks
+    def test_direct_threaded_crypto(self):
+        KEY = b"k"*32
+        s = transit.TransitSender(None, crypto_threads=2)
+        r = transit.TransitReceiver(None, crypto_threads=2)
+
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+
+        shints = yield s.get_connection_hints()
+        rhints = yield r.get_connection_hints()
+
+        s.add_connection_hints(rhints)
+        r.add_connection_hints(shints)
+
+        (x,y) = yield self.doBoth(s.connect(), r.connect())
+
+        data = b"".join(b"%06d" % i for i in range(50000))
+        f = io.BytesIO()
+        d = y.writeToFile(f, len(data))
+        fs = basic.FileSender()
+        fs.CHUNK_SIZE = 4096
+        yield fs.beginFileTransfer(io.BytesIO(data), x)
+        received = yield d
+        self.assertEqual(received, len(data))
+        self.assertEqual(f.getvalue(), data)
+
+        yield x.close()
+        yield y.close()
+
+    @inlineCallbacks
+    def test_direct_striped(self):
+        KEY = b"k"*32
+        s = transit.TransitSender(None)
+        r = transit.TransitReceiver(None)
+        s.STRIPE_WINDOW = r.STRIPE_WINDOW = 0.1
+
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+        s.add_connection_abilities(r.get_connection_abilities())
+        r.add_connection_abilities(s.get_connection_abilities())
+
+        shints = yield s.get_connection_hints()
+        rhints = yield r.get_connection_hints()
+
+        s.add_connection_hints(rhints)
+        r.add_connection_hints(shints)
+
+        (x,y) = yield self.doBoth(s.connect(), r.connect())
+        self.assertIsInstance(x, transit.StripedConnection)
+        self.assertIsInstance(y, transit.StripedConnection)
+        # let the extra streams join, and the windows close
+        yield task.deferLater(reactor, 0.5, lambda: None)
+        self.assertEqual(len(x.streams()), len(y.streams()))
+
+        data = b"".join(b"%06d" % i for i in range(50000))
+        f = io.BytesIO()
+        d = y.writeToFile(f, len(data))
+        fs = basic.FileSender()
+        fs.CHUNK_SIZE = 4096
+        yield fs.beginFileTransfer(io.BytesIO(data), x)
+        received = yield d
+        self.assertEqual(received, len(data))
+        self.assertEqual(f.getvalue(), data)
+
+        y.send_record(b"ack")
+        ack = yield x.receive_record()
+        self.assertEqual(ack, b"ack")
+
+        yield x.close()
+        yield y.close()
+
     @inlineCallbacks
     def test_relay(self):
         KEY = b"k"*32
@@ -0,0 +1,287 @@
+from __future__ import print_function, unicode_literals
+import mock
+from binascii import hexlify
+from twisted.trial import unittest
+from twisted.internet import protocol, reactor, defer, endpoints, task
+from twisted.internet.defer import inlineCallbacks
+from ..server import transit_server
+from ..server.database import get_db
+
+class Accumulator(protocol.Protocol):
+    def __init__(self):
+        self.data = b""
+        self.count = 0
+        self._wait = None
+        self._disconnect = defer.Deferred()
+    def waitForBytes(self, more):
+        assert self._wait is None
+        self.count = more
+        self._wait = defer.Deferred()
+        self._check_done()
+        return self._wait
+    def dataReceived(self, data):
+        self.data = self.data + data
+        self._check_done()
+    def _check_done(self):
+        if self._wait and len(self.data) >= self.count:
+            d = self._wait
+            self._wait = None
+            d.callback(self)
+    def connectionLost(self, why):
+        if self._wait:
+            self._wait.errback(RuntimeError("closed"))
+        self._disconnect.callback(None)
+
+def handshake(token, side=None):
+    hs = b"please relay " + hexlify(token)
+    if side is not None:
+        hs += b" for side " + hexlify(side)
+    hs += b"\n"
+    return hs
+
+def wait_for(f):
+    d = defer.Deferred()
+    def _check():
+        if f():
+            d.callback(None)
+        else:
+            reactor.callLater(0.01, _check)
+    _check()
+    return d
+
+class Blur(unittest.TestCase):
+    def test_blur_size(self):
+        blur = transit_server.blur_size
+        self.assertEqual(blur(0), 0)
+        self.assertEqual(blur(1), 10e3)
+        self.assertEqual(blur(10e3), 10e3)
+        self.assertEqual(blur(10e3+1), 20e3)
+        self.assertEqual(blur(1e6), 1e6)
+        self.assertEqual(blur(1e6+1), 2e6)
+        self.assertEqual(blur(1e9), 1e9)
+        self.assertEqual(blur(1e9+1), 1.1e9)
+
+class CollectStats(unittest.TestCase):
+    def test_usage_writer(self):
+        db = get_db(":memory:")
+        usage = mock.Mock()
+        counts = {"transit": defer.Deferred(),
+                  "transit_bytes": defer.Deferred()}
+        usage.get_usage_counts.side_effect = counts.get
+        t = transit_server.Transit(db, None, usage=usage)
+        t.recordUsage(1, "happy", 100, 2, 1)
+        usage.record_transit_usage.assert_called_once_with(1, 2, 1, 100,
+                                                           "happy")
+        d = t.collect_stats()
+        # the totals come from the usage writer, which owns the database
+        self.assertNoResult(d)
+        counts["transit"].callback({"happy": 2, "lonely": 1})
+        counts["transit_bytes"].callback({"happy": 300})
+        stats = self.successResultOf(d)
+        self.assertEqual(stats["active"], {"connected": 0, "waiting": 0})
+        self.assertEqual(stats["since_reboot"]["total"], 1)
+        self.assertEqual(stats["all_time"],
+                         {"total": 3, "bytes": 300,
+                          "moods": {"happy": 2, "lonely": 1, "errory": 0}})
+
+    def test_no_usage_writer(self):
+        t = transit_server.Transit(get_db(":memory:"), None)
+        stats = self.successResultOf(t.collect_stats())
+        self.assertEqual(stats, t.get_stats())
+
+class _Transit:
+    splice = None
+
+    @inlineCallbacks
+    def setUp(self):
+        self._db = get_db(":memory:")
+        self._transit = transit_server.Transit(self._db, None,
+                                               splice=self.splice,
+                                               reactor=reactor)
+        ep = endpoints.TCP4ServerEndpoint(reactor, 0, interface="127.0.0.1")
+        self._port = yield ep.listen(self._transit)
+        self.addCleanup(self._port.stopListening)
+        self._clients = []
+
+    @inlineCallbacks
+    def tearDown(self):
+        for a in self._clients:
+            a.transport.loseConnection()
+        for a in self._clients:
+            yield a._disconnect
+
+    @inlineCallbacks
+    def connect(self):
+        ep = endpoints.TCP4ClientEndpoint(reactor, "127.0.0.1",
+                                          self._port.getHost().port)
+        a = yield endpoints.connectProtocol(ep, Accumulator())
+        self._clients.append(a)
+        defer.returnValue(a)
+
+    def usage(self):
+        return self._db.execute("SELECT * FROM `transit_usage`").fetchall()
+
+    @inlineCallbacks
+    def test_register(self):
+        a1 = yield self.connect()
+        token1 = b"\x00"*32
+        side1 = b"\x01"*8
+        a1.transport.write(handshake(token1, side1))
+        yield wait_for(lambda: self._transit._pending_requests)
+        self.assertEqual(list(self._transit._pending_requests.keys()),
+                         [hexlify(token1)])
+        a1.transport.loseConnection()
+        yield a1._disconnect
+        yield wait_for(lambda: not self._transit._pending_requests)
+        self.assertEqual(self.usage()[0]["result"], "lonely")
+
+    @inlineCallbacks
+    def _pair(self, side1, side2):
+        token1 = b"\x00"*32
+        a1 = yield self.connect()
+        a2 = yield self.connect()
+        a1.transport.write(handshake(token1, side1))
+        a2.transport.write(handshake(token1, side2))
+        # a correct handshake yields an ack, after which we can send
+        yield a1.waitForBytes(3)
+        yield a2.waitForBytes(3)
+        self.assertEqual(a1.data, b"ok\n")
+        self.assertEqual(a2.data, b"ok\n")
+        defer.returnValue((a1, a2))
+
+    @inlineCallbacks
+    def _relay_and_close(self, a1, a2):
+        exp = b"x"*1000*1000 # enough to fill a pipe or two
+        a1.transport.write(exp)
+        a2.transport.write(b"y"*1000)
+        yield a2.waitForBytes(3+len(exp))
+        self.assertEqual(a2.data, b"ok\n"+exp)
+        yield a1.waitForBytes(3+1000)
+        self.assertEqual(a1.data, b"ok\n"+b"y"*1000)
+
+        a1.transport.loseConnection()
+        # the relay should close the other side too
+        yield a2._disconnect
+        yield a1._disconnect
+        yield wait_for(lambda: not self._transit._active_connections)
+        rows = self.usage()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["result"], "happy")
+        self.assertEqual(rows[0]["total_bytes"], len(exp)+1000)
+
+    def _spliced(self):
+        return [tc._splicer is not None
+                for tc in self._transit._active_connections]
+
+    @inlineCallbacks
+    def test_both_sided(self):
+        a1, a2 = yield self._pair(b"\x01"*8, b"\x02"*8)
+        self.assertEqual(self._spliced(), [bool(self.splice)]*2)
+        yield self._relay_and_close(a1, a2)
+
+    @inlineCallbacks
+    def test_sided_unsided(self):
+        a1, a2 = yield self._pair(b"\x01"*8, None)
+        yield self._relay_and_close(a1, a2)
+
+    @inlineCallbacks
+    def test_both_unsided(self):
+        a1, a2 = yield self._pair(None, None)
+        yield self._relay_and_close(a1, a2)
+
+    @inlineCallbacks
+    def test_close_after_data(self):
+        # data sent just before a close must still be delivered
+        a1, a2 = yield self._pair(b"\x01"*8, b"\x02"*8)
+        a1.transport.write(b"last words")
+        a1.transport.loseConnection()
+        yield a2._disconnect
+        self.assertEqual(a2.data, b"ok\nlast words")
+
+    @inlineCallbacks
+    def test_same_side(self):
+        token1 = b"\x00"*32
+        side1 = b"\x01"*8
+        a1 = yield self.connect()
+        a2 = yield self.connect()
+        a1.transport.write(handshake(token1, side1))
+        a2.transport.write(handshake(token1, side1))
+        # the two connections use the same side, so they don't match
+        yield wait_for(lambda: len(self._transit._pending_requests.get(
+            hexlify(token1), ())) == 2)
+        self.assertEqual(a1.data, b"")
+        self.assertEqual(a2.data, b"")
+
+    @inlineCallbacks
+    def test_bad_handshake(self):
+        a1 = yield self.connect()
+        a1.transport.write(b"please DELAY " + hexlify(b"\x00"*32) + b"\n")
+        yield a1._disconnect
+        self.assertEqual(a1.data, b"bad handshake\n")
+        self.assertEqual(self.usage()[0]["result"], "errory")
+
+    @inlineCallbacks
+    def test_impatience(self):
+        a1 = yield self.connect()
+        a1.transport.write(handshake(b"\x00"*32, b"\x01"*8) + b"NOWNOWNOW")
+        yield a1._disconnect
+        self.assertEqual(a1.data, b"impatient\n")
+
+    @inlineCallbacks
+    def test_stop_service(self):
+        a1, a2 = yield self._pair(b"\x01"*8, b"\x02"*8)
+        a3 = yield self.connect()
+        a3.transport.write(handshake(b"\x03"*32, b"\x01"*8))
+        yield wait_for(lambda: len(self._transit._pending_requests) == 1)
+        self._transit.startService()
+        yield self._transit.stopService()
+        yield a1._disconnect
+        yield a2._disconnect
+        yield a3._disconnect
+
+    @inlineCallbacks
+    def test_stats(self):
+        a1, a2 = yield self._pair(b"\x01"*8, b"\x02"*8)
+        stats = self._transit.get_stats()
+        self.assertEqual(stats["active"], {"connected": 1, "waiting": 0})
+        yield self._relay_and_close(a1, a2)
+        stats = self._transit.get_stats()
+        self.assertEqual(stats["active"], {"connected": 0, "waiting": 0})
+        self.assertEqual(stats["since_reboot"]["moods"], {"happy": 1})
+        self.assertEqual(stats["all_time"]["total"], 1)
+        self.assertEqual(stats["all_time"]["bytes"], 1001000)
+        # let the test's cleanup see that everybody is gone
+        yield task.deferLater(reactor, 0, lambda: None)
+
+class Plain(_Transit, unittest.TestCase):
+    splice = False
+
+class Spliced(_Transit, unittest.TestCase):
+    splice = True
+    if transit_server._splice is None:
+        skip = "os.splice() is not available here"
+
+    @inlineCallbacks
+    def test_one_reader_per_fd(self):
+        yield self._pair(b"\x01"*8, b"\x02"*8)
+        readers = reactor.getReaders()
+        writers = reactor.getWriters()
+        for tc in self._transit._active_connections:
+            # the spliced end watches the socket, and the transport doesn't
+            self.assertNotIn(tc.transport, readers)
+            self.assertNotIn(tc.transport, writers)
+            fds = [r.fileno() for r in readers
+                   if isinstance(r, transit_server._SplicedEnd)]
+            self.assertIn(tc.transport.fileno(), fds)
+
+    @inlineCallbacks
+    def test_start_fails(self):
+        # if the splice can't get going, the transports get their sockets
+        # back, and relay the usual way
+        with mock.patch.object(transit_server._SplicedEnd, "startReading",
+                               side_effect=OSError("nope")):
+            a1, a2 = yield self._pair(b"\x01"*8, b"\x02"*8)
+        self.assertEqual(self._spliced(), [False, False])
+        for tc in self._transit._active_connections:
+            self.assertIn(tc.transport, reactor.getReaders())
+        yield self._relay_and_close(a1, a2)
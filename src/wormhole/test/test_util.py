@@ -1,6 +1,8 @@
 from __future__ import unicode_literals
 import six
+import io
 import mock
+import hashlib
 import unicodedata
 from twisted.trial import unittest
 from .. import util
@@ -29,7 +31,12 @@ class Utils(unittest.TestCase):
         self.assertIsInstance(b, type(b""))
         self.assertEqual(b, b"\x00\x45\x91\xfe\xff")
 
+    def use_json_codec(self, name):
+        self.addCleanup(util.use_json_codec, util.json_codec)
+        util.use_json_codec(name)
+
     def test_dict_to_bytes(self):
+        self.use_json_codec("json")
         d = {"a": "b"}
         b = util.dict_to_bytes(d)
         self.assertIsInstance(b, type(b""))
@@ -41,6 +48,76 @@ class Utils(unittest.TestCase):
         self.assertIsInstance(d, dict)
         self.assertEqual(d, {"a": "b", "c": 2})
 
+    def test_dict_and_body(self):
+        b = util.dict_and_body_to_bytes({"a": "b"}, b"\x00\xff")
+        self.assertIsInstance(b, type(b""))
+        d, body = util.bytes_to_dict_and_body(b)
+        self.assertEqual(d, {"a": "b"})
+        self.assertEqual(body, b"\x00\xff")
+        d, body = util.bytes_to_dict_and_body(
+            util.dict_and_body_to_bytes({}, b""))
+        self.assertEqual((d, body), ({}, b""))
+        self.assertRaises(ValueError, util.bytes_to_dict_and_body, b"\x00")
+        self.assertRaises(ValueError, util.bytes_to_dict_and_body,
+                          b"\x00\x10{}")
+
+    def test_json_codecs(self):
+        # whichever codec wrote it, every codec reads back the same dict
+        messages = [{"a": "b", "c": 2},
+                    {"type": "message", "side": "abc", "body": "00ff",
+                     "server_rx": 1500000000.123456, "id": None},
+                    {"A\u0308": ["\u2603", "a/b", "\n\u0000", True, -1e-7]},
+                    {"digits": "9"*25, "null": "null", "none": [None]},
+                    {"nan": float("nan"), "inf": float("inf")},
+                    {"lone": "\ud800"},
+                    ]
+        for writer in util.JSON_CODECS:
+            self.use_json_codec(writer)
+            for m in messages:
+                b = util.dict_to_bytes(m)
+                self.assertIsInstance(b, type(b""))
+                for reader in util.JSON_CODECS:
+                    util.use_json_codec(reader)
+                    # nan != nan, so compare them by their repr
+                    self.assertEqual(repr(util.bytes_to_dict(b)), repr(m),
+                                     (writer, reader))
+                util.use_json_codec(writer)
+
+    def test_json_codec_huge_ints(self):
+        # every codec can write integers that don't fit in 64 bits, and all
+        # but orjson read them back exactly (orjson reads them as floats)
+        m = {"huge": 2**70, "tiny": -2**64}
+        for writer in util.JSON_CODECS:
+            self.use_json_codec(writer)
+            b = util.dict_to_bytes(m)
+            for reader in util.JSON_CODECS:
+                util.use_json_codec(reader)
+                if reader == "orjson":
+                    self.assertEqual(util.bytes_to_dict(b),
+                                     {"huge": 2.0**70, "tiny": -2.0**64})
+                else:
+                    self.assertEqual(util.bytes_to_dict(b), m)
+            util.use_json_codec(writer)
+
+    def test_orjson_null(self):
+        if "orjson" not in util.JSON_CODECS:
+            raise unittest.SkipTest("orjson is not installed")
+        import orjson
+        self.use_json_codec("orjson")
+        # a null (or "null") that isn't a NaN doesn't need the stdlib
+        m = {"body": "null", "id": None}
+        self.assertEqual(util.dict_to_bytes(m), orjson.dumps(m))
+        m = {"id": None, "x": [float("nan")]}
+        self.assertEqual(util.dict_to_bytes(m), util._stdlib_dumps(m))
+
+    def test_json_codec_errors(self):
+        for name in util.JSON_CODECS:
+            self.use_json_codec(name)
+            self.assertRaises(TypeError, util.dict_to_bytes, {"a": object()})
+            self.assertRaises(ValueError, util.bytes_to_dict, b'{"a": ')
+            self.assertRaises(ValueError, util.bytes_to_dict, b'{"a": "\xff"}')
+            self.assertRaises(AssertionError, util.bytes_to_dict, b'[1]')
+
 class Space(unittest.TestCase):
     def test_free_space(self):
         free = util.estimate_free_space(".")
@@ -58,3 +135,14 @@ class Space(unittest.TestCase):
                 self.assertEqual(util.estimate_free_space("."), None)
         except AttributeError: # raised by mock.get_original()
             pass
+
+class HashPrefix(unittest.TestCase):
+    def test_hash_file_prefix(self):
+        f = io.BytesIO(b"abcdefghij")
+        hasher = hashlib.sha256()
+        self.assertEqual(util.hash_file_prefix(f, 7, hasher, chunk_size=3), 7)
+        self.assertEqual(hasher.digest(), hashlib.sha256(b"abcdefg").digest())
+        self.assertEqual(f.read(), b"hij")
+        # a short file gives us fewer bytes than we asked for
+        f = io.BytesIO(b"abc")
+        self.assertEqual(util.hash_file_prefix(f, 7, hashlib.sha256()), 3)
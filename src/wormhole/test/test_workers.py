@@ -0,0 +1,253 @@
+from __future__ import print_function, unicode_literals
+import os, json, socket
+from twisted.trial import unittest
+from twisted.application import service
+from twisted.internet import reactor, defer, task
+from twisted.internet.defer import inlineCallbacks, returnValue
+from ..server import server, workers
+from .test_server import WSFactory
+
+def app_owned_by(index, count):
+    for i in range(1000):
+        app_id = "appid-%d" % i
+        if workers.owner_of(app_id, count) == index:
+            return app_id
+
+class Owner(unittest.TestCase):
+    def test_owner(self):
+        owners = set()
+        for i in range(100):
+            owner = workers.owner_of("appid-%d" % i, 4)
+            self.assertEqual(owner, workers.owner_of("appid-%d" % i, 4))
+            owners.add(owner)
+        self.assertEqual(owners, set([0, 1, 2, 3]))
+        self.assertEqual(workers.owner_of("appid", 1), 0)
+
+    def test_requires_memory(self):
+        with self.assertRaises(ValueError):
+            server.RelayServer(str("tcp:0"), None, workers=2)
+
+    def test_with_port(self):
+        self.assertEqual(server._with_port("tcp:0:interface=127.0.0.1", 1234),
+                         "tcp:1234:interface=127.0.0.1")
+
+class ListenReusePort(unittest.TestCase):
+    def test_not_tcp(self):
+        with self.assertRaises(ValueError):
+            workers.listen_reuseport(reactor, "unix:/tmp/foo", None)
+
+    @inlineCallbacks
+    def test_shared(self):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise unittest.SkipTest("no SO_REUSEPORT here")
+        f = server.PrivacyEnhancedSite(server.Root())
+        p1 = workers.listen_reuseport(reactor, "tcp:0:interface=127.0.0.1", f)
+        self.addCleanup(p1.stopListening)
+        port = p1.getHost().port
+        p2 = workers.listen_reuseport(
+            reactor, "tcp:%d:interface=127.0.0.1" % port, f)
+        yield p2.stopListening()
+
+class MergeStats(unittest.TestCase):
+    def stats(self, n):
+        return {"active": {"apps": n, "nameplates_total": n},
+                "since_reboot": {"nameplate_moods": {"happy": n},
+                                 "nameplates_total": n},
+                "all_time": {"nameplates_total": 100+n},
+                "prune": {"passes": 1, "mailboxes_visited": n,
+                          "busy_seconds": 0.5, "max_slice_seconds": 0.1*n,
+                          "last": None}}
+
+    def test_merge(self):
+        mine = self.stats(1)
+        merged = workers.merge_stats(mine, [self.stats(2), None,
+                                            self.stats(3)])
+        self.assertEqual(mine, self.stats(1)) # unmodified
+        self.assertEqual(merged["active"], {"apps": 6, "nameplates_total": 6})
+        self.assertEqual(merged["since_reboot"],
+                         {"nameplate_moods": {"happy": 6},
+                          "nameplates_total": 6})
+        # all workers share the database, so the all-time counts are ours
+        self.assertEqual(merged["all_time"], {"nameplates_total": 101})
+        self.assertEqual(merged["prune"]["passes"], 3)
+        self.assertEqual(merged["prune"]["busy_seconds"], 1.5)
+        self.assertAlmostEqual(merged["prune"]["max_slice_seconds"], 0.3)
+        self.assertEqual(merged["workers"], {"total": 4, "answered": 3})
+
+class Routing(unittest.TestCase):
+    # two workers in the same process, each listening on its own port, so
+    # we can choose which one each client connects to
+    def setUp(self):
+        self._clients = []
+        self.sp = service.MultiService()
+        self.sp.startService()
+        self.addCleanup(self.sp.stopService)
+        self.worker_dir = self.mktemp()
+        os.mkdir(self.worker_dir)
+        self.stats_file = os.path.join(self.worker_dir, "stats.json")
+        self.servers = []
+        for index in range(2):
+            s = server.RelayServer(
+                str("tcp:0:interface=127.0.0.1"), None,
+                rendezvous_state="memory", workers=2, worker_index=index,
+                worker_dir=self.worker_dir,
+                stats_file=self.stats_file if index == 0 else None)
+            s.setServiceParent(self.sp)
+            self.servers.append(s)
+
+    def tearDown(self):
+        for c in self._clients:
+            c.transport.loseConnection()
+        # let the disconnections reach the other worker
+        return task.deferLater(reactor, 0.1, lambda: None)
+
+    @inlineCallbacks
+    def make_client(self, index):
+        port = self.servers[index]._rendezvous_web_service.port.getHost().port
+        f = WSFactory("ws://127.0.0.1:%d/v1" % port)
+        f.d = defer.Deferred()
+        reactor.connectTCP("127.0.0.1", port, f)
+        c = yield f.d
+        self._clients.append(c)
+        m = yield c.next_non_ack()
+        self.assertEqual(m["type"], "welcome")
+        returnValue(c)
+
+    @inlineCallbacks
+    def test_exchange(self):
+        app_id = app_owned_by(1, 2)
+        rv0 = self.servers[0]._rendezvous
+        rv1 = self.servers[1]._rendezvous
+        c1 = yield self.make_client(0) # relayed to worker 1
+        c2 = yield self.make_client(1)
+        c1.send("bind", appid=app_id, side="side1")
+        c2.send("bind", appid=app_id, side="side2")
+        yield c1.sync()
+
+        c1.send("allocate")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "allocated")
+        nameplate = m["nameplate"]
+        c1.send("claim", nameplate=nameplate)
+        m = yield c1.next_non_ack()
+        mailbox = m["mailbox"]
+        c1.send("open", mailbox=mailbox)
+        c1.send("add", phase="pake", body="1234")
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["type"], m["side"]), ("message", "side1"))
+
+        self.assertEqual(rv0.get_all_apps(), set())
+        self.assertEqual(rv1.get_all_apps(), set([app_id]))
+
+        c2.send("claim", nameplate=nameplate)
+        m = yield c2.next_non_ack()
+        self.assertEqual(m["mailbox"], mailbox)
+        c2.send("open", mailbox=mailbox)
+        m = yield c2.next_non_ack()
+        self.assertEqual((m["type"], m["side"], m["body"]),
+                         ("message", "side1", "1234"))
+        c2.send("add", phase="pake", body="5678")
+        for c in [c1, c2]:
+            m = yield c.next_non_ack()
+            self.assertEqual((m["type"], m["side"], m["body"]),
+                             ("message", "side2", "5678"))
+
+        # the dump includes both workers
+        yield self.servers[0].timer()
+        with open(self.stats_file) as f:
+            data = json.load(f)
+        self.assertEqual(data["rendezvous"]["workers"],
+                         {"total": 2, "answered": 2})
+        self.assertEqual(data["rendezvous"]["active"]["mailboxes_total"], 1)
+
+        for c in [c1, c2]:
+            c.send("release")
+            m = yield c.next_non_ack()
+            self.assertEqual(m["type"], "released")
+            c.send("close", mood="happy")
+            m = yield c.next_non_ack()
+            self.assertEqual(m["type"], "closed")
+        self.assertEqual(rv1.get_all_apps(), set())
+        stats = rv1.get_stats()
+        self.assertEqual(stats["since_reboot"]["mailbox_moods"],
+                         {"happy": 1})
+
+    @inlineCallbacks
+    def test_acked_locally(self):
+        # the worker the client connected to parses and acks each message,
+        # so the owner only sends back the real responses
+        relayed = []
+        orig = workers._ProxiedRendezvous.sendMessage
+        def sendMessage(p, payload, isBinary=False):
+            relayed.append(json.loads(payload.decode("utf-8"))["type"])
+            return orig(p, payload, isBinary)
+        self.patch(workers._ProxiedRendezvous, "sendMessage", sendMessage)
+        c1 = yield self.make_client(0)
+        c1.send("bind", appid=app_owned_by(1, 2), side="side1", id="m1")
+        c1.send("allocate", id="m2")
+        events = []
+        while True:
+            m = yield c1.next_event()
+            events.append((m["type"], m.get("id")))
+            if m["type"] == "allocated":
+                break
+        self.assertEqual(events, [("ack", "m1"), ("ack", "m2"),
+                                  ("allocated", None)])
+        self.assertEqual(relayed, ["allocated"])
+        # and messages without a type go no further
+        c1.send_notype()
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["type"], m["error"]), ("error", "missing 'type'"))
+        self.assertEqual(relayed, ["allocated"])
+
+    @inlineCallbacks
+    def test_binary(self):
+        # binary messages are relayed too
+        c1 = yield self.make_client(0)
+        c1.send("bind", appid=app_owned_by(1, 2), side="side1", binary=True)
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "bound")
+        c1.send("open", mailbox="mb1")
+        c1.send_binary("add", b"\x00\xff", phase="pake")
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["type"], m["body"]), ("message", b"\x00\xff"))
+
+    @inlineCallbacks
+    def test_local(self):
+        # apps that the worker owns itself are not relayed
+        c1 = yield self.make_client(0)
+        app_id = app_owned_by(0, 2)
+        c1.send("bind", appid=app_id, side="side1")
+        c1.send("list")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "nameplates")
+        self.assertIn(app_id, self.servers[0]._rendezvous._apps)
+        self.assertNotIn(app_id, self.servers[1]._rendezvous._apps)
+
+    @inlineCallbacks
+    def test_disconnect(self):
+        # when a relayed client goes away, the owner stops listening for it
+        app_id = app_owned_by(1, 2)
+        rv1 = self.servers[1]._rendezvous
+        c1 = yield self.make_client(0)
+        c1.send("bind", appid=app_id, side="side1")
+        c1.send("open", mailbox="mb1")
+        yield c1.sync()
+        mb = rv1.get_app(app_id)._mailboxes["mb1"]
+        self.assertEqual(len(mb._listeners), 1)
+        c1.transport.loseConnection()
+        for i in range(100):
+            if not mb._listeners:
+                break
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(mb._listeners, {})
+
+    @inlineCallbacks
+    def test_bind_errors(self):
+        # a bad bind is rejected by the worker the client is connected to
+        c1 = yield self.make_client(0)
+        c1.send("bind", appid=app_owned_by(1, 2))
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "error")
+        self.assertEqual(m["error"], "bind requires 'side'")
+        self.assertEqual(self.servers[1]._rendezvous._apps, {})
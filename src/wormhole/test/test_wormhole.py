@@ -558,6 +558,37 @@ class Wormholes(ServerBase, unittest.TestCase):
         yield w1.close()
         yield w2.close()
 
+class Deflate(ServerBase, unittest.TestCase):
+    def setUp(self):
+        self._setup_relay(None, websocket_protocol_options=[
+            ("permessage_deflate", {"window_bits": 10})])
+
+    @inlineCallbacks
+    def test_deflate(self):
+        w1 = wormhole.create(APPID, self.relayurl, reactor,
+                             websocket_deflate=True)
+        w2 = wormhole.create(APPID, self.relayurl, reactor,
+                             websocket_deflate={"mem_level": 1,
+                                                "peer_window_bits": 9})
+        w1.allocate_code()
+        code = yield w1.get_code()
+        w2.set_code(code)
+        w1.send_message(b"data1")
+        dataY = yield w2.get_message()
+        self.assertEqual(dataY, b"data1")
+        # both connections were compressed
+        for w in [w1, w2]:
+            pmd = w._boss._RC._ws._perMessageCompress
+            self.assertNotEqual(pmd, None)
+        self.assertEqual(pmd.server_max_window_bits, 9)
+        yield w1.close()
+        yield w2.close()
+
+    def test_bad_options(self):
+        with self.assertRaises(ValueError):
+            wormhole.create(APPID, self.relayurl, reactor,
+                            websocket_deflate={"window_bits": 20})
+
 class MessageDoubler(_rendezvous.RendezvousConnector):
     # we could double messages on the sending side, but a future server will
     # strip those duplicates, so to really exercise the receiver, we must
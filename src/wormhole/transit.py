@@ -1,14 +1,14 @@
 # no unicode_literals, revisit after twisted patch
 from __future__ import print_function, absolute_import
-import os, re, sys, time, socket
+import os, re, sys, time, mmap, socket, struct
 from collections import namedtuple, deque
-from binascii import hexlify, unhexlify
+from binascii import hexlify
 import six
 from zope.interface import implementer
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.python.runtime import platformType
 from twisted.internet import (reactor, interfaces, defer, protocol,
-                              endpoints, task, address, error)
+                              endpoints, address, error, threads)
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.protocols import policies
 from nacl.secret import SecretBox
@@ -17,6 +17,10 @@ from .errors import InternalError
 from .timing import DebugTiming
 from .util import bytes_to_hexstr
 from . import ipaddrs
+from ._records import (RecordDecoder, encode_length, encode_nonce,
+                       decode_nonce, MAX_NONCE, MAX_LENGTH)
+from ._pipeline import OrderedPipeline, ProducerThrottle, TransferThreadPool
+from . import _compression
 
 def HKDF(skm, outlen, salt=None, CTXinfo=b""):
     return Hkdf(salt, skm).expand(CTXinfo, outlen)
@@ -62,6 +66,15 @@ class BadNonce(TransitError):
 # up upon the first wrong byte. The sender lookgs for "transit receiver
 # RXID_HEX ready\n\n" and then makes a first/not-first decision about sending
 # "go\n" or "nevermind\n"+close().
+#
+# If both sides advertised the "striped-v1" ability, the sender can keep a few
+# more of the sockets that finish negotiation, and use them to carry the
+# transfer in parallel. Each of these gets:
+#
+#  sender -> receiver: go-stripe N\n
+#
+# where N (1 <= N < the negotiated stream count) selects the record keys for
+# that socket. The first socket still gets a plain "go\n", and uses stripe 0.
 
 def build_receiver_handshake(key):
     hexid = HKDF(key, 32, CTXinfo=b"transit_receiver")
@@ -95,11 +108,20 @@ TorTCPV1Hint = namedtuple("TorTCPV1Hint", ["hostname", "port", "priority"])
 # rest of the V1 protocol. Only one hint per relay is useful.
 RelayV1Hint = namedtuple("RelayV1Hint", ["hints"])
 
+def _is_ipv6(hostname):
+    # hostnames and IPv4 addresses never contain a colon
+    return u":" in hostname
+
+def _describe_host(hostname):
+    if _is_ipv6(hostname):
+        return u"[%s]" % hostname
+    return hostname
+
 def describe_hint_obj(hint):
     if isinstance(hint, DirectTCPV1Hint):
-        return u"tcp:%s:%d" % (hint.hostname, hint.port)
+        return u"tcp:%s:%d" % (_describe_host(hint.hostname), hint.port)
     elif isinstance(hint, TorTCPV1Hint):
-        return u"tor:%s:%d" % (hint.hostname, hint.port)
+        return u"tor:%s:%d" % (_describe_host(hint.hostname), hint.port)
     else:
         return str(hint)
 
@@ -116,7 +138,14 @@ def parse_hint_argv(hint, stderr=sys.stderr):
         print("unknown hint type '%s' in '%s'" % (hint_type, hint), file=stderr)
         return None
     hint_value = mo.group(2)
-    pieces = hint_value.split(":")
+    # an IPv6 address is written in brackets: tcp:[2001:db8::1]:1234
+    mo = re.search(r'^\[([0-9a-fA-F:.]+)\](:.*)?$', hint_value)
+    if mo:
+        pieces = [mo.group(1)]
+        if mo.group(2):
+            pieces.extend(mo.group(2)[1:].split(":"))
+    else:
+        pieces = hint_value.split(":")
     if len(pieces) < 2:
         print("unparseable TCP hint (need more colons) '%s'" % (hint,),
               file=stderr)
@@ -139,9 +168,146 @@ def parse_hint_argv(hint, stderr=sys.stderr):
     return DirectTCPV1Hint(hint_host, hint_port, priority)
 
 TIMEOUT = 60 # seconds
+CRYPTO_WINDOW = 8 # records in flight, per direction, with threaded crypto
+
+class _RecordPipe(object):
+    """I hold the inbound half of a record pipe: records handed to
+    recordReceived() are queued for receive_record(), or written to a
+    consumer attached with connectConsumer(). Both Connection and
+    StripedConnection use me."""
+
+    def _init_record_pipe(self):
+        self._consumer = None
+        self._consumer_bytes_written = 0
+        self._consumer_bytes_expected = None
+        self._consumer_deferred = None
+        self._consumer_count = None
+        self._inbound_records = deque()
+        self._waiting_reads = deque()
+
+    def recordReceived(self, record):
+        if self._consumer:
+            self._writeToConsumer(record)
+            return
+        self._inbound_records.append(record)
+        self._deliverRecords()
+
+    def receive_record(self):
+        d = defer.Deferred()
+        self._waiting_reads.append(d)
+        self._deliverRecords()
+        return d
+
+    def _deliverRecords(self):
+        while self._inbound_records and self._waiting_reads:
+            r = self._inbound_records.popleft()
+            d = self._waiting_reads.popleft()
+            d.callback(r)
+
+    # Helper methods
+
+    def connectConsumer(self, consumer, expected=None, count=None):
+        """Helper method to glue an instance of e.g. t.p.ftp.FileConsumer to
+        us. Inbound records will be written as bytes to the consumer.
+
+        Set 'expected' to an integer to automatically disconnect when at
+        least that number of bytes have been written. This function will then
+        return a Deferred (that fires with the number of bytes actually
+        received). If the connection is lost while this Deferred is
+        outstanding, it will errback. If 'expected' is 0, the Deferred will
+        fire right away.
+
+        If 'expected' is None, then this function returns None instead of a
+        Deferred, and you must call disconnectConsumer() when you are done.
+
+        Records are counted against 'expected' by their length, unless
+        'count' is provided: then it is called after each write, and must
+        return the total number of bytes the consumer has written so far.
+        This is for consumers (like a decompressing FileConsumer) whose
+        output isn't the same size as their input."""
+
+        if self._consumer:
+            raise RuntimeError("A consumer is already attached: %r" %
+                               self._consumer)
+
+        # be aware of an ordering hazard: when we call the consumer's
+        # .registerProducer method, they are likely to immediately call
+        # self.resumeProducing, which we'll deliver to self.transport, which
+        # might call our .dataReceived, which may cause more records to be
+        # available. By waiting to set self._consumer until *after* we drain
+        # any pending records, we avoid delivering records out of order,
+        # which would be bad.
+        consumer.registerProducer(self, True)
+        # There might be enough data queued to exceed 'expected' before we
+        # leave this function. We must be sure to register the producer
+        # before it gets unregistered.
+
+        self._consumer = consumer
+        self._consumer_bytes_written = 0
+        self._consumer_bytes_expected = expected
+        self._consumer_count = count
+        d = None
+        if expected is not None:
+            d = defer.Deferred()
+        self._consumer_deferred = d
+        if expected == 0:
+            # write empty record to kick consumer into shutdown
+            self._writeToConsumer(b"")
+        # drain any pending records
+        while self._consumer and self._inbound_records:
+            r = self._inbound_records.popleft()
+            self._writeToConsumer(r)
+        return d
+
+    def _writeToConsumer(self, record):
+        self._consumer.write(record)
+        if self._consumer_count:
+            self._consumer_bytes_written = self._consumer_count()
+        else:
+            self._consumer_bytes_written += len(record)
+        if self._consumer_bytes_expected is not None:
+            if self._consumer_bytes_written >= self._consumer_bytes_expected:
+                d = self._consumer_deferred
+                self.disconnectConsumer()
+                d.callback(self._consumer_bytes_written)
+
+    def disconnectConsumer(self):
+        self._consumer.unregisterProducer()
+        self._consumer = None
+        self._consumer_bytes_expected = None
+        self._consumer_deferred = None
+        self._consumer_count = None
+
+    # Helper method to write a known number of bytes to a file. By default
+    # this has no flow control: the filehandle cannot push back. 'progress'
+    # is an optional callable which will be called on each write (with the
+    # number of bytes written). Returns a Deferred that fires (with the
+    # number of bytes written) when the count is reached or the RecordPipe
+    # is closed. If the sender compressed the records (see _compression),
+    # pass a Decompressor, and 'expected' counts the decompressed bytes.
+    #
+    # With threaded=True, the file is written by a ThreadedFileConsumer,
+    # which pauses us while the disk catches up, and 'fsync' is passed to
+    # it. The Deferred then fires once everything has reached the file.
+
+    def writeToFile(self, f, expected, progress=None, hasher=None,
+                    decompressor=None, threaded=False, fsync=None):
+        if threaded:
+            fc = ThreadedFileConsumer(f, progress, hasher, decompressor,
+                                      fsync)
+            d = self.connectConsumer(fc, expected,
+                                     count=lambda: fc.bytes_written)
+            d.addBoth(fc.finish)
+            return d
+        assert fsync is None, "fsync needs threaded=True"
+        fc = FileConsumer(f, progress, hasher, decompressor)
+        if decompressor:
+            return self.connectConsumer(fc, expected,
+                                        count=lambda: fc.bytes_written)
+        return self.connectConsumer(fc, expected)
 
 @implementer(interfaces.IProducer, interfaces.IConsumer)
-class Connection(protocol.Protocol, policies.TimeoutMixin):
+class Connection(protocol.Protocol, policies.TimeoutMixin, _RecordPipe):
     def __init__(self, owner, relay_handshake, start, description):
         self.state = "too-early"
         self.buf = b""
@@ -151,12 +317,19 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         self._description = description
         self._negotiation_d = defer.Deferred(self._cancel)
         self._error = None
-        self._consumer = None
-        self._consumer_bytes_written = 0
-        self._consumer_bytes_expected = None
-        self._consumer_deferred = None
-        self._inbound_records = deque()
-        self._waiting_reads = deque()
+        self._init_record_pipe()
+        self._decoder = RecordDecoder()
+        self._stripe_index = 0 # set by "go-stripe N"
+        self._lost = False
+        self._lost_reason = None
+        self._lost_waiters = []
+        # these are only used once useThreadedCrypto() is called
+        self._threadpool = None
+        self._seal_pipeline = None
+        self._open_pipeline = None
+        self._throttle = None
+        self._consumer_paused = False
+        self._open_paused = False
 
     def connectionMade(self):
         self.setTimeout(TIMEOUT) # does timeoutConnection() when it expires
@@ -209,6 +382,11 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         #  wait for (receive|send)_handshake
         #  sender: decide, send "go" or hang up
         #  receiver: wait for "go"
+        if self.state == "records":
+            # the fast path: once negotiation is done, inbound bytes go
+            # straight to the record decoder
+            self._decoder.feed(data)
+            return self.dataReceivedRECORDS()
         self.buf += data
 
         assert self.state != "too-early"
@@ -231,17 +409,25 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             # hang up).
 
         if self.state == "wait-for-decision":
-            if not self._check_and_remove(b"go\n"):
+            if not self._check_decision():
                 return
             self._negotiationSuccessful()
         if self.state == "go":
             GO = b"go\n"
             self.transport.write(GO)
             self._negotiationSuccessful()
+        if self.state == "go-stripe":
+            self.transport.write(("go-stripe %d\n" % self._stripe_index)
+                                 .encode("ascii"))
+            self._negotiationSuccessful()
         if self.state == "nevermind":
             self.transport.write(b"nevermind\n")
             raise BadHandshake("abandoned")
         if self.state == "records":
+            # anything left over after the handshake is the start of the
+            # first record
+            self._decoder.feed(self.buf)
+            self.buf = b""
             return self.dataReceivedRECORDS()
         if self.state == "hung up":
             return
@@ -249,13 +435,34 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             raise self.state
         raise ValueError("internal error: unknown state %s" % (self.state,))
 
+    def _check_decision(self):
+        # the receiver waits for "go\n", or "go-stripe N\n" on the extra
+        # sockets of a striped transfer
+        if not self.buf.startswith(b"go-"):
+            return self._check_and_remove(b"go\n")
+        mo = re.search(br"^go-stripe (\d{1,3})\n", self.buf)
+        if not mo:
+            if b"\n" in self.buf or len(self.buf) > len(b"go-stripe 999\n"):
+                raise BadHandshake("got %r want go-stripe" % (self.buf,))
+            return False # keep waiting
+        index = int(mo.group(1))
+        if not self.owner._accept_stripe(index):
+            raise BadHandshake("unexpected stripe %d" % index)
+        self._stripe_index = index
+        self.buf = self.buf[mo.end():]
+        return True
+
     def _negotiationSuccessful(self):
         self.state = "records"
         self.setTimeout(None)
-        send_key = self.owner._sender_record_key()
+        if self._stripe_index:
+            send_key = self.owner._sender_record_key(self._stripe_index)
+            receive_key = self.owner._receiver_record_key(self._stripe_index)
+        else:
+            send_key = self.owner._sender_record_key()
+            receive_key = self.owner._receiver_record_key()
         self.send_box = SecretBox(send_key)
         self.send_nonce = 0
-        receive_key = self.owner._receiver_record_key()
         self.receive_box = SecretBox(receive_key)
         self.next_receive_nonce = 0
         d, self._negotiation_d = self._negotiation_d, None
@@ -263,23 +470,31 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
 
     def dataReceivedRECORDS(self):
         while True:
-            if len(self.buf) < 4:
+            if self._open_pipeline and self._open_pipeline.is_full():
+                # leave the rest in the decoder until some records are done
+                self._update_open_paused()
                 return
-            length = int(hexlify(self.buf[:4]), 16)
-            if len(self.buf) < 4+length:
+            encrypted = self._decoder.next_frame()
+            if encrypted is None:
                 return
-            encrypted, self.buf = self.buf[4:4+length], self.buf[4+length:]
-
+            if self._open_pipeline:
+                self._check_nonce(encrypted)
+                d = self._open_pipeline.submit(self.receive_box.decrypt,
+                                               encrypted)
+                d.addErrback(lambda f: None) # reported by _crypto_failed()
+                continue
             record = self._decrypt_record(encrypted)
             self.recordReceived(record)
 
-    def _decrypt_record(self, encrypted):
-        nonce_buf = encrypted[:SecretBox.NONCE_SIZE] # assume it's prepended
-        nonce = int(hexlify(nonce_buf), 16)
+    def _check_nonce(self, encrypted):
+        nonce = decode_nonce(encrypted) # assume it's prepended
         if nonce != self.next_receive_nonce:
             raise BadNonce("received out-of-order record: got %d, expected %d"
                            % (nonce, self.next_receive_nonce))
         self.next_receive_nonce += 1
+
+    def _decrypt_record(self, encrypted):
+        self._check_nonce(encrypted)
         record = self.receive_box.decrypt(encrypted)
         return record
 
@@ -287,38 +502,100 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         return self._description
 
     def send_record(self, record):
-        if not isinstance(record, type(b"")): raise InternalError
+        # a memoryview (like the mapped file slices from FileProducer) is
+        # only copied into bytes by _seal, unless a worker thread will seal it
+        if not isinstance(record, (type(b""), memoryview)):
+            raise InternalError
         assert SecretBox.NONCE_SIZE == 24
-        assert self.send_nonce < 2**(8*24)
-        assert len(record) < 2**(8*4)
-        nonce = unhexlify("%048x" % self.send_nonce) # big-endian
+        assert self.send_nonce < MAX_NONCE
+        assert len(record) < MAX_LENGTH
+        nonce = encode_nonce(self.send_nonce) # big-endian
         self.send_nonce += 1
-        encrypted = self.send_box.encrypt(record, nonce)
-        length = unhexlify("%08x" % len(encrypted)) # always 4 bytes long
-        self.transport.write(length)
-        self.transport.write(encrypted)
-
-    def recordReceived(self, record):
-        if self._consumer:
-            self._writeToConsumer(record)
+        if self._seal_pipeline:
+            # FileProducer only checks that the mapped file is still long
+            # enough just before it hands us a slice. The worker might not
+            # get to it until after the file has been truncated, and reading
+            # the missing pages would kill us with SIGBUS, so copy it now.
+            if isinstance(record, memoryview):
+                record = record.tobytes()
+            # the nonce is assigned here, and the pipeline writes the
+            # results in the same order, so the wire order is unchanged
+            d = self._seal_pipeline.submit(self._seal, record, nonce)
+            if self._throttle:
+                self._throttle.recordSubmitted()
+            return d
+        encrypted = self._seal(record, nonce)
+        self._write_encrypted(encrypted)
+
+    def _seal(self, record, nonce):
+        if isinstance(record, memoryview):
+            record = record.tobytes() # SecretBox only takes bytes
+        return self.send_box.encrypt(record, nonce)
+
+    def _write_encrypted(self, encrypted):
+        length = encode_length(len(encrypted)) # always 4 bytes long
+        self.transport.writeSequence([length, encrypted])
+
+    def useThreadedCrypto(self, threadpool, window=CRYPTO_WINDOW,
+                          reactor=reactor):
+        """Seal and open all further records on 'threadpool' (which must
+        already be started), with up to 'window' records in flight in each
+        direction. Records are still written, and delivered, in nonce order.
+        The threadpool is stopped when this connection is lost.
+
+        While the pipeline is in use, send_record() returns a Deferred that
+        fires once that record has been written to the transport.
+        """
+        assert self.state == "records"
+        self._threadpool = threadpool
+        self._seal_pipeline = OrderedPipeline(reactor, threadpool, window,
+                                              self._write_encrypted,
+                                              self._crypto_failed,
+                                              self._seal_pipeline_changed)
+        self._open_pipeline = OrderedPipeline(reactor, threadpool, window,
+                                              lambda r: self.recordReceived(r),
+                                              self._crypto_failed,
+                                              self._open_pipeline_changed)
+
+    def _seal_pipeline_changed(self):
+        if self._throttle:
+            self._throttle.pipelineChanged()
+
+    def _open_pipeline_changed(self):
+        if self.state != "records":
             return
-        self._inbound_records.append(record)
-        self._deliverRecords()
-
-    def receive_record(self):
-        d = defer.Deferred()
-        self._waiting_reads.append(d)
-        self._deliverRecords()
-        return d
-
-    def _deliverRecords(self):
-        while self._inbound_records and self._waiting_reads:
-            r = self._inbound_records.popleft()
-            d = self._waiting_reads.popleft()
-            d.callback(r)
+        try:
+            self.dataReceivedRECORDS() # work on anything left in the decoder
+        except Exception as e:
+            self._crypto_failed(failure.Failure(e))
+        self._update_open_paused()
+
+    def _update_open_paused(self):
+        # stop reading from the transport while the decrypt pipeline is full
+        full = self._open_pipeline.is_full()
+        if full and not self._open_paused:
+            self._open_paused = True
+            if not self._consumer_paused:
+                self.transport.pauseProducing()
+        elif not full and self._open_paused:
+            self._open_paused = False
+            if not self._consumer_paused:
+                self.transport.resumeProducing()
+
+    def _crypto_failed(self, f):
+        # treat this like an exception in dataReceived: drop the connection
+        log.err(f, "transit record crypto failed")
+        self._error = f.value
+        self.state = "hung up"
+        self.transport.loseConnection()
 
     def close(self):
-        self.transport.loseConnection()
+        if self._seal_pipeline and not self._seal_pipeline.is_empty():
+            # let the records we've already accepted reach the wire first
+            d = self._seal_pipeline.when_drained()
+            d.addCallback(lambda _: self.transport.loseConnection())
+        else:
+            self.transport.loseConnection()
         while self._waiting_reads:
             d = self._waiting_reads.popleft()
             d.errback(error.ConnectionClosed())
@@ -329,6 +606,21 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
 
     def connectionLost(self, reason=None):
         self.setTimeout(None)
+        self._lost_reason = reason
+        if self._open_pipeline and not self._open_pipeline.is_empty():
+            # records that arrived before the connection was lost are still
+            # being decrypted: deliver them before reporting the loss
+            d = self._open_pipeline.when_drained()
+            d.addCallback(lambda _: self._connectionLost())
+            return
+        self._connectionLost()
+
+    def _connectionLost(self):
+        pool, self._threadpool = self._threadpool, None
+        if isinstance(pool, TransferThreadPool):
+            pool.stopSoon() # without blocking the reactor
+        elif pool and pool.started:
+            pool.stop()
         d, self._negotiation_d = self._negotiation_d, None
         # the Deferred is only relevant until negotiation finishes, so skip
         # this if it's alredy been fired
@@ -347,98 +639,286 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             d.errback(self._error or BadHandshake("connection lost"))
         if self._consumer_deferred:
             self._consumer_deferred.errback(error.ConnectionClosed())
+        self._lost = True
+        waiters, self._lost_waiters = self._lost_waiters, []
+        for d in waiters:
+            d.callback(self)
+
+    def whenLost(self):
+        """Return a Deferred that fires (with this Connection) once the
+        connection has been lost."""
+        if self._lost:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self._lost_waiters.append(d)
+        return d
+
+    def lostCleanly(self):
+        """Return True if the connection was closed on purpose (by either
+        side), rather than torn down by an error."""
+        return bool(self._lost_reason and
+                    self._lost_reason.check(error.ConnectionDone))
 
     # IConsumer methods, for outbound flow-control. We pass these through to
     # the transport. The 'producer' is something like a t.p.basic.FileSender
     def registerProducer(self, producer, streaming):
         assert interfaces.IConsumer.providedBy(self.transport)
+        if self._seal_pipeline:
+            # the transport talks to the throttle, which also holds the
+            # producer back while the encryption pipeline is full
+            self._throttle = ProducerThrottle(producer, streaming,
+                                              self._seal_pipeline)
+            producer = self._throttle
         self.transport.registerProducer(producer, streaming)
     def unregisterProducer(self):
+        if self._throttle:
+            self._throttle.detach()
+            self._throttle = None
         self.transport.unregisterProducer()
     def write(self, data):
-        self.send_record(data)
+        d = self.send_record(data)
+        if d is not None:
+            # failures are already reported by _crypto_failed()
+            d.addErrback(lambda f: None)
 
     # IProducer methods, for inbound flow-control. We pass these through to
     # the transport.
     def stopProducing(self):
         self.transport.stopProducing()
     def pauseProducing(self):
-        self.transport.pauseProducing()
+        self._consumer_paused = True
+        if not self._open_paused:
+            self.transport.pauseProducing()
     def resumeProducing(self):
-        self.transport.resumeProducing()
+        self._consumer_paused = False
+        if not self._open_paused:
+            self.transport.resumeProducing()
+
+_SEQUENCE = struct.Struct(">Q")
+
+class _Stripe(object):
+    """I connect one member Connection to its StripedConnection. I am the
+    consumer of the member's inbound records, and the (push) producer that
+    its transport pauses and resumes for outbound flow control."""
+    def __init__(self, group, connection):
+        self.group = group
+        self.connection = connection
+        self.writable = True # the transport buffer has room
+        self.paused = False # we've paused its inbound records
+        self.last_seq = -1 # newest sequence number received on it
+        self.lost = False
+
+    # IConsumer, for the member's inbound records
+    def registerProducer(self, producer, streaming):
+        pass
+    def unregisterProducer(self):
+        pass
+    def write(self, record):
+        self.group._stripeRecordReceived(self, record)
 
-    # Helper methods
+    # IPushProducer, for the member's transport
+    def pauseProducing(self):
+        self.writable = False
+        self.group._writableChanged()
+    def resumeProducing(self):
+        self.writable = True
+        self.group._writableChanged()
+    def stopProducing(self):
+        self.group._stopOutbound()
 
-    def connectConsumer(self, consumer, expected=None):
-        """Helper method to glue an instance of e.g. t.p.ftp.FileConsumer to
-        us. Inbound records will be written as bytes to the consumer.
+@implementer(interfaces.IProducer, interfaces.IConsumer)
+class StripedConnection(_RecordPipe):
+    """I spread one record pipe across several negotiated Connections.
+
+    Each outbound record is prefixed with an 8-byte big-endian sequence
+    number and sent on whichever member has room in its transport buffer
+    (taking turns when they all do). Inbound records are put back into
+    sequence order before delivery. Each member encrypts with its own keys
+    and nonces, so this layer needs no crypto of its own.
+
+    I offer the same methods as Connection (send_record, receive_record,
+    connectConsumer, writeToFile, close, and the IConsumer/IProducer
+    methods), so the file-transfer code can use either.
+    """
+    # If this many records are waiting for an earlier one, pause the members
+    # that are ahead, so a slow stream can't make us buffer without limit.
+    MAX_REORDER = 64
+
+    def __init__(self, first, closed=None):
+        self._init_record_pipe()
+        self._closed = closed # called by close()
+        self._streams = []
+        self._next_send_seq = 0
+        self._next_receive_seq = 0
+        self._reorder = {} # seq -> record
+        self._send_cursor = 0
+        self._producer = None
+        self._streaming = False
+        self._producer_paused = False
+        self._pumping = False
+        self._paused = False # by our consumer
+        self._closing = False
+        self.add_stream(first)
+
+    def add_stream(self, c):
+        stream = _Stripe(self, c)
+        self._streams.append(stream)
+        c.whenLost().addCallback(lambda _: self._streamLost(stream))
+        if self._producer:
+            c.registerProducer(stream, True)
+            self._writableChanged()
+        # this delivers anything the member has already received
+        c.connectConsumer(stream)
+        self._updateInboundFlow()
+
+    def streams(self):
+        return [s.connection for s in self._streams]
 
-        Set 'expected' to an integer to automatically disconnect when at
-        least that number of bytes have been written. This function will then
-        return a Deferred (that fires with the number of bytes actually
-        received). If the connection is lost while this Deferred is
-        outstanding, it will errback. If 'expected' is 0, the Deferred will
-        fire right away.
+    def describe(self):
+        return " + ".join(s.connection.describe() for s in self._streams)
 
-        If 'expected' is None, then this function returns None instead of a
-        Deferred, and you must call disconnectConsumer() when you are done."""
+    def useThreadedCrypto(self, *args, **kwargs):
+        for s in self._streams:
+            s.connection.useThreadedCrypto(*args, **kwargs)
 
-        if self._consumer:
-            raise RuntimeError("A consumer is already attached: %r" %
-                               self._consumer)
+    def send_record(self, record):
+        if not isinstance(record, (type(b""), memoryview)):
+            raise InternalError
+        seq = self._next_send_seq
+        self._next_send_seq += 1
+        stream = self._pickStream()
+        return stream.connection.send_record(_SEQUENCE.pack(seq) + record)
+
+    def _pickStream(self):
+        live = [s for s in self._streams if not s.lost] or self._streams
+        count = len(live)
+        for i in range(count):
+            s = live[(self._send_cursor + i) % count]
+            if s.writable:
+                self._send_cursor = (self._send_cursor + i + 1) % count
+                return s
+        s = live[self._send_cursor % count] # everybody is full
+        self._send_cursor = (self._send_cursor + 1) % count
+        return s
+
+    def _stripeRecordReceived(self, stream, record):
+        if len(record) < _SEQUENCE.size:
+            raise BadNonce("striped record is too short")
+        (seq,) = _SEQUENCE.unpack_from(record)
+        stream.last_seq = seq
+        if seq < self._next_receive_seq or seq in self._reorder:
+            raise BadNonce("received duplicate striped record %d" % seq)
+        self._reorder[seq] = record[_SEQUENCE.size:]
+        while self._next_receive_seq in self._reorder:
+            r = self._reorder.pop(self._next_receive_seq)
+            self._next_receive_seq += 1
+            self.recordReceived(r)
+        self._updateInboundFlow()
+
+    def _updateInboundFlow(self):
+        crowded = len(self._reorder) > self.MAX_REORDER
+        for s in self._streams:
+            # the member carrying the record we're waiting for has not yet
+            # reached _next_receive_seq, and is never held back for crowding
+            ahead = s.last_seq >= self._next_receive_seq
+            pause = self._paused or (crowded and ahead)
+            if pause and not s.paused:
+                s.paused = True
+                s.connection.pauseProducing()
+            elif not pause and s.paused:
+                s.paused = False
+                s.connection.resumeProducing()
+
+    def _streamLost(self, stream):
+        stream.lost = True
+        if self._closing:
+            return
+        if (stream.connection.lostCleanly()
+            and not all(s.lost for s in self._streams)):
+            # the other side closed it, which it only does once it's done
+            # with the whole pipe, so everything it sent on that member has
+            # arrived. The others may still have records in flight.
+            return
+        # records on that member are gone, so the transfer can't finish
+        d, self._consumer_deferred = self._consumer_deferred, None
+        if d:
+            d.errback(error.ConnectionClosed())
+        while self._waiting_reads:
+            self._waiting_reads.popleft().errback(error.ConnectionClosed())
 
-        # be aware of an ordering hazard: when we call the consumer's
-        # .registerProducer method, they are likely to immediately call
-        # self.resumeProducing, which we'll deliver to self.transport, which
-        # might call our .dataReceived, which may cause more records to be
-        # available. By waiting to set self._consumer until *after* we drain
-        # any pending records, we avoid delivering records out of order,
-        # which would be bad.
-        consumer.registerProducer(self, True)
-        # There might be enough data queued to exceed 'expected' before we
-        # leave this function. We must be sure to register the producer
-        # before it gets unregistered.
+    def close(self):
+        self._closing = True
+        if self._closed:
+            self._closed()
+        for s in self._streams:
+            s.connection.close()
+        while self._waiting_reads:
+            d = self._waiting_reads.popleft()
+            d.errback(error.ConnectionClosed())
 
-        self._consumer = consumer
-        self._consumer_bytes_written = 0
-        self._consumer_bytes_expected = expected
-        d = None
-        if expected is not None:
-            d = defer.Deferred()
-        self._consumer_deferred = d
-        if expected == 0:
-            # write empty record to kick consumer into shutdown
-            self._writeToConsumer(b"")
-        # drain any pending records
-        while self._consumer and self._inbound_records:
-            r = self._inbound_records.popleft()
-            self._writeToConsumer(r)
-        return d
+    # IConsumer methods, for outbound flow-control. Each member's transport
+    # pauses and resumes its own _Stripe, and the producer is held back only
+    # when none of them have room.
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+        self._streaming = streaming
+        self._producer_paused = False
+        for s in self._streams:
+            s.connection.registerProducer(s, True)
+        if not streaming:
+            self._pump()
+    def unregisterProducer(self):
+        self._producer = None
+        for s in self._streams:
+            s.connection.unregisterProducer()
+    def write(self, data):
+        d = self.send_record(data)
+        if d is not None:
+            # failures are already reported by the member
+            d.addErrback(lambda f: None)
 
-    def _writeToConsumer(self, record):
-        self._consumer.write(record)
-        self._consumer_bytes_written += len(record)
-        if self._consumer_bytes_expected is not None:
-            if self._consumer_bytes_written >= self._consumer_bytes_expected:
-                d = self._consumer_deferred
-                self.disconnectConsumer()
-                d.callback(self._consumer_bytes_written)
+    def _anyWritable(self):
+        return any(s.writable for s in self._streams if not s.lost)
 
-    def disconnectConsumer(self):
-        self._consumer.unregisterProducer()
-        self._consumer = None
-        self._consumer_bytes_expected = None
-        self._consumer_deferred = None
+    def _writableChanged(self):
+        if self._producer is None:
+            return
+        if not self._streaming:
+            self._pump()
+            return
+        writable = self._anyWritable()
+        if not writable and not self._producer_paused:
+            self._producer_paused = True
+            self._producer.pauseProducing()
+        elif writable and self._producer_paused:
+            self._producer_paused = False
+            self._producer.resumeProducing()
+
+    def _pump(self):
+        # pull from a non-streaming producer while any member has room
+        if self._pumping:
+            return
+        self._pumping = True
+        try:
+            while self._producer is not None and self._anyWritable():
+                self._producer.resumeProducing()
+        finally:
+            self._pumping = False
 
-    # Helper method to write a known number of bytes to a file. This has no
-    # flow control: the filehandle cannot push back. 'progress' is an
-    # optional callable which will be called on each write (with the number
-    # of bytes written). Returns a Deferred that fires (with the number of
-    # bytes written) when the count is reached or the RecordPipe is closed.
+    def _stopOutbound(self):
+        if self._producer:
+            self._producer.stopProducing()
 
-    def writeToFile(self, f, expected, progress=None, hasher=None):
-        fc = FileConsumer(f, progress, hasher)
-        return self.connectConsumer(fc, expected)
+    # IProducer methods, for inbound flow-control
+    def stopProducing(self):
+        for s in self._streams:
+            s.connection.stopProducing()
+    def pauseProducing(self):
+        self._paused = True
+        self._updateInboundFlow()
+    def resumeProducing(self):
+        self._paused = False
+        self._updateInboundFlow()
 
 class OutboundConnectionFactory(protocol.ClientFactory):
     protocol = Connection
@@ -468,6 +948,10 @@ class InboundConnectionFactory(protocol.ClientFactory):
         self.start = time.time()
         self._inbound_d = defer.Deferred(self._cancel)
         self._pending_connections = set()
+        # When striping, Common sets this to a callable that takes the
+        # connections which succeed after the first one. Until the owner
+        # shuts us down, the rest are allowed to keep negotiating.
+        self.extra_connection = None
 
     def whenDone(self):
         return self._inbound_d
@@ -504,7 +988,12 @@ class InboundConnectionFactory(protocol.ClientFactory):
         return res
 
     def _proto_succeeded(self, p):
-        self._shutdown()
+        if self._inbound_d.called:
+            # only possible when striping
+            self.extra_connection(p)
+            return
+        if self.extra_connection is None:
+            self._shutdown()
         self._inbound_d.callback(p)
 
     def _proto_failed(self, f):
@@ -527,6 +1016,43 @@ def allocate_tcp_port():
     s.close()
     return port
 
+class _ListeningPorts(object):
+    def __init__(self, ports, ipv6):
+        self._ports = ports
+        self.ipv6 = ipv6 # False if we could only listen on IPv4
+
+    def stopListening(self):
+        return defer.gatherResults([defer.maybeDeferred(p.stopListening)
+                                    for p in self._ports])
+
+class _DualStackServerEndpoint(object):
+    """I listen on 'portnum' for both IPv4 and IPv6 connections. Where an
+    IPv6 socket also accepts IPv4 (the usual default on Linux and OS-X),
+    binding the IPv4 one fails and we don't need it. Elsewhere (Windows, or
+    where net.ipv6.bindv6only is set), we use two sockets. My listen()
+    yields a _ListeningPorts."""
+    def __init__(self, reactor, portnum):
+        self._reactor = reactor
+        self._portnum = portnum
+
+    @inlineCallbacks
+    def listen(self, factory):
+        ports = []
+        v6 = endpoints.TCP6ServerEndpoint(self._reactor, self._portnum,
+                                          interface="::")
+        try:
+            ports.append((yield v6.listen(factory)))
+        except error.CannotListenError:
+            pass # no IPv6 here, or somebody else has the port
+        ipv6 = bool(ports)
+        v4 = endpoints.TCP4ServerEndpoint(self._reactor, self._portnum)
+        try:
+            ports.append((yield v4.listen(factory)))
+        except error.CannotListenError:
+            if not ports:
+                raise
+        returnValue(_ListeningPorts(ports, ipv6))
+
 class _ThereCanBeOnlyOne:
     """Accept a list of contender Deferreds, and return a summary Deferred.
     When the first contender fires successfully, cancel the rest and fire the
@@ -584,12 +1110,169 @@ class _ThereCanBeOnlyOne:
 def there_can_be_only_one(contenders):
     return _ThereCanBeOnlyOne(contenders).run()
 
+class _ThereCanBeSeveral(_ThereCanBeOnlyOne):
+    """Like _ThereCanBeOnlyOne, but fire the summary Deferred as soon as the
+    first contender succeeds, and pass any others that succeed within
+    'window' seconds after that to 'extra'. The rest are cancelled when the
+    window closes, and then 'done' (if provided) is called.
+
+    This is used for striped transfers, which can use several connections.
+    """
+    def __init__(self, contenders, extra, window, reactor, done=None):
+        _ThereCanBeOnlyOne.__init__(self, contenders)
+        self._extra = extra
+        self._window = window
+        self._reactor = reactor
+        self._done = done
+        self._timer = None
+
+    def _succeeded(self, res):
+        if self._have_winner:
+            self._extra(res)
+            return
+        self._have_winner = True
+        self._first_success = res
+        self._timer = self._reactor.callLater(self._window, self._stop)
+
+    def _stop(self):
+        self._timer = None
+        for d in list(self._remaining):
+            d.cancel()
+        if self._done:
+            self._done()
+
+    def close_window(self):
+        """Stop waiting for extra contenders before the window is up."""
+        if self._timer:
+            self._timer.cancel()
+            self._stop()
+
+    def _maybe_done(self, _):
+        if self._fired:
+            if not self._remaining and self._timer:
+                # everybody finished before the window closed
+                self._timer.cancel()
+                self._stop()
+            return
+        if self._have_winner:
+            self._fired = True
+            self._winner_d.callback(self._first_success)
+            if not self._remaining:
+                self._maybe_done(None)
+            return
+        if self._remaining:
+            return
+        self._fired = True
+        self._winner_d.errback(self._first_failure)
+
+def there_can_be_several(contenders, extra, window, reactor, done=None):
+    return _ThereCanBeSeveral(contenders, extra, window, reactor, done).run()
+
+class _StaggeredAttempts(object):
+    """I start connection attempts one after another, instead of all at
+    once (RFC 8305 "happy eyeballs"). Each attempt is added with a callable
+    that starts it (and returns a Deferred), and how many seconds to wait
+    after starting the previous attempt before starting this one. If all
+    the attempts we've started have failed, the next one starts right away,
+    so an unreachable address (or address family) costs nothing.
+
+    add() returns a Deferred for the attempt, which there_can_be_only_one()
+    can race against the others. Cancelling one that hasn't started yet
+    just takes it out of the line, so the losers are never even started.
+    """
+    def __init__(self, reactor):
+        self._reactor = reactor
+        self._waiting = deque() # (start, delay, Deferred)
+        self._started = {} # our Deferred -> the one start() returned
+        self._timer = None
+
+    def add(self, start, delay):
+        d = defer.Deferred(self._cancel)
+        self._waiting.append((start, delay, d))
+        return d
+
+    def run(self):
+        self._start_next()
+
+    def _cancel(self, d):
+        attempt_d = self._started.get(d)
+        if attempt_d:
+            attempt_d.cancel() # which fires 'd' through _finished
+            return
+        for i, waiting in enumerate(self._waiting):
+            if waiting[2] is d:
+                del self._waiting[i]
+                break
+        if not self._waiting and self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _start_next(self):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        while self._waiting:
+            start, _, d = self._waiting.popleft()
+            attempt_d = defer.maybeDeferred(start)
+            self._started[d] = attempt_d
+            attempt_d.addBoth(self._finished, d)
+            # attempts with no delay start along with this one
+            if not self._waiting or self._waiting[0][1] > 0:
+                break
+        if self._waiting and not self._timer:
+            self._timer = self._reactor.callLater(self._waiting[0][1],
+                                                  self._start_next)
+
+    def _finished(self, res, d):
+        del self._started[d]
+        if isinstance(res, failure.Failure):
+            d.errback(res)
+            if not self._started and not res.check(defer.CancelledError):
+                self._start_next()
+        else:
+            d.callback(res)
+
+def interleave_hints(hints):
+    """Order direct hints the way RFC 8305 (section 4) suggests: highest
+    priority first, and within each priority, alternate between IPv6 and
+    IPv4 addresses (IPv6 first), keeping each family in its original
+    order. Hostnames are grouped with the IPv4 addresses, since
+    HostnameEndpoint will race their addresses by itself."""
+    by_priority = {}
+    for h in hints:
+        by_priority.setdefault(h.priority, []).append(h)
+    ordered = []
+    for priority in sorted(by_priority, reverse=True):
+        group = by_priority[priority]
+        v6 = [h for h in group if _is_ipv6(h.hostname)]
+        v4 = [h for h in group if not _is_ipv6(h.hostname)]
+        while v6 or v4:
+            if v6:
+                ordered.append(v6.pop(0))
+            if v4:
+                ordered.append(v4.pop(0))
+    return ordered
+
 class Common:
     RELAY_DELAY = 2.0
+    ATTEMPT_DELAY = 0.25 # RFC 8305's "Connection Attempt Delay"
     TRANSIT_KEY_LENGTH = SecretBox.KEY_SIZE
+    # Records are 16KiB (the twisted FileSender chunk size) unless both sides
+    # advertise "large-records-v1", in which case we use the smaller of the
+    # two advertised sizes. Each record costs 44 bytes of framing and a
+    # couple of Python calls on each end, so on fast links bigger is better.
+    DEFAULT_RECORD_SIZE = 16*1024
+    MAX_RECORD_SIZE = 256*1024
+    # If both sides advertise "striped-v1", a transfer can be spread across
+    # up to the smaller of the two "max-streams" connections. The sender
+    # accepts extra streams for STRIPE_WINDOW seconds after the first one
+    # wins. The receiver waits twice as long, so a "go-stripe" that is still
+    # in flight when the sender's window closes will find it listening.
+    MAX_STREAMS = 4
+    STRIPE_WINDOW = 5.0
 
     def __init__(self, transit_relay, no_listen=False, tor=None,
-                 reactor=reactor, timing=None):
+                 reactor=reactor, timing=None, crypto_threads=0):
         self._side = bytes_to_hexstr(os.urandom(8)) # unicode
         if transit_relay:
             if not isinstance(transit_relay, type(u"")):
@@ -601,6 +1284,10 @@ class Common:
         else:
             self._transit_relays = []
         self._their_direct_hints = [] # hintobjs
+        self._their_max_record_size = None
+        self._their_max_streams = None
+        self._accepted_stripes = set()
+        self._their_compression_methods = []
         self._our_relay_hints = set(self._transit_relays)
         self._tor = tor
         self._transit_key = None
@@ -611,27 +1298,108 @@ class Common:
         self._reactor = reactor
         self._timing = timing or DebugTiming()
         self._timing.add("transit")
+        self._crypto_threads = crypto_threads
+        self._listener_f = None
+        self._stripes_assigned = 0 # sender only
+        self._stripe_group = None
+        self._stripe_racer = None
+        self._early_stripes = []
 
     def _build_listener(self):
         if self._no_listen or self._tor:
             return ([], None)
         portnum = allocate_tcp_port()
         addresses = ipaddrs.find_addresses()
-        non_loopback_addresses = [a for a in addresses if a != "127.0.0.1"]
+        non_loopback_addresses = [a for a in addresses
+                                  if a not in ("127.0.0.1", "::1")]
         if non_loopback_addresses:
             # some test hosts, including the appveyor VMs, *only* have
             # 127.0.0.1, and the tests will hang badly if we remove it.
             addresses = non_loopback_addresses
         direct_hints = [DirectTCPV1Hint(six.u(addr), portnum, 0.0)
                         for addr in addresses]
-        ep = endpoints.serverFromString(reactor, "tcp:%d" % portnum)
+        if any(_is_ipv6(h.hostname) for h in direct_hints):
+            ep = _DualStackServerEndpoint(reactor, portnum)
+        else:
+            ep = endpoints.serverFromString(reactor, "tcp:%d" % portnum)
         return direct_hints, ep
 
     def get_connection_abilities(self):
         return [{u"type": u"direct-tcp-v1"},
                 {u"type": u"relay-v1"},
+                {u"type": u"large-records-v1",
+                 u"max-record-size": self.MAX_RECORD_SIZE},
+                {u"type": u"striped-v1",
+                 u"max-streams": self.MAX_STREAMS},
+                {u"type": u"compression-v1",
+                 u"methods": _compression.available_methods()},
                 ]
 
+    def add_connection_abilities(self, abilities):
+        for a in abilities: # ability structs
+            if a.get(u"type", u"") == u"large-records-v1":
+                size = a.get(u"max-record-size")
+                if (not isinstance(size, six.integer_types)
+                    or isinstance(size, bool) or size <= 0):
+                    log.msg("invalid max-record-size in ability: %r" % (a,))
+                    continue
+                self._their_max_record_size = size
+            if a.get(u"type", u"") == u"striped-v1":
+                streams = a.get(u"max-streams")
+                if (not isinstance(streams, six.integer_types)
+                    or isinstance(streams, bool) or streams <= 0):
+                    log.msg("invalid max-streams in ability: %r" % (a,))
+                    continue
+                self._their_max_streams = streams
+            if a.get(u"type", u"") == u"compression-v1":
+                methods = a.get(u"methods")
+                if not isinstance(methods, list):
+                    log.msg("invalid methods in ability: %r" % (a,))
+                    continue
+                self._their_compression_methods = methods
+        self._update_listener_striping()
+
+    def get_record_size(self):
+        """Return the size of the records that a sender should emit, based
+        upon the abilities our peer gave to add_connection_abilities()."""
+        if self._their_max_record_size is None:
+            return self.DEFAULT_RECORD_SIZE
+        return min(self.MAX_RECORD_SIZE, self._their_max_record_size)
+
+    def get_stream_count(self):
+        """Return the number of connections a transfer may be striped
+        across, based upon the abilities our peer gave to
+        add_connection_abilities(). 1 means no striping."""
+        if self._their_max_streams is None:
+            return 1
+        return max(1, min(self.MAX_STREAMS, self._their_max_streams))
+
+    def get_compression(self):
+        """Return the name of the compression method that file records
+        should use (see _compression), or None if our peer didn't offer one
+        that we have. Both sides make the same choice."""
+        return _compression.choose_method(_compression.available_methods(),
+                                          self._their_compression_methods)
+
+    def get_compressor(self):
+        method = self.get_compression()
+        if method is None:
+            return None
+        return _compression.Compressor(method)
+
+    def get_decompressor(self):
+        method = self.get_compression()
+        if method is None:
+            return None
+        # records never hold more than MAX_RECORD_SIZE of file data
+        return _compression.Decompressor(method, self.MAX_RECORD_SIZE)
+
+    def _update_listener_striping(self):
+        # let inbound connections keep negotiating after the first one
+        # succeeds, so they can join the transfer
+        if self._listener_f and self.get_stream_count() > 1:
+            self._listener_f.extra_connection = self._add_stripe
+
     @inlineCallbacks
     def get_connection_hints(self):
         hints = []
@@ -674,10 +1442,14 @@ class Common:
         f = InboundConnectionFactory(self)
         self._listener_f = f # for tests # XX move to __init__ ?
         self._listener_d = f.whenDone()
+        self._update_listener_striping()
         d = self._listener.listen(f)
         def _listening(lp):
             # lp is an IListeningPort
             #self._listener_port = lp # for tests
+            if isinstance(lp, _ListeningPorts) and not lp.ipv6:
+                self._my_direct_hints = [h for h in self._my_direct_hints
+                                         if not _is_ipv6(h.hostname)]
             def _stop_listening(res):
                 lp.stopListening()
                 return res
@@ -750,23 +1522,27 @@ class Common:
         else:
             return build_sender_handshake(self._transit_key)# + b"go\n"
 
-    def _sender_record_key(self):
+    def _record_key(self, ctxinfo, stripe):
+        # every stripe starts its nonces at zero, so each one needs its own
+        # keys. Stripe 0 (the only one, without striping) uses the original
+        # CTXinfo.
+        if stripe:
+            ctxinfo += ("_stripe_%d" % stripe).encode("ascii")
+        return HKDF(self._transit_key, SecretBox.KEY_SIZE, CTXinfo=ctxinfo)
+
+    def _sender_record_key(self, stripe=0):
         assert self._transit_key
         if self.is_sender:
-            return HKDF(self._transit_key, SecretBox.KEY_SIZE,
-                        CTXinfo=b"transit_record_sender_key")
+            return self._record_key(b"transit_record_sender_key", stripe)
         else:
-            return HKDF(self._transit_key, SecretBox.KEY_SIZE,
-                        CTXinfo=b"transit_record_receiver_key")
+            return self._record_key(b"transit_record_receiver_key", stripe)
 
-    def _receiver_record_key(self):
+    def _receiver_record_key(self, stripe=0):
         assert self._transit_key
         if self.is_sender:
-            return HKDF(self._transit_key, SecretBox.KEY_SIZE,
-                        CTXinfo=b"transit_record_receiver_key")
+            return self._record_key(b"transit_record_receiver_key", stripe)
         else:
-            return HKDF(self._transit_key, SecretBox.KEY_SIZE,
-                        CTXinfo=b"transit_record_sender_key")
+            return self._record_key(b"transit_record_sender_key", stripe)
 
     def set_transit_key(self, key):
         assert isinstance(key, type(b"")), type(key)
@@ -798,20 +1574,75 @@ class Common:
             # connections, so those connections will know what to say when
             # they connect
             winner = yield self._connect()
+        self._prepare_stream(winner)
+        if self.get_stream_count() > 1:
+            group = StripedConnection(winner, closed=self._close_stripe_window)
+            self._stripe_group = group
+            early, self._early_stripes = self._early_stripes, []
+            for p in early:
+                group.add_stream(p)
+            winner = group
         returnValue(winner)
 
+    def _prepare_stream(self, p):
+        if self._crypto_threads:
+            p.useThreadedCrypto(self._start_crypto_threadpool(),
+                                reactor=self._reactor)
+
+    def _add_stripe(self, p):
+        # an extra connection for a striped transfer
+        self._prepare_stream(p)
+        if self._stripe_group:
+            self._stripe_group.add_stream(p)
+        else:
+            # connect() hasn't seen the winner yet
+            self._early_stripes.append(p)
+
+    def _close_stripe_window(self):
+        # the transfer is over before the window closed: the stragglers
+        # won't be needed
+        if self._stripe_racer:
+            self._stripe_racer.close_window()
+
+    def _stop_striping(self):
+        # the window has closed: stop accepting inbound connections
+        if self._listener_f:
+            self._listener_f.extra_connection = None
+            self._listener_f._shutdown()
+
+    def _accept_stripe(self, index):
+        # the receiver checks the N of "go-stripe N". Each index may only be
+        # accepted once: two streams with the same index would share a
+        # record key, and so reuse nonces.
+        if not 0 < index < self.get_stream_count():
+            return False
+        if index in self._accepted_stripes:
+            return False
+        self._accepted_stripes.add(index)
+        return True
+
+    def _start_crypto_threadpool(self):
+        return TransferThreadPool(self._reactor, self._crypto_threads,
+                                  "wormhole-transit-crypto")
+
     def _connect(self):
-        # It might be nice to wire this so that a failure in the direct hints
-        # causes the relay hints to be used right away (fast failover). But
-        # none of our current use cases would take advantage of that: if we
-        # have any viable direct hints, then they're either going to succeed
-        # quickly or hang for a long time.
+        # The outbound attempts are started one at a time (see
+        # _StaggeredAttempts): the direct hints ATTEMPT_DELAY apart, and
+        # alternating between IPv6 and IPv4, then the relays. As soon as
+        # everything we've started has failed, the next one starts, so when
+        # none of the direct hints are reachable, we fail over to the relays
+        # right away.
         contenders = []
         if self._listener_d:
             contenders.append(self._listener_d)
+        attempts = _StaggeredAttempts(self._reactor)
         relay_delay = 0
+        # but a striped transfer wants as many connections as it can get
+        attempt_delay = self.ATTEMPT_DELAY
+        if self.get_stream_count() > 1:
+            attempt_delay = 0
 
-        for hint_obj in self._their_direct_hints:
+        for hint_obj in interleave_hints(self._their_direct_hints):
             # Check the hint type to see if we can support it (e.g. skip
             # onion hints on a non-Tor client). Do not increase relay_delay
             # unless we have at least one viable hint.
@@ -821,16 +1652,18 @@ class Common:
             description = "->%s" % describe_hint_obj(hint_obj)
             if self._tor:
                 description = "tor" + description
-            d = self._start_connector(ep, description)
+            d = attempts.add(lambda ep=ep, description=description:
+                             self._start_connector(ep, description),
+                             attempt_delay)
             contenders.append(d)
             relay_delay = self.RELAY_DELAY
 
         # Start trying the relays a few seconds after we start to try the
-        # direct hints. The idea is to prefer direct connections, but not be
-        # afraid of using a relay when we have direct hints that don't
-        # resolve quickly. Many direct hints will be to unused local-network
-        # IP addresses, which won't answer, and would take the full TCP
-        # timeout (30s or more) to fail.
+        # direct hints (unless they've all failed by then). The idea is to
+        # prefer direct connections, but not be afraid of using a relay when
+        # we have direct hints that don't resolve quickly. Many direct hints
+        # will be to unused local-network IP addresses, which won't answer,
+        # and would take the full TCP timeout (30s or more) to fail.
 
         prioritized_relays = {}
         for rh in self._our_relay_hints:
@@ -848,16 +1681,31 @@ class Common:
                 description = "->relay:%s" % describe_hint_obj(hint_obj)
                 if self._tor:
                     description = "tor" + description
-                d = task.deferLater(self._reactor, relay_delay,
-                                    self._start_connector, ep, description,
-                                    is_relay=True)
+                # relays with the same priority all start together, and
+                # each lower priority waits another RELAY_DELAY
+                d = attempts.add(lambda ep=ep, description=description:
+                                 self._start_connector(ep, description,
+                                                       is_relay=True),
+                                 relay_delay)
                 contenders.append(d)
-            relay_delay += self.RELAY_DELAY
+                relay_delay = 0
+            relay_delay = self.RELAY_DELAY
 
         if not contenders:
             raise TransitError("No contenders for connection")
-
-        winner = there_can_be_only_one(contenders)
+        attempts.run()
+
+        if self.get_stream_count() > 1:
+            window = self.STRIPE_WINDOW
+            if not self.is_sender:
+                window *= 2
+            self._stripe_racer = _ThereCanBeSeveral(contenders,
+                                                    self._add_stripe,
+                                                    window, self._reactor,
+                                                    self._stop_striping)
+            winner = self._stripe_racer.run()
+        else:
+            winner = there_can_be_only_one(contenders)
         return self._not_forever(2*TIMEOUT, winner)
 
     def _not_forever(self, timeout, d):
@@ -909,6 +1757,11 @@ class Common:
             return "wait-for-decision"
 
         if self._winner:
+            if self._stripes_assigned < self.get_stream_count() - 1:
+                # striping: this one joins the transfer
+                self._stripes_assigned += 1
+                p._stripe_index = self._stripes_assigned
+                return "go-stripe"
             # we already have a winner, so this one loses
             return "nevermind"
         # this one wins!
@@ -924,15 +1777,19 @@ class TransitReceiver(Common):
 
 # based on twisted.protocols.ftp.FileConsumer, but don't close the filehandle
 # when done, and add a progress function that gets called with the length of
-# each write, and a hasher function that gets called with the data.
+# each write, and a hasher function that gets called with the data. If a
+# decompressor is provided, each record is decompressed before anything else
+# sees it.
 
 @implementer(interfaces.IConsumer)
 class FileConsumer:
-    def __init__(self, f, progress=None, hasher=None):
+    def __init__(self, f, progress=None, hasher=None, decompressor=None):
         self._f = f
         self._progress = progress
         self._hasher = hasher
+        self._decompressor = decompressor
         self._producer = None
+        self.bytes_written = 0
 
     def registerProducer(self, producer, streaming):
         assert not self._producer
@@ -940,15 +1797,322 @@ class FileConsumer:
         assert streaming
 
     def write(self, bytes):
+        if self._decompressor:
+            bytes = self._decompressor.decompress(bytes)
+        self._f.write(bytes)
+        self.bytes_written += len(bytes)
+        if self._progress:
+            self._progress(len(bytes))
+        if self._hasher:
+            self._hasher(bytes)
+
+    def unregisterProducer(self):
+        assert self._producer
+        self._producer = None
+
+# Like FileConsumer, but the writes (and any fsyncs) happen on a background
+# thread, so a slow disk doesn't stall the reactor. Once more than
+# 'max_queued' bytes are waiting to be written, the producer (the record
+# pipe) is paused, and it is resumed when the backlog has shrunk to half
+# that. 'progress' and 'hasher' are called on the reactor thread, in order,
+# as each write completes, so they only ever see data that is in the file.
+#
+# 'fsync' is None to never fsync, 0 to fsync once at the end, or N to also
+# fsync after every N bytes. Call finish() when the producer is done.
+
+@implementer(interfaces.IConsumer)
+class ThreadedFileConsumer:
+    MAX_QUEUED = 16*1024*1024 # bytes
+
+    def __init__(self, f, progress=None, hasher=None, decompressor=None,
+                 fsync=None, max_queued=MAX_QUEUED, threadpool=None,
+                 reactor=reactor):
+        self._f = f
+        self._progress = progress
+        self._hasher = hasher
+        self._decompressor = decompressor
+        self._fsync = fsync
+        self._max_queued = max_queued
+        self._threadpool = threadpool
+        self._own_threadpool = None
+        self._reactor = reactor
+        self._producer = None
+        self._paused = False
+        self._queued = 0 # bytes handed to the thread but not yet written
+        self._pending = 0 # writes handed to the thread but not yet done
+        self._unsynced = 0 # only touched by the writer thread
+        self._failure = None
+        self._drain_waiters = []
+        self.bytes_written = 0 # accepted by write(), maybe not yet written
+
+    def registerProducer(self, producer, streaming):
+        assert not self._producer
+        self._producer = producer
+        assert streaming
+        if self._threadpool is None:
+            self._threadpool = self._start_threadpool()
+
+    def _start_threadpool(self):
+        pool = TransferThreadPool(self._reactor, 1, "wormhole-transit-writer")
+        self._own_threadpool = pool
+        return pool
+
+    def _stop_threadpool(self):
+        # the writer thread might still be busy (say, with an fsync), so
+        # this waits for it on another thread, not the reactor's
+        pool, self._own_threadpool = self._own_threadpool, None
+        if pool:
+            return pool.stopSoon()
+        return defer.succeed(None)
+
+    def write(self, bytes):
+        if self._decompressor:
+            bytes = self._decompressor.decompress(bytes)
+        self.bytes_written += len(bytes)
+        if not bytes or self._failure:
+            return
+        self._queued += len(bytes)
+        self._pending += 1
+        d = threads.deferToThreadPool(self._reactor, self._threadpool,
+                                      self._write, bytes)
+        d.addCallback(self._written, bytes)
+        d.addErrback(self._writeFailed)
+        d.addBoth(self._completed, len(bytes))
+        if (self._queued > self._max_queued and self._producer
+            and not self._paused):
+            self._paused = True
+            self._producer.pauseProducing()
+
+    # this runs in the writer thread
+    def _write(self, bytes):
+        if self._failure:
+            return # we're giving up: don't bother
         self._f.write(bytes)
+        if self._fsync:
+            self._unsynced += len(bytes)
+            if self._unsynced >= self._fsync:
+                self._sync()
+
+    # and so does this
+    def _sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._unsynced = 0
+
+    def _written(self, _, bytes):
+        if self._failure:
+            return
         if self._progress:
             self._progress(len(bytes))
         if self._hasher:
             self._hasher(bytes)
 
+    def _writeFailed(self, f):
+        if self._failure:
+            return
+        self._failure = f
+        # there's no point in receiving any more
+        if self._producer:
+            self._producer.stopProducing()
+
+    def _completed(self, _, size):
+        self._queued -= size
+        self._pending -= 1
+        if (self._paused and self._queued <= self._max_queued // 2
+            and self._producer):
+            self._paused = False
+            self._producer.resumeProducing()
+        if not self._pending:
+            waiters, self._drain_waiters = self._drain_waiters, []
+            for d in waiters:
+                d.callback(None)
+
     def unregisterProducer(self):
         assert self._producer
         self._producer = None
+        self._paused = False
+
+    def _drained(self):
+        if not self._pending:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._drain_waiters.append(d)
+        return d
+
+    def finish(self, result=None):
+        """Return a Deferred that fires (with 'result', which may be a
+        Failure) once everything has been written and, if asked, fsynced.
+        If any write failed, it errbacks with that failure instead."""
+        d = self._drained()
+        if self._fsync is not None:
+            def _sync_at_end(_):
+                if not self._failure:
+                    return threads.deferToThreadPool(
+                        self._reactor, self._threadpool, self._sync)
+            d.addCallback(_sync_at_end)
+        def _done(res):
+            if isinstance(res, failure.Failure) and not self._failure:
+                self._failure = res # the final fsync failed
+            d2 = self._stop_threadpool()
+            d2.addCallback(lambda _: self._failure or result)
+            return d2
+        d.addBoth(_done)
+        return d
+
+# the sending half: this sits between a producer (like a FileSender) and a
+# record pipe, and turns each chunk into one compressed (or flagged-raw)
+# record
+
+@implementer(interfaces.IConsumer)
+class CompressingConsumer:
+    def __init__(self, consumer, compressor):
+        self._consumer = consumer
+        self._compressor = compressor
+
+    def registerProducer(self, producer, streaming):
+        self._consumer.registerProducer(producer, streaming)
+
+    def write(self, bytes):
+        self._consumer.write(self._compressor.compress(bytes))
+
+    def unregisterProducer(self):
+        self._consumer.unregisterProducer()
+
+# A faster FileSender for regular files. FileSender reads each chunk into a
+# new string, which the transform and the record pipe then copy again. I map
+# the file instead, and hand out memoryview slices of the mapping, so hashing
+# and compression read the page cache directly, and the only copy happens
+# when the record is sealed. Files that can't be mapped (like a BytesIO) are
+# read in chunks instead, and so is any file opened with mappable=False: the
+# caller passes that for a SpooledTemporaryFile that's still in memory, since
+# asking for its fileno() would copy all of it to disk first.
+#
+# If a mapped file is truncated while we're sending it, touching the pages
+# that went away kills the process with SIGBUS. We check the file's size
+# before handing out each slice, and the hasher and compressor use it right
+# away, so only a truncation in between those can still do that. Anything
+# that keeps a slice for later (like the sealing threads) must copy it first.
+
+@implementer(interfaces.IPushProducer)
+class FileProducer:
+    CHUNKS_PER_TURN = 16 # then let the reactor run before writing more
+
+    def __init__(self, f, chunk_size, offset=0, mappable=True,
+                 reactor=reactor):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._offset = offset
+        self._mappable = mappable
+        self._reactor = reactor
+        self._fd = None
+        self._size = None
+        self._view = None
+        self._consumer = None
+        self._transform = None
+        self._deferred = None
+        self._paused = False
+        self._call = None
+
+    def beginFileTransfer(self, consumer, transform=None):
+        """Write the file (starting at 'offset') to 'consumer', passing each
+        chunk through 'transform' first. The chunks are memoryviews when the
+        file could be mapped, and strings otherwise. Returns a Deferred that
+        fires when the last chunk has been written."""
+        self._consumer = consumer
+        self._transform = transform
+        self._deferred = d = defer.Deferred()
+        self._open()
+        consumer.registerProducer(self, True)
+        self._schedule()
+        return d
+
+    def _open(self):
+        if not self._mappable:
+            self._f.seek(self._offset, 0)
+            return
+        try:
+            self._fd = self._f.fileno()
+            self._size = os.fstat(self._fd).st_size
+        except (AttributeError, IOError, OSError, ValueError):
+            self._fd = None
+        if self._fd is not None and hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(self._fd, self._offset, 0,
+                             os.POSIX_FADV_SEQUENTIAL)
+        # py2's mmap doesn't support memoryview, so slicing it would copy
+        if six.PY3 and self._fd is not None and self._size > self._offset:
+            try:
+                m = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError) as e:
+                log.msg("unable to mmap file, reading it instead: %s" % (e,))
+            else:
+                self._view = memoryview(m)
+                return
+        self._f.seek(self._offset, 0)
+
+    def _next_chunk(self):
+        if self._view is None:
+            return self._f.read(self._chunk_size)
+        start = self._offset
+        end = min(start + self._chunk_size, self._size)
+        # touching a page past the end of a truncated file kills us with
+        # SIGBUS, so check that it's still there first
+        if end > start and os.fstat(self._fd).st_size < end:
+            raise IOError("file shrank while it was being sent")
+        self._offset = end
+        return self._view[start:end]
+
+    def _schedule(self):
+        if self._consumer and not self._paused and not self._call:
+            self._call = self._reactor.callLater(0, self._produce)
+
+    def _produce(self):
+        self._call = None
+        try:
+            for i in range(self.CHUNKS_PER_TURN):
+                if self._paused or not self._consumer:
+                    return
+                chunk = self._next_chunk()
+                if not chunk:
+                    self._finish(None)
+                    return
+                if self._transform:
+                    chunk = self._transform(chunk)
+                self._consumer.write(chunk)
+        except Exception:
+            self._finish(failure.Failure())
+            return
+        self._schedule()
+
+    def _finish(self, result, unregister=True):
+        if self._call:
+            self._call.cancel()
+            self._call = None
+        consumer, self._consumer = self._consumer, None
+        # the mapping goes away once the consumer lets go of the last slice
+        self._view = None
+        d, self._deferred = self._deferred, None
+        if consumer and unregister:
+            consumer.unregisterProducer()
+        if d:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def pauseProducing(self):
+        self._paused = True
+        if self._call:
+            self._call.cancel()
+            self._call = None
+
+    def resumeProducing(self):
+        self._paused = False
+        self._schedule()
+
+    def stopProducing(self):
+        self._finish(failure.Failure(
+            Exception("Consumer asked us to stop producing")),
+                     unregister=False)
 
 # the TransitSender/Receiver.connect() yields a Connection, on which you can
 # do send_record(), but what should the receive API be? set a callback for
@@ -1,5 +1,5 @@
 # No unicode_literals
-import os, json, unicodedata
+import os, json, struct, unicodedata
 from binascii import hexlify, unhexlify
 
 def to_bytes(u):
@@ -14,17 +14,114 @@ def hexstr_to_bytes(hexstr):
     b = unhexlify(hexstr.encode("ascii"))
     assert isinstance(b, type(b""))
     return b
+
+# Every protocol message (and file-transfer control message) goes through
+# dict_to_bytes() and bytes_to_dict(), so they use the fastest JSON codec
+# that is installed: orjson, then ujson, then the stdlib. The fast ones write
+# compact UTF-8 instead of the stdlib's spaced, ASCII-escaped form, but every
+# decoder reads the same dict back, and the stdlib's output is unchanged.
+# Anything a fast codec rejects (like orjson with an integer that doesn't fit
+# in 64 bits, or a non-string key) is handed to the stdlib instead, so the
+# same inputs are accepted (or rejected, with a ValueError) whichever codec is
+# in use. orjson writes NaN and infinities as null without complaint, so a
+# message that has one of those is written by the stdlib instead. The one
+# difference left is that orjson reads integers that don't fit in 64 bits as
+# floats: no wormhole message carries one (sizes and offsets are far
+# smaller), so we don't pay to look for them.
+
+def _stdlib_dumps(d):
+    return json.dumps(d).encode("utf-8")
+def _stdlib_loads(b):
+    return json.loads(b.decode("utf-8"))
+
+def _with_fallback(dumps, loads):
+    def _dumps(d):
+        try:
+            return dumps(d)
+        except (TypeError, ValueError, OverflowError):
+            return _stdlib_dumps(d) # which raises the usual errors, if any
+    def _loads(b):
+        try:
+            return loads(b)
+        except ValueError:
+            return _stdlib_loads(b)
+    return _dumps, _loads
+
+JSON_CODECS = {"json": (_stdlib_dumps, _stdlib_loads)}
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    JSON_CODECS["ujson"] = _with_fallback(
+        lambda d: ujson.dumps(d, ensure_ascii=False,
+                              escape_forward_slashes=False).encode("utf-8"),
+        ujson.loads)
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    _INF = float("inf")
+    def _nonfinite(o):
+        if isinstance(o, float):
+            return o != o or o in (_INF, -_INF)
+        if isinstance(o, dict):
+            o = o.values()
+        elif not isinstance(o, list):
+            return False
+        for v in o:
+            if _nonfinite(v):
+                return True
+        return False
+    def _orjson_dumps(d):
+        b = orjson.dumps(d)
+        # only a null in the output can be a NaN or infinity: most messages
+        # have none, and the rest are usually just None
+        if b"null" in b and _nonfinite(d):
+            return _stdlib_dumps(d)
+        return b
+    JSON_CODECS["orjson"] = _with_fallback(_orjson_dumps, orjson.loads)
+
+def use_json_codec(name):
+    """Switch dict_to_bytes() and bytes_to_dict() to one of JSON_CODECS."""
+    global json_codec, _dumps, _loads
+    _dumps, _loads = JSON_CODECS[name]
+    json_codec = name
+for _name in ["orjson", "ujson", "json"]:
+    if _name in JSON_CODECS:
+        use_json_codec(_name)
+        break
+
 def dict_to_bytes(d):
     assert isinstance(d, dict)
-    b = json.dumps(d).encode("utf-8")
+    b = _dumps(d)
     assert isinstance(b, type(b""))
     return b
 def bytes_to_dict(b):
     assert isinstance(b, type(b""))
-    d = json.loads(b.decode("utf-8"))
+    d = _loads(b)
     assert isinstance(d, dict)
     return d
 
+# A "binary" WebSocket message carries a dict and a bytestring body without
+# hex-encoding the body: a 2-byte big-endian length, that many bytes of
+# header (the dict, as written by dict_to_bytes), then the body itself.
+
+def dict_and_body_to_bytes(d, body):
+    assert isinstance(body, type(b""))
+    header = dict_to_bytes(d)
+    assert len(header) < 2**16
+    return struct.pack(">H", len(header)) + header + body
+def bytes_to_dict_and_body(b):
+    assert isinstance(b, type(b""))
+    if len(b) < 2:
+        raise ValueError("binary message is too short")
+    (length,) = struct.unpack(">H", b[:2])
+    if len(b) < 2+length:
+        raise ValueError("binary message is shorter than its header")
+    return bytes_to_dict(b[2:2+length]), b[2+length:]
+
 def estimate_free_space(target):
     # f_bfree is the blocks available to a root user. It might be more
     # accurate to use f_bavail (blocks available to non-root user), but we
@@ -36,3 +133,16 @@ def estimate_free_space(target):
         return s.f_frsize * s.f_bfree
     except AttributeError:
         return None
+
+def hash_file_prefix(f, length, hasher, chunk_size=1024*1024):
+    # Feed the next 'length' bytes of 'f' to 'hasher', a chunk at a time, and
+    # return how many bytes it had (fewer than 'length' if it ended first).
+    # This can take a while for a big file, so callers run it in a thread.
+    remaining = length
+    while remaining:
+        data = f.read(min(remaining, chunk_size))
+        if not data:
+            break
+        hasher.update(data)
+        remaining -= len(data)
+    return length - remaining
@@ -281,7 +281,8 @@ def create(appid, relay_url, reactor, # use keyword args for everything else
            versions={},
            delegate=None, journal=None, tor=None,
            timing=None,
-           stderr=sys.stderr):
+           stderr=sys.stderr,
+           websocket_deflate=None):
     timing = timing or DebugTiming()
     side = bytes_to_hexstr(os.urandom(5))
     journal = journal or ImmediateJournal()
@@ -292,7 +293,7 @@ def create(appid, relay_url, reactor, # use keyword args for everything else
     wormhole_versions = {} # will be used to indicate Wormhole capabilities
     wormhole_versions["app_versions"] = versions # app-specific capabilities
     b = Boss(w, side, relay_url, appid, wormhole_versions,
-             reactor, journal, tor, timing)
+             reactor, journal, tor, timing, websocket_deflate)
     w._set_boss(b)
     b.start()
     return w